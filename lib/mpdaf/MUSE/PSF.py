@@ -34,10 +34,10 @@ OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 import astropy.units as u
 import numpy as np
 
-from astropy.stats import gaussian_fwhm_to_sigma
 from scipy import special
 
 from .fsf import Moffat2D, FSFModel
+from ..obj import gauss_psf, moffat_psf
 from ..tools import deprecated
 
 
@@ -358,26 +358,15 @@ def create_psf_cube(shape, fwhm, beta=None, wcs=None, unit_fwhm=u.arcsec):
         raise ValueError('fwhm length ({}) and input shape ({}) do not match'
                          .format(len(fwhm), shape[0]))
 
-    nl = shape[0]
-    y0, x0 = (np.array(shape[1:]) - 1) / 2.0
-    yy, xx = np.mgrid[:shape[1], :shape[2]]
-
-    fwhm = np.asarray(fwhm)
+    fwhm = np.asarray(fwhm, dtype=float)
     if unit_fwhm is not None:
         fwhm = fwhm / wcs.get_step(unit=unit_fwhm)[0]
 
-    from astropy.modeling.models import Moffat2D, Gaussian2D
+    # The images are computed for all the wavelengths at once, and cached
+    # for the next sources with the same PSF.
     if beta is None:
         # a Gaussian expected.
-        stddev = fwhm * gaussian_fwhm_to_sigma
-        m = Gaussian2D(amplitude=[1] * nl, theta=[0] * nl,
-                       x_mean=[x0] * nl, y_mean=[y0] * nl,
-                       x_stddev=stddev, y_stddev=stddev, n_models=nl)
+        cube = gauss_psf(shape[1:], fwhm)
     else:
-        alpha = fwhm / (2 * np.sqrt(2 ** (1.0 / beta) - 1.0))
-        m = Moffat2D(amplitude=[1] * nl, x_0=[x0] * nl, y_0=[y0] * nl,
-                     gamma=alpha, alpha=[beta] * nl, n_models=nl)
-
-    cube = m(xx, yy, model_set_axis=False)
-    cube /= cube.sum(axis=(1, 2))[:, None, None]
+        cube = moffat_psf(shape[1:], fwhm, beta)
     return cube
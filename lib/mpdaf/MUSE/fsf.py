@@ -36,11 +36,9 @@ import numpy as np
 import warnings
 from astropy.io import fits
 from astropy.table import Table
-from astropy.modeling.models import Moffat2D as astMoffat2D
-from astropy.stats import sigma_clip
 
-from ..obj import Cube, WCS, Image, iter_ima
-from ..tools import all_subclasses
+from ..obj import Cube, WCS, Image, iter_ima, moffat_psf
+from ..tools import all_subclasses, clipped_stats
 
 __all__ = ['Moffat2D', 'FSFModel', 'OldMoffatModel', 'MoffatModel2', 'combine_fsf']
 
@@ -83,39 +81,18 @@ def Moffat2D(fwhm, beta, shape, center=None, normalize=True):
         MUSE PSF
 
     """
-    # alpha coefficient in pixel
-    alpha = fwhm / (2 * np.sqrt(2**(1 / beta) - 1))
-    amplitude = (beta - 1) * (np.pi * alpha**2)
     if center is None:
-        x0, y0 = np.array(shape) / 2 - np.array([0.5,0.5])
-    else:
-        x0, y0 = center
-    xx, yy = np.mgrid[:shape[0], :shape[1]]
-
-    if np.isscalar(alpha) and np.isscalar(beta):
-        model = astMoffat2D(amplitude, x0, y0, alpha, beta)
-        moffat = model(xx, yy)
-        # Normalization
-        if normalize:
-            moffat /= np.sum(moffat)
-    else:
-        if np.isscalar(beta):
-            Nz = alpha.shape[0]
-            beta = [beta] * Nz
-        elif np.isscalar(alpha):
-            Nz = beta.shape[0]
-            alpha = [alpha] * Nz
-        else:
-            Nz = alpha.shape[0]
-            if beta.shape[0] != Nz:
-                raise ValueError('alpha and beta must have the same dimension')
-
-        model = astMoffat2D(amplitude, [x0] * Nz, [y0] * Nz, alpha, beta,
-                            n_models=Nz)
-        moffat = model(xx, yy, model_set_axis=False)
-        # Normalization
-        if normalize:
-            moffat /= np.sum(moffat, axis=(1, 2))[:, np.newaxis, np.newaxis]
+        center = np.array(shape) / 2 - np.array([0.5, 0.5])
+    moffat = moffat_psf(shape, fwhm, beta, center=center, normalize=normalize)
+
+    if not normalize:
+        # amplitude with alpha coefficient in pixel
+        alpha = fwhm / (2 * np.sqrt(2**(1 / beta) - 1))
+        amplitude = (beta - 1) * (np.pi * alpha**2)
+        if moffat.ndim == 3:
+            amplitude = np.broadcast_to(amplitude, moffat.shape[:1])
+            amplitude = amplitude[:, np.newaxis, np.newaxis]
+        moffat *= amplitude
 
     return moffat
 
@@ -140,12 +117,12 @@ def fit_poly(x, y, deg, reject=3.0):
     yp = np.polyval(pol, x)
     err = yp - y
     if reject > 0:
-        err_masked = sigma_clip(err, sigma=reject)
-        xx = x[~err_masked.mask]
+        rejected = clipped_stats(err, sigma=reject, return_mask=True)[-1]
+        xx = x[~rejected]
         if len(xx) < len(x):
             logger.debug('%d points rejected in polynomial fit',
                          len(x) - len(xx))
-            yy = y[~err_masked.mask]
+            yy = y[~rejected]
             pol = np.polyfit(xx, yy, deg)
             yp = np.polyval(pol, x)
             err = yp - y
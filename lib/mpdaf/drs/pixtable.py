@@ -35,18 +35,25 @@ OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import astropy.units as u
 import datetime
+import json
 import logging
 import numpy as np
+import os
+import tempfile
 import warnings
 
 from astropy.io import fits
 from astropy.io.fits import Column, ImageHDU
-from astropy.stats import sigma_clip
 from astropy.table import Table
-from os.path import basename
+from os.path import basename, join
+
+from concurrent.futures import ThreadPoolExecutor
 
 from ..obj import Image, WCS
-from ..tools import add_mpdaf_method_keywords, copy_header
+from ..obj.objs import UnitArray
+from ..tools import (add_mpdaf_method_keywords, copy_header, chunk_slices,
+                     clipped_stats, get_workers, sorted_clipped_stats,
+                     MAD_TO_STD)
 
 try:
     import numexpr
@@ -67,6 +74,11 @@ KEYWORD = 'HIERARCH ESO DRS MUSE PIXTABLE'
 DEG2RAD = np.pi / 180
 RAD2DEG = 180 / np.pi
 
+# Files and dtypes used for the columnar cache (see PixTable.write_cache)
+CACHE_META = 'columns.json'
+CACHE_HEADER = 'primary_header.hdr'
+ORIGIN_FIELDS = ('ifu', 'slice', 'ypix', 'xpix')
+
 
 def _get_file_basename(f):
     """Return a string with the basename of f if f is not None"""
@@ -321,18 +333,16 @@ def merge_autocal_factors(flist, outfile=None):
         # corr.append(cube)
 
     # stack corrections and compute its clipped mean/std
-    corr = np.ma.masked_invalid(corr)
-    scorr = sigma_clip(corr, axis=0)
-    nkeep = np.count_nonzero(~scorr.mask, axis=0)
-    nrej = np.count_nonzero(scorr.mask, axis=0)
-    meancorr = np.ma.mean(scorr, axis=0)
-    stdcorr = np.ma.std(scorr, axis=0)
+    corr = np.asarray(corr, dtype=float)
+    meancorr, _, stdcorr, nkeep = clipped_stats(corr, axis=0)
+    # the invalid corrections are counted as rejected
+    nrej = corr.shape[0] - nkeep
 
     # use the first one to create the output table
     tab = Table.read(flist[0])
     tab.remove_columns(['npts', 'corr_orig'])
-    tab['std_corr'] = stdcorr.filled(np.nan).ravel()
-    tab['corr'] = meancorr.filled(np.nan).ravel()
+    tab['std_corr'] = stdcorr.ravel()
+    tab['corr'] = meancorr.ravel()
     tab['nkeep'] = nkeep.ravel()
     tab['nrej'] = nrej.ravel()
 
@@ -346,6 +356,27 @@ def merge_autocal_factors(flist, outfile=None):
     return tab
 
 
+def _sorted_group_stats(values, counts, sigma=3.0, maxiters=5):
+    """Compute robust statistics for groups of sorted values.
+
+    ``values`` contains the values of each group, sorted by group and by
+    value inside each group, and ``counts`` the (non-zero) number of values
+    in each group. Returns the mean, median, MAD, and the sigma-clipped mean
+    and std (clipping around the median, as `astropy.stats.sigma_clip`).
+
+    """
+    starts = np.zeros(len(counts), dtype=np.int64)
+    np.cumsum(counts[:-1], out=starts[1:])
+
+    # statistics of all the values, without clipping
+    mean, med, mad, _ = sorted_clipped_stats(values, starts, counts,
+                                             maxiters=0, stdfunc='mad')
+    mad /= MAD_TO_STD
+    clipped_mean, _, clipped_std, n = sorted_clipped_stats(
+        values, starts, counts, sigma=sigma, maxiters=maxiters)
+    return mean, med, mad, clipped_mean, clipped_std, n
+
+
 class PixTable:
 
     """PixTable class.
@@ -356,10 +387,16 @@ class PixTable:
     ``get_data``, ``get_dq``, ``get_stat`` and ``get_origin`` must be used to
     get columns data.
 
+    A pixtable can also be reopened from a columnar cache written with
+    `~mpdaf.drs.PixTable.write_cache`, by giving the cache directory instead
+    of a FITS file. In that case each column is memory-mapped from its own
+    ``.npy`` file.
+
     Parameters
     ----------
     filename : str
-        The FITS file name. None by default.
+        The FITS file name, or the directory of a columnar cache. None by
+        default.
 
     Attributes
     ----------
@@ -404,8 +441,13 @@ class PixTable:
         self.unit_data = unit_data
         self.xc = 0.0
         self.yc = 0.0
+        self._cache = None
+        self._pos_sky = None
 
-        if filename is not None:
+        if isinstance(filename, str) and os.path.isdir(filename):
+            self.hdulist = None
+            self._open_cache(filename)
+        elif filename is not None:
             self.hdulist = fits.open(self.filename, memmap=1)
             self.primary_header = self.hdulist[0].header
             self.nrows = self.hdulist[1].header["NAXIS2"]
@@ -471,6 +513,21 @@ class PixTable:
                 except Exception:
                     pass
 
+    def _open_cache(self, dirname):
+        """Memory-map the columns of a cache written by `write_cache`."""
+        with open(join(dirname, CACHE_META)) as f:
+            meta = json.load(f)
+        self.primary_header = fits.Header.fromfile(join(dirname, CACHE_HEADER))
+        self.nrows = meta['nrows']
+        self.ima = meta['ima']
+        self.wcs = u.Unit(meta['wcs'])
+        self.wave = u.Unit(meta['wave'])
+        self.unit_data = u.Unit(meta['unit_data'])
+        # copy-on-write, as for the memory-mapped FITS files
+        self._cache = {name: np.load(join(dirname, name + '.npy'),
+                                     mmap_mode='c')
+                       for name in meta['columns']}
+
     def __repr__(self):
         msg = "<{}({} rows, {} ifus, {})>".format(
             self.__class__.__name__, self.nrows, self.nifu, self.projection)
@@ -580,6 +637,120 @@ class PixTable:
         self.filename = filename
         self.ima = save_as_ima
 
+    def write_cache(self, dirname, double=True, chunksize=10000000):
+        """Export the pixtable to a columnar cache.
+
+        The cache is a directory with one raw little-endian ``.npy`` file per
+        column, the primary header, and the decoded fields of the origin
+        column (ifu, slice, ypix and xpix). Giving this directory to
+        `~mpdaf.drs.PixTable` reopens the pixtable almost instantly, and
+        only the columns that are used are read from the disk.
+
+        Parameters
+        ----------
+        dirname : str
+            Directory of the cache, created if needed.
+        double : bool
+            If True (default), float columns are stored in double precision,
+            so that they can be used without any conversion when the cache
+            is reopened. Otherwise they are stored as float32, which halves
+            the disk usage.
+        chunksize : int
+            Number of rows that are converted at once.
+
+        """
+        os.makedirs(dirname, exist_ok=True)
+        names = ['xpos', 'ypos', 'lambda', 'data', 'dq', 'stat', 'origin']
+        if self.get_keyword("WEIGHTED", False):
+            names.append('weight')
+
+        columns = []
+        for name in names:
+            column = self._get_raw_column(name)
+            if np.issubdtype(column.dtype, np.floating):
+                dtype = '<f8' if double else '<f4'
+            else:
+                dtype = column.dtype.newbyteorder('<')
+            self._write_cache_column(dirname, name, column, dtype, chunksize)
+            columns.append(name)
+
+        origin = self._get_raw_column('origin')
+        for name in ORIGIN_FIELDS:
+            try:
+                self._write_cache_column(dirname, name, origin, '<i4',
+                                         chunksize,
+                                         func=getattr(self, 'origin2' + name))
+            except KeyError:
+                # xpix needs the XOFFSET keywords, which may be missing
+                self._logger.warning('cannot decode the %s field of the '
+                                     'origin column', name)
+                os.remove(join(dirname, name + '.npy'))
+            else:
+                columns.append(name)
+
+        self.primary_header.tofile(join(dirname, CACHE_HEADER),
+                                   overwrite=True)
+        meta = {
+            'nrows': int(self.nrows),
+            'ima': bool(self.ima),
+            'wcs': self.wcs.to_string('fits'),
+            'wave': self.wave.to_string('fits'),
+            'unit_data': self.unit_data.to_string('fits'),
+            'columns': columns,
+        }
+        with open(join(dirname, CACHE_META), 'w') as f:
+            json.dump(meta, f, indent=2)
+
+    def _write_cache_column(self, dirname, name, column, dtype, chunksize,
+                            func=None):
+        out = np.lib.format.open_memmap(join(dirname, name + '.npy'),
+                                        mode='w+', dtype=dtype,
+                                        shape=(self.nrows,))
+        for start in range(0, self.nrows, chunksize):
+            chunk = column[start:start + chunksize]
+            out[start:start + chunksize] = chunk if func is None \
+                else func(np.asarray(chunk))
+        out.flush()
+        del out
+
+    def _get_raw_column(self, name):
+        """Return a column without any conversion (a memory-mapped array
+        when the pixtable comes from a file)."""
+        attr = getattr(self, 'lbda' if name == 'lambda' else name, None)
+        if attr is not None:
+            return attr
+        elif self._cache is not None:
+            return self._cache.get(name)
+        elif self.hdulist is None:
+            return None
+        elif self.ima:
+            return self.hdulist[name].data[:, 0]
+        else:
+            return self.hdulist[1].data.field(name)
+
+    def _get_cached_origin_field(self, name):
+        """Return a decoded field of the origin column from the columnar
+        cache, or None.
+
+        The cached fields are decoded from the origin column of the cache,
+        so they are not used once the origin column has been set in memory,
+        which may then have been modified.
+
+        """
+        if self._cache is None or self.origin is not None:
+            return None
+        return self._cache.get(name)
+
+    def _get_origin_field(self, name, origin=None, ksel=None):
+        """Return a decoded field of the origin column ('ifu', 'slice',
+        'ypix' or 'xpix'), using the columnar cache when available."""
+        if origin is None:
+            field = self._get_cached_origin_field(name)
+            if field is not None:
+                return field if ksel is None else field[ksel]
+            origin = self.get_origin(ksel=ksel)
+        return getattr(self, 'origin2' + name)(origin)
+
     def get_column(self, name, ksel=None):
         """Load a column and return it.
 
@@ -602,26 +773,18 @@ class PixTable:
             else:
                 return attr[ksel]
         else:
-            if self.hdulist is None:
+            column = self._get_raw_column(name)
+            if column is None:
                 return None
-            else:
-                if ksel is None:
-                    if self.ima:
-                        column = self.hdulist[name].data[:, 0]
-                    else:
-                        column = self.hdulist[1].data.field(name)
-                else:
-                    if isinstance(ksel, tuple):
-                        ksel = ksel[0]
-                    if self.ima:
-                        column = self.hdulist[name].data[ksel, 0]
-                    else:
-                        column = self.hdulist[1].data.field(name)[ksel]
+            if ksel is not None:
+                if isinstance(ksel, tuple):
+                    ksel = ksel[0]
+                column = column[ksel]
 
-                if np.issubdtype(column.dtype, np.floating):
-                    # Ensure that float values are converted to double
-                    column = column.astype(float)
-                return column
+            if np.issubdtype(column.dtype, np.floating):
+                # Ensure that float values are converted to double
+                column = column.astype(float, copy=False)
+            return column
 
     def set_column(self, name, data, ksel=None):
         """Set a column (or a part of it).
@@ -637,6 +800,8 @@ class PixTable:
         """
         attr_name = 'lbda' if name == 'lambda' else name
         data = np.asarray(data)
+        if name in ('xpos', 'ypos'):
+            self._pos_sky = None
         if ksel is None:
             assert data.shape[0] == self.nrows, 'Wrong dimension number'
             setattr(self, attr_name, data)
@@ -1026,8 +1191,7 @@ class PixTable:
         out : array of bool
             mask
         """
-        col_origin = origin if origin is not None else self.get_origin()
-        col_sli = self.origin2slice(col_origin)
+        col_sli = self._get_origin_field('slice', origin=origin)
         if numexpr:
             mask = np.zeros(self.nrows, dtype=bool)
             for s in slices:
@@ -1049,8 +1213,7 @@ class PixTable:
         out : array of bool
             mask
         """
-        col_origin = origin if origin is not None else self.get_origin()
-        col_ifu = self.origin2ifu(col_origin)
+        col_ifu = self._get_origin_field('ifu', origin=origin)
         if numexpr:
             mask = np.zeros(self.nrows, dtype=bool)
             for ifu in ifus:
@@ -1094,8 +1257,7 @@ class PixTable:
         out : array of bool
             mask
         """
-        col_origin = origin if origin is not None else self.get_origin()
-        col_xpix = self.origin2xpix(col_origin)
+        col_xpix = self._get_origin_field('xpix', origin=origin)
         if hasattr(xpix, '__iter__'):
             mask = np.zeros(self.nrows, dtype=bool)
             if numexpr:
@@ -1126,8 +1288,7 @@ class PixTable:
         out : array of bool
             mask
         """
-        col_origin = origin if origin is not None else self.get_origin()
-        col_ypix = self.origin2ypix(col_origin)
+        col_ypix = self._get_origin_field('ypix', origin=origin)
         if hasattr(ypix, '__iter__'):
             mask = np.zeros(self.nrows, dtype=bool)
             if numexpr:
@@ -1207,74 +1368,150 @@ class PixTable:
                     raise ValueError('Unknown shape parameter')
         return mask
 
-    def extract_from_mask(self, mask):
+    def extract_from_mask(self, mask, filename=None, chunksize=10000000):
         """Return a new pixtable extracted with the given mask.
 
+        The columns are read and selected by chunks of rows, so only the
+        selected rows are loaded in memory. If a filename is given, the
+        extracted columns are streamed directly to a new pixtable file
+        (saved as multi-extension FITS image), which is then opened with
+        memory mapping.
+
         Parameters
         ----------
         mask : numpy.ndarray
             Mask (array of bool).
+        filename : str
+            If given, the FITS filename where the extracted pixtable is
+            written.
+        chunksize : int
+            Number of rows processed at once.
 
         Returns
         -------
         out : PixTable
         """
-        if np.count_nonzero(mask) == 0:
+        nsel = np.count_nonzero(mask)
+        if nsel == 0:
             return None
 
         hdr = self.primary_header.copy()
+        self._set_extract_exp_keywords(hdr, mask)
+        names = ['xpos', 'ypos', 'lambda', 'data', 'dq', 'stat', 'origin']
+        if self.get_keyword("WEIGHTED", False):
+            names.append('weight')
 
-        # xpos
-        xpos = self.get_xpos(ksel=mask)
-        hdr["%s LIMITS X LOW" % KEYWORD] = float(xpos.min())
-        hdr["%s LIMITS X HIGH" % KEYWORD] = float(xpos.max())
-
-        # ypos
-        ypos = self.get_ypos(ksel=mask)
-        hdr["%s LIMITS Y LOW" % KEYWORD] = float(ypos.min())
-        hdr["%s LIMITS Y HIGH" % KEYWORD] = float(ypos.max())
-
-        # lambda
-        lbda = self.get_lambda(ksel=mask)
-        hdr["%s LIMITS LAMBDA LOW" % KEYWORD] = float(lbda.min())
-        hdr["%s LIMITS LAMBDA HIGH" % KEYWORD] = float(lbda.max())
-
-        # origin
-        origin = self.get_origin(ksel=mask)
-        ifu = self.origin2ifu(origin)
-        sl = self.origin2slice(origin)
-        hdr["%s LIMITS IFU LOW" % KEYWORD] = int(ifu.min())
-        hdr["%s LIMITS IFU HIGH" % KEYWORD] = int(ifu.max())
-        hdr["%s LIMITS SLICE LOW" % KEYWORD] = int(sl.min())
-        hdr["%s LIMITS SLICE HIGH" % KEYWORD] = int(sl.max())
+        if filename is None:
+            cols = {}
+            for name in names:
+                chunks = list(self._iter_masked_column(name, mask,
+                                                       chunksize))
+                col = np.concatenate(chunks) if len(chunks) > 1 \
+                    else chunks[0]
+                if np.issubdtype(col.dtype, np.floating):
+                    col = col.astype(float, copy=False)
+                cols[name] = col
+            self._set_extract_limits_keywords(
+                hdr, *[[cols[name]] for name in ('xpos', 'ypos', 'lambda',
+                                                 'origin')])
+            return PixTable(None, cols['xpos'], cols['ypos'], cols['lambda'],
+                            cols['data'], cols['dq'], cols['stat'],
+                            cols['origin'], cols.get('weight'), hdr,
+                            self.ima, self.wcs, self.wave,
+                            unit_data=self.unit_data)
+
+        self._set_extract_limits_keywords(
+            hdr, *[self._iter_masked_column(name, mask, chunksize)
+                   for name in ('xpos', 'ypos', 'lambda', 'origin')])
+        hdr['date'] = (str(datetime.datetime.now()), 'creation date')
+        hdr['author'] = ('MPDAF', 'origin of the file')
+        fits.PrimaryHDU(header=hdr).writeto(filename, overwrite=True,
+                                            output_verify='fix')
+        units = {'xpos': self.wcs, 'ypos': self.wcs, 'lambda': self.wave,
+                 'data': self.unit_data, 'stat': self.unit_data**2}
+        for name in names:
+            dtype = np.int32 if name in ('dq', 'origin') else np.float32
+            exthdr = fits.Header([
+                ('XTENSION', 'IMAGE'),
+                ('BITPIX', 32 if dtype is np.int32 else -32),
+                ('NAXIS', 2),
+                ('NAXIS1', 1),
+                ('NAXIS2', nsel),
+                ('PCOUNT', 0),
+                ('GCOUNT', 1),
+                ('EXTNAME', name),
+            ])
+            if name in units:
+                exthdr['BUNIT'] = units[name].to_string('fits')
+            shdu = fits.StreamingHDU(filename, exthdr)
+            for chunk in self._iter_masked_column(name, mask, chunksize):
+                shdu.write(np.asarray(chunk, dtype=dtype))
+            shdu.close()
+        return PixTable(filename)
+
+    def _iter_masked_column(self, name, mask, chunksize):
+        """Yield the rows of a column selected by mask, by chunks."""
+        column = self._get_raw_column(name)
+        for sl in chunk_slices(self.nrows, chunksize):
+            ksel = np.asarray(mask[sl], dtype=bool)
+            if ksel.any():
+                yield np.asarray(column[sl][ksel])
+
+    def _set_extract_limits_keywords(self, hdr, xpos, ypos, lbda, origin):
+        """Set the LIMITS keywords of an extracted pixtable, from iterables
+        on the chunks of its columns."""
+        for key, chunks in (('X', xpos), ('Y', ypos), ('LAMBDA', lbda)):
+            vmin, vmax = np.inf, -np.inf
+            for chunk in chunks:
+                vmin = min(vmin, chunk.min())
+                vmax = max(vmax, chunk.max())
+            hdr["%s LIMITS %s LOW" % (KEYWORD, key)] = float(vmin)
+            hdr["%s LIMITS %s HIGH" % (KEYWORD, key)] = float(vmax)
+
+        ifus = set()
+        slmin, slmax = np.inf, -np.inf
+        for chunk in origin:
+            ifus.update(np.unique(self.origin2ifu(chunk)).tolist())
+            sl = self.origin2slice(chunk)
+            slmin = min(slmin, sl.min())
+            slmax = max(slmax, sl.max())
+        hdr["%s LIMITS IFU LOW" % KEYWORD] = int(min(ifus))
+        hdr["%s LIMITS IFU HIGH" % KEYWORD] = int(max(ifus))
+        hdr["%s LIMITS SLICE LOW" % KEYWORD] = int(slmin)
+        hdr["%s LIMITS SLICE HIGH" % KEYWORD] = int(slmax)
 
         # merged pixtable
         if self.nifu > 1:
-            hdr["%s MERGED" % KEYWORD] = len(np.unique(ifu))
-
-        # combined exposures
-        selfexp = self.get_exp()
-        if selfexp is not None:
-            newexp = selfexp[mask]
-            numbers_exp = np.unique(newexp)
-            hdr["%s COMBINED" % KEYWORD] = len(numbers_exp)
-            for iexp, i in zip(numbers_exp, range(1, len(numbers_exp) + 1)):
-                k = np.where(newexp == iexp)
-                hdr["%s EXP%i FIRST" % (KEYWORD, i)] = k[0][0]
-                hdr["%s EXP%i LAST" % (KEYWORD, i)] = k[0][-1]
-            for i in range(len(numbers_exp) + 1,
-                           self.get_keyword("COMBINED") + 1):
-                del hdr["%s EXP%i FIRST" % (KEYWORD, i)]
-                del hdr["%s EXP%i LAST" % (KEYWORD, i)]
-
-        # return sub pixtable
-        data = self.get_data(ksel=mask)
-        stat = self.get_stat(ksel=mask)
-        dq = self.get_dq(ksel=mask)
-        weight = self.get_weight(ksel=mask)
-        return PixTable(None, xpos, ypos, lbda, data, dq, stat, origin,
-                        weight, hdr, self.ima, self.wcs, self.wave,
-                        unit_data=self.unit_data)
+            hdr["%s MERGED" % KEYWORD] = len(ifus)
+
+    def _set_extract_exp_keywords(self, hdr, mask):
+        """Set the keywords of the combined exposures of an extracted
+        pixtable, from the exposure ranges and without building the column
+        of exposure numbers."""
+        try:
+            nexp = self.get_keyword("COMBINED")
+            ranges = [(self.get_keyword("EXP%i FIRST" % i),
+                       self.get_keyword("EXP%i LAST" % i))
+                      for i in range(1, nexp + 1)]
+        except Exception:
+            return
+
+        # The exposures are contiguous ranges of rows, so the new ranges are
+        # given by the number of selected rows before and inside each range.
+        exps = []
+        for first, last in sorted(ranges):
+            nbefore = np.count_nonzero(mask[:first])
+            ninside = np.count_nonzero(mask[first:last + 1])
+            if ninside > 0:
+                exps.append((nbefore, nbefore + ninside - 1))
+
+        hdr["%s COMBINED" % KEYWORD] = len(exps)
+        for i, (first, last) in enumerate(exps, start=1):
+            hdr["%s EXP%i FIRST" % (KEYWORD, i)] = first
+            hdr["%s EXP%i LAST" % (KEYWORD, i)] = last
+        for i in range(len(exps) + 1, nexp + 1):
+            del hdr["%s EXP%i FIRST" % (KEYWORD, i)]
+            del hdr["%s EXP%i LAST" % (KEYWORD, i)]
 
     def extract(self, filename=None, sky=None, lbda=None, ifu=None, sl=None,
                 xpix=None, ypix=None, exp=None, stack=None, method='and'):
@@ -1352,7 +1589,10 @@ class PixTable:
         # Do the selection on the origin column
         if (ifu is not None) or (sl is not None) or (stack is not None) or \
                 (xpix is not None) or (ypix is not None):
-            origin = self.get_origin()
+            if self._get_cached_origin_field('ifu') is not None:
+                origin = None  # use the decoded fields from the cache
+            else:
+                origin = self.get_origin()
             if sl is not None:
                 lfunc(kmask, self.select_slices(sl, origin=origin), out=kmask)
             if stack is not None:
@@ -1373,11 +1613,187 @@ class PixTable:
                 lfunc(kmask, self.select_exp(exp, col_exp), out=kmask)
 
         # Compute the new pixtable
-        pix = self.extract_from_mask(kmask)
-        if pix is not None and filename is not None:
-            pix.filename = filename
-            pix.write(filename)
-        return pix
+        return self.extract_from_mask(kmask, filename=filename)
+
+    def group_stats(self, keys=('ifu', 'slice'), lbda_bins=None,
+                    column='data', mask=None, sigma=3.0, maxiters=5,
+                    unit=u.angstrom, chunksize=10000000):
+        """Compute robust statistics of a column, grouped by keys and
+        wavelength bins.
+
+        For each group of rows sharing the same values of the key columns
+        (and the same wavelength bin if ``lbda_bins`` is given), this
+        computes the number of values, the mean, median and median absolute
+        deviation (MAD), and the sigma-clipped mean and standard deviation.
+        Rows with a NaN value are ignored.
+
+        The table is read by chunks of ``chunksize`` rows: the rows of each
+        group are counted, then their values are gathered by group (in a
+        temporary file if there are more than ``chunksize`` values), and the
+        groups are processed by chunks of at most ``chunksize`` values, where
+        the values are sorted in each group. This bounds the memory usage,
+        and avoids looping on `extract` or `select_slices` results.
+
+        Parameters
+        ----------
+        keys : list of str
+            Columns used to group the rows. 'ifu', 'slice', 'xpix', 'ypix'
+            (decoded from the origin column), 'exp' (exposure numbers), or
+            the name of an integer column.
+        lbda_bins : array-like
+            Edges of the wavelength bins, e.g. ``SKY_SEGMENTS``. The bin
+            number (starting at 1) is returned in the 'quad' column. Rows
+            outside of the bins are ignored.
+        column : str
+            Name of the column for which statistics are computed.
+        mask : array of bool
+            Rows to ignore (True for masked rows).
+        sigma : float
+            Number of standard deviations used for the clipping.
+        maxiters : int
+            Maximum number of clipping iterations.
+        unit : `astropy.units.Unit`
+            Unit of the wavelength bins.
+        chunksize : int
+            Number of rows processed at once.
+
+        Returns
+        -------
+        out : `astropy.table.Table`
+            Table with one row per non-empty group, with the key columns,
+            'quad' if ``lbda_bins`` is given, and the 'npts', 'mean',
+            'median', 'mad', 'clipped_mean', 'clipped_std' and
+            'clipped_npts' columns.
+
+        """
+        if self.nrows == 0:
+            return None
+
+        keys = list(keys)
+        if lbda_bins is not None:
+            lbda_bins = (np.asarray(lbda_bins, dtype=float) *
+                         unit).to(self.wave).value
+        exp = self.get_exp() if 'exp' in keys else None
+        if exp is not None:
+            exp = exp.astype(int)
+        origin_fields = [k for k in keys if k in ORIGIN_FIELDS]
+        origin = None
+        cached = {k: self._get_cached_origin_field(k) for k in origin_fields}
+        if any(field is None for field in cached.values()):
+            origin = self._get_raw_column('origin')
+        col_values = self._get_raw_column(column)
+        col_lbda = self._get_raw_column('lambda')
+
+        def get_keys(sl):
+            orig = None if origin is None else np.asarray(origin[sl])
+            out = []
+            for key in keys:
+                if key in ORIGIN_FIELDS:
+                    if orig is None:
+                        out.append(np.asarray(cached[key][sl]))
+                    else:
+                        out.append(getattr(self, 'origin2' + key)(orig))
+                elif key == 'exp':
+                    if exp is None:
+                        raise ValueError('no exposure numbers in this '
+                                         'pixtable')
+                    out.append(exp[sl])
+                else:
+                    out.append(np.asarray(self._get_raw_column(key)[sl]))
+            if lbda_bins is not None:
+                out.append(np.searchsorted(lbda_bins, col_lbda[sl],
+                                           side='right'))
+            return out
+
+        slices = chunk_slices(self.nrows, chunksize)
+
+        # First pass to get the range of each key
+        kmin = [np.inf] * len(keys)
+        kmax = [-np.inf] * len(keys)
+        for sl in slices:
+            for i, k in enumerate(get_keys(sl)[:len(keys)]):
+                kmin[i] = min(kmin[i], k.min())
+                kmax[i] = max(kmax[i], k.max())
+        kmin = [int(k) for k in kmin]
+        dims = [int(k) - m + 1 for k, m in zip(kmax, kmin)]
+        if lbda_bins is not None:
+            kmin.append(1)
+            dims.append(len(lbda_bins) - 1)
+        ngroups = int(np.prod(dims))
+        if ngroups > np.iinfo(np.int32).max:
+            raise ValueError('too many groups')
+
+        def get_codes(sl):
+            # group index of the valid rows of a chunk, and their values
+            kvals = get_keys(sl)
+            values = np.asarray(col_values[sl], dtype=float)
+            valid = ~np.isnan(values)
+            if mask is not None:
+                valid &= ~np.asarray(mask[sl], dtype=bool)
+            if lbda_bins is not None:
+                valid &= (kvals[-1] >= 1) & (kvals[-1] < len(lbda_bins))
+            if not dims:
+                # a single group
+                return np.zeros(np.count_nonzero(valid), dtype=int), \
+                    values[valid]
+            kvals = [k[valid] - m for k, m in zip(kvals, kmin)]
+            return np.ravel_multi_index(kvals, dims), values[valid]
+
+        # Second pass to count the rows of each group
+        counts = np.zeros(ngroups, dtype=np.int64)
+        for sl in slices:
+            counts += np.bincount(get_codes(sl)[0], minlength=ngroups)
+        groups = np.flatnonzero(counts)
+        csum = np.cumsum(counts[groups])
+        nvalid = int(csum[-1]) if len(groups) else 0
+
+        with tempfile.TemporaryFile() as tmpfile:
+            # Third pass to gather the values by group (a counting sort),
+            # in memory if they fit in a chunk, or in a temporary file.
+            if nvalid <= chunksize:
+                values = np.empty(nvalid)
+            else:
+                values = np.memmap(tmpfile, dtype=float, mode='w+',
+                                   shape=(nvalid, ))
+            fill = np.zeros(ngroups, dtype=np.int64)
+            fill[groups] = csum - counts[groups]
+            for sl in slices:
+                code, vals = get_codes(sl)
+                order = np.argsort(code, kind='stable')
+                code = code[order]
+                rank = np.arange(len(code)) - np.searchsorted(code, code)
+                values[fill[code] + rank] = vals[order]
+                fill += np.bincount(code, minlength=ngroups)
+
+            # Process the non-empty groups by chunks of rows
+            stats = []
+            first = 0
+            while first < len(groups):
+                start = csum[first] - counts[groups[first]]
+                last = max(np.searchsorted(csum, start + chunksize,
+                                           side='right'), first + 1)
+                gcounts = counts[groups[first:last]]
+                vals = np.array(values[start:csum[last - 1]])
+                gid = np.repeat(np.arange(last - first), gcounts)
+                order = np.lexsort((vals, gid))
+                stats.append(_sorted_group_stats(vals[order], gcounts,
+                                                 sigma=sigma,
+                                                 maxiters=maxiters))
+                first = last
+            del values
+
+        names = keys + (['quad'] if lbda_bins is not None else [])
+        kvals = np.unravel_index(groups, dims) if dims else ()
+        t = Table([k + m for k, m in zip(kvals, kmin)], names=names)
+        t['npts'] = counts[groups]
+        for i, name in enumerate(('mean', 'median', 'mad', 'clipped_mean',
+                                  'clipped_std', 'clipped_npts')):
+            if stats:
+                t[name] = np.concatenate([st[i] for st in stats])
+            else:
+                t[name] = np.zeros(0, dtype=np.int64 if name == 'clipped_npts'
+                                   else float)
+        return t
 
     def origin2ifu(self, origin):
         """Converts the origin value and returns the ifu number.
@@ -1532,28 +1948,81 @@ class PixTable:
                 ypos_sky = numexpr.evaluate("yc + ypos")
         return xpos_sky, ypos_sky
 
-    def get_pos_sky(self, xpos=None, ypos=None):
+    def get_pos_sky(self, xpos=None, ypos=None, chunksize=2**22,
+                    workers=None):
         """Return the absolute position on the sky in degrees/pixel.
 
+        When the positions are computed for the xpos and ypos columns of the
+        pixtable, the result is cached and reused until the columns are
+        modified with `set_xpos` or `set_ypos`, or until ``xc`` or ``yc``
+        are changed. The cached arrays are read-only.
+
+        The computation is done by chunks of rows, with numexpr if it is
+        available or with a pool of threads otherwise.
+
         Parameters
         ----------
         xpos : numpy.array
             xpos values
         ypos : numpy.array
             ypos values
+        chunksize : int
+            Number of rows processed at once.
+        workers : int
+            Number of threads, defaults to the number of CPUs (or
+            ``mpdaf.CPU``).
 
         Returns
         -------
         xpos_sky, ypos_sky : numpy.array, numpy.array
         """
-        if xpos is None:
-            xpos = self.get_xpos()
-        if ypos is None:
-            ypos = self.get_ypos()
-        if numexpr:
-            return self._get_pos_sky_numexpr(xpos, ypos)
+        use_cache = xpos is None and ypos is None
+        if use_cache:
+            pos_sky = self._get_cached_pos_sky()
+            if pos_sky is not None:
+                return pos_sky
+
+        xpos = self._get_raw_column('xpos') if xpos is None \
+            else np.asarray(xpos)
+        ypos = self._get_raw_column('ypos') if ypos is None \
+            else np.asarray(ypos)
+        func = self._get_pos_sky_numexpr if numexpr else self._get_pos_sky
+        if xpos.ndim == 0:
+            return func(xpos, ypos)
+
+        nrows = len(xpos)
+        xpos_sky = np.empty(nrows, dtype=float)
+        ypos_sky = np.empty(nrows, dtype=float)
+
+        def compute(sl):
+            xpos_sky[sl], ypos_sky[sl] = func(
+                np.asarray(xpos[sl], dtype=float),
+                np.asarray(ypos[sl], dtype=float))
+
+        slices = chunk_slices(nrows, chunksize)
+        workers = get_workers(workers)
+        if numexpr or workers == 1 or len(slices) < 2:
+            # numexpr already uses several threads
+            for sl in slices:
+                compute(sl)
         else:
-            return self._get_pos_sky(xpos, ypos)
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                list(executor.map(compute, slices))
+
+        if use_cache:
+            xpos_sky.flags.writeable = False
+            ypos_sky.flags.writeable = False
+            self._pos_sky = (self._pos_sky_key(), (xpos_sky, ypos_sky))
+        return xpos_sky, ypos_sky
+
+    def _pos_sky_key(self):
+        return (self.xc, self.yc, self.projection, self.wcs)
+
+    def _get_cached_pos_sky(self):
+        """Return the cached sky positions if they are still valid."""
+        if self._pos_sky is not None and \
+                self._pos_sky[0] == self._pos_sky_key():
+            return self._pos_sky[1]
 
     def get_keyword(self, key, default=_NOT_SET):
         """Return the keyword value corresponding to key, adding the keyword
@@ -1674,15 +2143,25 @@ class PixTable:
 
         return Image(data=image, wcs=wcs, unit=self.wave, copy=False)
 
-    def mask_column(self, maskfile=None):
+    def mask_column(self, maskfile=None, chunksize=2**22, workers=None):
         """Compute the mask column corresponding to a mask file.
 
+        The positions are processed by chunks of rows, in parallel threads.
+        For a mask image with a gnomonic (TAN) or linear WCS, the pixel
+        coordinates are computed with a precomputed linear transform instead
+        of the general astropy WCS path.
+
         Parameters
         ----------
         maskfile : str
             Path to a FITS image file with WCS information, used to mask
             out bright continuum objects present in the FoV. Values must
             be 0 for the background and >0 for objects.
+        chunksize : int
+            Number of rows processed at once.
+        workers : int
+            Number of threads, defaults to the number of CPUs (or
+            ``mpdaf.CPU``).
 
         Returns
         -------
@@ -1692,10 +2171,35 @@ class PixTable:
         if maskfile is None:
             return np.zeros(self.nrows, dtype=bool)
 
-        pos = np.array(self.get_pos_sky()[::-1]).T
         ima_mask = Image(maskfile, dtype=bool)
-        sky = ima_mask.wcs.sky2pix(pos, nearest=True, unit=u.deg).T
-        mask = ima_mask.data.data[sky[0], sky[1]]
+        data = ima_mask.data.data
+        wcs = ima_mask.wcs
+        pos_sky = self._get_cached_pos_sky()
+        xpos = self._get_raw_column('xpos')
+        ypos = self._get_raw_column('ypos')
+        mask = np.empty(self.nrows, dtype=bool)
+
+        def compute(sl):
+            if pos_sky is None:
+                ra, dec = self.get_pos_sky(xpos[sl], ypos[sl])
+            else:
+                ra, dec = pos_sky[0][sl], pos_sky[1][sl]
+            y, x = wcs._world2pix(UnitArray(dec, u.deg, wcs.unit),
+                                  UnitArray(ra, u.deg, wcs.unit))
+            # nearest pixel, clipped to the image limits (as WCS.sky2pix)
+            y = np.clip((y + 0.5).astype(int), 0, data.shape[0] - 1)
+            x = np.clip((x + 0.5).astype(int), 0, data.shape[1] - 1)
+            mask[sl] = data[y, x]
+
+        slices = chunk_slices(self.nrows, chunksize)
+        workers = get_workers(workers)
+        if numexpr or workers == 1 or len(slices) < 2:
+            # numexpr already uses several threads
+            for sl in slices:
+                compute(sl)
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                list(executor.map(compute, slices))
 
         return PixTableMask(maskfile=maskfile, maskcol=mask,
                             pixtable=self.filename)
@@ -35,12 +35,17 @@ OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 import logging
 import numpy as np
 import os
+import threading
 
 from astropy.io import fits
+from astropy.table import Table
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
 from ..obj import Image, WCS
+from ..tools import get_workers
 
-__all__ = ('RawFile', 'Channel')
+__all__ = ('RawFile', 'Channel', 'compute_raw_stats')
 
 NB_SUBSLICERS = 4  # number of sub-slicers
 NB_SPEC_PER_SLICE = 75  # number of pixels per slice
@@ -48,6 +53,130 @@ NB_SLICES = 12  # number of slices per sub-slicer
 INTERSPEC = 7  # inter-spectrum distance in pixel
 OVERSCAN = 32  # overscan width in pixel
 SLIT_POSITION = np.array([9, 8, 1, 10, 7, 2, 11, 6, 3, 12, 5, 4])
+SATURATION = 65535  # saturation level of the detectors in ADU
+
+# lru_cache does not prevent concurrent computations of the same value, so
+# this makes sure that channels read in threads share the same geometry
+_geometry_lock = threading.Lock()
+
+
+def _get_layout(header):
+    """Return a hashable description of the detector layout of a channel:
+    (nx, ny, nx_data, ny_data, outputs), where outputs gives for each
+    quadrant (nx, ny, prscx, prscy, x, y)."""
+    outputs = []
+    for idx in range(1, 5):
+        key = "ESO DET OUT%i" % idx
+        outputs.append((header["%s NX" % key], header["%s NY" % key],
+                        header.get("%s PRSCX" % key, OVERSCAN),
+                        header.get("%s PRSCY" % key, OVERSCAN),
+                        header["%s X" % key], header["%s Y" % key]))
+    return (header["NAXIS1"], header["NAXIS2"], header["ESO DET CHIP NX"],
+            header["ESO DET CHIP NY"], tuple(outputs))
+
+
+def _detector_indices(layout, idx, with_prescan=True):
+    """Return the indices for one quadrant, with prescan or not."""
+    chan_nx, chan_ny, nx_data, ny_data, outputs = layout
+    # Output data pixels, prescan pixels, and location of output in X, Y
+    nx, ny, prscx, prscy, x, y = outputs[idx - 1]
+
+    if with_prescan:
+        if x < nx_data // 2:
+            i1 = x - 1
+            i2 = i1 + nx + 2 * prscx
+        else:
+            i2 = chan_nx
+            i1 = i2 - nx - 2 * prscx
+
+        if y < ny_data // 2:
+            j1 = y - 1
+            j2 = j1 + ny + 2 * prscy
+        else:
+            j2 = chan_ny
+            j1 = j2 - ny - 2 * prscy
+    else:
+        if x < nx_data // 2:
+            i1 = x - 1 + prscx
+            i2 = i1 + nx
+        else:
+            i2 = chan_nx - prscx
+            i1 = i2 - nx
+
+        if y < ny_data // 2:
+            j1 = y - 1 + prscy
+            j2 = j1 + ny
+        else:
+            j2 = chan_ny - prscy
+            j1 = j2 - ny
+
+    return slice(j1, j2), slice(i1, i2)
+
+
+@lru_cache(maxsize=16)
+def _get_geometry(layout):
+    """Compute the quadrant indices and the overscan mask of a detector
+    layout. This is cached, as all the channels of a raw file usually share
+    the same layout."""
+    indices = {(idx, prescan): _detector_indices(layout, idx, prescan)
+               for idx in range(1, 5) for prescan in (True, False)}
+    # mask that invalidates over scanned pixels
+    mask = np.ones((layout[1], layout[0]), dtype=bool)
+    for idx in range(1, 5):
+        sy, sx = indices[(idx, False)]
+        mask[sy, sx] = False
+    mask.flags.writeable = False
+    return indices, mask
+
+
+def _resample_slices(spe, xstart, xend, npix=NB_SPEC_PER_SLICE):
+    """Resample the slices of a spectrum to npix pixels.
+
+    Slice i covers ``spe[xstart[i]:xend[i] + 1]``. The spectrum is seen as a
+    step function (pixel j covering [j - 0.5, j + 0.5[, extended with the
+    edge values), which is integrated exactly on each output pixel using its
+    cumulative sum. Returns an array of shape (nslices, npix).
+
+    """
+    spe = np.asarray(spe, dtype=float)
+    xstart = np.asarray(xstart)[:, np.newaxis]
+    n = np.asarray(xend)[:, np.newaxis] - xstart + 1
+    step = n / npix
+    # edges of the output pixels, shifted so that pixel j covers [j, j + 1[
+    t = np.arange(npix + 1) * step + 0.5 - 0.5 * step
+    j = np.clip(np.floor(t).astype(int), 0, n - 1)
+    csum = np.concatenate(([0.], np.cumsum(spe)))
+    # cumulative integral at the edges of the output pixels
+    cint = csum[xstart + j] + (t - j) * spe[xstart + j]
+    return np.diff(cint, axis=1) / step
+
+
+@lru_cache(maxsize=1)
+def _load_white_image_mask(filename):
+    """Return the trimmed mask and the slices limits of all the channels of
+    a mask file used to reconstruct white images. This is cached, so that
+    the mask file is read only once."""
+    masks = {}
+    for chan in RawFile(filename).get_channels():
+        mask = chan.get_trimmed_image(bias=False).data.data
+        if np.array_equal(mask, mask.astype(bool)):
+            mask = mask.astype(bool)
+        mask.flags.writeable = False
+
+        hdr = chan.header
+        xlim = np.array([[hdr['ESO DET SLICE%d XSTART' % sli],
+                          hdr['ESO DET SLICE%d XEND' % sli]]
+                         for sli in range(1, 49)]) - OVERSCAN
+        xlim[xlim > (hdr["ESO DET CHIP NX"] / 2.0)] -= 2 * OVERSCAN
+        masks[chan.extname] = (mask, xlim[:, 0], xlim[:, 1])
+    return masks
+
+
+def _is_compressed(filename):
+    """Return True if filename is a compressed (gzip, bzip2 or zip) file."""
+    with open(filename, 'rb') as f:
+        magic = f.read(3)
+    return magic[:2] in (b'\x1f\x8b', b'PK') or magic == b'BZh'
 
 
 class Channel:
@@ -60,6 +189,13 @@ class Channel:
         The extension name.
     filename : str
         The raw FITS file name.
+    memmap : bool or None
+        If None (default), the data is memory-mapped when possible, i.e.
+        when it is not scaled with BZERO/BSCALE (in which case it is
+        converted in memory). True forces memory mapping, and False disables
+        it.
+    hdulist : `astropy.io.fits.HDUList`
+        An already opened raw file, used instead of opening filename.
 
     Attributes
     ----------
@@ -73,86 +209,42 @@ class Channel:
         Lengths of data in Y
     mask : array of bool
         Arrays that contents TRUE for overscanned pixels, FALSE for the others.
+        This read-only array is shared by the channels with the same detector
+        layout.
 
     """
 
-    def __init__(self, extname, filename):
+    def __init__(self, extname, filename, memmap=None, hdulist=None):
         self._logger = logging.getLogger(__name__)
         self.extname = extname
 
-        with fits.open(filename) as hdulist:
-            self.header = hdr = hdulist[extname].header
-            self.nx = hdr["NAXIS1"]
-            self.ny = hdr["NAXIS2"]
-            self.data = hdulist[extname].data
+        if hdulist is None:
+            with fits.open(filename, memmap=memmap) as hdulist:
+                self._read(hdulist[extname])
+        else:
+            self._read(hdulist[extname])
+
+        with _geometry_lock:
+            self._indices, self.mask = _get_geometry(
+                _get_layout(self.header))
 
-        self.mask = self._init_mask()
+    def _read(self, hdu):
+        self.header = hdr = hdu.header
+        self.nx = hdr["NAXIS1"]
+        self.ny = hdr["NAXIS2"]
+        self.data = hdu.data
 
     def _get_detector_indices(self, idx, with_prescan=True):
         """Return the indices for one quadrant, with prescan or not."""
-
         if idx not in (1, 2, 3, 4):
             raise ValueError('Invalid quadrant index')
-
-        # Physical active pixels in X, Y
-        nx_data = self.header["ESO DET CHIP NX"]
-        ny_data = self.header["ESO DET CHIP NY"]
-
-        # Output data pixels in X, Y
-        key = "ESO DET OUT%i" % idx
-        nx = self.header["%s NX" % key]
-        ny = self.header["%s NY" % key]
-
-        # Output prescan pixels in X, Y
-        prscx = self.header.get("%s PRSCX" % key, OVERSCAN)
-        prscy = self.header.get("%s PRSCY" % key, OVERSCAN)
-
-        # X, Y location of output
-        x = self.header["%s X" % key]
-        y = self.header["%s Y" % key]
-
-        if with_prescan:
-            if x < nx_data // 2:
-                i1 = x - 1
-                i2 = i1 + nx + 2 * prscx
-            else:
-                i2 = self.nx
-                i1 = i2 - nx - 2 * prscx
-
-            if y < ny_data // 2:
-                j1 = y - 1
-                j2 = j1 + ny + 2 * prscy
-            else:
-                j2 = self.ny
-                j1 = j2 - ny - 2 * prscy
-        else:
-            if x < nx_data // 2:
-                i1 = x - 1 + prscx
-                i2 = i1 + nx
-            else:
-                i2 = self.nx - prscx
-                i1 = i2 - nx
-
-            if y < ny_data // 2:
-                j1 = y - 1 + prscy
-                j2 = j1 + ny
-            else:
-                j2 = self.ny - prscy
-                j1 = j2 - ny
-
-        return slice(j1, j2), slice(i1, i2)
-
-    def _init_mask(self):
-        """Create mask that invalidates over scanned pixels."""
-        mask = np.ones((self.ny, self.nx), dtype=bool)
-        for i in range(1, 5):
-            sy, sx = self._get_detector_indices(i, with_prescan=False)
-            mask[sy, sx] = False
-        return mask
+        return self._indices[(idx, bool(with_prescan))]
 
     def trimmed(self, copy=True):
         """Return a masked array where overscan pixels are masked."""
-        return np.ma.MaskedArray(self.data, mask=self.mask, copy=copy)
+        # the shared mask is read-only, so it must be copied in all cases
+        mask = self.mask if copy else self.mask.copy()
+        return np.ma.MaskedArray(self.data, mask=mask, copy=copy)
 
     def overscan(self, copy=True):
         """Return a masked array where only overscan pixels are not masked."""
@@ -205,6 +297,57 @@ class Channel:
         ksel = np.where(ima.data.mask == False)
         return np.median(ima.data.data[ksel])
 
+    def get_stats(self, saturation=SATURATION):
+        """Compute the overscan and bad pixels statistics of each quadrant.
+
+        Parameters
+        ----------
+        saturation : float
+            Saturation level, data pixels above or equal to this value are
+            counted as saturated.
+
+        Returns
+        -------
+        out : list of dict
+            One dict per quadrant, and one for the whole channel (with
+            ``quad`` = 0), with the following keys: ``quad``, ``bias``
+            (median value of the overscanned pixels, as computed by
+            `get_bias_level`), ``ovsc_mean`` and ``ovsc_std`` (mean and
+            standard deviation of the overscanned pixels), ``npix`` (number
+            of data pixels), ``nsat`` and ``nzero`` (number of saturated and
+            null data pixels).
+
+        """
+        stats = []
+        ovsc_all = []
+        for det in range(1, 5):
+            sy, sx = self._get_detector_indices(det, with_prescan=True)
+            ovsc = self.data[sy, sx][self.mask[sy, sx]]
+            ovsc_all.append(ovsc)
+            sy, sx = self._get_detector_indices(det, with_prescan=False)
+            data = self.data[sy, sx]
+            stats.append({
+                'quad': det,
+                'bias': np.median(ovsc),
+                'ovsc_mean': np.mean(ovsc, dtype=float),
+                'ovsc_std': np.std(ovsc, dtype=float),
+                'npix': data.size,
+                'nsat': np.count_nonzero(data >= saturation),
+                'nzero': np.count_nonzero(data == 0),
+            })
+
+        ovsc = np.concatenate(ovsc_all)
+        stats.insert(0, {
+            'quad': 0,
+            'bias': np.median(ovsc),
+            'ovsc_mean': np.mean(ovsc, dtype=float),
+            'ovsc_std': np.std(ovsc, dtype=float),
+            'npix': sum(st['npix'] for st in stats),
+            'nsat': sum(st['nsat'] for st in stats),
+            'nzero': sum(st['nzero'] for st in stats),
+        })
+        return stats
+
     def get_trimmed_image(self, det_out=None, bias=False):
         """Return an Image object without over scanned pixels.
 
@@ -286,6 +429,71 @@ class Channel:
         return ima
 
 
+def compute_raw_stats(filenames, channels="all", saturation=SATURATION,
+                      workers=None, outfile=None):
+    """Compute the detector statistics of a list of raw files.
+
+    Each file is read only once, and the files are processed by a pool of
+    threads. For each channel, the statistics are computed for each
+    quadrant, and for the whole channel (``quad`` = 0), see
+    `mpdaf.drs.Channel.get_stats`.
+
+    Parameters
+    ----------
+    filenames : list of str
+        The raw FITS file names.
+    channels : list or 'all'
+        List of channel names. All by default.
+    saturation : float
+        Saturation level, data pixels above or equal to this value are
+        counted as saturated.
+    workers : int
+        Number of threads, defaults to the number of CPUs (or
+        ``mpdaf.CPU``).
+    outfile : str
+        If not None, the table is also saved to this file.
+
+    Returns
+    -------
+    out : `astropy.table.Table`
+        Table with one row per file, channel and quadrant.
+
+    """
+    logger = logging.getLogger(__name__)
+
+    def process(filename):
+        logger.debug('computing statistics for %s', filename)
+        rows = []
+        with fits.open(filename) as hdulist:
+            for hdu in hdulist[1:]:
+                hdr = hdu.header
+                if hdr['XTENSION'] != 'IMAGE' or hdr['NAXIS'] == 0:
+                    continue
+                extname = hdr['EXTNAME']
+                if channels != "all" and extname not in channels:
+                    continue
+                chan = Channel(extname, filename, hdulist=hdulist)
+                for row in chan.get_stats(saturation=saturation):
+                    row['filename'] = os.path.basename(filename)
+                    row['extname'] = extname
+                    rows.append(row)
+        return rows
+
+    workers = min(get_workers(workers), len(filenames))
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        rows = [row for res in executor.map(process, filenames)
+                for row in res]
+
+    names = ('filename', 'extname', 'quad', 'bias', 'ovsc_mean', 'ovsc_std',
+             'npix', 'nsat', 'nzero')
+    t = Table(rows=[[row[name] for name in names] for row in rows],
+              names=names)
+    t.meta['SATLEVEL'] = saturation
+    if outfile is not None:
+        t.write(outfile, overwrite=True)
+    return t
+
+
 class RawFile:
 
     """RawFile class manages input/output for raw FITS file.
@@ -375,6 +583,43 @@ class RawFile:
             self.channels[extname] = Channel(extname, self.filename)
         return self.channels[extname]
 
+    def get_channels(self, channels="all", workers=None):
+        """Load several channels at once and return them.
+
+        For an uncompressed file, the channels are memory-mapped and loaded
+        by a pool of threads. A compressed file is read only once,
+        sequentially.
+
+        Parameters
+        ----------
+        channels : list or 'all'
+            List of channel names. All by default.
+        workers : int
+            Number of threads, defaults to the number of CPUs (or
+            ``mpdaf.CPU``).
+
+        Returns
+        -------
+        out : list of `mpdaf.drs.Channel`
+        """
+        if channels == "all":
+            channels = self.get_channels_extname_list()
+
+        todo = [name for name in channels if self.channels[name] is None]
+        workers = min(get_workers(workers), len(todo))
+        if workers > 1 and not _is_compressed(self.filename):
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                chans = executor.map(
+                    lambda name: Channel(name, self.filename), todo)
+                self.channels.update(zip(todo, chans))
+        elif todo:
+            with fits.open(self.filename) as hdulist:
+                for name in todo:
+                    self.channels[name] = Channel(name, self.filename,
+                                                  hdulist=hdulist)
+
+        return [self.channels[name] for name in channels]
+
     def __len__(self):
         """Return the number of extensions."""
         return self.next
@@ -444,8 +689,8 @@ class RawFile:
         else:
             ncols = int(nchan // nrows) + 1
 
-        for i, name in enumerate(channels):
-            chan = self.get_channel(name)
+        chans = self.get_channels(channels)
+        for i, (name, chan) in enumerate(zip(channels, chans)):
             ima = chan.get_trimmed_image(det_out=None, bias=False)
             if area is not None:
                 ima = ima[area[0]:area[1], area[2]:area[3]]
@@ -458,9 +703,13 @@ class RawFile:
                      style='italic',
                      bbox={'facecolor': 'red', 'alpha': 0.2, 'pad': 10})
 
-    def reconstruct_white_image(self, mask=None, channels="all"):
+    def reconstruct_white_image(self, mask=None, channels="all",
+                                workers=None):
         """Reconstructs the white image of the FOV using a mask file.
 
+        The mask file is cached between calls, and the channels are
+        processed in parallel threads.
+
         Parameters
         ----------
         mask : str
@@ -470,6 +719,9 @@ class RawFile:
             comes with Mpdaf.
         channels : list or 'all'
             List of channel names. All by default.
+        workers : int
+            Number of threads, defaults to the number of CPUs (or
+            ``mpdaf.CPU``).
 
         Returns
         -------
@@ -483,51 +735,22 @@ class RawFile:
         if channels == "all":
             channels = self.get_channels_extname_list()
 
-        from scipy.integrate import quad
-        raw_mask = RawFile(mask)
-        white_ima = np.zeros((12 * 24, 300))
+        masks = _load_white_image_mask(mask)
+        chans = self.get_channels(channels, workers=workers)
 
-        for chan in channels:
-            ifu = int(chan[-2:])
-            mask_chan = raw_mask.get_channel(chan)
-            ima = self.get_channel(chan).get_trimmed_image(bias=True).data.data
-            mask = mask_chan.get_trimmed_image(bias=False).data.data
+        def compute(chan):
+            mask, xstart, xend = masks[chan.extname]
+            ima = chan.get_trimmed_image(bias=True).data.data
             ima *= mask
             spe = ima.sum(axis=0)
-            data = np.empty((48, NB_SPEC_PER_SLICE))
-            mhdr = mask_chan.header
-
-            for sli in range(1, 49):
-                xstart = mhdr['ESO DET SLICE%d XSTART' % sli] - OVERSCAN
-                xend = mhdr['ESO DET SLICE%d XEND' % sli] - OVERSCAN
-                if xstart > (mhdr["ESO DET CHIP NX"] / 2.0):
-                    xstart -= 2 * OVERSCAN
-                if xend > (mhdr["ESO DET CHIP NX"] / 2.0):
-                    xend -= 2 * OVERSCAN
-
-                spe_slice = spe[xstart:xend + 1]
-                n = spe_slice.shape[0]
-
-                if n < NB_SPEC_PER_SLICE:
-                    spe_slice_75pix = np.zeros(NB_SPEC_PER_SLICE)
-                    spe_slice_75pix[:n] = spe_slice
-                elif n == NB_SPEC_PER_SLICE:
-                    spe_slice_75pix = spe_slice
-                else:
-                    spe_slice_75pix = np.empty(NB_SPEC_PER_SLICE,
-                                               dtype=float)
+            return _resample_slices(spe, xstart, xend)
 
-                f = lambda x: spe_slice[int(x + 0.5)]
-                pix = np.arange(NB_SPEC_PER_SLICE + 1, dtype=float)
-                new_step = float(n) / NB_SPEC_PER_SLICE
-                x = pix * new_step - 0.5 * new_step
-
-                for i in range(NB_SPEC_PER_SLICE):
-                    spe_slice_75pix[i] = quad(f, x[i], x[i + 1],
-                                              full_output=1)[0] / new_step
-
-                data[sli - 1, :] = spe_slice_75pix
+        with ThreadPoolExecutor(max_workers=get_workers(workers)) as executor:
+            results = list(executor.map(compute, chans))
 
+        white_ima = np.zeros((12 * 24, 300))
+        for chan, data in zip(channels, results):
+            ifu = int(chan[-2:])
             # For each subslicer 1-4
             for k in range(1, NB_SUBSLICERS + 1):
                 # For each slice 1-12*/
@@ -38,9 +38,11 @@ import tempfile
 import unittest
 
 from astropy.io import fits
+from astropy.table import Table
 from astropy.utils.data import download_file
 from contextlib import contextmanager
 from mpdaf.drs import PixTable, pixtable
+from mpdaf.obj import Image, WCS
 from numpy.testing import assert_array_equal, assert_allclose
 from os.path import join
 
@@ -64,6 +66,10 @@ def toggle_numexpr(active):
 
 class TestBasicPixTable(unittest.TestCase):
 
+    @pytest.fixture(autouse=True)
+    def _tmpdir(self, tmpdir):
+        self.tmpdir = str(tmpdir)
+
     @classmethod
     def setUp(self):
         np.random.seed(42)
@@ -257,6 +263,132 @@ class TestBasicPixTable(unittest.TestCase):
                         (self.aslice == 3))
                 assert_array_equal(self.data[ksel], pix.get_data())
 
+    def test_get_pos_sky(self):
+        for numexpr in (True, False):
+            with toggle_numexpr(numexpr):
+                pix = self.pix.copy()
+                x, y = pix.get_pos_sky()
+                x2, y2 = pix._get_pos_sky(self.xpos, self.ypos)
+                assert_allclose(x, x2)
+                assert_allclose(y, y2)
+
+                # chunked computation, with threads
+                x3, y3 = pix.get_pos_sky(self.xpos, self.ypos, chunksize=7,
+                                         workers=3)
+                assert_allclose(x, x3)
+                assert_allclose(y, y3)
+
+                # the result is cached, and invalidated when the columns or
+                # the center are changed
+                assert pix.get_pos_sky()[0] is x
+                pix.xc = 1.
+                assert_allclose(pix.get_pos_sky()[0], pix._get_pos_sky(
+                    self.xpos, self.ypos)[0])
+                pix.set_xpos(self.xpos + 0.1)
+                assert_allclose(pix.get_pos_sky()[0], pix._get_pos_sky(
+                    self.xpos + 0.1, self.ypos)[0])
+
+    def test_group_stats(self):
+        from astropy.stats import sigma_clip
+        data = np.random.RandomState(0).normal(size=NROWS)
+        data[:5] = 100
+        self.pix.set_data(data)
+        bins = [5000, 6000, 7000, 8000]
+        for numexpr in (True, False):
+            with toggle_numexpr(numexpr):
+                for keys, chunksize in ((['ifu'], 10), ([], NROWS)):
+                    t = self.pix.group_stats(keys=keys, lbda_bins=bins,
+                                             chunksize=chunksize)
+                    assert t['npts'].sum() == np.sum(self.lbda < 8000)
+                    for row in t:
+                        ksel = ((self.aifu == row['ifu']) if keys else True)
+                        ksel = (ksel &
+                                (self.lbda >= bins[row['quad'] - 1]) &
+                                (self.lbda < bins[row['quad']]))
+                        vals = data[ksel]
+                        med = np.median(vals)
+                        clipped = sigma_clip(vals, sigma=3, maxiters=5)
+                        assert row['npts'] == len(vals)
+                        assert_allclose(row['mean'], vals.mean())
+                        assert_allclose(row['median'], med)
+                        assert_allclose(row['mad'],
+                                        np.median(np.abs(vals - med)))
+                        assert_allclose(row['clipped_mean'], clipped.mean())
+                        assert_allclose(row['clipped_std'], clipped.std(),
+                                        atol=1e-12)
+                        assert row['clipped_npts'] == clipped.count()
+
+        t = self.pix.group_stats(keys=['ifu', 'slice'],
+                                 mask=(self.aslice == 1))
+        assert t['npts'].sum() == np.sum(self.aslice != 1)
+        assert 1 not in t['slice']
+
+        # a single group, with the values gathered in memory or in a
+        # temporary file
+        for chunksize in (7, NROWS):
+            t = self.pix.group_stats(keys=[], chunksize=chunksize)
+            assert len(t) == 1
+            assert t['npts'][0] == NROWS
+            assert_allclose(t['median'][0], np.median(data))
+
+        # all the rows are masked
+        t = self.pix.group_stats(keys=['ifu'], lbda_bins=bins,
+                                 mask=np.ones(NROWS, dtype=bool))
+        assert len(t) == 0
+        assert t.colnames == ['ifu', 'quad', 'npts', 'mean', 'median', 'mad',
+                              'clipped_mean', 'clipped_std', 'clipped_npts']
+
+    def test_extract_from_mask(self):
+        tmpdir = tempfile.mkdtemp(suffix='.mpdaf-test-pixtable')
+        pix = self.pix.copy()
+        pix.set_keyword('COMBINED', 2)
+        pix.set_keyword('EXP1 FIRST', 0)
+        pix.set_keyword('EXP1 LAST', 49)
+        pix.set_keyword('EXP2 FIRST', 50)
+        pix.set_keyword('EXP2 LAST', 99)
+        ksel = (self.lbda > 6500)
+
+        res1 = pix.extract_from_mask(ksel, chunksize=7)
+        out = join(tmpdir, 'PIX.fits')
+        res2 = pix.extract_from_mask(ksel, filename=out, chunksize=7)
+        assert res2.filename == out
+        for res in (res1, res2):
+            assert res.nrows == np.count_nonzero(ksel)
+            for name in ('xpos', 'ypos', 'lambda', 'data', 'stat', 'dq',
+                         'origin'):
+                assert_allclose(getattr(res, 'get_' + name)(),
+                                getattr(pix, 'get_' + name)(ksel),
+                                rtol=1e-6)
+            assert res.get_keyword('COMBINED') == 1
+            assert res.get_keyword('EXP1 FIRST') == 0
+            assert res.get_keyword('EXP1 LAST') == res.nrows - 1
+            assert res.get_keyword('EXP2 FIRST', None) is None
+            assert res.get_keyword('LIMITS LAMBDA LOW') == \
+                pytest.approx(self.lbda[ksel].min())
+            assert res.get_keyword('LIMITS IFU HIGH') == self.aifu[ksel].max()
+        res2.hdulist.close()
+
+    def test_mask_column(self):
+        tmpdir = tempfile.mkdtemp(suffix='.mpdaf-test-pixtable')
+        pix = self.pix.copy()
+        pix.set_xpos(self.xpos * 1e-4)
+        pix.set_ypos(self.ypos * 1e-4)
+        x, y = pix.get_pos_sky()
+        wcs = WCS(crval=(np.mean(y), np.mean(x)), cdelt=(1e-3, -1e-3),
+                  deg=True, rot=20, shape=(60, 40))
+        data = np.random.RandomState(0).randint(0, 2, size=(60, 40))
+        maskfile = join(tmpdir, 'mask.fits')
+        Image(data=data, wcs=wcs).write(maskfile)
+
+        pos = wcs.sky2pix(np.array([y, x]).T, nearest=True, unit=u.deg)
+        expected = data[pos[:, 0], pos[:, 1]].astype(bool)
+        for numexpr in (True, False):
+            with toggle_numexpr(numexpr):
+                # with and without the cached positions
+                for p in (pix, pix.copy()):
+                    mask = p.mask_column(maskfile, chunksize=30, workers=2)
+                    assert_array_equal(mask.maskcol, expected)
+
     def test_write(self):
         tmpdir = tempfile.mkdtemp(suffix='.mpdaf-test-pixtable')
         out = join(tmpdir, 'PIX.fits')
@@ -276,6 +408,77 @@ class TestBasicPixTable(unittest.TestCase):
         pix1.hdulist.close()
         pix2.hdulist.close()
 
+    def test_cache(self):
+        tmpdir = self.tmpdir
+        for double in (True, False):
+            for pixt in (self.pix, self.pix2):
+                out = join(tmpdir, 'cache-{}'.format(double))
+                pixt.write_cache(out, double=double)
+                pix = PixTable(out)
+                self.assertEqual(self.pix.nrows, pix.nrows)
+                self.assertEqual(pix.projection, 'projected')
+                self.assertIn('ifu', pix._cache)
+                self.assertNotIn('xpix', pix._cache)
+                for name in ('xpos', 'ypos', 'data', 'dq', 'stat', 'origin'):
+                    col = getattr(pix, 'get_' + name)()
+                    if name not in ('dq', 'origin'):
+                        self.assertEqual(col.dtype, np.float64)
+                    assert_allclose(col, getattr(self, name), rtol=1e-6)
+
+                res = pix.extract(ifu=1, sl=self.aslice[0])
+                ksel = (self.aifu == 1) & (self.aslice == self.aslice[0])
+                assert_allclose(self.data[ksel], res.get_data(), rtol=1e-6)
+
+                # changing the origin column invalidates the decoded fields
+                # the decoded fields are not used once the origin column
+                # is in memory, and may be modified
+                pix2 = pix.copy()
+                pix2.origin = self.origin.copy()
+                assert_array_equal(pix2.select_ifus([1]), self.aifu == 1)
+                pix2.origin[:] = self.origin[::-1]
+                assert_array_equal(pix2.select_ifus([1]),
+                                   self.aifu[::-1] == 1)
+                pix2 = pix2.copy()
+                res = pix2.extract(ifu=1)
+                assert_allclose(res.get_data(),
+                                self.data[self.aifu[::-1] == 1], rtol=1e-6)
+                assert_array_equal(pix.select_ifus([1]), self.aifu == 1)
+
+                pix.set_origin(self.origin[::-1].copy())
+                assert_array_equal(pix.select_ifus([1]), self.aifu[::-1] == 1)
+
+
+def test_merge_autocal_factors(tmpdir):
+    rng = np.random.RandomState(0)
+    nrows = pixtable.NIFUS * pixtable.NSLICES
+    hdr = fits.Header({'HIERARCH ESO DRS MUSE LAMBDA1 MIN': 4800.,
+                       'HIERARCH ESO DRS MUSE LAMBDA1 MAX': 9300.})
+    flist = []
+    for i in range(10):
+        npts = np.full(nrows, 10)
+        npts[:3] = 0      # invalid corrections
+        corr = 1 + rng.normal(0, 0.01, nrows)
+        if i == 0:
+            corr[5] = 10  # outlier
+        tbl = Table([np.repeat(np.arange(1, 25), 48),
+                     np.tile(np.arange(1, 49), 24),
+                     np.ones(nrows, dtype=int), npts, corr, corr],
+                    names=('ifu', 'sli', 'quad', 'npts', 'corr', 'corr_orig'))
+        fname = str(tmpdir.join('autocal-{}.fits'.format(i)))
+        fits.HDUList([fits.PrimaryHDU(header=hdr),
+                      fits.table_to_hdu(tbl)]).writeto(fname)
+        flist.append(fname)
+
+    tab = pixtable.merge_autocal_factors(flist)
+    assert len(tab) == nrows
+    # the invalid corrections are counted as rejected
+    assert_array_equal(tab['nkeep'][:3], 0)
+    assert_array_equal(tab['nrej'][:3], 10)
+    assert np.all(np.isnan(tab['corr'][:3]))
+    assert tab['nkeep'][5] == 9
+    assert tab['nrej'][5] == 1
+    assert_array_equal(tab['nkeep'] + tab['nrej'], 10)
+
 
 @pytest.fixture
 def pixfile():
@@ -31,10 +31,44 @@ OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 
 import numpy as np
+import os
 import pytest
+from astropy.io import fits
+from astropy.table import Table
 from astropy.utils.data import download_file
-from mpdaf.drs import RawFile
-from numpy.testing import assert_array_equal
+from mpdaf.drs import RawFile, compute_raw_stats
+from mpdaf.drs.rawobj import _resample_slices
+from numpy.testing import assert_allclose, assert_array_equal
+
+# Layout of the fake raw files: 4 quadrants of 20x15 pixels with a prescan
+# and overscan of 4 pixels
+CHIP_NX, CHIP_NY, OUT_NX, OUT_NY, PRSC = 40, 30, 20, 15, 4
+
+
+def fake_rawfile(filename, nchan=3):
+    """Create a fake raw file, with nchan channels."""
+    nx, ny = CHIP_NX + 4 * PRSC, CHIP_NY + 4 * PRSC
+    hdul = fits.HDUList([fits.PrimaryHDU()])
+    hdul[0].header['ORIGIN'] = 'MPDAF'
+    rng = np.random.RandomState(0)
+    for chan in range(1, nchan + 1):
+        data = rng.randint(1000, 1100, size=(ny, nx)).astype(np.uint16)
+        hdu = fits.ImageHDU(data=data, name='CHAN%02d' % chan)
+        hdr = hdu.header
+        hdr['ESO DET CHIP NX'] = CHIP_NX
+        hdr['ESO DET CHIP NY'] = CHIP_NY
+        for idx, (x, y) in enumerate([(1, 1), (CHIP_NX, 1),
+                                      (CHIP_NX, CHIP_NY), (1, CHIP_NY)], 1):
+            key = 'ESO DET OUT%d' % idx
+            hdr[key + ' NX'] = OUT_NX
+            hdr[key + ' NY'] = OUT_NY
+            hdr[key + ' PRSCX'] = PRSC
+            hdr[key + ' PRSCY'] = PRSC
+            hdr[key + ' X'] = x
+            hdr[key + ' Y'] = y
+        hdul.append(hdu)
+    hdul.writeto(filename, overwrite=True)
+    return filename
 
 
 @pytest.fixture
@@ -103,3 +137,84 @@ def test_raw_mask(rawobj):
     out = rawobj[1].overscan() * 2
     assert out.data[24, 12] == 2 * overscan
     assert out.data[240, 120] == pixel
+
+
+@pytest.mark.parametrize('ext', ('.fits', '.fits.gz'))
+def test_get_channels(tmpdir, ext):
+    filename = fake_rawfile(os.path.join(str(tmpdir), 'raw' + ext))
+    raw = RawFile(filename)
+    assert len(raw) == 3
+
+    chans = raw.get_channels(workers=2)
+    assert len(chans) == 3
+    for i, chan in enumerate(chans, 1):
+        assert raw[i] is chan
+        assert_array_equal(chan.data, fits.getdata(filename, i))
+        # the overscan mask is computed once for the common layout
+        assert chan.mask is chans[0].mask
+        assert np.count_nonzero(~chan.mask) == CHIP_NX * CHIP_NY
+
+    chan = raw[1]
+    sy, sx = chan._get_detector_indices(3, with_prescan=False)
+    assert chan.data[sy, sx].shape == (OUT_NY, OUT_NX)
+    assert chan.get_trimmed_image().shape == (CHIP_NY, CHIP_NX)
+    assert chan.get_image(det_out=2).shape == (OUT_NY + 2 * PRSC,
+                                               OUT_NX + 2 * PRSC)
+    # the shared mask is not modified
+    out = chan.trimmed(copy=False)
+    out[PRSC, PRSC] = np.ma.masked
+    assert not chan.mask[PRSC, PRSC]
+
+
+def test_resample_slices():
+    """Raw objects: tests the resampling of the slices to 75 pixels"""
+    from scipy.integrate import quad
+    rng = np.random.RandomState(0)
+    spe = rng.rand(400) * 100
+    xstart = np.array([0, 90, 200])
+    xend = np.array([82, 194, 290])
+
+    res = _resample_slices(spe, xstart, xend)
+    assert res.shape == (3, 75)
+
+    for i, (start, end) in enumerate(zip(xstart, xend)):
+        spe_slice = spe[start:end + 1]
+        n = spe_slice.shape[0]
+        step = n / 75
+        x = np.arange(76) * step - 0.5 * step
+        f = lambda x: spe_slice[int(x + 0.5)]
+        expected = [quad(f, x[k], x[k + 1], full_output=1)[0] / step
+                    for k in range(75)]
+        assert_allclose(res[i], expected, rtol=1e-6)
+
+    # with 75 pixels the spectrum is unchanged
+    assert_allclose(_resample_slices(spe, [10], [84])[0], spe[10:85])
+
+
+def test_compute_raw_stats(tmpdir):
+    """Raw objects: tests the batch statistics"""
+    files = [fake_rawfile(str(tmpdir.join('raw%d.fits' % i)), nchan=2)
+             for i in range(3)]
+    with fits.open(files[1], mode='update') as hdul:
+        hdul['CHAN02'].data[PRSC + 2, PRSC + 3] = 65535
+        hdul['CHAN02'].data[PRSC + 5, PRSC + 3] = 0
+
+    outfile = str(tmpdir.join('stats.fits'))
+    t = compute_raw_stats(files, workers=2, outfile=outfile)
+    assert len(t) == 3 * 2 * 5
+    assert_array_equal(Table.read(outfile)['bias'], t['bias'])
+
+    chan = RawFile(files[1]).get_channel('CHAN02')
+    rows = t[(t['filename'] == 'raw1.fits') & (t['extname'] == 'CHAN02')]
+    assert_array_equal(rows['quad'], [0, 1, 2, 3, 4])
+    for det in range(1, 5):
+        assert rows['bias'][det] == chan.get_bias_level(det)
+    assert rows['bias'][0] == np.median(chan.data[chan.mask])
+    assert_array_equal(rows['npix'], [CHIP_NX * CHIP_NY] +
+                       [OUT_NX * OUT_NY] * 4)
+    assert_array_equal(rows['nsat'], [1, 1, 0, 0, 0])
+    assert_array_equal(rows['nzero'], [1, 1, 0, 0, 0])
+    assert t['nsat'][t['quad'] > 0].sum() == 1
+
+    t = compute_raw_stats(files[:1], channels=['CHAN01'])
+    assert len(t) == 5
@@ -40,5 +40,6 @@ from .image import *
 from .masking import *
 from .objs import *
 from .plot import *
+from .psf import *
 from .spectrum import *
 from .wavelet1D import *
@@ -40,6 +40,7 @@ import numbers
 import numpy as np
 
 from astropy.io import fits
+from functools import partial
 
 from .objs import UnitArray
 from ..tools import fix_unit_read
@@ -48,6 +49,11 @@ __all__ = ('deg2sexa', 'sexa2deg', 'deg2hms', 'hms2deg', 'deg2dms', 'dms2deg',
            'image_angle_from_cd', 'axis_increments_from_cd',
            'WCS', 'WaveCoord', 'determine_refframe')
 
+# Minimum number of coordinates for which the transformations of `WCS` are
+# computed with Numpy (see `WCS._get_transform`). Astropy is faster for a
+# few coordinates.
+NUMPY_TRANSFORM_SIZE = 100
+
 
 def deg2sexa(x):
     """Transform equatorial coordinates from degrees to sexagesimal strings.
@@ -389,6 +395,53 @@ def determine_refframe(phdr):
         return None, None
 
 
+def _wcsprm_key(wcs):
+    """Return a hashable value that identifies the parameters of the
+    transformations of an `astropy.wcs.WCS` object."""
+    w = wcs.wcs
+    # cdelt is ignored (with a warning) when the CD matrix is present
+    if w.has_cd():
+        lin = (w.cd.tobytes(), )
+    else:
+        lin = (w.cdelt.tobytes(), w.pc.tobytes() if w.has_pc() else None,
+               w.crota.tobytes() if w.has_crota() else None)
+    return (tuple(w.ctype), w.crval.tobytes(), w.crpix.tobytes(), lin,
+            np.array([w.lonpole, w.latpole]).tobytes(), tuple(w.get_pv()),
+            _has_distortion(wcs))
+
+
+def _has_distortion(wcs):
+    """Return True if an `astropy.wcs.WCS` object has distortions."""
+    return (wcs.sip is not None or wcs.cpdis1 is not None or
+            wcs.cpdis2 is not None or wcs.det2im1 is not None or
+            wcs.det2im2 is not None)
+
+
+def _wcs_fingerprint(wcs):
+    """Return a hashable value that identifies the world coordinates and
+    the dimensions of an image."""
+    return (wcs.naxis1, wcs.naxis2) + _wcsprm_key(wcs.wcs)
+
+
+def _memoize(obj, name, key, func):
+    """Return the value computed by func for an object of coordinates.
+
+    The value is kept in the ``_coords_cache`` dictionary of the object with
+    the value returned by key, computed after func (which may update the
+    parameters of the astropy WCS object with ``wcs.set()``). It is returned
+    as long as key returns the same value, so the cache is invalidated by
+    the setters, and by the direct modifications of the astropy object.
+
+    """
+    cache = obj.__dict__.setdefault('_coords_cache', {})
+    item = cache.get(name)
+    if item is not None and item[0] == key():
+        return item[1]
+    value = func()
+    cache[name] = (key(), value)
+    return value
+
+
 class WCS:
 
     """The WCS class manages the world coordinates of the spatial axes of
@@ -713,9 +766,7 @@ class WCS:
             x[:, 1] = UnitArray(x[:, 1], unit, self.unit)
             x[:, 0] = UnitArray(x[:, 0], unit, self.unit)
 
-        # Tell world2pix to convert the world coordinates to
-        # zero-relative array indexes.
-        ax, ay = self.wcs.wcs_world2pix(x[:, 1], x[:, 0], 0)
+        ay, ax = self._world2pix(x[:, 0], x[:, 1])
         res = np.array([ay, ax]).T
 
         if nearest:
@@ -758,12 +809,18 @@ class WCS:
             [r, theta]
 
         """
-        pixcrd = np.indices((self.naxis2, self.naxis1))
         if spaxel:
-            x, y = pixcrd
+            x, y = np.indices((self.naxis2, self.naxis1))
         else:
-            coord = self.pix2sky(pixcrd.reshape(2, -1).T).T
-            x, y = coord.reshape(pixcrd.shape)
+            # The coordinates of all the pixels are cached
+            def compute():
+                y, x = np.indices((self.naxis2, self.naxis1), dtype=float)
+                coord = np.array(self._pix2world(y, x))
+                coord.flags.writeable = False
+                return coord
+
+            x, y = _memoize(self, 'coord', partial(_wcs_fingerprint, self),
+                            compute).copy()
 
         if mask is not None:
             x = x[~mask]
@@ -818,15 +875,101 @@ class WCS:
         elif len(x.shape) != 2 or x.shape[1] != 2:
             raise IOError('invalid input coordinates for pix2sky')
 
-        # Tell world2pix to treat the pixel indexes as zero relative
-        # array indexes.
-        ra, dec = self.wcs.wcs_pix2world(x[:, 1], x[:, 0], 0)
+        dec, ra = self._pix2world(x[:, 0], x[:, 1])
         if unit is not None:
             ra = UnitArray(ra, self.unit, unit)
             dec = UnitArray(dec, self.unit, unit)
 
         return np.array([dec, ra]).T
 
+    def _get_transform(self):
+        """Return the coefficients of the transformations between pixel and
+        world coordinates, or None if they are not done with Numpy.
+
+        The transformations of the linear coordinates, and of the gnomonic
+        (TAN) projections in degrees without distortions, are computed with
+        Numpy from the CD matrix, its inverse, the reference pixel and its
+        coordinates, which are cached until the parameters of ``self.wcs``
+        change. The other transformations, and those of less than
+        ``NUMPY_TRANSFORM_SIZE`` coordinates, use astropy.
+
+        """
+        def compute():
+            w = self.wcs.wcs
+            w.set()
+            ctype = tuple(w.ctype)
+            is_tan = (ctype == ('RA---TAN', 'DEC--TAN') and
+                      tuple(w.cunit) == (u.deg, u.deg) and
+                      w.lonpole == 180 and not w.get_pv())
+            is_linear = ctype == ('LINEAR', 'LINEAR')
+            if _has_distortion(self.wcs) or not (is_tan or is_linear):
+                return None
+            cd = w.get_pc() * w.get_cdelt()[:, np.newaxis]
+            return ('tan' if is_tan else 'linear', cd, np.linalg.inv(cd),
+                    w.crpix - 1, w.crval.copy())
+
+        return _memoize(self, 'transform', partial(_wcsprm_key, self.wcs),
+                        compute)
+
+    def _pix2world(self, y, x):
+        """Convert arrays of pixel indexes (y, x) to world coordinates
+        (dec, ra), in the units of the WCS."""
+        transform = None
+        if np.size(x) >= NUMPY_TRANSFORM_SIZE:
+            transform = self._get_transform()
+        if transform is None:
+            # Tell world2pix to treat the pixel indexes as zero relative
+            # array indexes.
+            ra, dec = self.wcs.wcs_pix2world(x, y, 0)
+            return dec, ra
+
+        kind, cd, _, crpix, (ra0, dec0) = transform
+        dx = x - crpix[0]
+        dy = y - crpix[1]
+        xi = cd[0, 0] * dx + cd[0, 1] * dy
+        eta = cd[1, 0] * dx + cd[1, 1] * dy
+        if kind == 'linear':
+            return dec0 + eta, ra0 + xi
+
+        # Inverse gnomonic projection
+        xi = np.deg2rad(xi)
+        eta = np.deg2rad(eta)
+        sdec0, cdec0 = np.sin(np.deg2rad(dec0)), np.cos(np.deg2rad(dec0))
+        den = cdec0 - eta * sdec0
+        ra = np.mod(ra0 + np.rad2deg(np.arctan2(xi, den)), 360)
+        dec = np.rad2deg(np.arctan2(eta * cdec0 + sdec0, np.hypot(xi, den)))
+        return dec, ra
+
+    def _world2pix(self, dec, ra):
+        """Convert arrays of world coordinates (dec, ra), in the units of the
+        WCS, to pixel indexes (y, x)."""
+        transform = None
+        if np.size(ra) >= NUMPY_TRANSFORM_SIZE:
+            transform = self._get_transform()
+        if transform is None:
+            # Tell world2pix to convert the world coordinates to
+            # zero-relative array indexes.
+            x, y = self.wcs.wcs_world2pix(ra, dec, 0)
+            return y, x
+
+        kind, _, icd, crpix, (ra0, dec0) = transform
+        if kind == 'linear':
+            xi = ra - ra0
+            eta = dec - dec0
+        else:
+            # Gnomonic projection
+            dra = np.deg2rad(ra - ra0)
+            dec = np.deg2rad(dec)
+            sdec0, cdec0 = np.sin(np.deg2rad(dec0)), np.cos(np.deg2rad(dec0))
+            sdec, cdec = np.sin(dec), np.cos(dec)
+            cdra = np.cos(dra)
+            cosc = np.rad2deg(1) / (sdec0 * sdec + cdec0 * cdec * cdra)
+            xi = cdec * np.sin(dra) * cosc
+            eta = (cdec0 * sdec - sdec0 * cdec * cdra) * cosc
+        x = icd[0, 0] * xi + icd[0, 1] * eta + crpix[0]
+        y = icd[1, 0] * xi + icd[1, 1] * eta + crpix[1]
+        return y, x
+
     def isEqual(self, other, start_atol=1e-6, rot_atol=1e-6):
         """Return True if other and self have the same attributes.
 
@@ -1756,13 +1899,19 @@ class WaveCoord:
             raise IOError("wavelength coordinates without dimension")
 
         if pixel is None:
-            pixelarr = np.arange(self.shape, dtype=float)
+            # The full coordinate array is cached for each unit
+            def compute():
+                res = self._pix2world(np.arange(self.shape, dtype=float))
+                if unit is not None:
+                    res = (res * self.unit).to(unit).value
+                res.flags.writeable = False
+                return res
+
+            res = _memoize(self, ('coord', unit), self._key, compute).copy()
         else:
-            pixelarr = np.atleast_1d(pixel)
-
-        res = self.wcs.wcs_pix2world(pixelarr, 0)[0]
-        if unit is not None:
-            res = (res * self.unit).to(unit).value
+            res = self._pix2world(np.atleast_1d(pixel))
+            if unit is not None:
+                res = (res * self.unit).to(unit).value
 
         result = res[0] if np.isscalar(pixel) else res
 
@@ -1806,7 +1955,7 @@ class WaveCoord:
         lbdarr = np.atleast_1d(lbda)
         if unit is not None:
             lbdarr = UnitArray(lbdarr, unit, self.unit)
-        pix = self.wcs.wcs_world2pix(lbdarr, 0)[0]
+        pix = self._world2pix(lbdarr)
         if nearest:
             pix = (pix + 0.5).astype(int)
             np.maximum(pix, 0, out=pix)
@@ -1814,6 +1963,48 @@ class WaveCoord:
                 np.minimum(pix, self.shape - 1, out=pix)
         return pix[0] if np.isscalar(lbda) else pix
 
+    def _key(self):
+        """Return a hashable value that identifies the coordinates."""
+        return (self.shape, self.unit, _wcsprm_key(self.wcs))
+
+    def _get_transform(self):
+        """Return the coefficients of the linear transformation between
+        pixel and world coordinates, or None for the non-linear axes.
+
+        The coefficients (crval, step, cdelt, pc, crpix) are cached until
+        the parameters of ``self.wcs`` change, and are used with Numpy in
+        the same way as wcslib, which gives the same results as astropy
+        without its overhead.
+
+        """
+        def compute():
+            w = self.wcs.wcs
+            w.set()
+            if '-' in w.ctype[0].strip() or _has_distortion(self.wcs):
+                return None
+            cdelt = w.get_cdelt()[0]
+            pc = w.get_pc()[0, 0]
+            return (w.crval[0], cdelt * pc, cdelt, pc, w.crpix[0])
+
+        return _memoize(self, 'transform', partial(_wcsprm_key, self.wcs),
+                        compute)
+
+    def _pix2world(self, pixel):
+        """Convert an array of pixel indexes to wavelengths."""
+        transform = self._get_transform()
+        if transform is None:
+            return self.wcs.wcs_pix2world(pixel, 0)[0]
+        crval, step, _, _, crpix = transform
+        return step * (pixel + 1 - crpix) + crval
+
+    def _world2pix(self, lbda):
+        """Convert an array of wavelengths to pixel indexes."""
+        transform = self._get_transform()
+        if transform is None:
+            return self.wcs.wcs_world2pix(lbda, 0)[0]
+        crval, _, cdelt, pc, crpix = transform
+        return ((lbda - crval) / cdelt) * (1 / pc) + crpix - 1
+
     def __getitem__(self, item):
         """Return the coordinate corresponding to pixel if item is an integer
         Return the corresponding WaveCoord object if item is a slice."""
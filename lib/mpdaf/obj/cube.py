@@ -35,6 +35,7 @@ OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 
 import astropy.units as u
+import hashlib
 import multiprocessing
 import numpy as np
 import os.path
@@ -44,18 +45,33 @@ import types
 import warnings
 
 from astropy.io import fits
+from astropy.stats import gaussian_fwhm_to_sigma
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from numpy import ma
 from scipy import interpolate, signal, ndimage as ndi
 
 from .arithmetic import ArithmeticMixin
-from .data import DataArray
-from .image import Image
-from .objs import bounding_box, is_number
-from .spectrum import Spectrum
-from ..tools import add_mpdaf_method_keywords, MpdafWarning
+from .data import DataArray, _fftconvolve
+from .fitting import _fit_gauss1d_stack, _gauss1d_params
+from .image import Image, _map_tiles
+from .objs import bounding_box, is_number, polygon_mask, _mask_outside
+from .spectrum import (Spectrum, _interp_masked, _lsf_operator,
+                       _median_continuum, _poly_continuum, _resample_decimate,
+                       _wavelet_continuum)
+from ..tools import (add_mpdaf_method_keywords, chunk_slices, get_workers,
+                     MpdafWarning)
 
 __all__ = ('iter_spe', 'iter_ima', 'Cube')
 
+# Number of spectra fitted at once by each thread of `Cube.gauss_fit_maps`.
+_LINE_FIT_CHUNK_SIZE = 2048
+
+# Maximum size (in bytes) of each block of spectra processed by the threads
+# of the continuum methods (`Cube.poly_spec`, `Cube.median_filter` and
+# `Cube.wavelet_filter`).
+_SPECTRA_BLOCK_BYTES = 2 ** 24
+
 
 def iter_spe(cube, index=False):
     """An iterator over the spectra of successive image pixels in a Cube
@@ -383,18 +399,19 @@ class Cube(ArithmeticMixin, DataArray):
             form="rectangle", center=center, radii=radius,
             shape=self.shape[1:], step=step)
 
+        # The mask is modified in place, so it must be an array.
+        if self._mask is ma.nomask:
+            self._mask = np.zeros(self.shape, dtype=bool)
+
         # Mask pixels inside the region.
         if inside:
-            self.data[lmin:lmax, sy, sx] = ma.masked
+            self._mask[lmin:lmax, sy, sx] = True
 
         # Mask pixels outside the region.
         else:
-            self.data[:lmin, :, :] = ma.masked
-            self.data[lmax:, :, :] = ma.masked
-            self.data[lmin:lmax, 0:sy.start, :] = np.ma.masked
-            self.data[lmin:lmax, sy.stop:, :] = np.ma.masked
-            self.data[lmin:lmax, sy, 0:sx.start] = np.ma.masked
-            self.data[lmin:lmax, sy, sx.stop:] = np.ma.masked
+            self._mask[:lmin] = True
+            self._mask[lmax:] = True
+            _mask_outside(self._mask[lmin:lmax], [sy, sx])
 
     def mask_ellipse(self, center, radius, posangle, lmin=None, lmax=None,
                      inside=True, unit_center=u.deg,
@@ -502,19 +519,18 @@ class Cube(ArithmeticMixin, DataArray):
         ksel = (((x * cospa + y * sinpa) / radii[0]) ** 2 +
                 ((y * cospa - x * sinpa) / radii[1]) ** 2)
 
+        # The mask is modified in place, so it must be an array.
+        if self._mask is ma.nomask:
+            self._mask = np.zeros(self.shape, dtype=bool)
+
+        # The 2D mask of the ellipse is broadcast over the wavelength range.
         if inside:
-            grid3d = np.resize(ksel < 1, (lmax - lmin, ) + ksel.shape)
-            self.data[lmin:lmax, sy, sx][grid3d] = ma.masked
+            self._mask[lmin:lmax, sy, sx] |= ksel < 1
         else:
-            self.data[:lmin, :, :] = ma.masked
-            self.data[lmax:, :, :] = ma.masked
-            self.data[lmin:lmax, :sy.start, :] = ma.masked
-            self.data[lmin:lmax, sy.stop:, :] = ma.masked
-            self.data[lmin:lmax, :, :sx.start] = ma.masked
-            self.data[lmin:lmax, :, sx.stop:] = ma.masked
-
-            grid3d = np.resize(ksel > 1, (lmax - lmin, ) + ksel.shape)
-            self.data[lmin:lmax, sy, sx][grid3d] = ma.masked
+            self._mask[:lmin] = True
+            self._mask[lmax:] = True
+            _mask_outside(self._mask[lmin:lmax], [sy, sx])
+            self._mask[lmin:lmax, sy, sx] |= ksel > 1
 
     def mask_polygon(self, poly, lmin=None, lmax=None,
                      unit_poly=u.deg, unit_wave=u.angstrom, inside=True):
@@ -542,31 +558,12 @@ class Cube(ArithmeticMixin, DataArray):
 
         # Convert DEC,RA (deg) values coming from poly into Y,X value (pixels)
         if unit_poly is not None:
-            poly = np.array([
-                [self.wcs.sky2pix((val[0], val[1]), unit=unit_poly)[0][0],
-                 self.wcs.sky2pix((val[0], val[1]), unit=unit_poly)[0][1]]
-                for val in poly])
-
-        P, Q = np.meshgrid(list(range(self.shape[1])),
-                           list(range(self.shape[2])))
-        b = np.dstack([P.ravel(), Q.ravel()])
-
-        # Use a matplotlib method to create a path, which is the polygon we
-        # want to use.
-        from matplotlib.path import Path
-        polymask = Path(poly)
-
-        # Go through all pixels in the image to see if they are within the
-        # polygon. The ouput is a boolean table.
-        c = polymask.contains_points(b[0])
-
-        # Invert the boolean table to mask pixels outside the polygon?
-        if not inside:
-            c = ~np.array(c)
+            poly = self.wcs.sky2pix(np.asarray(poly, dtype=float),
+                                    unit=unit_poly)
 
-        # Convert the boolean table into a matrix.
-        c = c.reshape(self.shape[2], self.shape[1])
-        c = c.T
+        # Rasterize the polygon within its bounding box.
+        clipped, inpoly = polygon_mask(poly, self.shape[1:])
+        sy, sx = clipped
 
         # Convert the minimum wavelength to a spectral pixel index.
         if lmin is None:
@@ -580,14 +577,20 @@ class Cube(ArithmeticMixin, DataArray):
         elif unit_wave is not None:
             lmax = self.wave.pixel(lmax, nearest=True, unit=unit_wave)
 
-        # Combine the previous mask with the new one between lmin and lmax.
-        self._mask[lmin:lmax, :, :] |= c
+        # The mask is modified in place, so it must be an array.
+        if self._mask is ma.nomask:
+            self._mask = np.zeros(self.shape, dtype=bool)
 
-        # When masking pixels outside the region, mask all pixels
-        # outside the specified wavelength range.
-        if not inside:
-            self.data[:lmin, :, :] = ma.masked
-            self.data[lmax:, :, :] = ma.masked
+        # Combine the previous mask with the 2D mask of the polygon, which
+        # is broadcast over the wavelength range. When masking pixels outside
+        # the region, mask all pixels outside the wavelength range.
+        if inside:
+            self._mask[lmin:lmax, sy, sx] |= inpoly
+        else:
+            self._mask[:lmin] = True
+            self._mask[lmax:] = True
+            _mask_outside(self._mask[lmin:lmax], clipped)
+            self._mask[lmin:lmax, sy, sx] |= ~inpoly
 
         return poly
 
@@ -1251,6 +1254,271 @@ class Cube(ArithmeticMixin, DataArray):
         factor = np.asarray(factor)
         return self._rebin(factor, margin, inplace)
 
+    def regrid(self, newdim, refpos, refpix, newinc, flux=False, order=1,
+               interp='no', unit_pos=u.deg, unit_inc=u.arcsec, antialias=True,
+               inplace=False, cutoff=0.25, window="blackman", workers=None):
+        """Resample the images of the cube to select their angular resolution,
+        to specify the position of the sky in the image arrays, and optionally
+        to reflect one or more of their axes.
+
+        This gives the same result as `mpdaf.obj.Image.regrid` applied to
+        each image of the cube, but the resampling transform, the
+        anti-aliasing filter and the interpolation weights are computed only
+        once and reused for all the images, which are processed by a pool of
+        threads.
+
+        Parameters
+        ----------
+        newdim : int or (int,int)
+            The desired new dimensions. Python notation: (ny,nx)
+        refpos : (float, float)
+            The sky position (dec,ra) to place at the pixel specified
+            by the refpix argument.
+        refpix : (float, float)
+            The [Y, X] indexes of the output pixel where the sky
+            position, refpos, should be placed.
+        newinc : float or (float, float)
+            The signed increments of the angle on the sky from one
+            pixel to the next, given as either a single increment for
+            both image axes, or two numbers (dy,dx) for the Y and X
+            axes respectively.
+        flux : bool
+            This tells the function whether the pixel units of the
+            cube are flux densities (flux=True), or per-steradian
+            brightness units (flux=False).
+        order : int
+            The order of the spline interpolation (1 by default).
+        interp : 'no' | 'linear' | 'spline'
+            How the masked values of each image are replaced before the
+            resampling, see `mpdaf.obj.Image.regrid`.
+        unit_pos : `astropy.units.Unit`
+            The units of the refpos coordinates.  Degrees by default.
+        unit_inc : `astropy.units.Unit`
+            The units of newinc.  Arcseconds by default.
+        antialias : bool
+            If True (the default), a low pass filter is applied to the
+            images before their resolution is reduced.
+        inplace : bool
+            If False, return a resampled copy of the cube (the default).
+            If True, resample the original cube in-place, and return that.
+        cutoff : float
+            Mask each output pixel where at least this fraction of the
+            pixel was interpolated from dummy values given to masked
+            input pixels.
+        window : str
+            The type of window function to use for antialiasing,
+            see `mpdaf.obj.Image.regrid`.
+        workers : int
+            Number of threads, defaults to the number of CPUs (or
+            ``mpdaf.CPU``).
+
+        Returns
+        -------
+        out : `~mpdaf.obj.Cube`
+
+        """
+        template = self._get_spatial_template()
+        plan = template._get_regrid_plan(
+            newdim, refpos, refpix, newinc, flux=flux, order=order,
+            unit_pos=unit_pos, unit_inc=unit_inc, antialias=antialias,
+            window=window)
+        return self._resample_images([(plan, None)], interp=interp,
+                                     cutoff=cutoff, inplace=inplace,
+                                     workers=workers)
+
+    def align_with_image(self, other, flux=False, inplace=False, cutoff=0.25,
+                         antialias=True, window="blackman", workers=None):
+        """Resample the images of the cube to give them the same orientation,
+        position, resolution and size as a given image.
+
+        This gives the same result as `mpdaf.obj.Image.align_with_image`
+        applied to each image of the cube, but the rotation and the
+        resampling transforms, the anti-aliasing filter and the
+        interpolation weights are computed only once and reused for all the
+        images, which are processed by a pool of threads. As with
+        `mpdaf.obj.Image.align_with_image`, the masked margins of each
+        rotated image are cropped before the resampling, so the resampling
+        transforms are computed once for each distinct crop.
+
+        Parameters
+        ----------
+        other : `~mpdaf.obj.Image`
+            The image to be aligned with.
+        flux : bool
+            This tells the function whether the pixel units of the
+            cube are flux densities (flux=True), or per-steradian
+            brightness units (flux=False).
+        inplace : bool
+            If False, return an aligned copy of the cube (the default).
+            If True, align the original cube in-place, and return that.
+        cutoff : float
+            Mask each output pixel where at least this fraction of the
+            pixel was interpolated from dummy values given to masked
+            input pixels.
+        antialias : bool
+            If True (the default), a low pass filter is applied to the
+            images before their resolution is reduced.
+        window : str
+            The type of window function to use for antialiasing,
+            see `mpdaf.obj.Image.align_with_image`.
+        workers : int
+            Number of threads, defaults to the number of CPUs (or
+            ``mpdaf.CPU``).
+
+        Returns
+        -------
+        out : `~mpdaf.obj.Cube`
+
+        """
+        # Do nothing if the images are already aligned.
+        if self.wcs.isEqual(other.wcs):
+            return self if inplace else self.copy()
+
+        # Determine the ranges of right-ascension and declination
+        # covered by the target image grid plus an extra pixel at
+        # each edge.
+        pixsky = other.wcs.pix2sky([[-1, -1],
+                                    [other.shape[0], -1],
+                                    [-1, other.shape[1]],
+                                    [other.shape[0], other.shape[1]]],
+                                   unit=u.deg)
+        dec_min, ra_min = pixsky.min(axis=0)
+        dec_max, ra_max = pixsky.max(axis=0)
+
+        # The transforms are computed with an image that has the world
+        # coordinates of the cube, by going through the same steps as
+        # Image.align_with_image: truncate the image to just enclose the
+        # above ranges of right-ascension and declination, rotate it to
+        # have the same orientation as the other image, and resample it.
+        template = self._get_spatial_template()
+        item = template._get_truncate_slices(dec_min, dec_max, ra_min, ra_max,
+                                             unit=u.deg)
+        template = template[item]
+        rotate_plan = template._get_rotate_plan(
+            other.wcs.get_rot() - template.wcs.get_rot(), reshape=True,
+            regrid=True, flux=flux)
+
+        centerpix = np.asarray(other.shape) / 2.0
+        centersky = other.wcs.pix2sky(centerpix)[0]
+        newinc = other.wcs.get_axis_increments(unit=u.deg)
+        regrid_plans = {}
+
+        def get_stages(mask):
+            # The rotated images are cropped to remove their masked margins,
+            # which depend on the mask of each image, and the resampling
+            # transforms depend on this crop.
+            rotated = Image(wcs=rotate_plan.wcs.copy(),
+                            data=np.zeros(rotate_plan.outshape),
+                            mask=rotate_plan.apply_mask(mask, cutoff=cutoff),
+                            copy=False)
+            crop = None if rotated._mask.all() else rotated.crop()
+            key = None if crop is None else tuple((s.start, s.stop)
+                                                  for s in crop)
+            if key not in regrid_plans:
+                regrid_plans[key] = rotated._get_regrid_plan(
+                    other.shape, centersky, centerpix, newinc, flux=flux,
+                    unit_inc=u.deg, antialias=antialias, window=window)
+            return [(rotate_plan, crop), (regrid_plans[key], None)]
+
+        return self._resample_images(get_stages, item=item, cutoff=cutoff,
+                                     inplace=inplace, workers=workers)
+
+    def _get_spatial_template(self):
+        """Return an image with the world coordinates of the cube, which is
+        used to compute the transforms that are applied to all the
+        images."""
+        return Image(wcs=self.wcs.copy(), data=np.zeros(self.shape[1:]),
+                     copy=False)
+
+    def _resample_images(self, stages, item=None, interp='no',
+                         cutoff=0.25, inplace=False, workers=None):
+        """Apply a sequence of resampling plans to all the images of the
+        cube.
+
+        Parameters
+        ----------
+        stages : list of (`mpdaf.obj.image._ResamplingPlan`, slices)
+            The plans and the slices used to crop the images after each
+            plan, or None. This can also be a function that returns this
+            list for the mask of an image (after the truncation), when the
+            plans depend on the mask. The world coordinates of the
+            resampled images are those of the last plan.
+        item : (slice, slice)
+            The slices used to truncate the images before the resampling.
+
+        """
+        item = (slice(None), ) + (item or ())
+        data = self._data[item]
+        var = None if self._var is None else self._var[item]
+        if self._mask is ma.nomask:
+            masks = np.zeros((1, ) + data.shape[1:], dtype=bool)
+            keys = [0] * data.shape[0]
+        else:
+            masks = self._mask[item]
+            keys = [hashlib.sha1(np.ascontiguousarray(mask)).digest()
+                    for mask in masks]
+
+        # The images usually share a few different masks, which are
+        # resampled only once.
+        first = {}
+        for k, key in enumerate(keys):
+            first.setdefault(key, k)
+
+        chains = {key: stages(masks[k]) if callable(stages) else stages
+                  for key, k in first.items()}
+        for chain in chains.values():
+            for plan, _ in chain:
+                plan.precompute()
+
+        def resample_mask(k):
+            # Resample the mask of the k-th image, and return the mask
+            # before each plan and the final mask.
+            mask = masks[k]
+            res = [mask]
+            for plan, crop in chains[keys[k]]:
+                mask = plan.apply_mask(mask, cutoff=cutoff)
+                if crop is not None:
+                    mask = mask[crop]
+                res.append(mask)
+            return res
+
+        def resample_image(k):
+            chain = resampled_masks[keys[k]]
+            ima = data[k]
+            imavar = None if var is None else var[k]
+            for (plan, crop), mask in zip(chains[keys[k]], chain):
+                ima = _prepare_image_data(ima, mask, interp)
+                ima, imavar = plan.apply_data(ima, imavar)
+                if crop is not None:
+                    ima = ima[crop]
+                    if imavar is not None:
+                        imavar = imavar[crop]
+            return ima, chain[-1], imavar
+
+        with ThreadPoolExecutor(max_workers=get_workers(workers)) as executor:
+            resampled_masks = dict(zip(first.keys(),
+                                       executor.map(resample_mask,
+                                                    first.values())))
+            results = executor.map(resample_image, range(data.shape[0]))
+            for k, (ima, mask, imavar) in enumerate(results):
+                if k == 0:
+                    shape = (data.shape[0], ) + ima.shape
+                    newdata = np.empty(shape, dtype=ima.dtype)
+                    newmask = np.empty(shape, dtype=bool)
+                    newvar = (None if imavar is None else
+                              np.empty(shape, dtype=imavar.dtype))
+                newdata[k] = ima
+                newmask[k] = mask
+                if newvar is not None:
+                    newvar[k] = imavar
+
+        out = self if inplace else self.clone()
+        out._data = newdata
+        out._mask = newmask
+        out._var = newvar
+        out.wcs = chains[keys[0]][-1][0].wcs
+        return out
+
     def loop_spe_multiprocessing(self, f, cpu=None, verbose=True, **kargs):
         """Use multiple processes to run a function on each spectrum of a cube.
 
@@ -2070,7 +2338,7 @@ class Cube(ArithmeticMixin, DataArray):
         """
         return self._convolve(signal.convolve, other=other, inplace=inplace)
 
-    def fftconvolve(self, other, inplace=False):
+    def fftconvolve(self, other, inplace=False, spatial=False, workers=None):
         """Convolve a Cube with a 3D array or another Cube, using the
         Fourier convolution theorem.
 
@@ -2094,20 +2362,27 @@ class Cube(ArithmeticMixin, DataArray):
         The speed of this function scales as O(Nd x log(Nd)) where
         Nd=self.data.size.  It temporarily allocates a pair of arrays that
         have the sum of the shapes of self.shape and other.shape, rounded up
-        to a power of two along each axis. This can involve a lot of memory
-        being allocated. For this reason, when other.shape is small,
-        Cube.convolve() may be more efficient than Cube.fftconvolve().
+        to a size that is efficient for the FFT along each axis. This can
+        involve a lot of memory being allocated. For this reason, when
+        other.shape is small, Cube.convolve() may be more efficient than
+        Cube.fftconvolve().
 
-        Uses `scipy.signal.fftconvolve`.
+        The transforms are computed with `scipy.fft`, and the transforms of
+        ``other`` and ``other**2`` are cached. For a spatial convolution, the
+        images are processed by batches, and the transform of a kernel
+        shared by all the images is computed only once.
 
         Parameters
         ----------
-        other : Cube or numpy.ndarray
+        other : Cube, Image or numpy.ndarray
             The 3D array with which to convolve the cube in self.data.
             This array can be the same size as self, or it can be a
             smaller array, such as a small 3D gaussian to use to
             smooth the larger cube.
 
+            If ``other`` is a 2D array or an Image, each image of the cube
+            is convolved with it (spatial convolution).
+
             When ``other`` contains a symmetric filtering function, such as a
             3-dimensional gaussian, the center of the function should be
             placed at the center of pixel:
@@ -2120,13 +2395,512 @@ class Cube(ArithmeticMixin, DataArray):
         inplace : bool
             If False (the default), return the results in a new Cube.
             If True, record the result in self and return that.
+        spatial : bool
+            If True, only the spatial axes are convolved, i.e. each image of
+            the cube is convolved with the corresponding image of ``other``.
+            ``other`` must then contain one image per wavelength (e.g. a PSF
+            that depends on the wavelength), or a single image.
+        workers : int
+            Number of threads used for the Fourier transforms. By default,
+            use the number of CPUs (see `mpdaf.tools.get_workers`).
 
         Returns
         -------
         `~mpdaf.obj.Cube`
 
         """
-        return self._convolve(signal.fftconvolve, other=other, inplace=inplace)
+        if isinstance(other, DataArray):
+            other = other.data
+        if other.ndim == 2:
+            other = other[np.newaxis]
+            spatial = True
+
+        if spatial:
+            if other.ndim != 3 or other.shape[0] not in (1, self.shape[0]):
+                raise ValueError('other must contain a single image or one '
+                                 'image per wavelength of the cube')
+            func = partial(_fftconvolve, axes=(1, 2), workers=workers)
+        else:
+            func = partial(_fftconvolve, workers=workers)
+        return self._convolve(func, other=other, inplace=inplace)
+
+    def resample(self, step, start=None, shape=None, unit=u.angstrom,
+                 inplace=False, atten=40.0, cutoff=0.25, workers=None):
+        """Resample the spectra of the cube to have a different wavelength
+        interval.
+
+        This gives the same results as `Spectrum.resample` applied to each
+        spectrum of the cube, but the decimation filter and the linear
+        interpolation are applied to blocks of spectra at once, and written
+        directly in the arrays of the output cube. The kernel of the
+        decimation filter and its Fourier transform are computed only once.
+
+        Parameters
+        ----------
+        step : float
+            The new pixel size along the wavelength axis of the cube.
+        start : float
+            The wavelength at the center of the first pixel of the resampled
+            cube.  If None (the default) the center of the first pixel
+            has the same wavelength before and after resampling.
+        shape : int
+            The number of spectral pixels of the new cube. If this is not
+            specified, the shape is selected to encompass the wavelength
+            range from the chosen start wavelength to the ending wavelength
+            of the input cube.
+        unit : `astropy.units.Unit`
+            The wavelength units of the step and start arguments.
+            The default is u.angstrom.
+        inplace : bool
+            If False, return a resampled copy of the cube (the default).
+            If True, resample the original cube in-place, and return that.
+        atten : float
+            The minimum attenuation (dB), of the antialiasing
+            decimation filter at the Nyquist folding frequency of the
+            new pixel size. The default attenuation is 40.0 dB. To disable
+            antialiasing, specify atten=0.0.
+        cutoff : float
+            Mask each output pixel of which at least this fraction of the
+            pixel was interpolated from masked input pixels.
+        workers : int
+            Number of threads used for the Fourier transforms of the
+            decimation filter. By default, use the number of CPUs (see
+            `mpdaf.tools.get_workers`).
+
+        Returns
+        -------
+        out : `~mpdaf.obj.Cube`
+
+        """
+        # Don't allow the cube to be started beyond the far end of the
+        # wavelength range, because this would result in an empty cube.
+        if start is not None and start > self.wave.get_end(unit):
+            raise ValueError('The start value is past the end of the '
+                             'wavelength range')
+
+        # Get wavelength world coordinates of the output cube.
+        newwave = self.wave.resample(step, start, unit)
+        if shape is not None:
+            newwave.shape = shape
+        oldstep = self.wave.get_step(unit)
+
+        # Filter and interpolate the spectra by blocks of rows of spaxels,
+        # to bound the size of the temporary arrays.
+        xi = self.wave.coord()
+        xo = newwave.coord()
+        newshape = (newwave.shape, ) + self.shape[1:]
+        data = np.empty(newshape)
+        var = None if self._var is None else np.empty(newshape)
+        mask = np.empty(newshape, dtype=bool)
+        nrows = 2 ** 22 // (max(self.shape[0], newshape[0]) * self.shape[2])
+        for sl in chunk_slices(self.shape[1], nrows):
+            cube = self.data[:, sl]
+            data[:, sl], v, mask[:, sl] = _resample_decimate(
+                xi, xo, cube.filled(0.0),
+                None if var is None else self.var[:, sl].filled(0.0),
+                ma.getmaskarray(cube), oldstep, step, atten, cutoff,
+                workers=workers)
+            if var is not None:
+                var[:, sl] = v
+
+        out = self if inplace else self.clone()
+        out._data = data
+        out._var = var
+        out._mask = mask
+        out.wave = newwave
+        return out
+
+    def LSF_convolve(self, lsf, size, inplace=False, **kwargs):
+        """Convolve all the spectra of the cube with a LSF.
+
+        This gives the same results as `Spectrum.LSF_convolve` applied to
+        each spectrum of the cube, but the convolution operator is computed
+        once (and kept in cache, see ``mpdaf.obj.spectrum.LSF_CACHE_SIZE``)
+        and applied to all the spectra with a single sparse matrix product.
+        The variances are convolved by the square of the LSF.
+
+        Parameters
+        ----------
+        lsf : python function
+            `mpdaf.MUSE.LSF` object or function f describing the LSF.
+
+            The first three parameters of the function f must be lbda
+            (wavelength value in A), step (in A) and size (odd integer).
+
+            f returns an np.array with shape=2*(size/2)+1 and centered in lbda
+        size : odd int
+            size of LSF in pixels.
+        inplace : bool
+            If False, return a convolved copy of the cube (the default).
+            If True, convolve the original cube in-place, and return that.
+        kwargs : kwargs
+            it can be used to set function arguments.
+
+        Returns
+        -------
+        out : `~mpdaf.obj.Cube`
+
+        """
+        out = self if inplace else self.copy()
+        op, op2 = _lsf_operator(lsf, self.wave, size, kwargs)
+        nl = self.shape[0]
+        out._data = op.dot(out._data.reshape(nl, -1)).reshape(self.shape)
+        if out._var is not None:
+            out._var = op2.dot(out._var.reshape(nl, -1)).reshape(self.shape)
+        return out
+
+    def poly_spec(self, deg, weight=True, maxiter=0, nsig=(-3.0, 3.0),
+                  workers=None):
+        """Return a cube containing a polynomial fit of each spectrum, for
+        example to model the continuum.
+
+        This gives the same results as `Spectrum.poly_spec` applied to each
+        spectrum of the cube, but the least-squares problems of blocks of
+        spectra are solved at once, in parallel threads.
+
+        Parameters
+        ----------
+        deg : int
+            Polynomial degree.
+        weight : bool
+            If weight is True, the weight is computed as the inverse of
+            variance.
+        maxiter : int
+            Maximum allowed iterations (0)
+        nsig : (float,float)
+            The low and high rejection factor in std units (-3.0,3.0)
+        workers : int
+            Number of threads. By default, use the number of CPUs (see
+            `mpdaf.tools.get_workers`).
+
+        Returns
+        -------
+        out : `~mpdaf.obj.Cube`
+            The polynomials, masked for the spectra with too few valid
+            pixels.
+
+        """
+        if self.shape[0] <= deg + 1:
+            raise ValueError('Too few points to perform polynomial fit')
+        x = self.wave.coord()
+        var = self._var if weight else None
+        data = _map_spectra(
+            lambda d, m, v: _poly_continuum(x, d, m, v, deg, maxiter, nsig),
+            (self._data, ma.getmaskarray(self.data), var), workers=workers)
+        res = self.clone()
+        res._data = data
+        res._mask = ~np.isfinite(data)
+        return res
+
+    def median_filter(self, kernel_size=1., unit=u.angstrom, inplace=False,
+                      workers=None):
+        """Perform a median filter on all the spectra of the cube, for
+        example to model the continuum.
+
+        This gives the same results as `Spectrum.median_filter` applied to
+        each spectrum of the cube (the masked values are linearly
+        interpolated), but blocks of spectra are filtered at once with
+        `scipy.ndimage.median_filter`, in parallel threads.
+
+        Parameters
+        ----------
+        kernel_size : float
+            Size of the median filter window.
+        unit : `astropy.units.Unit`
+            unit ot the kernel size
+        inplace : bool
+            If False, return a filtered copy of the cube (the default).
+            If True, filter the original cube in-place, and return that.
+        workers : int
+            Number of threads. By default, use the number of CPUs (see
+            `mpdaf.tools.get_workers`).
+
+        Returns
+        -------
+        out : `~mpdaf.obj.Cube`
+
+        """
+        res = self if inplace else self.copy()
+        if unit is not None:
+            kernel_size = kernel_size / res.wave.get_step(unit=unit)
+        ks = int(kernel_size / 2) * 2 + 1
+        x = res.wave.coord()
+        res._data = _map_spectra(
+            lambda d, m: _median_continuum(_interp_masked(x, d, m), ks),
+            (res._data, ma.getmaskarray(res.data)), workers=workers)
+        res._var = None
+        return res
+
+    def wavelet_filter(self, levels=9, sigmaCutoff=5.0, epsilon=0.05,
+                       inplace=False, workers=None):
+        """Perform a wavelet filtering on all the spectra of the cube.
+
+        This applies the filter of `Spectrum.wavelet_filter` to each spectrum
+        of the cube, using the variances as noise estimates, on blocks of
+        spectra processed in parallel threads.
+
+        Parameters
+        ----------
+        levels : int
+            Highest  scale level.
+        sigmaCutoff : float
+            Cleaning threshold.
+            By default 5 for a 5 sigma cleaning in wavelet space.
+        epsilon : float in ]0,1[
+            Residual criterion used to perform the cleaning
+        inplace : bool
+            If False, return a filtered copy of the cube (the default).
+            If True, filter the original cube in-place, and return that.
+        workers : int
+            Number of threads. By default, use the number of CPUs (see
+            `mpdaf.tools.get_workers`).
+
+        Returns
+        -------
+        out : `~mpdaf.obj.Cube`
+
+        """
+        if self._var is None:
+            raise ValueError('The wavelet filter requires the variances')
+        res = self if inplace else self.copy()
+        res._data = _map_spectra(
+            lambda d, v: _wavelet_continuum(d, np.sqrt(v), levels,
+                                            sigmaCutoff, epsilon),
+            (res._data, res._var), workers=workers)
+        res._var = None
+        return res
+
+    def gauss_fit_maps(self, lmin, lmax, kind='single', lpeak=None,
+                       fwhm=None, cont=None, wratio=None, fratio=1.,
+                       fix_lpeak=False, weight=True, mask=None,
+                       unit=u.angstrom, maxiter=100, workers=None):
+        """Fit a line profile on all the spectra of the cube, and return
+        maps of the fitted parameters.
+
+        The models are the ones of `mpdaf.obj.Spectrum.gauss_fit`
+        (``kind='single'``), `mpdaf.obj.Spectrum.gauss_dfit`
+        (``kind='double'``) and `mpdaf.obj.Spectrum.gauss_asymfit`
+        (``kind='asym'``), but all the spectra are fitted at once, on the same
+        wavelength window, with a vectorized Levenberg-Marquardt algorithm
+        using the analytic derivatives of the models. The spectra are split
+        in blocks that are fitted in parallel threads. This is much faster
+        than fitting each spectrum with `Cube.loop_spe_multiprocessing`, for
+        example to make velocity and dispersion maps.
+
+        Masked pixels are ignored (they are not interpolated as done by the
+        Spectrum methods), and the continuum is estimated from the first and
+        last valid pixels of the window of each spectrum.
+
+        Parameters
+        ----------
+        lmin : float or (float,float)
+            Minimum wavelength value or wavelength range
+            used to initialize the gaussian left value.
+        lmax : float or (float,float)
+            Maximum wavelength or wavelength range
+            used to initialize the gaussian right value.
+        kind : str
+            'single', 'double' or 'asym'.
+        lpeak : float
+            Input gaussian center (of the first gaussian for the 'double'
+            kind). If None it is estimated in each spectrum with the
+            wavelength corresponding to the maximum value of the window.
+        fwhm : float
+            Input gaussian fwhm, if None it is estimated from the flux and
+            the peak value of each spectrum.
+        cont : float
+            Continuum value, if None it is estimated by the line through
+            points (max(lmin),mean(data[lmin])) and
+            (min(lmax),mean(data[lmax])).
+        wratio : float
+            Ratio between the two gaussian centers, required for the
+            'double' kind.
+        fratio : float
+            Initial ratio between the two integrated gaussian fluxes of the
+            'double' kind.
+        fix_lpeak : bool
+            If True, the center of the 'single' gaussian is fixed to lpeak.
+        weight : bool
+            If weight is True, the weight is computed as the inverse of
+            variance.
+        mask : array of bool or `~mpdaf.obj.Image`
+            Spaxels that are not fitted (True or masked values).
+        unit : `astropy.units.Unit`
+            Type of the wavelength coordinates. If None, inputs are in pixels.
+        maxiter : int
+            The maximum number of iterations.
+        workers : int
+            Number of threads. By default, use the number of CPUs (see
+            `mpdaf.tools.get_workers`).
+
+        Returns
+        -------
+        out : dict of `~mpdaf.obj.Image`
+            Maps of the fitted parameters and of their errors (with the names
+            of the attributes of `mpdaf.obj.Gauss1D`, suffixed by ``_1`` and
+            ``_2`` for the 'double' kind and by ``_left`` and ``_right`` for
+            the 'asym' kind), of the continuum (``cont``), of the chi-square
+            (``chisq``) and of the convergence of the fits (``success``).
+            The spaxels that were not fitted are masked.
+
+        """
+        if kind not in ('single', 'double', 'asym'):
+            raise ValueError("kind must be 'single', 'double' or 'asym'")
+        if kind == 'double' and wratio is None:
+            raise ValueError('wratio is required to fit two gaussians')
+        single = kind == 'single'
+
+        def pixel(lbda):
+            if unit is None:
+                return int(lbda + 0.5)
+            return self.wave.pixel(lbda, nearest=True, unit=unit)
+
+        # Mean values of the continuum ranges, and limits of the window
+        # (with the conventions of the Spectrum methods).
+        nl = self.shape[0]
+        fmean = []
+        for i, lim in enumerate((lmin, lmax)):
+            if np.isscalar(lim):
+                fmean.append(None)
+                continue
+            lim = np.array(lim, dtype=float)
+            sub = self.data[max(0, pixel(lim[0])):min(nl, pixel(lim[1]) + 1)]
+            fmean.append(ma.filled(sub.mean(axis=0), np.nan).ravel())
+            if single:
+                lim = (lim[0] + lim[1]) / 2.
+            else:
+                lim = lim[1 - i]
+            if i == 0:
+                lmin = lim
+            else:
+                lmax = lim
+        imin = max(0, pixel(lmin))
+        imax = min(nl, pixel(lmax) + 1)
+        if imax - imin < 2:
+            raise ValueError('The wavelength window is too small')
+        if unit is None:
+            l = np.arange(imin, imax, dtype=float)
+        else:
+            l = self.wave.coord(unit=unit)[imin:imax]
+
+        # Spectra of the window, with one row per spaxel, and weights
+        npix = imax - imin
+        data = self.data[imin:imax].reshape(npix, -1).T
+        invalid = ma.getmaskarray(data) | ~np.isfinite(data.data)
+        if self._var is not None and weight:
+            var = self.var[imin:imax].reshape(npix, -1).T
+            invalid |= ma.getmaskarray(var) | ~np.isfinite(var.data)
+            with np.errstate(divide='ignore'):
+                wght = 1.0 / np.sqrt(np.abs(var.data))
+            invalid |= ~np.isfinite(wght)
+        else:
+            wght = np.ones(data.shape)
+
+        # Selection of the spaxels
+        free = np.ones(3 if single else 4, dtype=bool)
+        if single and fix_lpeak:
+            free[1] = False
+        selected = (~invalid).sum(axis=1) > free.sum()
+        if mask is not None:
+            if isinstance(mask, Image):
+                mask = mask.data
+            mask = ma.filled(ma.asarray(mask).astype(bool), True)
+            selected &= ~mask.ravel()
+        sel = np.flatnonzero(selected)
+        if sel.size == 0:
+            raise ValueError('No spectrum to fit in the wavelength window')
+        valid = ~invalid[sel]
+        values = np.where(valid, data.data[sel], 0.)
+        wght = np.where(valid, wght[sel], 0.)
+        nobj = sel.size
+        rows = np.arange(nobj)
+
+        # Continuum: line through the first and last valid pixels of the
+        # window, or through the mean values of the continuum ranges.
+        first = valid.argmax(axis=1)
+        last = npix - 1 - valid[:, ::-1].argmax(axis=1)
+        xa, xb = l[first], l[last]
+        fa, fb = values[rows, first], values[rows, last]
+        if fmean[0] is not None:
+            xa, fa = l[0], fmean[0][sel]
+        if fmean[1] is not None:
+            xb, fb = l[-1], fmean[1][sel]
+
+        def line(x):
+            # x is either an array of wavelengths per spaxel or (1, npix)
+            xa_, xb_, fa_, fb_ = (np.reshape(p, (-1, ) + (1, ) * (x.ndim - 1))
+                                  for p in (xa, xb, fa, fb))
+            return fa_ + (fb_ - fa_) * (x - xa_) / (xb_ - xa_)
+
+        # Initial guesses
+        if lpeak is None:
+            lpeak = l[np.where(valid, values, -np.inf).argmax(axis=1)]
+        else:
+            lpeak = np.full(nobj, lpeak, dtype=float)
+        if cont is not None:
+            cont = np.full(nobj, cont, dtype=float)
+            continuum = cont[:, None]
+        elif single:
+            continuum = line(l[None, :])
+        else:
+            cont = line(lpeak)
+            continuum = cont[:, None]
+        resid = np.where(valid, values - continuum, 0.)
+        ipeak = np.abs(l[None, :] - lpeak[:, None]).argmin(axis=1)
+        peak = resid[rows, ipeak]
+        if fwhm is None:
+            dl = np.abs(np.gradient(l))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                sigma = (resid * dl).sum(axis=1) / (peak * np.sqrt(2 * np.pi))
+            bad = ~(sigma > 0)
+            sigma = np.clip(sigma, dl.min(), np.abs(l[-1] - l[0]))
+            sigma[bad] = 2 * dl.min()
+        else:
+            sigma = np.full(nobj, fwhm * gaussian_fwhm_to_sigma)
+        flux = peak * np.sqrt(2 * np.pi) * sigma
+
+        if single:
+            v0 = np.column_stack([flux, lpeak, sigma])
+        elif kind == 'double':
+            v0 = np.column_stack([flux, lpeak, sigma, fratio * flux])
+        else:
+            v0 = np.column_stack([flux, lpeak, sigma, sigma])
+
+        def fit(sl):
+            return _fit_gauss1d_stack(l, resid[sl], wght[sl], v0[sl], kind,
+                                      wratio=wratio, free=free,
+                                      maxiter=maxiter)
+
+        res = _map_tiles(fit, chunk_slices(nobj, _LINE_FIT_CHUNK_SIZE),
+                         workers)
+        v, err, chisq, dof, success = [np.concatenate(r) for r in zip(*res)]
+
+        params = _gauss1d_params(kind, v, err, wratio=wratio)
+        if single and fix_lpeak:
+            params['err_lpeak'] = np.zeros(nobj)
+        params['cont'] = line(params['lpeak']) if cont is None else cont
+        params['chisq'] = chisq
+        params['success'] = success
+
+        # Maps of the parameters
+        wunit = u.dimensionless_unscaled if unit is None else unit
+        units = dict(lpeak=wunit, fwhm=wunit, flux=self.unit * wunit,
+                     peak=self.unit, cont=self.unit)
+        fitted = np.zeros(selected.size, dtype=bool)
+        fitted[sel] = True
+        fitted = fitted.reshape(self.shape[1:])
+        out = {}
+        for name, values in params.items():
+            key = name[4:] if name.startswith('err_') else name
+            key = key.split('_')[0]
+            data = np.zeros(selected.size, dtype=values.dtype)
+            data[sel] = values
+            out[name] = Image(wcs=self.wcs.copy(),
+                              data=data.reshape(self.shape[1:]),
+                              mask=~fitted,
+                              unit=units.get(key, u.dimensionless_unscaled),
+                              copy=False, dtype=None)
+        return out
 
     def spatial_erosion(self, npixels, inplace=False):
         """Remove n pixels around the masked white image.
@@ -2149,6 +2923,41 @@ class Cube(ArithmeticMixin, DataArray):
         return res
 
 
+def _map_spectra(func, arrays, workers=None):
+    """Apply a function to blocks of the spectra of cube arrays.
+
+    ``func`` is called with the blocks of spectra of each of the arrays of
+    shape (nl, ny, nx) (or None) given in ``arrays``, as arrays of shape
+    (nspec, nl), and returns an array of the same shape. The blocks, whose
+    size is bounded by ``_SPECTRA_BLOCK_BYTES``, are processed in threads.
+    The results are returned as an array of shape (nl, ny, nx).
+
+    """
+    shape = arrays[0].shape
+    nl = shape[0]
+    arrays = [None if a is None else a.reshape(nl, -1) for a in arrays]
+    nspec = arrays[0].shape[1]
+    out = np.empty((nl, nspec))
+
+    def process(sl):
+        out[:, sl] = func(*[None if a is None else a[:, sl].T
+                            for a in arrays]).T
+
+    blocksize = _SPECTRA_BLOCK_BYTES // (8 * nl)
+    _map_tiles(process, chunk_slices(nspec, blocksize), workers)
+    return out.reshape(shape)
+
+
+def _prepare_image_data(data, mask, interp='no'):
+    """Return a copy of an image array in which masked values have been
+    filled, as done by `mpdaf.obj.Image._prepare_data`."""
+    if interp == 'no':
+        data = ma.MaskedArray(data, mask=mask, copy=False)
+        return ma.filled(data, ma.median(data))
+    ima = Image(data=data, mask=mask, copy=False, dtype=None)
+    return ima._prepare_data(interp)
+
+
 def _is_method(func, cls):
     """Check if func is a method of cls.
 
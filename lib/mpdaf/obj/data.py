@@ -32,22 +32,141 @@ OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 
+import hashlib
 import logging
 import numpy as np
+import threading
 import warnings
 
 from astropy import units as u
 from astropy.io import fits
+from collections import OrderedDict
 from datetime import datetime
 from numpy import ma
+from scipy import fft as sp_fft, signal
 
 from .coords import WCS, WaveCoord, determine_refframe
 from .objs import UnitMaskedArray, UnitArray, is_int
 from ..tools import (MpdafUnitsWarning, fix_unit_read, is_valid_fits_file,
-                     copy_header, read_slice_from_fits)
+                     copy_header, read_slice_from_fits, chunk_slices,
+                     get_workers)
 
 __all__ = ('DataArray', )
 
+# Maximum number of kernel spectra kept in cache by the FFT convolutions,
+# and the cache itself. Spectra larger than KERNEL_CACHE_MAXBYTES are not
+# cached.
+KERNEL_CACHE_SIZE = 8
+KERNEL_CACHE_MAXBYTES = 2 ** 28
+_kernel_spectra = OrderedDict()
+_kernel_spectra_lock = threading.Lock()
+
+# Approximate size in bytes of the Fourier transforms computed at once when
+# the convolution is done by batches of planes.
+_FFT_BATCH_BYTES = 2 ** 26
+
+
+def _kernel_spectrum(kernel, fshape, axes, workers):
+    """Return the real Fourier transform of a kernel, padded to fshape.
+
+    The transforms are kept in a LRU cache, with a key computed from the
+    content of the kernel and the padded shape.
+    """
+    kernel = np.ascontiguousarray(kernel)
+    key = (hashlib.sha1(kernel.view(np.uint8)).hexdigest(), kernel.shape,
+           kernel.dtype.str, tuple(fshape), tuple(axes))
+
+    with _kernel_spectra_lock:
+        spec = _kernel_spectra.get(key)
+        if spec is not None:
+            _kernel_spectra.move_to_end(key)
+            return spec
+
+    spec = sp_fft.rfftn(kernel, fshape, axes=axes, workers=workers)
+    spec.flags.writeable = False
+    if spec.nbytes <= KERNEL_CACHE_MAXBYTES:
+        with _kernel_spectra_lock:
+            _kernel_spectra[key] = spec
+            while len(_kernel_spectra) > KERNEL_CACHE_SIZE:
+                _kernel_spectra.popitem(last=False)
+    return spec
+
+
+def _fftconvolve(in1, in2, mode='same', axes=None, workers=None):
+    """Convolve two arrays using the FFT, like `scipy.signal.fftconvolve`.
+
+    This gives the same results as `scipy.signal.fftconvolve` but the
+    transforms are computed with `scipy.fft` on several threads, the
+    spectrum of the kernel ``in2`` is cached (see ``KERNEL_CACHE_SIZE``) so
+    that convolving many arrays with the same kernel transforms it only
+    once, and when some axes are not convolved (see ``axes``), the array is
+    processed by batches along the first of these axes to bound the memory
+    usage. Along the axes that are not convolved, ``in2`` must have the
+    same length as ``in1``, or a length of 1.
+
+    Only the ``'same'`` mode with real arrays is handled here, the other
+    cases are passed to `scipy.signal.fftconvolve`.
+    """
+    in1 = np.asarray(in1)
+    in2 = np.asarray(in2)
+    if (mode != 'same' or in1.ndim != in2.ndim or in1.size == 0 or
+            in2.size == 0 or np.iscomplexobj(in1) or np.iscomplexobj(in2)):
+        return signal.fftconvolve(in1, in2, mode=mode, axes=axes)
+
+    ndim = in1.ndim
+    if axes is None:
+        axes = tuple(range(ndim))
+    else:
+        axes = tuple(sorted(set(ax % ndim for ax in np.atleast_1d(axes))))
+    loop_axes = [ax for ax in range(ndim) if ax not in axes]
+    for ax in loop_axes:
+        if in2.shape[ax] not in (1, in1.shape[ax]):
+            raise ValueError('incompatible shapes for in1 and in2: {} and {}'
+                             .format(in1.shape, in2.shape))
+
+    s1, s2 = in1.shape, in2.shape
+    fshape = [sp_fft.next_fast_len(s1[ax] + s2[ax] - 1, True) for ax in axes]
+    # slice of the full convolution that gives the 'same' output
+    crop = [slice(None)] * ndim
+    for ax in axes:
+        start = (s2[ax] - 1) // 2
+        crop[ax] = slice(start, start + s1[ax])
+    crop = tuple(crop)
+    workers = get_workers(workers)
+
+    def convolve(data, spec):
+        sp = sp_fft.rfftn(data, fshape, axes=axes, workers=workers)
+        sp *= spec
+        return sp_fft.irfftn(sp, fshape, axes=axes, workers=workers)[crop]
+
+    if not loop_axes:
+        return convolve(in1, _kernel_spectrum(in2, fshape, axes, workers))
+
+    # process the array by batches along the first axis that is not
+    # convolved
+    batch_axis = loop_axes[0]
+    out = None
+    spec = None
+    plane_bytes = 16 * np.prod(fshape[:-1]) * (fshape[-1] // 2 + 1) * \
+        in1.size // np.prod([s1[ax] for ax in axes]) // s1[batch_axis]
+    batch = max(1, _FFT_BATCH_BYTES // max(plane_bytes, 1))
+    for sl in chunk_slices(s1[batch_axis], batch):
+        item = (slice(None),) * batch_axis + (sl,)
+        if s2[batch_axis] == 1:
+            if spec is None:
+                spec = _kernel_spectrum(in2, fshape, axes, workers)
+            kspec = spec
+        else:
+            # kernel that changes along the batch axis (e.g. a PSF that
+            # depends on the wavelength), which is not cached
+            kspec = sp_fft.rfftn(in2[item], fshape, axes=axes,
+                                 workers=workers)
+        res = convolve(in1[item], kspec)
+        if out is None:
+            out = np.empty(s1, dtype=res.dtype)
+        out[item] = res
+    return out
+
 
 class LazyData:
 
@@ -32,8 +32,13 @@ OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 
 import logging
+import numpy as np
 
-__all__ = ('Gauss1D', 'Gauss2D', 'Moffat2D')
+from astropy.stats import gaussian_sigma_to_fwhm, gaussian_fwhm_to_sigma
+from numpy import ma
+
+__all__ = ('Gauss1D', 'Gauss2D', 'Moffat2D', 'Gauss2DArray', 'Moffat2DArray',
+           'fit_gauss2d_stack', 'fit_moffat2d_stack')
 
 
 class Gauss1D:
@@ -247,3 +252,765 @@ class Moffat2D:
         info('n = %g (error:%g)', self.n, self.err_n)
         info('rotation in degree: %g (error:%g)', self.rot, self.err_rot)
         info('continuum = %g (error:%g)', self.cont, self.err_cont)
+
+
+class _Fit2DArray:
+
+    """Base class of the parameters of a set of 2D profiles fitted at once.
+
+    Each attribute listed in ``_fields`` is an array whose first axis runs
+    over the objects, and indexing with an integer returns the equivalent
+    single-object instance of ``_item_class``.
+    """
+
+    _fields = ()
+    _item_class = None
+
+    def __init__(self, *args, success=None, chisq=None, dof=None):
+        for name, value in zip(self._fields, args):
+            setattr(self, name, np.asarray(value))
+        n = len(self)
+        self.success = (np.ones(n, dtype=bool) if success is None
+                        else np.asarray(success, dtype=bool))
+        self.chisq = (np.full(n, np.nan) if chisq is None
+                      else np.asarray(chisq, dtype=float))
+        self.dof = (np.zeros(n, dtype=int) if dof is None
+                    else np.asarray(dof, dtype=int))
+
+    def __len__(self):
+        return len(getattr(self, self._fields[1]))
+
+    def __getitem__(self, item):
+        if isinstance(item, (int, np.integer)):
+            return self._item_class(*[getattr(self, name)[item]
+                                      for name in self._fields])
+        return self.__class__(*[getattr(self, name)[item]
+                                for name in self._fields],
+                              success=self.success[item],
+                              chisq=self.chisq[item], dof=self.dof[item])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __repr__(self):
+        return '<{}({} objects)>'.format(self.__class__.__name__, len(self))
+
+
+class Gauss2DArray(_Fit2DArray):
+
+    """This class stores the parameters of several 2D gaussians.
+
+    The attributes are the same as for `~mpdaf.obj.Gauss2D`, but each one is
+    an array whose first axis runs over the fitted objects. ``arr[i]``
+    returns the `~mpdaf.obj.Gauss2D` object of the i-th object.
+
+    Attributes
+    ----------
+    center : array of shape (n, 2)
+        Gaussian centers (y,x).
+    flux : array of shape (n,)
+        Gaussian integrated fluxes.
+    fwhm : array of shape (n, 2)
+        Gaussian fwhm (fhwm_y,fwhm_x).
+    cont : array of shape (n,)
+        Continuum values.
+    rot : array of shape (n,)
+        Rotations in degrees.
+    peak : array of shape (n,)
+        Gaussian peak values.
+    err_center, err_flux, err_fwhm, err_cont, err_rot, err_peak : arrays
+        Estimated errors on the parameters above.
+    success : array of bool
+        False for the objects whose fit did not converge.
+    chisq : array of float
+        Weighted sum of the squared residuals.
+    dof : array of int
+        Number of fitted pixels minus the number of free parameters.
+
+    """
+
+    _fields = ('center', 'flux', 'fwhm', 'cont', 'rot', 'peak', 'err_center',
+               'err_flux', 'err_fwhm', 'err_cont', 'err_rot', 'err_peak')
+    _item_class = Gauss2D
+
+
+class Moffat2DArray(_Fit2DArray):
+
+    """This class stores the parameters of several 2D moffat profiles.
+
+    The attributes are the same as for `~mpdaf.obj.Moffat2D`, but each one
+    is an array whose first axis runs over the fitted objects. ``arr[i]``
+    returns the `~mpdaf.obj.Moffat2D` object of the i-th object.
+
+    Attributes
+    ----------
+    center : array of shape (n, 2)
+        peak centers (y,x).
+    flux : array of shape (n,)
+        integrated fluxes.
+    fwhm : array of shape (n, 2)
+        fwhm (fhwm_y,fwhm_x).
+    cont : array of shape (n,)
+        Continuum values.
+    n : array of shape (n,)
+        Atmospheric scattering coefficients.
+    rot : array of shape (n,)
+        Rotations in degrees.
+    peak : array of shape (n,)
+        intensity peak values.
+    err_center, err_flux, err_fwhm, err_cont, err_n, err_rot, err_peak : arrays
+        Estimated errors on the parameters above.
+    success : array of bool
+        False for the objects whose fit did not converge.
+    chisq : array of float
+        Weighted sum of the squared residuals.
+    dof : array of int
+        Number of fitted pixels minus the number of free parameters.
+
+    """
+
+    _fields = ('center', 'flux', 'fwhm', 'cont', 'n', 'rot', 'peak',
+               'err_center', 'err_flux', 'err_fwhm', 'err_cont', 'err_n',
+               'err_rot', 'err_peak')
+    _item_class = Moffat2D
+
+
+def _levenberg_marquardt(model, v0, free, data, wght, maxiter=100,
+                         ftol=1.49012e-08, xtol=1.49012e-08, gtol=1e-6):
+    """Minimize the weighted sums of squares of many independent problems.
+
+    All the problems share the same model function and the same number of
+    pixels, so that each Levenberg-Marquardt iteration is done with a few
+    array operations on the whole batch. Converged problems are removed
+    from the active set.
+
+    Parameters
+    ----------
+    model : callable
+        ``model(v)`` returns the model values, of shape (m, npix), and their
+        derivatives with respect to the parameters, of shape
+        (m, npix, npar), for a (m, npar) array of parameters.
+    v0 : array of shape (nobj, npar)
+        Initial parameters.
+    free : array of bool of shape (npar,)
+        Parameters that are fitted, the other ones are kept fixed.
+    data, wght : arrays of shape (nobj, npix)
+        Data values and weights (0 for the ignored pixels).
+    maxiter : int
+        Maximum number of iterations.
+    ftol, xtol : float
+        Relative tolerances on the sum of squares and on the parameters.
+    gtol : float
+        Tolerance on the cosine of the angle between the residuals and the
+        derivatives, used when the trial steps stop decreasing the sum of
+        squares.
+
+    Returns
+    -------
+    v : array of shape (nobj, npar)
+        Best parameters.
+    covar : array of shape (nobj, nfree, nfree)
+        Inverse of the curvature matrix, for the free parameters.
+    chisq : array of shape (nobj,)
+        Weighted sums of the squared residuals.
+    success : array of bool of shape (nobj,)
+        True where the convergence criteria were reached.
+
+    """
+    v = np.array(v0, dtype=float)
+    nobj = v.shape[0]
+
+    def evaluate(vv, idx):
+        f, jac = model(vv)
+        jac = jac[:, :, free] * wght[idx, :, None]
+        res = wght[idx] * (f - data[idx])
+        return res, jac
+
+    res, jac = evaluate(v, np.arange(nobj))
+    chisq = np.einsum('ij,ij->i', res, res)
+    lam = np.full(nobj, 1e-3)
+    success = np.zeros(nobj, dtype=bool)
+    active = np.isfinite(chisq)
+
+    for _ in range(max(int(maxiter), 1)):
+        idx = np.flatnonzero(active)
+        if idx.size == 0:
+            break
+        J = jac[idx]
+        alpha = np.einsum('nki,nkj->nij', J, J)
+        beta = np.einsum('nki,nk->ni', J, res[idx])
+        diag = np.einsum('nii->ni', alpha)
+        damped = alpha.copy()
+        damped[:, np.arange(diag.shape[1]), np.arange(diag.shape[1])] += \
+            lam[idx, None] * np.where(diag > 0, diag, 1.)
+        try:
+            step = -np.linalg.solve(damped, beta[..., None])[..., 0]
+        except np.linalg.LinAlgError:
+            step = -np.einsum('nij,nj->ni', np.linalg.pinv(damped), beta)
+
+        vnew = v[idx].copy()
+        vnew[:, free] += step
+        rnew, jnew = evaluate(vnew, idx)
+        cnew = np.einsum('ij,ij->i', rnew, rnew)
+        better = np.isfinite(cnew) & (cnew <= chisq[idx])
+
+        acc = idx[better]
+        small_f = (chisq[acc] - cnew[better]) <= ftol * cnew[better]
+        small_x = np.all(np.abs(step[better]) <=
+                         xtol * (np.abs(v[acc][:, free]) + xtol), axis=1)
+        v[acc] = vnew[better]
+        res[acc] = rnew[better]
+        jac[acc] = jnew[better]
+        chisq[acc] = cnew[better]
+        lam[acc] /= 10
+        lam[idx[~better]] *= 10
+
+        done = acc[small_f | small_x]
+        success[done] = True
+        active[done] = False
+        # The damping can not grow indefinitely. The minimum is reached
+        # within the numerical precision if the gradient vanishes, but not
+        # if the trial steps give non-finite sums of squares.
+        stuck = ~better & (lam[idx] > 1e16)
+        if np.any(stuck):
+            norm = np.sqrt(np.where(diag > 0, diag, 1.) * chisq[idx, None])
+            cos = np.divide(np.abs(beta), norm, out=np.zeros_like(beta),
+                            where=norm > 0)
+            flat = np.isfinite(cnew) & np.all(cos <= gtol, axis=1)
+            success[idx[stuck & flat]] = True
+            active[idx[stuck]] = False
+
+    alpha = np.einsum('nki,nkj->nij', jac, jac)
+    covar = np.linalg.pinv(alpha)
+    return v, covar, chisq, success
+
+
+def _fit_errors(covar, chisq, dof, free):
+    """Return the parameter errors scaled by the reduced chi-square."""
+    err = np.zeros((covar.shape[0], free.size))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scale = np.where(dof > 0, np.abs(chisq / dof), np.nan)
+    err[:, free] = np.sqrt(np.abs(np.einsum('nii->ni', covar))) * \
+        np.sqrt(scale)[:, None]
+    return err
+
+
+def _prepare_stack(data, var, weight):
+    """Return the flattened data, the weights and the pixel coordinates."""
+    data = ma.asarray(data, dtype=float)
+    if data.ndim == 2:
+        data = data[np.newaxis]
+    if data.ndim != 3:
+        raise ValueError('a 2D image or a stack of 2D images is required')
+    mask = ma.getmaskarray(data) | ~np.isfinite(data.data)
+    if var is not None and weight:
+        var = ma.asarray(var, dtype=float).reshape(data.shape)
+        mask |= ma.getmaskarray(var) | ~np.isfinite(var.data)
+        with np.errstate(divide='ignore'):
+            wght = 1.0 / np.sqrt(np.abs(var.data))
+    else:
+        wght = np.ones(data.shape)
+    wght[mask] = 0
+    npix = (~mask).reshape(len(data), -1).sum(axis=1)
+    if np.any(npix == 0):
+        raise ValueError('empty sub-image')
+    values = np.where(mask, 0., data.data)
+    p, q = np.indices(data.shape[1:], dtype=float)
+    return (values.reshape(len(data), -1), wght.reshape(len(data), -1),
+            p.ravel(), q.ravel(), npix, mask)
+
+
+def _initial_guesses(values, mask, shape, center, fwhm):
+    """Estimate the centers and fwhm (in pixels) of each image of a stack.
+
+    The estimates are the position of the maximum and the moments used by
+    `mpdaf.obj.Image.moments`.
+    """
+    nobj = values.shape[0]
+    ima = values.reshape((nobj,) + shape)
+    if center is None:
+        imax = np.where(mask, -np.inf, ima).reshape(nobj, -1).argmax(axis=1)
+        center = np.column_stack(np.unravel_index(imax, shape)).astype(float)
+    else:
+        center = np.broadcast_to(np.asarray(center, dtype=float),
+                                 (nobj, 2)).copy()
+
+    if fwhm is None:
+        absima = np.abs(ima)
+        total = absima.sum(axis=(1, 2))
+        P, Q = np.indices(shape)
+        i = np.arange(nobj)
+        p = np.argmax((Q * absima).sum(axis=2) / total[:, None], axis=1)
+        q = np.argmax((P * absima).sum(axis=1) / total[:, None], axis=1)
+        col = ima[i, p, :]
+        row = ima[i, :, q]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            width_q = np.sqrt(np.abs((np.arange(shape[1]) - p[:, None]) *
+                                     col).sum(axis=1) /
+                              np.abs(col).sum(axis=1))
+            width_p = np.sqrt(np.abs((np.arange(shape[0]) - q[:, None]) *
+                                     row).sum(axis=1) /
+                              np.abs(row).sum(axis=1))
+        fwhm = np.column_stack([width_p, width_q]) * gaussian_sigma_to_fwhm
+        fwhm[~(fwhm > 0)] = 1.
+    else:
+        fwhm = np.broadcast_to(np.asarray(fwhm, dtype=float),
+                               (nobj, 2)).copy()
+
+    # value of the image at the initial center
+    ip = np.clip(center[:, 0].astype(int), 0, shape[0] - 1)
+    iq = np.clip(center[:, 1].astype(int), 0, shape[1] - 1)
+    return center, fwhm, ima[np.arange(nobj), ip, iq]
+
+
+def _gauss2d_model(p, q, circular):
+    """Return the model function of a 2D gaussian and its derivatives.
+
+    The parameters are (flux, p_peak, q_peak, p_width, q_width, rot, cont),
+    with the same conventions as in `mpdaf.obj.Image.gauss_fit`. For a
+    circular gaussian the q_width parameter is tied to p_width.
+    """
+    def model(v):
+        flux, p0, q0, sp, sq, rot, cont = [x[:, None] for x in v.T]
+        if circular:
+            sq = sp
+        dp = p - p0
+        dq = q - q0
+        cost, sint = np.cos(rot), np.sin(rot)
+        u = dp * cost - dq * sint
+        w = dp * sint + dq * cost
+        norm = np.exp(-u ** 2 / (2 * sp ** 2) - w ** 2 / (2 * sq ** 2)) / \
+            (2 * np.pi * sp * sq)
+        g = flux * norm
+
+        jac = np.empty(g.shape + (7,))
+        jac[..., 0] = norm
+        jac[..., 1] = g * (u * cost / sp ** 2 + w * sint / sq ** 2)
+        jac[..., 2] = g * (w * cost / sq ** 2 - u * sint / sp ** 2)
+        jac[..., 3] = g * (u ** 2 / sp ** 3 - 1 / sp)
+        jac[..., 4] = g * (w ** 2 / sq ** 3 - 1 / sq)
+        jac[..., 5] = g * u * w * (1 / sp ** 2 - 1 / sq ** 2)
+        jac[..., 6] = 1.
+        if circular:
+            jac[..., 3] += jac[..., 4]
+            jac[..., 4] = 0
+        return cont + g, jac
+    return model
+
+
+def _moffat2d_model(p, q):
+    """Return the model function of a 2D moffat and its derivatives.
+
+    The parameters are (peak, p_peak, q_peak, a, n, e, rot, cont), with
+    the same conventions as in `mpdaf.obj.Image.moffat_fit`.
+    """
+    def model(v):
+        amp, p0, q0, a, n, e, rot, cont = [x[:, None] for x in v.T]
+        dp = p - p0
+        dq = q - q0
+        cost, sint = np.cos(rot), np.sin(rot)
+        u = dp * cost - dq * sint
+        w = dp * sint + dq * cost
+        a2 = a ** 2
+        ae2 = a2 * e ** 2
+        r1 = 1 + u ** 2 / a2 + w ** 2 / ae2
+        base = r1 ** (-n)
+        m = amp * base
+        dm_dr = -n * m / r1
+
+        jac = np.empty(m.shape + (8,))
+        jac[..., 0] = base
+        jac[..., 1] = dm_dr * (-2 * u * cost / a2 - 2 * w * sint / ae2)
+        jac[..., 2] = dm_dr * (2 * u * sint / a2 - 2 * w * cost / ae2)
+        jac[..., 3] = dm_dr * (-2 * (r1 - 1) / a)
+        jac[..., 4] = -m * np.log(r1)
+        jac[..., 5] = dm_dr * (-2 * w ** 2 / (ae2 * e))
+        jac[..., 6] = dm_dr * (2 * u * w / a2 * (1 / e ** 2 - 1))
+        jac[..., 7] = 1.
+        return cont + m, jac
+    return model
+
+
+def fit_gauss2d_stack(data, var=None, center=None, flux=None, fwhm=None,
+                      circular=False, cont=0, fit_back=True, rot=0,
+                      peak=False, weight=True, maxiter=100):
+    """Fit a 2D gaussian on each image of a stack, all at once.
+
+    All the fits are done simultaneously with a vectorized
+    Levenberg-Marquardt algorithm using the analytic derivatives of the
+    gaussian, which is much faster than calling
+    `mpdaf.obj.Image.gauss_fit` on each image (e.g. on cut-outs around many
+    stars or on the wavelength planes of a cube). The model is the same as
+    in `mpdaf.obj.Image.gauss_fit` (with ``factor=1``), and all the
+    coordinates and sizes are in pixels of the images.
+
+    Parameters
+    ----------
+    data : array or masked array of shape (n, ny, nx)
+        Stack of images. Masked and non-finite values are ignored.
+    var : array of shape (n, ny, nx)
+        Variances, used to weight the pixels if ``weight`` is True.
+    center : array of shape (2,) or (n, 2)
+        Initial gaussian centers (y_peak,x_peak) in pixels. If None, the
+        position of the maximum of each image is used.
+    flux : float or array of shape (n,)
+        Initial integrated gaussian fluxes or gaussian peak values if peak
+        is True. If None, the peak values are estimated.
+    fwhm : array of shape (2,) or (n, 2)
+        Initial gaussian fwhm (fwhm_y,fwhm_x) in pixels. If None, they are
+        estimated from the moments of the images.
+    circular : bool
+        True: circular gaussian, False: elliptical gaussian
+    cont : float or array of shape (n,)
+        continuum value, 0 by default.
+    fit_back : bool
+        False: continuum value is fixed,
+        True: continuum value is a fit parameter.
+    rot : float
+        Initial rotation in degree.
+        If None, rotation is fixed to 0.
+    peak : bool
+        If true, flux contains a gaussian peak value.
+    weight : bool
+        If weight is True, the weight is computed as the inverse of
+        variance.
+    maxiter : int
+        The maximum number of iterations.
+
+    Returns
+    -------
+    out : `mpdaf.obj.Gauss2DArray`
+        Parameters of the gaussians, in pixels.
+
+    """
+    values, wght, p, q, npix, mask = _prepare_stack(data, var, weight)
+    nobj = values.shape[0]
+    shape = mask.shape[1:]
+    center, fwhm, start = _initial_guesses(values, mask, shape, center, fwhm)
+
+    cont = np.broadcast_to(np.asarray(cont, dtype=float), (nobj,))
+    if flux is None:
+        amp = start - cont
+    elif peak is True:
+        amp = np.broadcast_to(np.asarray(flux, dtype=float), (nobj,)) - cont
+    else:
+        amp = None
+
+    width = fwhm * gaussian_fwhm_to_sigma
+    if amp is not None:
+        flux = amp * 2 * np.pi * width[:, 0] * width[:, 1]
+    flux = np.broadcast_to(np.asarray(flux, dtype=float), (nobj,))
+
+    fit_rot = rot is not None and not circular
+    rot = 0 if rot is None else np.pi * rot / 180.0
+    v0 = np.column_stack([flux, center[:, 0], center[:, 1], width[:, 0],
+                          width[:, 1], np.full(nobj, rot), cont])
+    if circular:
+        v0[:, 5] = 0
+    free = np.array([True, True, True, True, not circular, fit_rot,
+                     bool(fit_back)])
+
+    v, covar, chisq, success = _levenberg_marquardt(
+        _gauss2d_model(p, q, circular), v0, free, values, wght,
+        maxiter=maxiter)
+    dof = npix - free.sum()
+    err = _fit_errors(covar, chisq, dof, free)
+    if circular:
+        v[:, 4] = v[:, 3]
+        err[:, 4] = err[:, 3]
+
+    p_width = np.abs(v[:, 3])
+    q_width = np.abs(v[:, 4])
+    err_p_width = err[:, 3]
+    err_q_width = err[:, 4]
+    rot = np.zeros(nobj)
+    if fit_rot:
+        # the first fwhm is the major axis
+        swap = p_width < q_width
+        p_width, q_width = (np.where(swap, q_width, p_width),
+                            np.where(swap, p_width, q_width))
+        err_p_width, err_q_width = (np.where(swap, err_q_width, err_p_width),
+                                    np.where(swap, err_p_width, err_q_width))
+        rot = (v[:, 5] * 180.0 / np.pi + np.where(swap, 90, 0)) % 180
+
+    flux = v[:, 0]
+    peak = flux / (2 * np.pi * p_width * q_width)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        err_peak = np.abs(peak) * np.sqrt((err[:, 0] / flux) ** 2 +
+                                          (err_p_width / p_width) ** 2 +
+                                          (err_q_width / q_width) ** 2)
+
+    return Gauss2DArray(
+        v[:, 1:3], flux,
+        np.column_stack([p_width, q_width]) * gaussian_sigma_to_fwhm,
+        v[:, 6], rot, peak, err[:, 1:3], err[:, 0],
+        np.column_stack([err_p_width, err_q_width]) * gaussian_sigma_to_fwhm,
+        err[:, 6], err[:, 5] * 180.0 / np.pi, err_peak,
+        success=success, chisq=chisq, dof=dof)
+
+
+def fit_moffat2d_stack(data, var=None, center=None, flux=None, fwhm=None,
+                       n=2.0, circular=False, cont=0, fit_back=True, rot=0,
+                       peak=False, weight=True, fit_n=True, maxiter=100):
+    """Fit a 2D moffat on each image of a stack, all at once.
+
+    This is the equivalent of `mpdaf.obj.fit_gauss2d_stack` for the model
+    of `mpdaf.obj.Image.moffat_fit` (with ``factor=1``). All the coordinates
+    and sizes are in pixels of the images.
+
+    Parameters
+    ----------
+    data : array or masked array of shape (n, ny, nx)
+        Stack of images. Masked and non-finite values are ignored.
+    var : array of shape (n, ny, nx)
+        Variances, used to weight the pixels if ``weight`` is True.
+    center : array of shape (2,) or (n, 2)
+        Initial moffat centers (y_peak,x_peak) in pixels. If None, the
+        position of the maximum of each image is used.
+    flux : float or array of shape (n,)
+        Initial integrated fluxes or peak values if peak is True. If None,
+        the peak values are estimated.
+    fwhm : array of shape (2,) or (n, 2)
+        Initial fwhm (fwhm_y,fwhm_x) in pixels. If None, they are estimated
+        from the moments of the images.
+    n : float or array of shape (n,)
+        Initial atmospheric scattering coefficient.
+    circular : bool
+        True: circular moffat, False: elliptical moffat
+    cont : float or array of shape (n,)
+        continuum value, 0 by default.
+    fit_back : bool
+        False: continuum value is fixed,
+        True: continuum value is a fit parameter.
+    rot : float
+        Initial angle position in degree.
+        If None, rotation is fixed to 0.
+    peak : bool
+        If true, flux contains a peak value.
+    weight : bool
+        If weight is True, the weight is computed as the inverse of
+        variance.
+    fit_n : bool
+        False: n value is fixed,
+        True: n value is a fit parameter.
+    maxiter : int
+        The maximum number of iterations.
+
+    Returns
+    -------
+    out : `mpdaf.obj.Moffat2DArray`
+        Parameters of the moffat profiles, in pixels.
+
+    """
+    values, wght, p, q, npix, mask = _prepare_stack(data, var, weight)
+    nobj = values.shape[0]
+    shape = mask.shape[1:]
+    center, fwhm, start = _initial_guesses(values, mask, shape, center, fwhm)
+
+    cont = np.broadcast_to(np.asarray(cont, dtype=float), (nobj,))
+    n = np.broadcast_to(np.asarray(n, dtype=float), (nobj,))
+    a = fwhm[:, 0] / (2 * np.sqrt(2 ** (1.0 / n) - 1.0))
+    e = np.ones(nobj) if circular else fwhm[:, 0] / fwhm[:, 1]
+
+    if flux is None:
+        amp = start - cont
+    elif peak is True:
+        amp = np.asarray(flux, dtype=float) - cont
+    else:
+        amp = np.asarray(flux, dtype=float) * (n - 1) / (np.pi * a * a * e)
+    amp = np.broadcast_to(amp, (nobj,))
+
+    fit_rot = rot is not None and not circular
+    rot = 0 if rot is None or circular else np.pi * rot / 180.0
+    v0 = np.column_stack([amp, center[:, 0], center[:, 1], a, n, e,
+                          np.full(nobj, rot), cont])
+    free = np.array([True, True, True, True, bool(fit_n), not circular,
+                     fit_rot, bool(fit_back)])
+
+    v, covar, chisq, success = _levenberg_marquardt(
+        _moffat2d_model(p, q), v0, free, values, wght, maxiter=maxiter)
+    dof = npix - free.sum()
+    err = _fit_errors(covar, chisq, dof, free)
+
+    amp = v[:, 0]
+    a = np.abs(v[:, 3])
+    n = v[:, 4]
+    e = np.abs(v[:, 5])
+    coef = 2 * np.sqrt(2 ** (1.0 / n) - 1.0)
+    _fwhm = a * coef
+    err_fwhm = err[:, 3] * coef
+    fwhm = np.column_stack([_fwhm, _fwhm * e])
+    err_fwhm = np.column_stack([err_fwhm, np.hypot(err_fwhm * e,
+                                                   _fwhm * err[:, 5])])
+    rot = np.zeros(nobj)
+    if fit_rot:
+        # the first fwhm is the major axis
+        swap = e > 1
+        fwhm = np.where(swap[:, None], fwhm[:, ::-1], fwhm)
+        err_fwhm = np.where(swap[:, None], err_fwhm[:, ::-1], err_fwhm)
+        rot = (v[:, 6] * 180.0 / np.pi + np.where(swap, 90, 0)) % 180
+
+    flux = amp / (n - 1) * (np.pi * a * a * e)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        err_flux = np.abs(flux) * np.sqrt((err[:, 0] / amp) ** 2 +
+                                          (2 * err[:, 3] / a) ** 2 +
+                                          (err[:, 5] / e) ** 2 +
+                                          (err[:, 4] / (n - 1)) ** 2)
+
+    return Moffat2DArray(
+        v[:, 1:3], flux, fwhm, v[:, 7], n, rot, amp, err[:, 1:3], err_flux,
+        err_fwhm, err[:, 7], err[:, 4], err[:, 6] * 180.0 / np.pi, err[:, 0],
+        success=success, chisq=chisq, dof=dof)
+
+
+def _gauss1d_model(x, kind, wratio=1.0):
+    """Return the model function of a 1D line profile and its derivatives.
+
+    The continuum is not part of the model, it is subtracted from the data
+    beforehand. The parameters follow the models of
+    `mpdaf.obj.Spectrum.gauss_fit`, `~mpdaf.obj.Spectrum.gauss_dfit` and
+    `~mpdaf.obj.Spectrum.gauss_asymfit`:
+
+    - 'single': (flux, lpeak, sigma)
+    - 'double': (flux_1, lpeak_1, sigma, flux_2), the second gaussian is
+      centered on ``lpeak_1 * wratio``.
+    - 'asym': (flux, lpeak, sigma_right, sigma_left), where flux is the
+      flux of the right-hand side gaussian if it was full.
+
+    """
+    norm = 1 / np.sqrt(2 * np.pi)
+
+    def gauss(flux, center, sigma):
+        dx = x - center
+        e = norm / sigma * np.exp(-dx ** 2 / (2 * sigma ** 2))
+        return e, flux * e, dx
+
+    def model(v):
+        v = [p[:, None] for p in v.T]
+        if kind == 'single':
+            flux, lpeak, sigma = v
+            e, g, dx = gauss(flux, lpeak, sigma)
+            jac = np.empty(g.shape + (3,))
+            jac[..., 0] = e
+            jac[..., 1] = g * dx / sigma ** 2
+            jac[..., 2] = g * (dx ** 2 / sigma ** 3 - 1 / sigma)
+            return g, jac
+        elif kind == 'double':
+            flux1, lpeak, sigma, flux2 = v
+            e1, g1, dx1 = gauss(flux1, lpeak, sigma)
+            e2, g2, dx2 = gauss(flux2, lpeak * wratio, sigma)
+            jac = np.empty(g1.shape + (4,))
+            jac[..., 0] = e1
+            jac[..., 1] = (g1 * dx1 + g2 * dx2 * wratio) / sigma ** 2
+            jac[..., 2] = ((g1 * dx1 ** 2 + g2 * dx2 ** 2) / sigma ** 3 -
+                           (g1 + g2) / sigma)
+            jac[..., 3] = e2
+            return g1 + g2, jac
+        else:
+            flux, lpeak, sig_r, sig_l = v
+            right = x > lpeak
+            sigma = np.where(right, sig_r, sig_l)
+            dx = x - lpeak
+            e = norm / sig_r * np.exp(-dx ** 2 / (2 * sigma ** 2))
+            g = flux * e
+            jac = np.empty(g.shape + (4,))
+            jac[..., 0] = e
+            jac[..., 1] = g * dx / sigma ** 2
+            jac[..., 2] = np.where(right, g * dx ** 2 / sig_r ** 3, 0) - \
+                g / sig_r
+            jac[..., 3] = np.where(right, 0, g * dx ** 2 / sig_l ** 3)
+            return g, jac
+    return model
+
+
+def _fit_gauss1d_stack(x, data, wght, v0, kind, wratio=1.0, free=None,
+                       maxiter=100):
+    """Fit the same kind of line profile on many spectra at once.
+
+    Parameters
+    ----------
+    x : array of shape (npix,)
+        Wavelengths shared by all the spectra.
+    data, wght : arrays of shape (nobj, npix)
+        Continuum subtracted data and weights (0 for the ignored pixels).
+    v0 : array of shape (nobj, npar)
+        Initial parameters (see `_gauss1d_model`).
+    kind : str
+        'single', 'double' or 'asym'.
+    wratio : float
+        Ratio between the centers of the two gaussians of the 'double' kind.
+    free : array of bool of shape (npar,)
+        Fitted parameters, all of them by default.
+    maxiter : int
+        The maximum number of iterations.
+
+    Returns
+    -------
+    v, err : arrays of shape (nobj, npar)
+        Best parameters and their errors, scaled by the reduced chi-square.
+    chisq : array of shape (nobj,)
+        Weighted sums of the squared residuals.
+    dof : array of shape (nobj,)
+        Number of fitted pixels minus the number of free parameters.
+    success : array of bool of shape (nobj,)
+        True where the fit converged.
+
+    """
+    if free is None:
+        free = np.ones(v0.shape[1], dtype=bool)
+    v, covar, chisq, success = _levenberg_marquardt(
+        _gauss1d_model(x, kind, wratio), v0, free, data, wght,
+        maxiter=maxiter)
+    dof = np.count_nonzero(wght, axis=1) - free.sum()
+    err = _fit_errors(covar, chisq, dof, free)
+    return v, err, chisq, dof, success
+
+
+def _gauss1d_params(kind, v, err, wratio=1.0):
+    """Return the line parameters derived from the fitted values of
+    `_fit_gauss1d_stack`, with the conventions of `mpdaf.obj.Gauss1D`."""
+    def peak_error(flux, sigma, err_flux, err_sigma):
+        return np.abs(1. / np.sqrt(2 * np.pi) *
+                      (err_flux * sigma - flux * err_sigma) / sigma / sigma)
+
+    if kind == 'single':
+        flux, lpeak, sigma = v[:, 0], v[:, 1], np.abs(v[:, 2])
+        return dict(
+            lpeak=lpeak, err_lpeak=err[:, 1],
+            flux=flux, err_flux=err[:, 0],
+            fwhm=sigma * gaussian_sigma_to_fwhm,
+            err_fwhm=err[:, 2] * gaussian_sigma_to_fwhm,
+            peak=flux / np.sqrt(2 * np.pi * sigma ** 2),
+            err_peak=peak_error(flux, sigma, err[:, 0], err[:, 2]))
+    elif kind == 'double':
+        flux1, lpeak, sigma, flux2 = v.T
+        sigma = np.abs(sigma)
+        return dict(
+            lpeak_1=lpeak, err_lpeak_1=err[:, 1],
+            lpeak_2=lpeak * wratio, err_lpeak_2=err[:, 1] * wratio,
+            flux_1=flux1, err_flux_1=err[:, 0],
+            flux_2=flux2, err_flux_2=err[:, 3],
+            fwhm=sigma * gaussian_sigma_to_fwhm,
+            err_fwhm=err[:, 2] * gaussian_sigma_to_fwhm,
+            peak_1=flux1 / np.sqrt(2 * np.pi * sigma ** 2),
+            err_peak_1=peak_error(flux1, sigma, err[:, 0], err[:, 2]),
+            peak_2=flux2 / np.sqrt(2 * np.pi * sigma ** 2),
+            err_peak_2=peak_error(flux2, sigma, err[:, 3], err[:, 2]))
+    else:
+        sigma_right = np.abs(v[:, 2])
+        sigma_left = np.abs(v[:, 3])
+        flux_right = 0.5 * v[:, 0]
+        flux_left = flux_right * sigma_left / sigma_right
+        flux = flux_right + flux_left
+        return dict(
+            lpeak=v[:, 1], err_lpeak=err[:, 1],
+            flux=flux, err_flux=err[:, 0],
+            flux_left=flux_left, flux_right=flux_right,
+            err_flux_left=err[:, 0] / 2, err_flux_right=err[:, 0] / 2,
+            fwhm_left=sigma_left * gaussian_sigma_to_fwhm,
+            err_fwhm_left=err[:, 3] * gaussian_sigma_to_fwhm,
+            fwhm_right=sigma_right * gaussian_sigma_to_fwhm,
+            err_fwhm_right=err[:, 2] * gaussian_sigma_to_fwhm,
+            peak=flux_right / np.sqrt(2 * np.pi * sigma_right ** 2),
+            err_peak=peak_error(flux, sigma_right, err[:, 0], err[:, 2]))
@@ -39,24 +39,47 @@ OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 
 import numpy as np
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from numpy import ma
 
 import astropy.units as u
 from astropy.io import fits
 from astropy.stats import gaussian_sigma_to_fwhm, gaussian_fwhm_to_sigma
-from scipy import interpolate, signal
+from astropy.table import Table
+from scipy import interpolate, signal, sparse
 from scipy import ndimage as ndi
 from scipy.ndimage.interpolation import affine_transform
 from scipy.optimize import leastsq
+from scipy.sparse.csgraph import connected_components
 
 from .arithmetic import ArithmeticMixin
-from .coords import WCS
-from .data import DataArray
-from .fitting import Gauss2D, Moffat2D
-from .objs import is_int, is_number, bounding_box, UnitMaskedArray, UnitArray
+from .coords import WCS, _wcs_fingerprint
+from .data import DataArray, _fftconvolve
+from .fitting import (Gauss2D, Moffat2D, fit_gauss2d_stack,
+                      fit_moffat2d_stack)
+from .objs import (is_int, is_number, bounding_box, polygon_mask,
+                   UnitMaskedArray, UnitArray, _mask_outside)
 from .plot import FormatCoord, get_plot_norm
+from .psf import gauss_psf, moffat_psf
+from ..tools import clipped_stats, get_workers, sorted_clipped_stats
 
-__all__ = ('Image', 'gauss_image', 'moffat_image', 'SpatialFrequencyLimits')
+__all__ = ('Image', 'gauss_image', 'moffat_image', 'SpatialFrequencyLimits',
+           'RegridOperator', 'RadialProfile', 'estimate_coordinate_offsets')
+
+# Maximum number of regrid operators kept in cache by
+# Image.get_regrid_operator, and the cache itself.
+REGRID_CACHE_SIZE = 16
+_regrid_operators = OrderedDict()
+_regrid_operators_lock = threading.Lock()
+
+# Maximum number of radial-profile geometries kept in cache by
+# Image.radial_profile, and the cache itself.
+PROFILE_CACHE_SIZE = 16
+_profile_geometries = OrderedDict()
+_profile_geometries_lock = threading.Lock()
 
 
 class Image(ArithmeticMixin, DataArray):
@@ -460,24 +483,48 @@ class Image(ArithmeticMixin, DataArray):
 
         # Convert DEC,RA (deg) values coming from poly into Y,X value (pixels)
         if unit is not None:
-            poly = np.array([
-                [self.wcs.sky2pix((val[0], val[1]), unit=unit)[0][0],
-                 self.wcs.sky2pix((val[0], val[1]), unit=unit)[0][1]]
-                for val in poly])
-
-        b = np.mgrid[:self.shape[0], :self.shape[1]].reshape(2, -1).T
-
-        # Use a matplotlib method to create a polygon path and check if points
-        # are within the polygon. The ouput is a boolean table.
-        from matplotlib.path import Path
-        polymask = Path(poly)
-        c = polymask.contains_points(b)
-        if not inside:
-            c = ~c
-
-        self._mask |= c.reshape(self.shape)
+            poly = self.wcs.sky2pix(np.asarray(poly, dtype=float), unit=unit)
+
+        # The mask is modified in place, so it must be an array.
+        if self._mask is ma.nomask:
+            self._mask = np.zeros(self.shape, dtype=bool)
+
+        # Rasterize the polygon within its bounding box, and combine it with
+        # the current mask.
+        clipped, inpoly = polygon_mask(poly, self.shape)
+        sy, sx = clipped
+        if inside:
+            self._mask[sy, sx] |= inpoly
+        else:
+            _mask_outside(self._mask, clipped)
+            self._mask[sy, sx] |= ~inpoly
         return poly
 
+    def _get_truncate_slices(self, y_min, y_max, x_min, x_max, unit=u.deg):
+        """Return the slices of the smallest sub-image that contains a
+        region of the sky, see `truncate`."""
+
+        # Get the sky and pixel coordinates of the corners of the rectangular
+        # region that is bounded by x_min..x_max and y_min..y_max.
+        skycrd = np.array([[y_min, x_min],
+                           [y_min, x_max],
+                           [y_max, x_min],
+                           [y_max, x_max]])
+
+        if unit is not None:
+            pixcrd = self.wcs.sky2pix(skycrd, unit=unit)
+        else:
+            pixcrd = skycrd
+
+        # The sides of the selected region may not be parallel with the
+        # array axes. Determine the pixel bounds of a rectangular
+        # region of the array that contains the requested region.
+        imin = max(0, int(np.min(pixcrd[:, 0]) + 0.5))
+        imax = min(self.shape[0], int(np.max(pixcrd[:, 0]) + 0.5) + 1)
+        jmin = max(0, int(np.min(pixcrd[:, 1]) + 0.5))
+        jmax = min(self.shape[1], int(np.max(pixcrd[:, 1]) + 0.5) + 1)
+        return slice(imin, imax), slice(jmin, jmax)
+
     def truncate(self, y_min, y_max, x_min, x_max, mask=True, unit=u.deg,
                  inplace=False):
         """Return a sub-image that contains a specified area of the sky.
@@ -520,28 +567,9 @@ class Image(ArithmeticMixin, DataArray):
 
         """
 
-        # Get the sky and pixel coordinates of the corners of the rectangular
-        # region that is bounded by x_min..x_max and y_min..y_max.
-        skycrd = np.array([[y_min, x_min],
-                           [y_min, x_max],
-                           [y_max, x_min],
-                           [y_max, x_max]])
-
-        if unit is not None:
-            pixcrd = self.wcs.sky2pix(skycrd, unit=unit)
-        else:
-            pixcrd = skycrd
-
-        # The sides of the selected region may not be parallel with the
-        # array axes. Determine the pixel bounds of a rectangular
-        # region of the array that contains the requested region.
-        imin = max(0, int(np.min(pixcrd[:, 0]) + 0.5))
-        imax = min(self.shape[0], int(np.max(pixcrd[:, 0]) + 0.5) + 1)
-        jmin = max(0, int(np.min(pixcrd[:, 1]) + 0.5))
-        jmax = min(self.shape[1], int(np.max(pixcrd[:, 1]) + 0.5) + 1)
-
         # Extract the rectangular area that contains the requested region.
-        subima = self[imin:imax, jmin:jmax]
+        subima = self[self._get_truncate_slices(y_min, y_max, x_min, x_max,
+                                                unit=unit)]
         if inplace:
             self._data = subima._data
             if self._var is not None:
@@ -730,6 +758,41 @@ class Image(ArithmeticMixin, DataArray):
     def _rotate(self, theta=0.0, interp='no', reshape=False, order=1,
                 pivot=None, unit=u.deg, regrid=None, flux=False, cutoff=0.25):
 
+        # Compute how the pixels of the rotated image map to the pixels
+        # of the input image.
+        plan = self._get_rotate_plan(theta=theta, reshape=reshape,
+                                     order=order, pivot=pivot, unit=unit,
+                                     regrid=regrid, flux=flux)
+
+        # Get a copy of the current image array with masked values filled,
+        # and rotate it, along with the mask and the variances. Masked
+        # pixels are rotated as an array of 1s, and the corners that
+        # weren't mapped from the input array are flagged too.
+        data = self._prepare_data(interp)
+        self._data, self._mask, self._var = plan.apply(
+            data, ma.getmaskarray(self.data), self._var, cutoff=cutoff)
+
+        # Install the new world-coordinate transformation matrix, along
+        # with the new reference pixel.
+        self.wcs = plan.wcs
+
+        # If allowed to reshape the array, crop away any entirely
+        # masked margins. The plan and the slices of the crop are
+        # returned, so that they can be reused for other images.
+        item = self.crop() if reshape else None
+        return plan, item
+
+    def _get_rotate_plan(self, theta=0.0, reshape=False, order=1,
+                         pivot=None, unit=u.deg, regrid=None, flux=False):
+        """Compute the resampling plan used by `rotate`, which can then be
+        applied to all the images with the same shape and world coordinates
+        as this one. See `rotate` for the parameters.
+
+        Returns
+        -------
+        out : `_ResamplingPlan`
+
+        """
         # In general it isn't possible to both anchor a point in the
         # image while reshaping the image so that it fits.
         if reshape and pivot is not None:
@@ -898,52 +961,9 @@ class Image(ArithmeticMixin, DataArray):
 
         offset = oldcrpix - np.dot(new2old, newcrpix)
 
-        # Get a copy of the current image array with masked values filled.
-        newdata = self._prepare_data(interp)
-
-        # For each pixel of the rotated image, use the new2old affine
-        # transformation matrix to determine where that pixel
-        # originates in the input image, then interpolate a value from
-        # the pixels of the input image surrounding that point.
-        newdata = affine_transform(newdata, matrix=new2old,
-                                   offset=offset.flatten(), cval=0.0,
-                                   output_shape=newdims, output=float,
-                                   order=order, prefilter=prefilter)
-
-        # Zero the current data array and then fill its masked pixels
-        # with floating point 1.0s, so that we can rotate this in the
-        # the same way as the data to see where the masked areas end up.
-        self._data[:, :] = 0.0
-        newmask = np.ma.filled(self.data, 1.0)
-
-        # Rotate the array of 1s that represent masked pixels, and fill
-        # corners that weren't mapped from the input array with 1s, so
-        # that we end up flagging them too.
-        newmask = affine_transform(newmask, matrix=new2old,
-                                   offset=offset.flatten(), cval=1.0,
-                                   output_shape=newdims, output=float,
-                                   order=order, prefilter=prefilter)
-
-        # Create a new boolean mask in which all pixels that had an
-        # integrated contribution of more than 'cutoff' originally
-        # masked pixels are masked. Note that setting the cutoff to
-        # the "obvious" value of zero results in lots of pixels being
-        # masked that are far away from any masked pixels, due to
-        # precision errors in the affine_transform() function.
-        # Limit the minimum value of the cutoff to avoid this.
-        newmask = np.greater(newmask, max(cutoff, 1e-6))
-
-        # If the image has an associated array of variances, rotate it too.
-        if self._var is not None:
-            newvar = affine_transform(self._var, matrix=new2old,
-                                      offset=offset.flatten(), cval=0.0,
-                                      output_shape=newdims, output=float,
-                                      order=order, prefilter=prefilter)
-        else:
-            newvar = None
-
         # Compute the number of old pixel areas per new pixel, if the
         # pixel dimensions have been changed.
+        data_scale = var_scale = 1.0
         if regrid:
             n = newinc.prod() / oldinc.prod()
 
@@ -952,36 +972,35 @@ class Image(ArithmeticMixin, DataArray):
             if flux:
 
                 # Scale the pixel fluxes by the increase in the area.
-                newdata *= n
+                data_scale = n
 
                 # Each output pixel is an interpolation between the
                 # nearest neighboring pixels, so the variance is unchanged
                 # by resampling. Scaling the pixel values by n, however,
                 # increases the variances by n**2.
-                if newvar is not None:
-                    newvar *= n**2
-
-        # Install the rotated data array, mask and variances.
-        self._data = newdata
-        self._mask = newmask
-        self._var = newvar
+                var_scale = n**2
 
         # Install the new world-coordinate transformation matrix, along
-        # with the new reference pixel.
-        self.wcs.set_cd(newcd)
-        self.wcs.naxis1 = newdims[1]
-        self.wcs.naxis2 = newdims[0]
+        # with the new reference pixel, in a copy of the WCS object.
+        wcs = self.wcs.copy()
+        wcs.set_cd(newcd)
+        wcs.naxis1 = newdims[1]
+        wcs.naxis2 = newdims[0]
 
         # Record the new value of the coordinate reference pixel,
         # being careful to convert from python 0-relative pixel
         # indexes to FITS 1-relative pixel indexes.
-        self.wcs.set_crpix1(newcrpix[1] + 1)
-        self.wcs.set_crpix2(newcrpix[0] + 1)
+        wcs.set_crpix1(newcrpix[1] + 1)
+        wcs.set_crpix2(newcrpix[0] + 1)
+
+        # Note that the mask is rotated with the same interpolation
+        # order as the data.
+        return _ResamplingPlan(self.shape, newdims, new2old, offset, wcs,
+                               order=order, prefilter=prefilter,
+                               mask_order=order, mask_prefilter=prefilter,
+                               output=float, data_scale=data_scale,
+                               var_scale=var_scale)
 
-        # If allowed to reshape the array, crop away any entirely
-        # masked margins.
-        if reshape:
-            self.crop()
 
     def rotate(self, theta=0.0, interp='no', reshape=False, order=1,
                pivot=None, unit=u.deg, regrid=None, flux=False, cutoff=0.25,
@@ -1111,7 +1130,7 @@ class Image(ArithmeticMixin, DataArray):
         if self._var is not None:
             self._var *= (norm * norm)
 
-    def background(self, niter=3, sigma=3.0):
+    def background(self, niter=3, sigma=3.0, tile=None, workers=None):
         """Compute the image background with sigma-clipping.
 
         Returns the background value and its standard deviation.
@@ -1122,18 +1141,58 @@ class Image(ArithmeticMixin, DataArray):
             Number of iterations.
         sigma : float
             Number of sigma used for the clipping.
+        tile : int or (int,int)
+            If not None, the valid values are copied and sorted by tiles of
+            this size (in pixels), in parallel, instead of copying and
+            sorting the whole image at once. The result is the same, this
+            only limits the memory usage and the time for very large images.
+        workers : int
+            Number of threads used to process the tiles. By default, use the
+            number of CPUs (see `mpdaf.tools.get_workers`).
 
         Returns
         -------
         out : 2-dim float array
         """
-        tab = self.data.compressed()
-
-        for n in range(niter + 1):
-            tab = tab[tab <= (tab.mean() + sigma * tab.std())]
-        return tab.mean(), tab.std()
-
-    def peak_detection(self, nstruct, niter, threshold=None):
+        if tile is not None:
+            return self._tiled_background(niter, sigma, tile, workers)
+
+        # clip the values above mean + sigma * std, niter + 1 times
+        mean, _, std, _ = clipped_stats(self.data, sigma_lower=np.inf,
+                                        sigma_upper=sigma, cenfunc='mean',
+                                        maxiters=niter + 1)
+        return mean, std
+
+    def _tiled_background(self, niter, sigma, tile, workers):
+        tiles = [t for row in _tile_grid(self.shape, tile) for t in row]
+        mask = ma.getmaskarray(self.data)
+
+        def valid(sl):
+            return ~mask[sl] & np.isfinite(self._data[sl])
+
+        counts = _map_tiles(lambda sl: np.count_nonzero(valid(sl)), tiles,
+                            workers)
+        starts = np.cumsum([0] + counts)
+        values = np.empty(starts[-1])
+
+        def sort_tile(k):
+            sl = tiles[k]
+            tab = values[starts[k]:starts[k + 1]]
+            tab[:] = self._data[sl][valid(sl)]
+            tab.sort()
+
+        _map_tiles(sort_tile, range(len(tiles)), workers)
+
+        # Merge the sorted tiles (the stable sort merges the sorted runs),
+        # and clip the values above mean + sigma * std, niter + 1 times
+        values.sort(kind='stable')
+        mean, _, std, _ = sorted_clipped_stats(
+            values, [0], [len(values)], sigma_lower=np.inf,
+            sigma_upper=sigma, cenfunc='mean', maxiters=niter + 1)
+        return mean[0], std[0]
+
+    def peak_detection(self, nstruct, niter, threshold=None, tile=None,
+                       workers=None):
         """Return a list of peak locations.
 
         Parameters
@@ -1144,6 +1203,16 @@ class Image(ArithmeticMixin, DataArray):
             Number of iterations used for the erosion and the dilatation.
         threshold : float
             Threshold value. If None, it is initialized with background value.
+        tile : int or (int,int)
+            If not None, the image is processed by tiles of this size (in
+            pixels), in parallel. The tiles are extended by the margin
+            needed for the erosion and the dilatation, and the objects that
+            cross the borders of the tiles are merged, so that the result is
+            the same as for the whole image, with a memory usage that is
+            bounded by the size of the tiles.
+        workers : int
+            Number of threads used to process the tiles. By default, use the
+            number of CPUs (see `mpdaf.tools.get_workers`).
 
         Returns
         -------
@@ -1151,7 +1220,7 @@ class Image(ArithmeticMixin, DataArray):
 
         """
         if threshold is None:
-            background, std = self.background()
+            background, std = self.background(tile=tile, workers=workers)
             threshold = background + 10 * std
 
         def _struct(n):
@@ -1161,6 +1230,10 @@ class Image(ArithmeticMixin, DataArray):
                 struct[i][dist: abs(n - dist)] = 1
             return struct
 
+        if tile is not None:
+            return self._tiled_peak_detection(_struct(nstruct), niter,
+                                              threshold, tile, workers)
+
         selec = self.data > threshold
         selec.fill_value = False
         struct = _struct(nstruct)
@@ -1173,6 +1246,102 @@ class Image(ArithmeticMixin, DataArray):
                                               np.arange(label[1]) + 1)
         return np.array(pos)
 
+    def _tiled_peak_detection(self, struct, niter, threshold, tile, workers):
+        grid = _tile_grid(self.shape, tile)
+        tiles = [t for row in grid for t in row]
+        data = self.data
+        # the erosion and the dilatation shift the borders of the objects
+        # by up to niter times the radius of the structuring element
+        halo = 2 * niter * (max(struct.shape) // 2) + 1
+        struct4 = ndi.generate_binary_structure(2, 1)
+        struct8 = ndi.generate_binary_structure(2, 2)
+
+        def opening(core):
+            pad, inner = _pad_tile(core, self.shape, halo)
+            selec = data[pad] > threshold
+            selec.fill_value = False
+            selec = ndi.binary_erosion(selec, structure=struct,
+                                       iterations=niter)
+            selec = ndi.binary_dilation(selec, structure=struct,
+                                        iterations=niter)
+            return selec[inner]
+
+        def background_labels(selec):
+            return ndi.label(~selec, struct4)
+
+        # First pass: label the background of each tile, to find the holes
+        # of the selection, i.e. the parts of the background that are not
+        # connected to the borders of the image.
+        def first_pass(core):
+            selec = opening(core)
+            labels, nlabels = background_labels(selec)
+            edges = []
+            if core[0].start == 0:
+                edges.append(labels[0])
+            if core[0].stop == self.shape[0]:
+                edges.append(labels[-1])
+            if core[1].start == 0:
+                edges.append(labels[:, 0])
+            if core[1].stop == self.shape[1]:
+                edges.append(labels[:, -1])
+            touch = np.zeros(nlabels + 1, dtype=bool)
+            for e in edges:
+                touch[e] = True
+            return (np.packbits(selec), selec.shape, nlabels, touch[1:],
+                    _label_strips(labels))
+
+        res = _map_tiles(first_pass, tiles, workers)
+        offsets, comp, ncomp = _merge_tile_labels(
+            (len(grid), len(grid[0])), [r[2] for r in res],
+            [r[4] for r in res], connectivity=1)
+        not_hole = np.zeros(ncomp, dtype=bool)
+        if comp.size:
+            not_hole[comp[np.concatenate([r[3] for r in res])]] = True
+
+        # Second pass: fill the holes and label the objects.
+        def second_pass(k):
+            core = tiles[k]
+            packed, shape, nbg = res[k][:3]
+            selec = np.unpackbits(packed, count=shape[0] * shape[1])
+            selec = selec.reshape(shape).astype(bool)
+            labels, nlabels = background_labels(selec)
+            hole = np.zeros(nbg + 1, dtype=bool)
+            hole[1:] = ~not_hole[comp[offsets[k] + np.arange(nbg)]]
+            selec |= hole[labels]
+
+            labels, nlabels = ndi.label(selec, struct8)
+            y, x = np.mgrid[core]
+            # Use the same weights as scipy's center_of_mass applied to
+            # the masked data array in the untiled case, where masked
+            # pixels keep their raw value in the weighted sums.
+            w = self._data[core].astype(float)
+            m = ma.getmaskarray(data[core])
+            lab = labels.ravel()
+            sums = [np.bincount(lab, weights=v.ravel(),
+                                minlength=nlabels + 1)[1:]
+                    for v in (w, np.where(m, w, w * y),
+                              np.where(m, w, w * x))]
+            first = _first_pixels(labels, nlabels, core, self.shape[1])
+            return nlabels, _label_strips(labels), sums, first
+
+        res = _map_tiles(second_pass, range(len(tiles)), workers)
+        offsets, comp, ncomp = _merge_tile_labels(
+            (len(grid), len(grid[0])), [r[0] for r in res],
+            [r[1] for r in res], connectivity=2)
+        if ncomp == 0:
+            return np.array([])
+
+        sums = [np.bincount(comp, weights=np.concatenate([r[2][i]
+                                                          for r in res]),
+                            minlength=ncomp) for i in range(3)]
+        first = np.full(ncomp, np.iinfo(np.int64).max)
+        np.minimum.at(first, comp, np.concatenate([r[3] for r in res]))
+        # sort the objects like scipy.ndimage.label does, by position of
+        # their first pixel
+        order = np.argsort(first)
+        return np.column_stack([sums[1][order] / sums[0][order],
+                                sums[2][order] / sums[0][order]])
+
     def peak(self, center=None, radius=0, unit_center=u.deg,
              unit_radius=u.arcsec, dpix=2, background=None, plot=False):
         """Find image peak location.
@@ -1261,7 +1430,7 @@ class Image(ArithmeticMixin, DataArray):
         return {'x': ra, 'y': dec, 'p': ic, 'q': jc, 'data': maxv}
 
     def fwhm(self, center=None, radius=0, unit_center=u.deg,
-             unit_radius=u.arcsec):
+             unit_radius=u.arcsec, method='moments', cont=0):
         """Compute the fwhm.
 
         Parameters
@@ -1276,6 +1445,14 @@ class Image(ArithmeticMixin, DataArray):
             Degrees by default (use None for coordinates in pixels).
         unit_radius : `astropy.units.Unit`
             Radius unit.  Arcseconds by default (use None for radius in pixels)
+        method : 'moments' | 'profile'
+            With 'moments' (the default), the fwhm along each axis is derived
+            from the moments of the explored region (see `moments`).
+            With 'profile', the fwhm is measured on the radial profile around
+            the center (the center of the image if center is None), up to
+            the radius (see `radial_profile`).
+        cont : float
+            Continuum value, only used by the 'profile' method.
 
         Returns
         -------
@@ -1283,6 +1460,16 @@ class Image(ArithmeticMixin, DataArray):
             [fwhm_y,fwhm_x], returned in unit_radius (arcseconds by default).
 
         """
+        if method == 'profile':
+            if not is_number(radius):
+                raise ValueError('The profile method needs a single radius')
+            prof = self.radial_profile(center, radius=radius or None,
+                                       unit_center=unit_center,
+                                       unit_radius=unit_radius, cont=cont)
+            return np.repeat(prof.fwhm(), 2)
+        elif method != 'moments':
+            raise ValueError('Unknown method: {}'.format(method))
+
         if center is None or radius == 0:
             img = self
         else:
@@ -1344,42 +1531,37 @@ class Image(ArithmeticMixin, DataArray):
                 radius = radius / self.wcs.get_step(unit=unit_radius)
                 radius2 = radius[0] * radius[1]
 
-            imin = max(0, center[0] - radius[0])
-            imax = min(center[0] + radius[0] + 1, self.shape[0])
-            jmin = max(0, center[1] - radius[1])
-            jmax = min(center[1] + radius[1] + 1, self.shape[1])
-            ima = self[imin:imax, jmin:jmax]
+            imin = max(0, int(np.floor(center[0] - radius[0])))
+            imax = min(int(np.floor(center[0] + radius[0])) + 1,
+                       self.shape[0])
+            jmin = max(0, int(np.floor(center[1] - radius[1])))
+            jmax = min(int(np.floor(center[1] + radius[1])) + 1,
+                       self.shape[1])
 
+            data = self.data[imin:imax, jmin:jmax]
             if circular:
-                xaxis = np.arange(ima.shape[0], dtype=float) \
-                    - ima.shape[0] / 2.
-                yaxis = np.arange(ima.shape[1], dtype=float) \
-                    - ima.shape[1] / 2.
-                gridx = np.empty(ima.shape, dtype=float)
-                gridy = np.empty(ima.shape, dtype=float)
-                for j in range(ima.shape[1]):
-                    gridx[:, j] = xaxis
-                for i in range(ima.shape[0]):
-                    gridy[i, :] = yaxis
-                r2 = gridx * gridx + gridy * gridy
-                ksel = np.where(r2 < radius2)
-                if frac:
-                    return (ima.data[ksel] - cont).sum() \
-                        / (self.data - cont).sum()
-                else:
-                    return (ima.data[ksel] - cont).sum()
+                # the circle is centered on the middle of the region, which
+                # is truncated at the edges of the image
+                y = np.arange(data.shape[0]) - data.shape[0] / 2.
+                x = np.arange(data.shape[1]) - data.shape[1] / 2.
+                r2 = y[:, np.newaxis] ** 2 + x ** 2
+                flux = (data[r2 < radius2] - cont).sum()
             else:
-                if frac:
-                    return (ima.data - cont).sum() / (self.data - cont).sum()
-                else:
-                    return (ima.data - cont).sum()
+                flux = (data - cont).sum()
+
+            if frac:
+                return flux / (self.data - cont).sum()
+            else:
+                return flux
 
     def eer_curve(self, center=None, unit_center=u.deg, unit_radius=u.arcsec,
                   etot=None, cont=0):
         """Return containing enclosed energy as function of radius.
 
         The enclosed energy ratio (EER) shows how much light is concentrated
-        within a certain radius around the image-center.
+        within a certain radius around the image-center. The energy is
+        computed in squares of ``2 * radius + 1`` pixels, see
+        `radial_profile`.
 
 
         Parameters
@@ -1420,16 +1602,17 @@ class Image(ArithmeticMixin, DataArray):
             etot = (self.data - cont).sum()
         if nmax <= 1:
             raise ValueError('Coord area outside image limits')
-        ee = np.empty(nmax)
-        for d in range(0, nmax):
-            ee[d] = (self.data[i - d:i + d + 1, j - d:j + d + 1] - cont).sum() / etot
 
-        radius = np.arange(0, nmax)
+        prof = self.radial_profile((i, j), radius=nmax - 0.5,
+                                   unit_center=None, unit_radius=None,
+                                   square=True, cont=cont)
+        # half-size of the squares, in pixels
+        radius = prof.radius - 0.5
         if unit_radius is not None:
             step = np.mean(self.get_step(unit=unit_radius))
             radius = radius * step
 
-        return radius, ee
+        return radius, prof.eer(etot)[0]
 
     def ee_size(self, center=None, unit_center=u.deg, etot=None, frac=0.9,
                 cont=0, unit_size=u.arcsec):
@@ -1482,20 +1665,129 @@ class Image(ArithmeticMixin, DataArray):
                 return np.array([1, 1])
             else:
                 return self.get_step(unit_size)
-        for d in range(1, nmax):
-            ee2 = (self.data[i - d:i + d + 1, j - d:j + d + 1] - cont).sum() / etot
-            if ee2 > frac:
-                break
-        d -= 1
-        ee1 = (self.data[i - d:i + d + 1, i - d:i + d + 1] - cont).sum() / etot
-        d += (frac - ee1) / (ee2 - ee1)  # interpolate
-        d *= 2
+
+        prof = self.radial_profile((i, j), radius=nmax - 0.5,
+                                   unit_center=None, unit_radius=None,
+                                   square=True, cont=cont)
+        d = 2 * (prof.ee_radius(frac, etot)[0] - 0.5)
         if unit_size is None:
             return np.array([d, d])
         else:
             step = self.get_step(unit_size)
             return np.array([d * step[0], d * step[1]])
 
+    def radial_profile(self, center=None, radius=None, unit_center=u.deg,
+                       unit_radius=u.arcsec, step=None, square=False,
+                       oversample=1, cont=0):
+        """Compute the radial profiles of the image around one or several
+        positions, to measure encircled (or ensquared) energies.
+
+        The pixels around each position and their radial bins are computed
+        once and cached (see ``PROFILE_CACHE_SIZE``), with a key that
+        depends on the shape of the image, the positions and the bins. The
+        fluxes of all the bins of all the profiles are then summed with a
+        single `numpy.bincount`, so computing the profiles again for another
+        image with the same shape, or after a modification of the data, is
+        cheap. This is used by `ee`, `eer_curve`, `ee_size` and `fwhm`, and
+        gives the same measurements for many stars at once with
+        `~mpdaf.obj.RadialProfile`.
+
+        Parameters
+        ----------
+        center : (float,float) or array of shape (n, 2)
+            Center(s) (y,x) of the profiles.
+            If center is None, the center of the image is used.
+        radius : float
+            Maximum radius of the apertures. By default, the largest radius
+            for which the apertures of all the profiles are inside the image.
+        unit_center : `astropy.units.Unit`
+            Type of the center coordinates.
+            Degrees by default (use None for coordinates in pixels).
+        unit_radius : `astropy.units.Unit`
+            Radius unit. Arcseconds by default (use None for radius in pixels)
+        step : float
+            Width of the annuli, in unit_radius. One pixel by default.
+        square : bool
+            If True, the apertures are squares (ensquared energy) instead of
+            circles (encircled energy).
+        oversample : int
+            If larger than 1, each pixel is divided in oversample x
+            oversample sub-pixels, to share its flux between the annuli
+            that cross it.
+        cont : float
+            Continuum value.
+
+        Returns
+        -------
+        out : `~mpdaf.obj.RadialProfile`
+
+        """
+        if center is None:
+            centers = np.array([[self.shape[0] // 2, self.shape[1] // 2]],
+                               dtype=float)
+        else:
+            centers = np.atleast_2d(np.asarray(center, dtype=float))
+            if unit_center is not None:
+                centers = self.wcs.sky2pix(centers, unit=unit_center)
+        centers = np.ascontiguousarray(centers, dtype=float)
+
+        if unit_radius is None:
+            scale = 1.0
+        else:
+            scale = np.mean(self.wcs.get_step(unit=unit_radius))
+        pstep = 1.0 if step is None else step / scale
+        if pstep <= 0 or int(oversample) < 1:
+            raise ValueError('The step and oversample must be positive')
+        if radius is None:
+            rmax = np.floor(min(centers.min(),
+                                (np.array(self.shape) - 1 - centers).min()))
+            rmax += 0.5
+        else:
+            rmax = radius / scale
+
+        # the apertures have radii of (k + 0.5) * step
+        nbins = int(np.floor(rmax / pstep - 0.5 + 1e-9)) + 1
+        if nbins < 1:
+            raise ValueError('Coord area outside image limits')
+        radii = (np.arange(nbins) + 0.5) * pstep
+        flux, npix, rmean = self._profile_arrays(
+            centers, radii ** 2, square=square, oversample=int(oversample),
+            cont=cont)
+        return RadialProfile(centers, radii * scale, rmean * scale, flux,
+                             npix, unit=unit_radius)
+
+    def _profile_arrays(self, centers, edges2, square=False, oversample=1,
+                        cont=0):
+        """Return the flux, the number of unmasked pixels and the mean
+        distance of the pixels in radial bins around several centers (see
+        `_radial_geometry`), with shapes (number of centers, number of
+        bins)."""
+        key = (self.shape, centers.tobytes(), edges2.tobytes(), bool(square),
+               oversample)
+        with _profile_geometries_lock:
+            geometry = _profile_geometries.get(key)
+            if geometry is not None:
+                _profile_geometries.move_to_end(key)
+
+        if geometry is None:
+            geometry = _radial_geometry(self.shape, centers, edges2,
+                                        square=square, oversample=oversample)
+            with _profile_geometries_lock:
+                _profile_geometries[key] = geometry
+                while len(_profile_geometries) > PROFILE_CACHE_SIZE:
+                    _profile_geometries.popitem(last=False)
+
+        pixels, bins, weights, rmean = geometry
+        data = self.data
+        values = data.filled(0).ravel()[pixels]
+        valid = ~ma.getmaskarray(data).ravel()[pixels]
+        size = rmean.size
+        flux = np.bincount(bins, weights=weights * values, minlength=size)
+        npix = np.bincount(bins, weights=weights * valid, minlength=size)
+        if cont != 0:
+            flux -= cont * npix
+        return flux.reshape(rmean.shape), npix.reshape(rmean.shape), rmean
+
     def _interp(self, grid, spline=False):
         """Return the interpolated values corresponding to the grid points.
 
@@ -2377,6 +2669,213 @@ class Image(ArithmeticMixin, DataArray):
             result.ima = ima
         return result
 
+    def _extract_stamps(self, centers, size, unit_center, unit_size):
+        """Return a stack of cut-outs of the image around several positions.
+
+        The cut-outs all have the same shape, the pixels that fall outside
+        of the image are masked. Also return the variances (or None) and
+        the pixel indexes of the first pixel of each cut-out.
+        """
+        centers = np.atleast_2d(np.asarray(centers, dtype=float))
+        if unit_center is not None:
+            centers = self.wcs.sky2pix(centers, unit=unit_center)
+
+        size = np.broadcast_to(np.asarray(size, dtype=float), (2,))
+        if np.any(size <= 0):
+            raise ValueError('Size must be positive')
+        if unit_size is not None:
+            size = size / self.wcs.get_step(unit=unit_size)
+        shape = np.maximum(np.round(size).astype(int), 1)
+
+        corner = np.round(centers).astype(int) - shape // 2
+        py = corner[:, 0, None, None] + np.arange(shape[0])[:, None]
+        px = corner[:, 1, None, None] + np.arange(shape[1])[None, :]
+        outside = ((py < 0) | (py >= self.shape[0]) |
+                   (px < 0) | (px >= self.shape[1]))
+        py = np.clip(py, 0, self.shape[0] - 1)
+        px = np.clip(px, 0, self.shape[1] - 1)
+
+        mask = outside | ma.getmaskarray(self.data)[py, px]
+        data = ma.array(self._data[py, px], mask=mask)
+        var = None if self._var is None else self._var[py, px]
+        return centers, data, var, corner
+
+    def _fit_results_to_world(self, res, corner, unit_center, unit_fwhm,
+                              fwhm_step):
+        """Convert in place the pixel parameters of fitted cut-outs."""
+        res.center = res.center + corner
+        if unit_center is not None:
+            res.center = self.wcs.pix2sky(res.center, unit=unit_center)
+            res.err_center = res.err_center * \
+                self.wcs.get_step(unit=unit_center)
+        if unit_fwhm is not None:
+            res.fwhm = res.fwhm * fwhm_step
+            res.err_fwhm = res.err_fwhm * fwhm_step
+        return res
+
+    def gauss_fit_multi(self, centers, size, flux=None, fwhm=None,
+                        circular=False, cont=0, fit_back=True, rot=0,
+                        peak=False, weight=True, unit_center=u.deg,
+                        unit_size=u.arcsec, unit_fwhm=u.arcsec, maxiter=100):
+        """Perform Gaussian fits on many sources of the image at once.
+
+        A cut-out of the given size is extracted around each position, and
+        the gaussians are fitted simultaneously with
+        `mpdaf.obj.fit_gauss2d_stack`, which uses a vectorized
+        Levenberg-Marquardt algorithm with the analytic derivatives of the
+        gaussian. The model is the same as in `mpdaf.obj.Image.gauss_fit`
+        (with ``factor=1``).
+
+        Parameters
+        ----------
+        centers : array of shape (n, 2)
+            Positions (y,x) of the sources, which are also the initial
+            gaussian centers. The unit is given by the unit_center parameter
+            (degrees by default).
+        size : float or (float,float)
+            Size of the cut-outs. The unit is given by the unit_size
+            parameter (arcseconds by default).
+        flux : float or array of shape (n,)
+            Initial integrated gaussian fluxes or gaussian peak values if
+            peak is True. If None, peak values are estimated.
+        fwhm : (float,float) or array of shape (n, 2)
+            Initial gaussian fwhm (fwhm_y,fwhm_x). If None, they are
+            estimated. The unit is given by ``unit_fwhm`` (arcseconds by
+            default).
+        circular : bool
+            True: circular gaussian, False: elliptical gaussian
+        cont : float or array of shape (n,)
+            continuum value, 0 by default.
+        fit_back : bool
+            False: continuum value is fixed,
+            True: continuum value is a fit parameter.
+        rot : float
+            Initial rotation in degree.
+            If None, rotation is fixed to 0.
+        peak : bool
+            If true, flux contains a gaussian peak value.
+        weight : bool
+            If weight is True, the weight is computed as the inverse of
+            variance.
+        unit_center : `astropy.units.Unit`
+            type of the center and position coordinates.
+            Degrees by default (use None for coordinates in pixels).
+        unit_size : `astropy.units.Unit`
+            Size unit. Arcseconds by default (use None for sizes in pixels).
+        unit_fwhm : `astropy.units.Unit`
+            FWHM unit. Arcseconds by default (use None for radius in pixels)
+        maxiter : int
+            The maximum number of iterations.
+
+        Returns
+        -------
+        out : `mpdaf.obj.Gauss2DArray`
+            The parameters of all the gaussians. ``out[i]`` is the
+            `mpdaf.obj.Gauss2D` object of the i-th source.
+
+        """
+        centers, data, var, corner = self._extract_stamps(
+            centers, size, unit_center, unit_size)
+        step = (np.ones(2) if unit_fwhm is None
+                else self.wcs.get_step(unit=unit_fwhm))
+        if fwhm is not None:
+            fwhm = np.asarray(fwhm, dtype=float) / step
+        res = fit_gauss2d_stack(data, var=var, center=centers - corner,
+                                flux=flux, fwhm=fwhm, circular=circular,
+                                cont=cont, fit_back=fit_back, rot=rot,
+                                peak=peak, weight=weight, maxiter=maxiter)
+        if not np.all(res.success):
+            self._logger.warning('%d fit(s) did not converge',
+                                 np.count_nonzero(~res.success))
+        return self._fit_results_to_world(res, corner, unit_center,
+                                          unit_fwhm, step)
+
+    def moffat_fit_multi(self, centers, size, fwhm=None, flux=None, n=2.0,
+                         circular=False, cont=0, fit_back=True, rot=0,
+                         peak=False, weight=True, unit_center=u.deg,
+                         unit_size=u.arcsec, unit_fwhm=u.arcsec, fit_n=True,
+                         maxiter=100):
+        """Perform moffat fits on many sources of the image at once.
+
+        A cut-out of the given size is extracted around each position, and
+        the moffat profiles are fitted simultaneously with
+        `mpdaf.obj.fit_moffat2d_stack`, which uses a vectorized
+        Levenberg-Marquardt algorithm with the analytic derivatives of the
+        moffat function. The model is the same as in
+        `mpdaf.obj.Image.moffat_fit` (with ``factor=1``).
+
+        Parameters
+        ----------
+        centers : array of shape (n, 2)
+            Positions (y,x) of the sources, which are also the initial
+            moffat centers. The unit is given by the unit_center parameter
+            (degrees by default).
+        size : float or (float,float)
+            Size of the cut-outs. The unit is given by the unit_size
+            parameter (arcseconds by default).
+        fwhm : (float,float) or array of shape (n, 2)
+            Initial fwhm (fwhm_y,fwhm_x). If None, they are estimated.
+            Their unit is given by the unit_fwhm parameter (arcseconds by
+            default).
+        flux : float or array of shape (n,)
+            Initial integrated fluxes or peak values if peak is True. If
+            None, peak values are estimated.
+        n : float or array of shape (n,)
+            Initial atmospheric scattering coefficient.
+        circular : bool
+            True: circular moffat, False: elliptical moffat
+        cont : float or array of shape (n,)
+            continuum value, 0 by default.
+        fit_back : bool
+            False: continuum value is fixed,
+            True: continuum value is a fit parameter.
+        rot : float
+            Initial angle position in degree.
+            If None, rotation is fixed to 0.
+        peak : bool
+            If true, flux contains a peak value.
+        weight : bool
+            If weight is True, the weight is computed as the inverse of
+            variance.
+        unit_center : `astropy.units.Unit`
+            type of the center and position coordinates.
+            Degrees by default (use None for coordinates in pixels).
+        unit_size : `astropy.units.Unit`
+            Size unit. Arcseconds by default (use None for sizes in pixels).
+        unit_fwhm : `astropy.units.Unit`
+            FWHM unit. Arcseconds by default (use None for radius in pixels)
+        fit_n : bool
+            False: n value is fixed,
+            True: n value is a fit parameter.
+        maxiter : int
+            The maximum number of iterations.
+
+        Returns
+        -------
+        out : `mpdaf.obj.Moffat2DArray`
+            The parameters of all the moffat profiles. ``out[i]`` is the
+            `mpdaf.obj.Moffat2D` object of the i-th source.
+
+        """
+        centers, data, var, corner = self._extract_stamps(
+            centers, size, unit_center, unit_size)
+        step = (np.ones(2) if unit_fwhm is None
+                else self.wcs.get_step(unit=unit_fwhm))
+        if fwhm is not None:
+            fwhm = np.asarray(fwhm, dtype=float) / step
+        res = fit_moffat2d_stack(data, var=var, center=centers - corner,
+                                 flux=flux, fwhm=fwhm, n=n, circular=circular,
+                                 cont=cont, fit_back=fit_back, rot=rot,
+                                 peak=peak, weight=weight, fit_n=fit_n,
+                                 maxiter=maxiter)
+        if not np.all(res.success):
+            self._logger.warning('%d fit(s) did not converge',
+                                 np.count_nonzero(~res.success))
+        # as in moffat_fit, the fwhm are converted with the step of the
+        # first axis
+        return self._fit_results_to_world(res, corner, unit_center,
+                                          unit_fwhm, step[0])
+
     def rebin(self, factor, margin='center', inplace=False):
         """Combine neighboring pixels to reduce the size of an image by
         integer factors along each axis.
@@ -2724,6 +3223,44 @@ class Image(ArithmeticMixin, DataArray):
         out : `~mpdaf.obj.Image`
             The resampled image is returned.
 
+        """
+        plan = self._get_regrid_plan(newdim, refpos, refpix, newinc,
+                                     flux=flux, order=order,
+                                     unit_pos=unit_pos, unit_inc=unit_inc,
+                                     antialias=antialias, window=window)
+
+        # Get a copy of the data array with masked values filled, and
+        # resample it, along with the mask and the variances.
+        data = self._prepare_data(interp)
+        data, mask, var = plan.apply(data, ma.getmaskarray(self.data),
+                                     self._var, cutoff=cutoff)
+
+        # Install the resampled data, mask and variance arrays, either
+        # within self, or in a new Image object.
+        out = self if inplace else self.clone()
+        out._data = data
+        out._mask = mask
+        out._var = var
+        out.wcs = plan.wcs
+
+        # If the spatial frequency band-limits of the image have been
+        # reduced by the changes in the Y and X sampling intervals,
+        # record this.
+        out.update_spatial_fmax(plan.newfmax)
+
+        return out
+
+    def _get_regrid_plan(self, newdim, refpos, refpix, newinc, flux=False,
+                         order=1, unit_pos=u.deg, unit_inc=u.arcsec,
+                         antialias=True, window="blackman"):
+        """Compute the resampling plan used by `regrid`, which can then be
+        applied to all the images with the same shape and world coordinates
+        as this one. See `regrid` for the parameters.
+
+        Returns
+        -------
+        out : `_ResamplingPlan`
+
         """
         if is_int(newdim):
             newdim = (newdim, newdim)
@@ -2770,17 +3307,15 @@ class Image(ArithmeticMixin, DataArray):
         if unit_inc is not None:
             newinc = UnitArray(newinc, unit_inc, self.wcs.unit)
 
-        # Get a copy of the data array with masked values filled.
-        data = self._prepare_data(interp)
-
         # If the angular pixel increments along either axis are being
         # increased, then low-pass filter the data along that axis to
         # prevent aliasing in the resampled data.
         if antialias:
-            data, newfmax = _antialias_filter_image(
-                data, abs(oldinc), abs(newinc), self.get_spatial_fmax(),
-                window)
+            filt = _AntialiasFilter(self.shape, abs(oldinc), abs(newinc),
+                                    self.get_spatial_fmax(), window)
+            newfmax = filt.newfmax
         else:
+            filt = None
             newfmax = 0.5 / abs(newinc)
 
         # For each pixel in the output image, the affine_transform
@@ -2829,39 +3364,6 @@ class Image(ArithmeticMixin, DataArray):
         offset = (self.wcs.sky2pix(refpos).T[:, :1] -
                   np.dot(new2old, refpix[np.newaxis, :].T))
 
-        # For each pixel of the output image, map its index to the
-        # equivalent index of the input image and interpolate a value
-        # for the new pixel from there.
-        data = affine_transform(data, new2old, offset.flatten(),
-                                output_shape=newdim, order=order,
-                                prefilter=order >= 3)
-
-        # Create a floating point version of the mask in which masked
-        # elements are 1.0 and unmasked elements are 0.0.
-        mask = self._mask.astype(float)
-
-        # Resample the floating point version of the mask array.
-        mask = affine_transform(mask, new2old, offset.flatten(), cval=1.0,
-                                output_shape=newdim, output=float)
-
-        # Create new boolean mask in which all pixels that had an
-        # integrated contribution of more than 'cutoff' originally
-        # masked pixels are masked. Note that setting the cutoff to
-        # the "obvious" value of zero results in lots of pixels being
-        # masked that are far away from any masked pixels, due to
-        # precision errors in the affine_transform() function.
-        # Limit the minimum value of the cutoff to avoid this.
-        mask = np.greater(mask, max(cutoff, 1.0e-6))
-
-        # Also repeat the procedure for the array of variances, if any.
-        if self._var is not None:
-            var = affine_transform(self._var, new2old, offset.flatten(),
-                                   output_shape=newdim, order=order,
-                                   prefilter=order >= 3)
-
-        else:
-            var = None
-
         # Compute the absolute changes in the size of the pixels
         # along the X and Y axes.
         xs = abs(newinc[1] / oldinc[1])
@@ -2875,7 +3377,7 @@ class Image(ArithmeticMixin, DataArray):
 
         if flux:
             # Scale the pixel fluxes by the increase in the area.
-            data *= n
+            data_scale = n
 
             # The variances of the output pixels depend on whether an
             # anti-aliasing filter was applied, as follows.
@@ -2901,11 +3403,10 @@ class Image(ArithmeticMixin, DataArray):
             #    while those of the other axis are decreased, then we
             #    have a mix of the above two cases.
 
-            if var is not None:
-                # Scale the variance according to the prescription described
-                # above.
-                var *= ((xs if xs > 1.0 and antialias else xs**2) *
-                        (ys if ys > 1.0 and antialias else ys**2))
+            # Scale the variance according to the prescription described
+            # above.
+            var_scale = ((xs if xs > 1.0 and antialias else xs**2) *
+                         (ys if ys > 1.0 and antialias else ys**2))
 
         # If we haven't been asked to scale the fluxes by the increase
         # in the area of a pixel, the effect on the variances are as
@@ -2917,9 +3418,9 @@ class Image(ArithmeticMixin, DataArray):
         # variance.
 
         else:
-            if var is not None and (xs > 1.0 or ys > 1.0):
-                var *= ((1 / xs if xs > 1.0 and antialias else 1.0) *
-                        (1 / ys if ys > 1.0 and antialias else 1.0))
+            data_scale = 1.0
+            var_scale = ((1 / xs if xs > 1.0 and antialias else 1.0) *
+                         (1 / ys if ys > 1.0 and antialias else 1.0))
 
         # Get the coordinate reference pixel of the input image,
         # arranged as a column vector in python (Y,X) order. Note that
@@ -2947,20 +3448,67 @@ class Image(ArithmeticMixin, DataArray):
         wcs.set_crpix1(newcrpix[1] + 1)
         wcs.set_crpix2(newcrpix[0] + 1)
 
-        # Install the resampled data, mask and variance arrays, either
-        # within self, or in a new Image object.
-        out = self if inplace else self.clone()
-        out._data = data
-        out._mask = mask
-        out._var = var
-        out.wcs = wcs
+        return _ResamplingPlan(self.shape, newdim, new2old, offset, wcs,
+                               order=order, prefilter=order >= 3,
+                               mask_order=3, mask_prefilter=True,
+                               antialias=filt, data_scale=data_scale,
+                               var_scale=var_scale, newfmax=newfmax)
+
+    def get_regrid_operator(self, newdim, refpos, refpix, newinc, flux=False,
+                            order=1, unit_pos=u.deg, unit_inc=u.arcsec):
+        """Return a sparse linear operator that resamples images with the
+        shape and world coordinates of this image, like `regrid` without
+        anti-aliasing filter.
+
+        The operator is computed once and can then be applied to many
+        images, or to stacks of images at once. The operators are cached
+        (see ``REGRID_CACHE_SIZE``) with a key that depends on the world
+        coordinates and the shape of this image and on the output pixel
+        grid, so that calling this method again for an image with the same
+        coordinates is cheap, even when the output grid is specified with
+        another reference position.
 
-        # If the spatial frequency band-limits of the image have been
-        # reduced by the changes in the Y and X sampling intervals,
-        # record this.
-        out.update_spatial_fmax(newfmax)
+        Parameters
+        ----------
+        newdim, refpos, refpix, newinc, flux, unit_pos, unit_inc
+            See `regrid`.
+        order : int
+            The order of the interpolation, 0 (nearest) or 1 (linear,
+            the default).
 
-        return out
+        Returns
+        -------
+        out : `~mpdaf.obj.RegridOperator`
+
+        """
+        if order not in (0, 1):
+            raise ValueError('only the orders 0 and 1 are supported')
+
+        # Without anti-aliasing filter the plan is cheap to compute, and
+        # the output grid only depends on its affine transform (the offset
+        # is rounded to ignore the errors of the coordinate transforms).
+        plan = self._get_regrid_plan(newdim, refpos, refpix, newinc,
+                                     flux=flux, order=order,
+                                     unit_pos=unit_pos, unit_inc=unit_inc,
+                                     antialias=False)
+        key = (_wcs_fingerprint(self.wcs), self.shape, plan.outshape,
+               tuple(plan.new2old.ravel().tolist()),
+               tuple(plan.offset.round(9).tolist()), int(order),
+               float(plan.data_scale), float(plan.var_scale))
+
+        with _regrid_operators_lock:
+            op = _regrid_operators.get(key)
+            if op is not None:
+                _regrid_operators.move_to_end(key)
+                return op
+
+        op = RegridOperator(plan)
+
+        with _regrid_operators_lock:
+            _regrid_operators[key] = op
+            while len(_regrid_operators) > REGRID_CACHE_SIZE:
+                _regrid_operators.popitem(last=False)
+        return op
 
     def align_with_image(self, other, flux=False, inplace=False, cutoff=0.25,
                          antialias=True, window="blackman"):
@@ -3144,56 +3692,13 @@ class Image(ArithmeticMixin, DataArray):
         #
         # First get the union of the masked areas of the two images.
         mask = np.ma.mask_or(self._mask, ref._mask)
-
-        # Place both image arrays into masked array containers that
-        # share the above mask.
-        sdata = np.ma.array(data=self._data, mask=mask)
-        rdata = np.ma.array(data=ref._data, mask=mask)
-
-        # Get copies of the above arrays with masked pixels filled
-        # with the median values of the images.
-        sdata = np.ma.filled(sdata, np.ma.median(sdata))
-        rdata = np.ma.filled(rdata, np.ma.median(rdata))
-
-        # When we cross-correlate the images, any constant or noisy
-        # background will bias the result towards the origin of the
-        # correlation, so remove most of the noisy background by
-        # zeroing all values that are less than nsigma standard
-        # deviations above the mean.
-        mask = sdata < sdata.mean() + nsigma * sdata.std()
-        sdata[mask] = 0
-        mask = rdata < rdata.mean() + nsigma * rdata.std()
-        rdata[mask] = 0
-
-        # Sometimes a bright artefact or a bright star with
-        # appreciable proper motion biases the correlation. To avoid
-        # this take the log of the thresholded data to prevent very
-        # bright features from dominating the correlation.
-        sdata = np.log(1.0 + sdata)
-        rdata = np.log(1.0 + rdata)
+        sdata = _correlation_data(self._data, mask, nsigma)
+        rdata = _correlation_data(ref._data, mask, nsigma)
 
         # Cross correlate our image with the reference image, by
         # convolving our image with an axis-reversed version of the
-        # reference image. Use mode="same" to only keep the inner half
-        # of the array. We don't expect the peak to be outside this
-        # area, and this avoids edge effects where there is incomplete
-        # data.
-        cc = signal.fftconvolve(sdata, rdata[::-1, ::-1], mode="same")
-
-        # Find the position of the maximum value in the correlation image.
-        py, px = np.unravel_index(np.argmax(cc), cc.shape)
-
-        # Quadratically interpolate a more precise peak position from three
-        # points along the X and Y axes, centered on the position found above.
-        py2 = py - 1 + _find_quadratic_peak(cc[py - 1: py + 2, px])
-        px2 = px - 1 + _find_quadratic_peak(cc[py, px - 1: px + 2])
-
-        # Compute the offset of the peak relative to the central pixel
-        # of the correlation image. This yields the offset between the
-        # two images.
-        dy = py2 - float(cc.shape[0] // 2)
-        dx = px2 - float(cc.shape[1] // 2)
-
+        # reference image.
+        dy, dx, _ = _correlation_offset(sdata, rdata)
         return dy, dx
 
     def adjust_coordinates(self, ref, nsigma=1.0, inplace=False):
@@ -3284,7 +3789,8 @@ class Image(ArithmeticMixin, DataArray):
         return out
 
     def segment(self, shape=(2, 2), minsize=20, minpts=None,
-                background=20, interp='no', median=None):
+                background=20, interp='no', median=None, tile=None,
+                workers=None):
         """Segment the image in a number of smaller images.
 
         Returns a list of images. Uses
@@ -3309,12 +3815,28 @@ class Image(ArithmeticMixin, DataArray):
         median : (int,int) or None
             If not None (default), size of the window to apply a median filter
             on the image.
+        tile : int or (int,int)
+            If not None, the image is processed by tiles of this size (in
+            pixels), in parallel. The tiles are extended by the margin
+            needed for the filters, and the objects that cross the borders of
+            the tiles are merged, so that the result is the same as for the
+            whole image, with a memory usage that is bounded by the size of
+            the tiles. Only ``interp='no'`` is supported in this case.
+        workers : int
+            Number of threads used to process the tiles. By default, use the
+            number of CPUs (see `mpdaf.tools.get_workers`).
 
         Returns
         -------
         out : list of `Image`
 
         """
+        if tile is not None:
+            if interp != 'no':
+                raise ValueError("only interp='no' is supported with tiles")
+            return self._tiled_segment(shape, minsize, minpts, background,
+                                       median, tile, workers)
+
         data = self._prepare_data(interp)
         if median is not None:
             data = np.ma.array(ndi.median_filter(data, median),
@@ -3329,6 +3851,63 @@ class Image(ArithmeticMixin, DataArray):
         return [self[slices[i]] for i in range(nlabels)
                 if minpts is None or len(data[labels == i + 1]) >= minpts]
 
+    def _tiled_segment(self, shape, minsize, minpts, background, median,
+                       tile, workers):
+        grid = _tile_grid(self.shape, tile)
+        tiles = [t for row in grid for t in row]
+        data = self.data
+        halo = minsize // 2 + 1
+        if median is not None:
+            halo += int(np.max(median)) // 2
+        structure = ndi.generate_binary_structure(shape[0], shape[1])
+
+        # median of the unmasked values, used to fill the masked values
+        fill = 0.
+        if np.any(self._mask):
+            nvalid = self.data.count()
+
+            def get_values(sl):
+                return data[sl].compressed()
+            fill = np.mean([_tiled_kth_value(tiles, get_values, k, workers)
+                            for k in sorted({(nvalid - 1) // 2,
+                                             nvalid // 2})])
+
+        def label_tile(core):
+            pad, inner = _pad_tile(core, self.shape, halo)
+            tdata = np.ma.filled(data[pad], fill)
+            if median is not None:
+                tdata = ndi.median_filter(tdata, median)
+            expanded = ndi.grey_dilation(tdata, (minsize, minsize))[inner]
+            expanded[expanded < background] = 0
+            labels, nlabels = ndi.label(expanded, structure)
+            boxes = np.array([[s[0].start, s[0].stop, s[1].start, s[1].stop]
+                              for s in ndi.find_objects(labels)],
+                             dtype=int).reshape(-1, 4)
+            boxes += [core[0].start, core[0].start,
+                      core[1].start, core[1].start]
+            npts = np.bincount(labels.ravel(), minlength=nlabels + 1)[1:]
+            first = _first_pixels(labels, nlabels, core, self.shape[1])
+            return nlabels, _label_strips(labels), boxes, npts, first
+
+        res = _map_tiles(label_tile, tiles, workers)
+        offsets, comp, ncomp = _merge_tile_labels(
+            (len(grid), len(grid[0])), [r[0] for r in res],
+            [r[1] for r in res], connectivity=2 if structure[0, 0] else 1)
+
+        boxes = np.concatenate([r[2] for r in res])
+        start = np.full((ncomp, 2), np.iinfo(int).max)
+        stop = np.full((ncomp, 2), -1)
+        np.minimum.at(start, comp, boxes[:, [0, 2]])
+        np.maximum.at(stop, comp, boxes[:, [1, 3]])
+        npts = np.bincount(comp, weights=np.concatenate([r[3] for r in res]),
+                           minlength=ncomp)
+        first = np.full(ncomp, np.iinfo(np.int64).max)
+        np.minimum.at(first, comp, np.concatenate([r[4] for r in res]))
+
+        return [self[start[i, 0]:stop[i, 0], start[i, 1]:stop[i, 1]]
+                for i in np.argsort(first)
+                if minpts is None or npts[i] >= minpts]
+
     def add_gaussian_noise(self, sigma, interp='no'):
         """Add Gaussian noise to image in place.
 
@@ -3429,7 +4008,7 @@ class Image(ArithmeticMixin, DataArray):
         # Delegate the task to DataArray._convolve()
         return self._convolve(signal.convolve, other=other, inplace=inplace)
 
-    def fftconvolve(self, other, inplace=False):
+    def fftconvolve(self, other, inplace=False, workers=None):
         """Convolve an Image with a 2D array or another Image, using the
         Fourier convolution theorem.
 
@@ -3454,11 +4033,14 @@ class Image(ArithmeticMixin, DataArray):
         The speed of this function scales as O(Nd x log(Nd)) where
         Nd=self.data.size.  It temporarily allocates a pair of arrays that
         have the sum of the shapes of self.shape and other.shape, rounded up
-        to a power of two along each axis. This can involve a lot of memory
-        being allocated. For this reason, when other.shape is small,
-        Image.convolve() may be more efficient than Image.fftconvolve().
+        to a size that is efficient for the FFT along each axis. This can
+        involve a lot of memory being allocated. For this reason, when
+        other.shape is small, Image.convolve() may be more efficient than
+        Image.fftconvolve().
 
-        Uses `scipy.signal.fftconvolve`.
+        The transforms are computed with `scipy.fft`, and the transforms of
+        ``other`` and ``other**2`` are cached, so convolving several images
+        with the same kernel is faster.
 
         Parameters
         ----------
@@ -3480,6 +4062,9 @@ class Image(ArithmeticMixin, DataArray):
         inplace : bool
             If False (the default), return the results in a new Image.
             If True, record the result in self and return that.
+        workers : int
+            Number of threads used for the Fourier transforms. By default,
+            use the number of CPUs (see `mpdaf.tools.get_workers`).
 
         Returns
         -------
@@ -3487,11 +4072,12 @@ class Image(ArithmeticMixin, DataArray):
 
         """
         # Delegate the task to DataArray._convolve()
-        return self._convolve(signal.fftconvolve, other=other, inplace=inplace)
+        return self._convolve(partial(_fftconvolve, workers=workers),
+                              other=other, inplace=inplace)
 
     def fftconvolve_gauss(self, center=None, flux=1., fwhm=(1., 1.),
                           peak=False, rot=0., factor=1, unit_center=u.deg,
-                          unit_fwhm=u.arcsec, inplace=False):
+                          unit_fwhm=u.arcsec, inplace=False, workers=None):
         """Return the convolution of the image with a 2D gaussian.
 
         Parameters
@@ -3522,6 +4108,8 @@ class Image(ArithmeticMixin, DataArray):
         inplace : bool
             If False, return a convolved copy of the image (default value).
             If True, convolve the original image in-place, and return that.
+        workers : int
+            Number of threads used for the Fourier transforms.
 
         Returns
         -------
@@ -3535,11 +4123,12 @@ class Image(ArithmeticMixin, DataArray):
 
         # Normalize the total flux of the Gaussian.
         ima.norm(typ='sum')
-        return self.fftconvolve(ima, inplace=inplace)
+        return self.fftconvolve(ima, inplace=inplace, workers=workers)
 
     def fftconvolve_moffat(self, center=None, flux=1., a=1.0, q=1.0,
                            n=2, peak=False, rot=0., factor=1,
-                           unit_center=u.deg, unit_a=u.arcsec, inplace=False):
+                           unit_center=u.deg, unit_a=u.arcsec, inplace=False,
+                           workers=None):
         """Return the convolution of the image with a 2D moffat.
 
         Parameters
@@ -3575,6 +4164,8 @@ class Image(ArithmeticMixin, DataArray):
         inplace : bool
             If False, return a convolved copy of the image (default value).
             If True, convolve the original image in-place, and return that.
+        workers : int
+            Number of threads used for the Fourier transforms.
 
         Returns
         -------
@@ -3588,7 +4179,7 @@ class Image(ArithmeticMixin, DataArray):
                            rot=rot, peak=peak, unit_center=unit_center,
                            unit_fwhm=unit_a, unit=self.unit)
         ima.norm(typ='sum')
-        return self.fftconvolve(ima, inplace=inplace)
+        return self.fftconvolve(ima, inplace=inplace, workers=workers)
 
     def correlate2d(self, other, interp='no'):
         """Return the cross-correlation of the image with an array/image
@@ -4036,61 +4627,22 @@ def gauss_image(shape=(101, 101), wcs=None, factor=1, gauss=None,
     if unit_fwhm is not None:
         fwhm = np.array(fwhm) / wcs.get_step(unit=unit_fwhm)
 
-    # data = np.empty(shape=shape, dtype=float)
-
     if fwhm[1] == 0 or fwhm[0] == 0:
         raise ValueError('fwhm equal to 0')
     p_width = fwhm[0] * gaussian_fwhm_to_sigma
     q_width = fwhm[1] * gaussian_fwhm_to_sigma
 
-    # rotation angle in rad
-    theta = np.pi * rot / 180.0
-
     if peak is True:
         norm = flux * 2 * np.pi * p_width * q_width
     else:
         norm = flux
 
-    def gauss(p, q):
-        cost = np.cos(theta)
-        sint = np.sin(theta)
-        xdiff = p - center[0]
-        ydiff = q - center[1]
-        return (
-            norm / (2 * np.pi * p_width * q_width) *
-            np.exp(-(xdiff * cost - ydiff * sint) ** 2 / (2 * p_width ** 2)) *
-            np.exp(-(xdiff * sint + ydiff * cost) ** 2 / (2 * q_width ** 2))
-        )
-
-    if factor > 1:
-        if rot == 0:
-            from scipy import special
-
-            X, Y = np.meshgrid(range(shape[0]), range(shape[1]))
-            pixcrd_min = np.array(list(zip(X.ravel(), Y.ravel()))) - 0.5
-            # pixsky_min = wcs.pix2sky(pixcrd)
-            xmin = (pixcrd_min[:, 1] - center[1]) / np.sqrt(2.0) / q_width
-            ymin = (pixcrd_min[:, 0] - center[0]) / np.sqrt(2.0) / p_width
-
-            pixcrd_max = np.array(list(zip(X.ravel(), Y.ravel()))) + 0.5
-            # pixsky_max = wcs.pix2sky(pixcrd)
-            xmax = (pixcrd_max[:, 1] - center[1]) / np.sqrt(2.0) / q_width
-            ymax = (pixcrd_max[:, 0] - center[0]) / np.sqrt(2.0) / p_width
-
-            dx = pixcrd_max[:, 1] - pixcrd_min[:, 1]
-            dy = pixcrd_max[:, 0] - pixcrd_min[:, 0]
-            data = norm * 0.25 / dx / dy \
-                * (special.erf(xmax) - special.erf(xmin)) \
-                * (special.erf(ymax) - special.erf(ymin))
-            data = np.reshape(data, (shape[1], shape[0])).T
-        else:
-            yy, xx = np.mgrid[:shape[0] * factor, :shape[1] * factor] / factor
-            data = gauss(yy, xx)
-            data = data.reshape(shape[0], 2, shape[1], 2).sum(axis=(1, 3))
-            data /= factor ** 2
-    else:
-        yy, xx = np.mgrid[:shape[0], :shape[1]]
-        data = gauss(yy, xx)
+    # The Gaussian is integrated over the pixels if factor > 1, analytically
+    # if it is not rotated.
+    data = gauss_psf(shape, fwhm[0], center=center, ratio=fwhm[1] / fwhm[0],
+                     rot=rot, integrate=factor > 1, oversample=factor,
+                     normalize=False)
+    data *= norm / (2 * np.pi * p_width * q_width)
 
     return Image(data=data + cont, wcs=wcs, unit=unit, copy=False, dtype=None)
 
@@ -4170,11 +4722,10 @@ def moffat_image(shape=(101, 101), wcs=None, factor=1, moffat=None,
         cont = moffat.cont
 
     fwhm = np.array(fwhm)
-    a = fwhm[0] / (2 * np.sqrt(2 ** (1.0 / n) - 1.0))
     e = fwhm[1] / fwhm[0]
-
     if unit_fwhm is not None:
-        a = a / wcs.get_step(unit=unit_fwhm)[0]
+        fwhm = fwhm / wcs.get_step(unit=unit_fwhm)[0]
+    a = fwhm[0] / (2 * np.sqrt(2 ** (1.0 / n) - 1.0))
 
     if peak:
         norm = flux
@@ -4187,35 +4738,140 @@ def moffat_image(shape=(101, 101), wcs=None, factor=1, moffat=None,
         if unit_center is not None:
             center = wcs.sky2pix(center, unit=unit_center)[0]
 
-    # rotation angle in rad
-    theta = np.pi * rot / 180.0
-
-    def moffat(p, q):
-        cost = np.cos(theta)
-        sint = np.sin(theta)
-        xdiff = p - center[0]
-        ydiff = q - center[1]
-        return (
-            norm * (1 +
-                    ((xdiff * cost - ydiff * sint) / a) ** 2 +
-                    ((xdiff * sint + ydiff * cost) / a / e) ** 2) ** (-n)
-        )
-
-    if factor > 1:
-        X, Y = np.meshgrid(range(shape[0] * factor),
-                           range(shape[1] * factor))
-        factor = float(factor)
-        pixcrd = np.array(list(zip(X.ravel() / factor, Y.ravel() / factor)))
-        data = moffat(pixcrd[:, 0], pixcrd[:, 1])
-        data = (data.reshape(shape[1], factor, shape[0], factor)
-                .sum(1).sum(2) / factor / factor).T
-    else:
-        yy, xx = np.mgrid[:shape[0], :shape[1]]
-        data = moffat(yy, xx)
+    # The Moffat is integrated over factor x factor sub-pixels if factor > 1.
+    data = moffat_psf(shape, fwhm[0], n, center=center, ratio=e, rot=rot,
+                      integrate=factor > 1, oversample=factor,
+                      normalize=False)
+    data *= norm
 
     return Image(data=data + cont, wcs=wcs, unit=unit, copy=False, dtype=None)
 
 
+def estimate_coordinate_offsets(images, ref, nsigma=1.0, workers=None):
+    """Estimate the coordinate offsets of several images relative to the
+    same reference image.
+
+    This does the same as `Image.estimate_coordinate_offset` for each image,
+    but the reference image is resampled only once for all the images that
+    have the same pixel scale and orientation, whatever their pointing,
+    onto a grid that covers all of them. The images are assumed to differ
+    by a translation, which is accurate for fields of a few arcminutes, and
+    the offsets of the images that are not at an integer pixel position on
+    this grid are corrected for the fractional part of this position. The
+    reference is prepared for the cross-correlation, and its Fourier
+    transform is computed, only once for the images that have the same
+    footprint. The images are cross-correlated with a pool of threads. This
+    is useful to check the astrometry of many exposures (e.g. their
+    white-light images) against the same reference image.
+
+    Unlike `Image.estimate_coordinate_offset`, the masked areas of each
+    image are not applied to the reference image, otherwise it would have
+    to be prepared again for each image. The masked areas of the resampled
+    reference image are still applied to the images.
+
+    Parameters
+    ----------
+    images : list of `~mpdaf.obj.Image`
+        The images to compare with the reference image.
+    ref : `~mpdaf.obj.Image`
+        The image of the sky that is to be used as the coordinate
+        reference, see `Image.estimate_coordinate_offset`.
+    nsigma : float
+        Only values that exceed this many standard deviations
+        above the mean of each image will be used.
+    workers : int
+        The number of threads. By default the number of CPUs, or
+        ``mpdaf.CPU`` if it is set.
+
+    Returns
+    -------
+    out : `astropy.table.Table`
+        A table with a row per image, with the pixel offsets ``dy`` and
+        ``dx`` that would need to be added to the coordinate reference
+        pixel values, crpix2 and crpix1, of each image, the corresponding
+        shifts of the coordinates ``shift_y`` and ``shift_x`` (in arcsec
+        for celestial coordinates, like `Image.adjust_coordinates`), and
+        ``peak``, the normalized value of the correlation peak, which is
+        close to 1 for images that are very similar to the reference.
+
+    """
+    images = list(images)
+    workers = get_workers(workers)
+
+    # Group the images whose pixel grids have the same scale and
+    # orientation, whatever their pointing. For each group, the reference
+    # image is resampled only once, onto a grid with this geometry that
+    # covers all the images. The grids of the images of a group are assumed
+    # to differ by a translation, which is accurate for fields of a few
+    # arcminutes. Each image is correlated with the part of this grid at its
+    # nearest integer pixel position, and the fractional part of this
+    # position is added to its offset.
+    groups = {}
+    for k, ima in enumerate(images):
+        key = (tuple(ima.wcs.wcs.wcs.ctype), ima.wcs.unit,
+               ima.wcs.get_cd().tobytes())
+        groups.setdefault(key, []).append(k)
+
+    tasks = [None] * len(images)
+    for indices in groups.values():
+        wcs = images[indices[0]].wcs
+        # position of the first pixel of each image on the grid of the
+        # first one (rounded to remove the errors of the transforms)
+        origins = np.array([wcs.sky2pix(images[k].wcs.pix2sky([0, 0]))[0]
+                            for k in indices]).round(6)
+        starts = np.floor(origins + 0.5).astype(int)
+        lo = starts.min(axis=0)
+        shape = (starts + [images[k].shape for k in indices]).max(axis=0) - lo
+
+        grid_wcs = wcs.copy()
+        grid_wcs.set_crpix1(wcs.get_crpix1() - lo[1])
+        grid_wcs.set_crpix2(wcs.get_crpix2() - lo[0])
+        grid_wcs.naxis1 = shape[1]
+        grid_wcs.naxis2 = shape[0]
+        aligned = ref.align_with_image(Image(wcs=grid_wcs,
+                                             data=np.zeros(shape), copy=False))
+        rmask = ma.getmaskarray(aligned.data)
+
+        # The images with the same footprint share the same prepared
+        # reference, so its spectrum is computed only once.
+        prepared = {}
+        for k, start, origin in zip(indices, starts, origins):
+            item = tuple(slice(st - l, st - l + n) for st, l, n in
+                         zip(start, lo, images[k].shape))
+            key = tuple((sl.start, sl.stop) for sl in item)
+            if key not in prepared:
+                prepared[key] = (rmask[item], _correlation_data(
+                    aligned._data[item], rmask[item], nsigma))
+            tasks[k] = prepared[key] + (origin - start, )
+
+    # Use all the threads for the FFTs when there is only one image.
+    fft_workers = workers if len(images) == 1 else 1
+
+    def offset(k):
+        ima = images[k]
+        rmask, rdata, frac = tasks[k]
+        mask = np.ma.mask_or(ima._mask, rmask)
+        sdata = _correlation_data(ima._data, mask, nsigma)
+        dy, dx, peak = _correlation_offset(sdata, rdata, workers=fft_workers)
+        return dy + frac[0], dx + frac[1], peak
+
+    results = _map_tiles(offset, range(len(images)), workers=workers)
+
+    unit = None
+    if images:
+        unit = u.arcsec if images[0].wcs.unit is u.deg else images[0].wcs.unit
+    rows = []
+    for ima, (dy, dx, peak) in zip(images, results):
+        shift = np.array([-dy, -dx]) * ima.wcs.get_axis_increments(unit)
+        rows.append((dy, dx, shift[0], shift[1], peak))
+
+    t = Table(rows=rows, names=('dy', 'dx', 'shift_y', 'shift_x', 'peak'),
+              dtype=(float, ) * 5)
+    t['shift_y'].unit = unit
+    t['shift_x'].unit = unit
+    return t
+
+
 def _antialias_filter_image(data, oldstep, newstep, oldfmax=None,
                             window="blackman"):
     """Apply an anti-aliasing prefilter to an image to prepare
@@ -4282,107 +4938,685 @@ def _antialias_filter_image(data, oldstep, newstep, oldfmax=None,
 
     """
 
-    # Convert oldstep into a numpy array of two float elements.
-    if is_number(oldstep):
-        oldstep = (oldstep, oldstep)
-    oldstep = abs(np.asarray(oldstep, dtype=float))
+    filt = _AntialiasFilter(data.shape, oldstep, newstep, oldfmax, window)
+    return filt(data), filt.newfmax
+
+
+class _AntialiasFilter:
+
+    """The anti-aliasing filter applied by `_antialias_filter_image`,
+    computed once for a given image shape so that it can be applied to
+    several images, like the planes of a cube.
+
+    Parameters
+    ----------
+    shape : (int, int)
+        The shape of the images to be filtered.
+    oldstep, newstep, oldfmax, window
+        See `_antialias_filter_image`.
+
+    Attributes
+    ----------
+    transfer : numpy.ndarray or None
+        The window function that is applied to the FFT of the zero-padded
+        images, or None if neither axis needs filtering.
+    newfmax : numpy.ndarray
+        The new band-limits along the Y and X axes.
+
+    """
+
+    def __init__(self, shape, oldstep, newstep, oldfmax=None,
+                 window="blackman"):
+
+        # Convert oldstep into a numpy array of two float elements.
+        if is_number(oldstep):
+            oldstep = (oldstep, oldstep)
+        oldstep = abs(np.asarray(oldstep, dtype=float))
+
+        # Convert newstep into a numpy array of two float elements.
+        if is_number(newstep):
+            newstep = (newstep, newstep)
+        newstep = abs(np.asarray(newstep, dtype=float))
+
+        # If no band-limits have been specified, substitute the
+        # band-limits dictated by the current sampling interval.
+        if oldfmax is None:
+            oldfmax = 0.5 / oldstep
+        else:
+            oldfmax = np.minimum(oldfmax, 0.5 / oldstep)
+
+        # Calculate the maximum frequencies that will be sampled by
+        # the new pixel sizes along the Y and X axes.
+        newfmax = 0.5 / newstep
+
+        # Which axes need to be filtered?
+        filter_axes = newfmax < oldfmax
+
+        # The original image is returned if neither axis needs filtering.
+        if np.all(np.logical_not(filter_axes)):
+            self.transfer = None
+            self.newfmax = oldfmax
+            return
+
+        # Get the extent of the input image as a pair of slices.
+        self.image_slice = (slice(0, shape[0]), slice(0, shape[1]))
+
+        # FFT algorithms can be extremely slow for arrays whose
+        # dimensions are not powers of 2. The conventional way to avoid
+        # this is to copy the image into a new array whose dimensions
+        # are powers of 2, and fill the extra pixels with zeros.
+        self.shape = 2**(np.ceil(np.log(np.asarray(shape)) /
+                                 np.log(2.0))).astype(int)
+
+        # Get the new dimensions of the zero-padded image.
+        ny, nx = self.shape
+
+        # The new pixel sizes along the X and Y axes can only correctly
+        # sample spatial frequencies up to the values in newfmax. Set the
+        # cutoff frequencies for the window functions along the x and y
+        # axes to those frequencies.
+        fycut, fxcut = newfmax
+
+        # Create an array which, for each pixel in the FFT image, holds
+        # the radial spatial-frequency of the pixel center, divided by
+        # the cutoff frequency. These values will later be used to index
+        # the 1D window-function.
+
+        wr = np.sqrt((np.fft.rfftfreq(nx, oldstep[1]) / fxcut)**2 +
+                     (np.fft.fftfreq(ny, oldstep[0]) /
+                      fycut)[np.newaxis, :].T**2)
+
+        # Get the requested window function as a function of frequency
+        # divided by its cutoff frequency.
+
+        if window is None or window == "blackman":
+            winfn = lambda r: np.where(r <= 1.0,
+                                       0.42 + 0.5 * np.cos(np.pi * r) +
+                                       0.08 * np.cos(2 * np.pi * r),
+                                       0.0)
+
+        # For the gaussian window the standard deviation, sigma, is
+        # as a fraction of the normalized cutoff frequency. Note that
+        # in the image plane the corresponding gaussian standard
+        # deviation should be newstep/(pi*sigma).
+
+        elif window == "gaussian":
+            sigma = 0.44
+            winfn = lambda r: np.exp(-0.5 * (r / sigma)**2)
+
+        # For the rectangular window, just multiply all pixels below the
+        # cutoff frequency by one, and the rest by zero.
+
+        elif window == "rectangle":
+            winfn = lambda r: np.where(r <= 1.0, 1.0, 0.0)
+
+        self.transfer = winfn(wr)
+        self.newfmax = np.where(filter_axes, newfmax, oldfmax)
+
+    def __call__(self, data):
+        """Return the filtered version of a 2D image."""
+        if self.transfer is None:
+            return data
+
+        # Zero-pad the image to the dimensions of the FFT.
+        if data.shape[0] != self.shape[0] or data.shape[1] != self.shape[1]:
+            tmp = np.zeros(self.shape)
+            tmp[self.image_slice] = data
+            data = tmp
+
+        # Obtain the FFT of the image.
+        fft = np.fft.rfft2(data)
+        del data
+
+        # Apply the window function to the FFT to remove frequencies above
+        # the cutoff frequencies.
+        fft *= self.transfer
+
+        # Perform an inverse Fourier transform to get the filtered image
+        data = np.fft.irfft2(fft)
+        del fft
+
+        # Crop the antialiased image to remove the zero-padded pixels.
+        return data[self.image_slice]
+
+
+
+def _affine_weights(inshape, outshape, new2old, offset, order=1):
+    """Compute the input pixels and the interpolation weights of each
+    output pixel of `scipy.ndimage.affine_transform`, for the orders 0
+    (nearest), 1 (linear) and 3 (cubic spline) and the 'constant' mode.
 
-    # Convert newstep into a numpy array of two float elements.
-    if is_number(newstep):
-        newstep = (newstep, newstep)
-    newstep = abs(np.asarray(newstep, dtype=float))
+    For the order 3, the weights apply to the spline coefficients of the
+    input array, i.e. to the output of
+    ``scipy.ndimage.spline_filter(data, 3, mode='constant')``.
 
-    # If no band-limits have been specified, substitute the
-    # band-limits dictated by the current sampling interval.
-    if oldfmax is None:
-        oldfmax = 0.5 / oldstep
+    Returns the flat indexes of the input pixels and their weights, both
+    arrays of shape (npix, nout) where npix is 1 for order 0, 4 for order 1
+    and 16 for order 3, and a boolean array that is False for the output
+    pixels that fall outside the input array (which get the constant
+    value).
+
+    """
+    inshape = np.asarray(inshape)
+    newpix = np.indices(outshape, dtype=float).reshape(2, -1)
+    coords = np.dot(new2old, newpix) + np.reshape(offset, (2, 1))
+    valid = np.all((coords >= 0) & (coords <= (inshape - 1)[:, None]),
+                   axis=0)
+    nmax = (inshape - 1)[:, None]
+
+    if order == 0:
+        pix = np.clip(np.floor(coords + 0.5), 0, nmax).astype(int)
+        indices = np.ravel_multi_index(pix, inshape)[np.newaxis]
+        weights = np.ones(indices.shape)
+    elif order == 1:
+        pix0 = np.clip(np.floor(coords), 0, nmax)
+        frac = np.clip(coords - pix0, 0, 1)
+        pix0 = pix0.astype(int)
+        pix1 = np.minimum(pix0 + 1, nmax)
+        indices = np.array([
+            np.ravel_multi_index((y, x), inshape)
+            for y in (pix0[0], pix1[0]) for x in (pix0[1], pix1[1])])
+        weights = np.array([wy * wx
+                            for wy in (1 - frac[0], frac[0])
+                            for wx in (1 - frac[1], frac[1])])
+    elif order == 3:
+        start = np.floor(coords).astype(int) - 1
+        t = coords - start - 1
+        # cubic B-spline weights of the pixels start to start + 3
+        wts = np.array([(1 - t) ** 3,
+                        3 * t ** 3 - 6 * t ** 2 + 4,
+                        -3 * t ** 3 + 3 * t ** 2 + 3 * t + 1,
+                        t ** 3]) / 6
+        # the coefficients outside the array are mirrored, like in
+        # scipy.ndimage
+        pix = np.abs(start + np.arange(4)[:, None, None])
+        pix = np.where(pix > nmax, 2 * nmax - pix, pix)
+        pix = np.clip(pix, 0, nmax)
+        indices = np.array([np.ravel_multi_index((y, x), inshape)
+                            for y in pix[:, 0] for x in pix[:, 1]])
+        weights = np.array([wy * wx for wy in wts[:, 0] for wx in wts[:, 1]])
     else:
-        oldfmax = np.minimum(oldfmax, 0.5 / oldstep)
+        raise ValueError('only the orders 0, 1 and 3 are supported')
+
+    return indices, weights, valid
+
+
+class _ResamplingPlan:
+
+    """The resampling of images onto a new pixel grid, as computed by
+    `Image._get_regrid_plan` and `Image._get_rotate_plan`.
+
+    The pixel indexes of the input images are computed from those of
+    the output images with the affine transform used by
+    `scipy.ndimage.affine_transform`::
+
+        oldpixel = new2old * newpixel + offset
+
+    A plan can be applied to all the images that have the same shape and
+    world coordinates, like the planes of a cube. The anti-aliasing filter
+    is computed only once, and `precompute` can be used to compute the
+    input pixels and interpolation weights of each output pixel (for the
+    orders 0 and 1), which are then reused for each image.
+
+    Attributes
+    ----------
+    inshape, outshape : (int, int)
+        The shapes of the input and output images.
+    new2old : numpy.ndarray
+        The 2x2 affine transform matrix, in (Y,X) axis order.
+    offset : numpy.ndarray
+        The offset of the affine transform.
+    wcs : `mpdaf.obj.WCS`
+        The world coordinates of the resampled images.
+    newfmax : numpy.ndarray or None
+        The spatial-frequency band-limits of the resampled images, if
+        they must be updated.
+
+    """
+
+    def __init__(self, inshape, outshape, new2old, offset, wcs, order=1,
+                 prefilter=False, mask_order=1, mask_prefilter=False,
+                 output=None, antialias=None, data_scale=1.0, var_scale=1.0,
+                 newfmax=None):
+        self.inshape = tuple(inshape)
+        self.outshape = tuple(int(n) for n in outshape)
+        self.new2old = new2old
+        self.offset = np.asarray(offset, dtype=float).flatten()
+        self.wcs = wcs
+        self.order = order
+        self.prefilter = prefilter
+        self.mask_order = mask_order
+        self.mask_prefilter = mask_prefilter
+        self.output = output
+        self.antialias = antialias
+        self.data_scale = data_scale
+        self.var_scale = var_scale
+        self.newfmax = newfmax
+        self._weights = {}
+
+    def precompute(self):
+        """Compute the input pixels and interpolation weights of the output
+        pixels, for the data and the mask if their interpolation order is
+        less than 2."""
+        for order in {self.order, self.mask_order}:
+            if order <= 1 and order not in self._weights:
+                self._weights[order] = _affine_weights(
+                    self.inshape, self.outshape, self.new2old, self.offset,
+                    order=order)
+
+    def _transform(self, data, order, prefilter, cval=0.0, output=None):
+        weights = self._weights.get(order)
+        if weights is None:
+            return affine_transform(data, self.new2old, self.offset,
+                                    output_shape=self.outshape, order=order,
+                                    prefilter=prefilter, cval=cval,
+                                    output=output)
+
+        indices, weights, valid = weights
+        flat = data.ravel()
+        res = weights[0] * flat[indices[0]]
+        for ind, wgt in zip(indices[1:], weights[1:]):
+            res += wgt * flat[ind]
+        res[~valid] = cval
+        return res.reshape(self.outshape).astype(output or data.dtype,
+                                                 copy=False)
+
+    def apply_data(self, data, var=None):
+        """Resample the data array, which must not contain masked values,
+        and the variance array if not None."""
+        if self.antialias is not None:
+            data = self.antialias(data)
+
+        data = self._transform(data, self.order, self.prefilter,
+                               output=self.output)
+        if self.data_scale != 1.0:
+            data *= self.data_scale
+
+        if var is not None:
+            var = self._transform(var, self.order, self.prefilter,
+                                  output=self.output)
+            if self.var_scale != 1.0:
+                var *= self.var_scale
+
+        return data, var
+
+    def apply_mask(self, mask, cutoff=0.25):
+        """Resample a boolean mask array."""
+        # Resample a floating point version of the mask array, in which
+        # masked elements are 1.0 and unmasked elements are 0.0. Pixels
+        # outside of the input array are masked.
+        mask = self._transform(mask.astype(float), self.mask_order,
+                               self.mask_prefilter, cval=1.0, output=float)
+
+        # Create new boolean mask in which all pixels that had an
+        # integrated contribution of more than 'cutoff' originally
+        # masked pixels are masked. Note that setting the cutoff to
+        # the "obvious" value of zero results in lots of pixels being
+        # masked that are far away from any masked pixels, due to
+        # precision errors in the affine_transform() function.
+        # Limit the minimum value of the cutoff to avoid this.
+        return np.greater(mask, max(cutoff, 1.0e-6))
+
+    def apply(self, data, mask, var=None, cutoff=0.25):
+        """Resample the data, mask and variance arrays of an image."""
+        data, var = self.apply_data(data, var)
+        return data, self.apply_mask(mask, cutoff), var
+
+
+class RegridOperator:
+
+    """A sparse linear operator that resamples images onto a new grid,
+    returned by `Image.get_regrid_operator`.
+
+    The interpolation of the images is a product with a sparse matrix,
+    which maps the input pixels to the output pixels. This gives the same
+    result as `Image.regrid` without anti-aliasing filter. The masks are
+    resampled like in `Image.regrid`, with a cubic spline, which is also a
+    product with a sparse matrix once the spline coefficients of the mask
+    are computed.
+
+    Attributes
+    ----------
+    matrix : `scipy.sparse.csr_matrix`
+        The interpolation matrix, of shape (number of output pixels, number
+        of input pixels).
+    inshape : (int, int)
+        The shape of the input images.
+    shape : (int, int)
+        The shape of the output images.
+    wcs : `mpdaf.obj.WCS`
+        The world coordinates of the output images.
+
+    """
+
+    def __init__(self, plan):
+        self._plan = plan
+        self.inshape = plan.inshape
+        self.shape = plan.outshape
+        self.wcs = plan.wcs
+
+        self.matrix, _ = self._get_matrix(plan.order)
+        # The masks are interpolated with their own matrix, and the output
+        # pixels that fall outside of the input images are masked.
+        self._mask_matrix, valid = self._get_matrix(plan.mask_order)
+        self._mask_outside = (~valid).astype(float)
+
+    def _get_matrix(self, order):
+        plan = self._plan
+        indices, weights, valid = _affine_weights(
+            plan.inshape, plan.outshape, plan.new2old, plan.offset,
+            order=order)
+        rows = np.broadcast_to(np.arange(indices.shape[1]), indices.shape)
+        matrix = sparse.csr_matrix(
+            ((weights * valid).ravel(), (rows.ravel(), indices.ravel())),
+            shape=(indices.shape[1], np.prod(plan.inshape)))
+        return matrix, valid
+
+    def __call__(self, data):
+        """Interpolate an image, or a stack of images, whose last two
+        dimensions are the input shape. Pixels that fall outside of the
+        input images are set to 0."""
+        data = np.asarray(data)
+        if data.shape[-2:] != self.inshape:
+            raise ValueError('the images must have a shape of {}'
+                             .format(self.inshape))
+        stack = data.reshape(-1, self.matrix.shape[1]).T
+        res = self.matrix.dot(stack).T
+        return res.reshape(data.shape[:-2] + self.shape)
+
+    def regrid(self, image, interp='no', cutoff=0.25, inplace=False):
+        """Resample an image.
+
+        Parameters
+        ----------
+        image : `~mpdaf.obj.Image`
+            The image, with the input shape and world coordinates of the
+            operator.
+        interp : 'no' | 'linear' | 'spline'
+            How the masked values are replaced before the interpolation,
+            see `Image.regrid`.
+        cutoff : float
+            Mask each output pixel where at least this fraction of the
+            pixel was interpolated from masked input pixels.
+        inplace : bool
+            If False, return a resampled copy of the image (the default).
+            If True, resample the original image in-place, and return that.
+
+        Returns
+        -------
+        out : `~mpdaf.obj.Image`
+
+        """
+        plan = self._plan
+        data = self(image._prepare_data(interp))
+        if plan.data_scale != 1.0:
+            data *= plan.data_scale
+
+        # The mask is resampled with the same spline as in Image.regrid,
+        # and masked where the contribution of the masked pixels is more
+        # than cutoff (see _ResamplingPlan.apply_mask).
+        mask = ma.getmaskarray(image.data).astype(float)
+        if plan.mask_prefilter and plan.mask_order > 1:
+            mask = ndi.spline_filter(mask, plan.mask_order, mode='constant')
+        mask = self._mask_matrix.dot(mask.ravel()) + self._mask_outside
+        mask = np.greater(mask.reshape(self.shape), max(cutoff, 1.0e-6))
+
+        if image._var is not None:
+            var = self(image._var)
+            if plan.var_scale != 1.0:
+                var *= plan.var_scale
+        else:
+            var = None
+
+        out = image if inplace else image.clone()
+        out._data = data
+        out._mask = mask
+        out._var = var
+        out.wcs = self.wcs.copy()
+        out.update_spatial_fmax(plan.newfmax)
+        return out
 
-    # Calculate the maximum frequencies that will be sampled by
-    # the new pixel sizes along the Y and X axes.
-    newfmax = 0.5 / newstep
 
-    # Which axes need to be filtered?
-    filter_axes = newfmax < oldfmax
+def _radial_geometry(shape, centers, edges2, square=False, oversample=1):
+    """Return the pixels and the radial bins of profiles around centers.
 
-    # Return the original image if neither axis needs filtering.
-    if np.all(np.logical_not(filter_axes)):
-        return data, oldfmax
+    A pixel (or sub-pixel when ``oversample > 1``) falls in the bin ``k`` of
+    a profile if its squared distance to the center is less than
+    ``edges2[k]`` and not less than ``edges2[k - 1]``. The distance is the
+    maximum of the distances along the two axes if ``square`` is True.
 
-    # Get the extent of the input image as a pair of slices.
-    image_slice = (slice(0, data.shape[0]), slice(0, data.shape[1]))
+    Return the flat indexes of the pixels, the flat indexes of their bins
+    (index of the center * number of bins + index of the bin), the fraction
+    of each pixel that falls in its bin, and the mean distance of the pixels
+    of each bin, with a shape of (number of centers, number of bins).
 
-    # FFT algorithms can be extremely slow for arrays whose
-    # dimensions are not powers of 2. The conventional way to avoid this
-    # is to copy the image into a new array whose dimensions
-    # are powers of 2, and fill the extra pixels with zeros.
+    """
+    nbins = len(edges2)
+    ncenters = len(centers)
+    half = int(np.ceil(np.sqrt(edges2[-1]))) + 1
+    win = np.arange(2 * half + 2)
+    origin = np.floor(centers).astype(int) - half
+    py = origin[:, 0, None] + win
+    px = origin[:, 1, None] + win
+    sub = (np.arange(oversample) + 0.5) / oversample - 0.5
+
+    # distances along each axis, of shape (centers, pixels, sub-pixels)
+    dy = py[:, :, None] + sub - centers[:, 0, None, None]
+    dx = px[:, :, None] + sub - centers[:, 1, None, None]
+    dy2 = (dy * dy)[:, :, None, :, None]
+    dx2 = (dx * dx)[:, None, :, None, :]
+    d2 = np.maximum(dy2, dx2) if square else dy2 + dx2
+
+    bins = np.searchsorted(edges2, d2, side='right')
+    inside = ((py >= 0) & (py < shape[0]))[:, :, None, None, None] & \
+        ((px >= 0) & (px < shape[1]))[:, None, :, None, None]
+    sel = np.nonzero(inside & (bins < nbins))
+
+    pixels = py[sel[0], sel[1]] * shape[1] + px[sel[0], sel[2]]
+    bins = sel[0] * nbins + bins[sel]
+    dist = np.sqrt(d2[sel])
+    weights = np.full(len(pixels), 1.0 / oversample ** 2)
+
+    size = ncenters * nbins
+    norm = np.bincount(bins, weights=weights, minlength=size)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rmean = np.bincount(bins, weights=dist * weights,
+                            minlength=size) / norm
+
+    if oversample > 1:
+        # merge the sub-pixels of a pixel that fall in the same bin
+        key, inverse = np.unique(bins * np.prod(shape) + pixels,
+                                 return_inverse=True)
+        weights = np.bincount(inverse, weights=weights)
+        bins, pixels = np.divmod(key, np.prod(shape))
+
+    return pixels, bins, weights, rmean.reshape(ncenters, nbins)
+
+
+class RadialProfile:
+
+    """Encircled or ensquared energy profiles around one or several
+    positions of an image, returned by `Image.radial_profile`.
+
+    The aperture of radius ``radius[k]`` contains the pixels (or
+    sub-pixels) whose distance to the center is less than ``radius[k]``.
+    With the default bin width of one pixel, ``radius[k]`` is ``k + 0.5``
+    pixels, and with ``square=True`` the aperture is then the square of
+    ``2 * k + 1`` pixels around the central pixel.
 
-    shape = 2**(np.ceil(np.log(np.asarray(data.shape)) /
-                        np.log(2.0))).astype(int)
-    if data.shape[0] != shape[0] or data.shape[1] != shape[1]:
-        tmp = np.zeros(shape)
-        tmp[image_slice] = data
-        data = tmp
+    Attributes
+    ----------
+    center : array of shape (n, 2)
+        The pixel coordinates (y, x) of the centers of the profiles.
+    radius : array of shape (nbins,)
+        The radii of the apertures, in ``unit`` (in pixels if None).
+    rmean : array of shape (n, nbins)
+        The mean distance to the center of the pixels of each annulus.
+    flux : array of shape (n, nbins)
+        The flux of the unmasked pixels of each annulus, minus the
+        continuum.
+    npix : array of shape (n, nbins)
+        The number of unmasked pixels in each annulus.
+    unit : `astropy.units.Unit`
+        The unit of the radii.
+
+    """
 
-    # Get the new dimensions of the zero-padded image.
-    ny, nx = shape
+    def __init__(self, center, radius, rmean, flux, npix, unit=None):
+        self.center = center
+        self.radius = radius
+        self.rmean = rmean
+        self.flux = flux
+        self.npix = npix
+        self.unit = unit
 
-    # Obtain the FFT of the image.
-    fft = np.fft.rfft2(data)
-    del data
+    def __len__(self):
+        return len(self.center)
 
-    # The new pixel sizes along the X and Y axes can only correctly
-    # sample spatial frequencies up to the values in newfmax. Set the
-    # cutoff frequencies for the window functions along the x and y
-    # axes to those frequencies.
-    fycut, fxcut = newfmax
+    @property
+    def ee(self):
+        """The cumulative flux in the apertures, of shape (n, nbins)."""
+        return np.cumsum(self.flux, axis=1)
 
-    # Create an array which, for each pixel in the FFT image, holds
-    # the radial spatial-frequency of the pixel center, divided by
-    # the cutoff frequency. These values will later be used to index
-    # the 1D window-function.
+    @property
+    def area(self):
+        """The cumulative number of unmasked pixels in the apertures."""
+        return np.cumsum(self.npix, axis=1)
 
-    wr = np.sqrt((np.fft.rfftfreq(nx, oldstep[1]) / fxcut)**2 +
-                 (np.fft.fftfreq(ny, oldstep[0]) / fycut)[np.newaxis, :].T**2)
+    @property
+    def sb(self):
+        """The mean flux per pixel in each annulus (NaN if empty)."""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.flux / self.npix
 
-    # Get the requested window function as a function of frequency
-    # divided by its cutoff frequency.
+    def eer(self, etot=None):
+        """Return the enclosed energy ratios, of shape (n, nbins).
+
+        Parameters
+        ----------
+        etot : float or array of shape (n,)
+            Total energy used to compute the ratios. By default the energy
+            in the largest aperture is used.
+
+        """
+        ee = self.ee
+        if etot is None:
+            etot = ee[:, -1]
+        return ee / np.reshape(etot, (-1, 1))
+
+    def ee_radius(self, frac=0.9, etot=None):
+        """Return the radius of the aperture containing a fraction of the
+        energy, for each profile.
+
+        The radius is interpolated between the first aperture whose
+        energy ratio is larger than ``frac`` and the previous one.
+
+        Parameters
+        ----------
+        frac : float in ]0,1]
+            Fraction of energy.
+        etot : float or array of shape (n,)
+            Total energy used to compute the ratios, see `eer`.
 
-    if window is None or window == "blackman":
-        winfn = lambda r: np.where(r <= 1.0,
-                                   0.42 + 0.5 * np.cos(np.pi * r) +
-                                   0.08 * np.cos(2 * np.pi * r),
-                                   0.0)
+        Returns
+        -------
+        out : array of shape (n,)
 
-    # For the gaussian window the standard deviation, sigma, is
-    # as a fraction of the normalized cutoff frequency. Note that
-    # in the image plane the corresponding gaussian standard
-    # deviation should be newstep/(pi*sigma).
+        """
+        eer = self.eer(etot)
+        if eer.shape[1] < 2:
+            raise ValueError('The profiles need at least two apertures')
+        above = eer[:, 1:] > frac
+        k = np.where(above.any(axis=1), above.argmax(axis=1) + 1,
+                     eer.shape[1] - 1)
+        rows = np.arange(len(eer))
+        e1, e2 = eer[rows, k - 1], eer[rows, k]
+        r1, r2 = self.radius[k - 1], self.radius[k]
+        return r1 + (frac - e1) / (e2 - e1) * (r2 - r1)
+
+    def fwhm(self):
+        """Return the full width at half maximum of each profile.
+
+        The half maximum is found on the mean flux per pixel of the annuli,
+        by linear interpolation of the mean distances of their pixels. NaN
+        is returned if the profile does not fall below half its maximum.
 
-    elif window == "gaussian":
-        sigma = 0.44
-        winfn = lambda r: np.exp(-0.5 * (r / sigma)**2)
+        """
+        sb = self.sb
+        with np.errstate(invalid='ignore'):
+            half = np.nanmax(sb, axis=1)[:, None] / 2
+            below = sb < half
+        found = below.any(axis=1)
+        k = np.maximum(below.argmax(axis=1), 1)
+        rows = np.arange(len(sb))
+        s1, s2 = sb[rows, k - 1], sb[rows, k]
+        r1, r2 = self.rmean[rows, k - 1], self.rmean[rows, k]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            rhalf = r1 + (half[:, 0] - s1) / (s2 - s1) * (r2 - r1)
+        return np.where(found, 2 * rhalf, np.nan)
+
+
+def _correlation_data(data, mask, nsigma):
+    """Prepare an image for the cross-correlation of
+    `Image.estimate_coordinate_offset`.
+
+    The masked pixels are replaced by the median value of the image, and all
+    the values that are less than nsigma standard deviations above the mean
+    are set to zero. The log of the remaining values is returned.
 
-    # For the rectangular window, just multiply all pixels below the
-    # cutoff frequency by one, and the rest by zero.
+    """
+    # Get a copy of the array with masked pixels filled with the median
+    # value of the image.
+    data = np.ma.array(data=data, mask=mask)
+    data = np.where(np.ma.getmaskarray(data), np.ma.median(data), data.data)
+
+    # When we cross-correlate the images, any constant or noisy
+    # background will bias the result towards the origin of the
+    # correlation, so remove most of the noisy background by
+    # zeroing all values that are less than nsigma standard
+    # deviations above the mean.
+    data[data < data.mean() + nsigma * data.std()] = 0
+
+    # Sometimes a bright artefact or a bright star with
+    # appreciable proper motion biases the correlation. To avoid
+    # this take the log of the thresholded data to prevent very
+    # bright features from dominating the correlation.
+    return np.log(1.0 + data)
+
+
+def _correlation_offset(sdata, rdata, workers=None):
+    """Return the offset (dy, dx) of the features of sdata relative to
+    those of rdata (two images prepared by `_correlation_data`), and the
+    normalized value of the correlation peak.
+
+    The images are cross-correlated by convolving sdata with an
+    axis-reversed version of rdata, whose spectrum is cached by
+    `~mpdaf.obj.data._fftconvolve`, so it is computed only once when many
+    images are correlated with the same reference.
 
-    elif window == "rectangle":
-        winfn = lambda r: np.where(r <= 1.0, 1.0, 0.0)
+    """
+    # Use mode="same" to only keep the inner half of the array. We don't
+    # expect the peak to be outside this area, and this avoids edge effects
+    # where there is incomplete data.
+    cc = _fftconvolve(sdata, rdata[::-1, ::-1], mode="same", workers=workers)
 
-    # Apply the window function to the FFT to remove frequencies above the
-    # cutoff frequencies.
+    # Find the position of the maximum value in the correlation image.
+    py, px = np.unravel_index(np.argmax(cc), cc.shape)
 
-    fft *= winfn(wr)
-    del wr
+    # Quadratically interpolate a more precise peak position from three
+    # points along the X and Y axes, centered on the position found above.
+    py2 = py - 1 + _find_quadratic_peak(cc[py - 1: py + 2, px])
+    px2 = px - 1 + _find_quadratic_peak(cc[py, px - 1: px + 2])
 
-    # Perform an inverse Fourier transform to get the filtered image
-    data = np.fft.irfft2(fft)
-    del fft
+    # Compute the offset of the peak relative to the central pixel
+    # of the correlation image. This yields the offset between the
+    # two images.
+    dy = py2 - float(cc.shape[0] // 2)
+    dx = px2 - float(cc.shape[1] // 2)
 
-    # Crop the antialiased image to remove the zero-padded pixels, and
-    # return this along with the new spatial-frequency limits.
-    return data[image_slice], np.where(filter_axes, newfmax, oldfmax)
+    norm = np.sqrt(np.sum(sdata ** 2) * np.sum(rdata ** 2))
+    peak = cc[py, px] / norm if norm > 0 else np.nan
+    return dy, dx, peak
 
 
 def _find_quadratic_peak(y):
@@ -4558,3 +5792,171 @@ class SpatialFrequencyLimits:
         y = xs * cos_t * sin_psi + ys * sin_t * cos_psi
 
         return np.array([y, x], dtype=float)
+
+
+def _tile_grid(shape, tile):
+    """Split an image shape in a grid of non-overlapping tiles.
+
+    Returns a list of rows of tiles, each tile being a (y, x) tuple of
+    slices.
+    """
+    ty, tx = np.broadcast_to(np.asarray(tile, dtype=int), (2,))
+    if ty <= 0 or tx <= 0:
+        raise ValueError('the tile size must be positive')
+    return [[(slice(y, min(y + ty, shape[0])), slice(x, min(x + tx, shape[1])))
+             for x in range(0, shape[1], tx)]
+            for y in range(0, shape[0], ty)]
+
+
+def _pad_tile(core, shape, halo):
+    """Return the slices of a tile extended by a margin of halo pixels, and
+    the slices of the tile in the extended tile."""
+    pad = tuple(slice(max(s.start - halo, 0), min(s.stop + halo, n))
+                for s, n in zip(core, shape))
+    inner = tuple(slice(s.start - p.start, s.stop - p.start)
+                  for s, p in zip(core, pad))
+    return pad, inner
+
+
+def _map_tiles(func, tiles, workers=None):
+    """Apply func on each tile, with a pool of threads."""
+    workers = get_workers(workers)
+    if workers == 1 or len(tiles) == 1:
+        return [func(t) for t in tiles]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(func, tiles))
+
+
+def _label_strips(labels):
+    """Return the labels of the first and last rows and columns."""
+    return (labels[0].copy(), labels[-1].copy(),
+            labels[:, 0].copy(), labels[:, -1].copy())
+
+
+def _merge_tile_labels(grid_shape, nlabels, strips, connectivity):
+    """Merge the labels of objects that cross the borders of tiles.
+
+    Parameters
+    ----------
+    grid_shape : (int, int)
+        Number of rows and columns of tiles.
+    nlabels : list of int
+        Number of labels of each tile, in row-major order.
+    strips : list of tuple
+        Labels of the first and last rows and columns of each tile (see
+        `_label_strips`).
+    connectivity : int
+        1 if only the direct neighbors are connected, 2 if diagonal
+        neighbors are also connected.
+
+    Returns
+    -------
+    offsets : array of int
+        Offset of the labels of each tile in the global numbering, the
+        local label i of tile k being global label ``offsets[k] + i - 1``.
+    comp : array of int
+        Index of the merged object of each global label.
+    ncomp : int
+        Number of merged objects.
+
+    """
+    nty, ntx = grid_shape
+    offsets = np.concatenate([[0], np.cumsum(nlabels)[:-1]]).astype(int)
+    total = int(np.sum(nlabels))
+
+    def glob(labels, k):
+        return np.where(labels > 0, labels + offsets[k] - 1, -1)
+
+    pairs = []
+
+    def connect(a, b):
+        shifts = [(slice(None), slice(None))]
+        if connectivity > 1:
+            shifts += [(slice(1, None), slice(None, -1)),
+                       (slice(None, -1), slice(1, None))]
+        for sa, sb in shifts:
+            ok = (a[sa] >= 0) & (b[sb] >= 0)
+            pairs.append(np.column_stack([a[sa][ok], b[sb][ok]]))
+
+    # horizontal borders: last row of a tile and first row of the next one
+    for i in range(1, nty):
+        upper = np.concatenate([glob(strips[(i - 1) * ntx + j][1],
+                                     (i - 1) * ntx + j) for j in range(ntx)])
+        lower = np.concatenate([glob(strips[i * ntx + j][0], i * ntx + j)
+                                for j in range(ntx)])
+        connect(upper, lower)
+
+    # vertical borders: last column of a tile and first column of the next
+    for j in range(1, ntx):
+        left = np.concatenate([glob(strips[i * ntx + j - 1][3],
+                                    i * ntx + j - 1) for i in range(nty)])
+        right = np.concatenate([glob(strips[i * ntx + j][2], i * ntx + j)
+                                for i in range(nty)])
+        connect(left, right)
+
+    pairs = np.concatenate(pairs) if pairs else np.zeros((0, 2), dtype=int)
+    graph = sparse.coo_matrix(
+        (np.ones(len(pairs), dtype=bool), (pairs[:, 0], pairs[:, 1])),
+        shape=(total, total))
+    ncomp, comp = connected_components(graph, directed=False)
+    return offsets, comp, ncomp
+
+
+def _first_pixels(labels, nlabels, core, width):
+    """Return the global raster index of the first pixel of each label."""
+    values, index = np.unique(labels, return_index=True)
+    first = np.empty(nlabels, dtype=np.int64)
+    ny, nx = labels.shape
+    y, x = np.divmod(index[values > 0], nx)
+    first[values[values > 0] - 1] = ((y + core[0].start) * width +
+                                     x + core[1].start)
+    return first
+
+
+def _tiled_kth_value(tiles, get_values, k, workers=None,
+                     maxvalues=2 ** 22):
+    """Return the k-th smallest value (from 0) of a tiled dataset.
+
+    The values are selected with successive histograms, so that at most
+    ``maxvalues`` values are gathered in memory.
+    """
+    def minmax(sl):
+        v = get_values(sl)
+        return (v.min(), v.max()) if v.size else (np.inf, -np.inf)
+
+    res = _map_tiles(minmax, tiles, workers)
+    lo = min(r[0] for r in res)
+    hi = max(r[1] for r in res)
+    below = 0
+    while True:
+        def count(sl):
+            v = get_values(sl)
+            return np.count_nonzero((v >= lo) & (v <= hi))
+        ninside = sum(_map_tiles(count, tiles, workers))
+        if lo == hi:
+            return lo
+        if ninside <= maxvalues:
+            def select(sl):
+                v = get_values(sl)
+                return v[(v >= lo) & (v <= hi)]
+            values = np.concatenate(_map_tiles(select, tiles, workers))
+            return np.partition(values, k - below)[k - below]
+
+        edges = np.linspace(lo, hi, 1025)
+
+        def histogram(sl):
+            v = get_values(sl)
+            return np.histogram(v[(v >= lo) & (v <= hi)], edges)[0]
+        cum = np.cumsum(np.sum(_map_tiles(histogram, tiles, workers), axis=0))
+        j = np.searchsorted(cum, k - below, side='right')
+        newlo = edges[j]
+        # the bins are [a, b[ except the last one
+        newhi = hi if j == len(edges) - 2 else np.nextafter(edges[j + 1],
+                                                              -np.inf)
+        if newlo == lo and newhi == hi:
+            # no progress, because of the floating-point resolution
+            maxvalues = np.inf
+            continue
+        if j > 0:
+            below += cum[j - 1]
+        lo, hi = newlo, newhi
@@ -32,9 +32,9 @@ OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 import logging
 import numpy as np
 import warnings
-from astropy.stats import sigma_clipped_stats
 
 from .image import Image
+from ..tools import clipped_stats
 
 __all__ = ('mask_sources', )
 
@@ -72,7 +72,7 @@ def mask_sources(image, sigma=3., iterations=2, opening_iterations=0,
 
     with warnings.catch_warnings():
         warnings.simplefilter('ignore', category=RuntimeWarning)
-        mean, median, std = sigma_clipped_stats(im.data, sigma=3.0)
+        mean, median, std, _ = clipped_stats(im.data, sigma=3.0)
         logger.info('mean: %s, median: %s, std: %s', mean, median, std)
         threshold = median + (std * sigma)
         segm_img = photutils.detect_sources(im.data, threshold, npixels=5)
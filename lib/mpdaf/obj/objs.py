@@ -39,7 +39,7 @@ from astropy.constants import c
 from astropy.units import Quantity
 
 __all__ = ('is_float', 'is_int', 'is_number', 'flux2mag', 'mag2flux',
-           'UnitArray', 'UnitMaskedArray', 'bounding_box')
+           'UnitArray', 'UnitMaskedArray', 'bounding_box', 'polygon_mask')
 
 
 def is_float(x):
@@ -60,16 +60,29 @@ def is_number(x):
 def flux2mag(flux, err_flux, wave):
     """Convert flux from erg.s-1.cm-2.A-1 to AB mag.
 
-    wave is the wavelength in A
+    wave is the wavelength in A. The fluxes, errors and wavelengths can be
+    arrays (broadcast together), the magnitudes of the negative or null
+    fluxes are set to 99 and their errors to inf.
 
     """
-    if flux > 0:
-        cs = c.to('Angstrom/s').value  # speed of light in A/s
-        mag = -48.60 - 2.5 * np.log10(wave ** 2 * flux / cs)
-        err_mag = np.abs(2.5 * err_flux / (flux * np.log(10)))
-        return (mag, err_mag)
-    else:
-        return (99, np.inf)
+    cs = c.to('Angstrom/s').value  # speed of light in A/s
+    if np.ndim(flux) == 0:
+        if flux > 0:
+            mag = -48.60 - 2.5 * np.log10(wave ** 2 * flux / cs)
+            err_mag = np.abs(2.5 * err_flux / (flux * np.log(10)))
+            return (mag, err_mag)
+        else:
+            return (99, np.inf)
+
+    flux, err_flux, wave = np.broadcast_arrays(flux, err_flux, wave)
+    positive = flux > 0
+    mag = np.full(flux.shape, 99.0)
+    err_mag = np.full(flux.shape, np.inf)
+    fpos = flux[positive]
+    mag[positive] = -48.60 - 2.5 * np.log10(wave[positive] ** 2 * fpos / cs)
+    err_mag[positive] = np.abs(2.5 * err_flux[positive] /
+                               (fpos * np.log(10)))
+    return (mag, err_mag)
 
 
 def mag2flux(mag, wave):
@@ -241,6 +254,91 @@ def bounding_box(form, center, radii, shape, posangle=0.0, step=None):
     return clipped_slices, ideal_slices, center
 
 
+def polygon_mask(poly, shape):
+    """Return the pixels of an image array whose centers are inside a
+    polygon.
+
+    The polygon is rasterized by scanlines along the Y axis: the
+    intersections of each column of pixels with the edges of the polygon are
+    sorted, and the pixels between pairs of intersections are selected (the
+    even-odd rule of `matplotlib.path.Path.contains_points`). Only the
+    bounding box of the polygon is processed, so the cost depends on the
+    area of the polygon and not on the size of the image.
+
+    Parameters
+    ----------
+    poly : array of shape (n, 2)
+       The floating point array indexes (y, x) of the vertices of the
+       polygon. The polygon is implicitly closed.
+    shape : int, int
+       The dimensions of the image array.
+
+    Returns
+    -------
+    out : clipped, mask
+
+       The 'clipped' return value is a list of the Y-axis and X-axis slices
+       of the bounding box of the polygon, clipped at the edges of the
+       array (zero-pixel slices if the polygon is outside of the array).
+
+       The 'mask' return value is a boolean array with the shape of the
+       bounding box, which is True for the pixels inside the polygon.
+
+    """
+    poly = np.asarray(poly, dtype=float)
+    ymax = min(int(np.floor(poly[:, 0].max())) + 1, shape[0])
+    xmax = min(int(np.floor(poly[:, 1].max())) + 1, shape[1])
+    ymin = min(max(int(np.ceil(poly[:, 0].min())), 0), max(ymax, 0))
+    xmin = min(max(int(np.ceil(poly[:, 1].min())), 0), max(xmax, 0))
+    ymax, xmax = max(ymax, ymin), max(xmax, xmin)
+    clipped = [slice(ymin, ymax), slice(xmin, xmax)]
+    ny, nx = ymax - ymin, xmax - xmin
+    if ny == 0 or nx == 0:
+        return clipped, np.zeros((ny, nx), dtype=bool)
+
+    # The edges that cross each column x, with a half-open rule for the
+    # vertices that are on the column.
+    y0, x0 = poly.T
+    y1, x1 = np.roll(poly, -1, axis=0).T
+    x = np.arange(xmin, xmax, dtype=float)[:, None]
+    col, edge = np.nonzero((x0 >= x) != (x1 >= x))
+    x = x[col, 0]
+    y0, x0, y1, x1 = y0[edge], x0[edge], y1[edge], x1[edge]
+
+    # A crossing toggles the pixels y up to the integer threshold t, i.e.
+    # the pixels below the intersection. The test of matplotlib is used to
+    # classify the pixels that are on the edges in the same way.
+    def below(y):
+        return ((x1 - x) * (y0 - y1) >= (y1 - y) * (x0 - x1)) == (x1 >= x)
+
+    t = np.floor(y0 + (x - x0) * (y1 - y0) / (x1 - x0))
+    t += below(t + 1)
+    t -= ~below(t)
+
+    # The pixels y with t[2k] < y <= t[2k+1] are inside. They are marked
+    # with +1 and -1 at the start and end of each run, and a cumulated sum
+    # along the columns gives the mask.
+    order = np.lexsort((t, col))
+    col, t = col[order][0::2], t[order]
+    start = np.clip(t[0::2] + 1 - ymin, 0, ny).astype(int)
+    stop = np.clip(t[1::2] + 1 - ymin, 0, ny).astype(int)
+    runs = np.zeros((nx, ny + 1), dtype=np.int8)
+    np.add.at(runs, (col, start), 1)
+    np.add.at(runs, (col, stop), -1)
+    mask = np.cumsum(runs, axis=1, dtype=np.int8)[:, :-1] > 0
+    return clipped, mask.T
+
+
+def _mask_outside(mask, clipped):
+    """Set to True the values of a mask outside of the Y-axis and X-axis
+    slices given by ``clipped``, along the last two axes of the mask."""
+    sy, sx = clipped
+    mask[..., :sy.start, :] = True
+    mask[..., sy.stop:, :] = True
+    mask[..., sy, :sx.start] = True
+    mask[..., sy, sx.stop:] = True
+
+
 def UnitArray(array, old_unit, new_unit):
     if new_unit == old_unit:
         return array
@@ -0,0 +1,274 @@
+"""
+Copyright (c) 2010-2018 CNRS / Centre de Recherche Astrophysique de Lyon
+Copyright (c) 2015-2019 Simon Conseil <simon.conseil@univ-lyon1.fr>
+
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors
+   may be used to endorse or promote products derived from this software
+   without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import numpy as np
+import threading
+from collections import OrderedDict
+from scipy.special import erfc
+
+from ..tools import chunk_slices
+
+__all__ = ('gauss_psf', 'moffat_psf')
+
+# Maximum number of PSF images (or stacks of images) kept in cache by
+# gauss_psf and moffat_psf, and the cache itself.
+PSF_CACHE_SIZE = 8
+_psf_images = OrderedDict()
+_psf_images_lock = threading.Lock()
+
+# Maximum number of values of the (oversampled) profiles that are computed
+# at once, for stacks of images.
+_PSF_CHUNK_SIZE = 2 ** 20
+
+
+def _erf_diff(lo, hi):
+    """Return erf(hi) - erf(lo), computed with the complementary error
+    function on the side of the profile where erf is close to +/-1, to keep
+    the precision in the wings."""
+    return np.where(lo > 0, erfc(lo) - erfc(hi), erfc(-hi) - erfc(-lo))
+
+
+def _offsets(n, center, oversample):
+    """Return the offsets from the center of the sub-pixels along an axis of
+    n pixels, each divided into oversample sub-pixels."""
+    return (np.arange(n * oversample) + 0.5) / oversample - 0.5 - center
+
+
+def _profile_planes(shape, profile, widths, center, rot, oversample,
+                    params=()):
+    """Evaluate a radial profile on the (sub-)pixels of a stack of images.
+
+    ``profile(r2, *params)`` returns the profile for the squared reduced
+    radius r2, ``widths`` is an array of shape (n, 2) of the scale lengths of
+    the profile along the Y and X axes (before the rotation), and ``params``
+    are arrays of shape (n, 1, 1). The values of the oversampled pixels are
+    averaged.
+
+    """
+    ny, nx = shape
+    dy = _offsets(ny, center[0], oversample)[:, np.newaxis]
+    dx = _offsets(nx, center[1], oversample)[np.newaxis, :]
+    if rot != 0:
+        cost, sint = np.cos(np.radians(rot)), np.sin(np.radians(rot))
+        dy, dx = dy * cost - dx * sint, dy * sint + dx * cost
+    dy2, dx2 = dy ** 2, dx ** 2
+
+    nplanes = widths.shape[0]
+    out = np.empty((nplanes, ny, nx))
+    chunksize = _PSF_CHUNK_SIZE // (ny * nx * oversample ** 2)
+    for sl in chunk_slices(nplanes, chunksize):
+        wy2 = widths[sl, 0, np.newaxis, np.newaxis] ** 2
+        wx2 = widths[sl, 1, np.newaxis, np.newaxis] ** 2
+        values = profile(dy2 / wy2 + dx2 / wx2, *[p[sl] for p in params])
+        if oversample > 1:
+            values = values.reshape(-1, ny, oversample, nx, oversample)
+            values = values.mean(axis=(2, 4))
+        out[sl] = values
+    return out
+
+
+def _gauss_planes(shape, sigma, center, rot, integrate, oversample):
+    """Return unit-peak Gaussian images, for an array of shape (n, 2) of the
+    standard deviations along the Y and X axes."""
+    if rot != 0:
+        return _profile_planes(shape, lambda r2: np.exp(-0.5 * r2), sigma,
+                               center, rot, oversample if integrate else 1)
+
+    # Without rotation the Gaussian is separable, and its integral over the
+    # pixels is given by the error function.
+    axes = []
+    for axis in (0, 1):
+        s = sigma[:, axis, np.newaxis]
+        if integrate:
+            edges = np.arange(shape[axis] + 1) - 0.5 - center[axis]
+            edges = edges / (np.sqrt(2) * s)
+            axes.append(np.sqrt(np.pi / 2) * s *
+                        _erf_diff(edges[:, :-1], edges[:, 1:]))
+        else:
+            axes.append(np.exp(-0.5 * ((np.arange(shape[axis]) -
+                                        center[axis]) / s) ** 2))
+    return axes[0][:, :, np.newaxis] * axes[1][:, np.newaxis, :]
+
+
+def _moffat_planes(shape, alpha, beta, center, rot, integrate, oversample):
+    """Return unit-peak Moffat images, for an array of shape (n, 2) of the
+    core widths along the Y and X axes and an array of shape (n, ) of the
+    power indexes."""
+    # (1 + r2) ** -beta is computed with log1p, which is accurate both in
+    # the core (r2 << 1) and in the wings of the profile.
+    def profile(r2, beta):
+        return np.exp(-beta * np.log1p(r2))
+
+    return _profile_planes(shape, profile, alpha, center, rot,
+                           oversample if integrate else 1,
+                           params=(beta[:, np.newaxis, np.newaxis], ))
+
+
+def _cached_psf(kind, shape, fwhm, ratio, beta, center, rot, integrate,
+                oversample, normalize):
+    """Return the PSF images for `gauss_psf` and `moffat_psf`, with a cache
+    (see ``PSF_CACHE_SIZE``) of the images computed for the same
+    parameters."""
+    shape = (shape, shape) if np.isscalar(shape) else tuple(shape)
+    shape = tuple(int(n) for n in shape)
+    if center is None:
+        center = ((shape[0] - 1) / 2, (shape[1] - 1) / 2)
+    center = tuple(float(c) for c in center)
+
+    single = all(np.ndim(p) == 0 for p in (fwhm, ratio, beta))
+    fwhm, ratio, beta = (np.atleast_1d(np.asarray(p, dtype=float))
+                         for p in (fwhm, ratio, beta))
+    fwhm, ratio, beta = np.broadcast_arrays(np.abs(fwhm), np.abs(ratio), beta)
+    if np.any(fwhm == 0) or np.any(ratio == 0):
+        raise ValueError('fwhm equal to 0')
+
+    oversample = max(int(oversample), 1) if integrate else 1
+    key = (kind, shape, fwhm.tobytes(), ratio.tobytes(), beta.tobytes(),
+           center, float(rot), bool(integrate), oversample, bool(normalize))
+    with _psf_images_lock:
+        data = _psf_images.get(key)
+        if data is not None:
+            _psf_images.move_to_end(key)
+
+    if data is None:
+        widths = fwhm[:, np.newaxis] * np.stack([np.ones_like(ratio), ratio],
+                                                axis=1)
+        if kind == 'gauss':
+            sigma = widths / (2 * np.sqrt(2 * np.log(2)))
+            data = _gauss_planes(shape, sigma, center, rot, integrate,
+                                 oversample)
+        else:
+            alpha = widths / (2 * np.sqrt(2 ** (1 / beta) - 1))[:, np.newaxis]
+            data = _moffat_planes(shape, alpha, beta, center, rot, integrate,
+                                  oversample)
+        if normalize:
+            data /= data.sum(axis=(1, 2))[:, np.newaxis, np.newaxis]
+        data.flags.writeable = False
+        with _psf_images_lock:
+            _psf_images[key] = data
+            while len(_psf_images) > PSF_CACHE_SIZE:
+                _psf_images.popitem(last=False)
+
+    return data[0].copy() if single else data.copy()
+
+
+def gauss_psf(shape, fwhm, center=None, ratio=1.0, rot=0.0, integrate=False,
+              oversample=5, normalize=True):
+    """Return images of a 2D Gaussian PSF, for one or several FWHM.
+
+    The images of several FWHM (e.g. the FWHM of the PSF at each wavelength
+    of a cube) are computed at once, and the results are kept in cache (see
+    ``PSF_CACHE_SIZE``), so that the same PSF images are not computed again
+    for the next sources. A copy of the cached images is returned.
+
+    Parameters
+    ----------
+    shape : int or (int, int)
+        The dimensions of the images (ny, nx).
+    fwhm : float or array of float
+        The FWHM along the Y axis in pixels, or an array of FWHM.
+    center : (float, float)
+        The center (y, x) of the PSF in pixels. If None, the center of the
+        images is used.
+    ratio : float or array of float
+        The ratio of the FWHM along the X axis to the FWHM along the Y axis,
+        1 for a circular PSF.
+    rot : float
+        The counter-clockwise rotation of the PSF in degrees.
+    integrate : bool
+        If False, the Gaussian is evaluated at the center of each pixel. If
+        True, the Gaussian is integrated over each pixel, analytically with
+        the error function when rot is 0, and otherwise by averaging
+        oversample x oversample sub-pixels.
+    oversample : int
+        The oversampling factor of the pixels when integrate is True and
+        the PSF is rotated.
+    normalize : bool
+        If True, the images are normalized to a sum of 1, otherwise the
+        Gaussian has a peak value of 1.
+
+    Returns
+    -------
+    out : numpy.ndarray
+        An image of shape (ny, nx), or a stack of images of shape
+        (n, ny, nx) if an array of FWHM or ratios is given.
+
+    """
+    return _cached_psf('gauss', shape, fwhm, ratio, 0.0, center, rot,
+                       integrate, oversample, normalize)
+
+
+def moffat_psf(shape, fwhm, beta, center=None, ratio=1.0, rot=0.0,
+               integrate=False, oversample=5, normalize=True):
+    """Return images of a 2D Moffat PSF, for one or several FWHM and power
+    indexes.
+
+    The Moffat profile is ``(1 + (r / alpha)**2)**-beta``, with
+    ``alpha = fwhm / (2 * sqrt(2**(1 / beta) - 1))``. The images of several
+    FWHM and beta are computed at once, and the results are kept in cache
+    (see ``PSF_CACHE_SIZE``). A copy of the cached images is returned.
+
+    Parameters
+    ----------
+    shape : int or (int, int)
+        The dimensions of the images (ny, nx).
+    fwhm : float or array of float
+        The FWHM along the Y axis in pixels, or an array of FWHM.
+    beta : float or array of float
+        The power index of the Moffat, or an array of power indexes.
+    center : (float, float)
+        The center (y, x) of the PSF in pixels. If None, the center of the
+        images is used.
+    ratio : float or array of float
+        The ratio of the FWHM along the X axis to the FWHM along the Y axis,
+        1 for a circular PSF.
+    rot : float
+        The counter-clockwise rotation of the PSF in degrees.
+    integrate : bool
+        If False, the Moffat is evaluated at the center of each pixel. If
+        True, it is integrated over each pixel by averaging
+        oversample x oversample sub-pixels.
+    oversample : int
+        The oversampling factor of the pixels when integrate is True.
+    normalize : bool
+        If True, the images are normalized to a sum of 1, otherwise the
+        Moffat has a peak value of 1.
+
+    Returns
+    -------
+    out : numpy.ndarray
+        An image of shape (ny, nx), or a stack of images of shape
+        (n, ny, nx) if an array of FWHM, beta or ratios is given.
+
+    """
+    return _cached_psf('moffat', shape, fwhm, ratio, beta, center, rot,
+                       integrate, oversample, normalize)
@@ -34,24 +34,46 @@ OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 
+import functools
 import numpy as np
+import threading
 import types
 
+from collections import OrderedDict
+
 import astropy.units as u
 from astropy.io import fits
 from astropy.stats import gaussian_sigma_to_fwhm, gaussian_fwhm_to_sigma
 from astropy.convolution import convolve, Box1DKernel
 from os.path import join, abspath, dirname
-from scipy import interpolate, signal
+from scipy import interpolate, signal, sparse, ndimage as ndi
 from scipy.optimize import leastsq
 
 from . import ABmag_filters, wavelet1D
 from .arithmetic import ArithmeticMixin
-from .data import DataArray
+from .data import DataArray, _fftconvolve
 from .fitting import Gauss1D
 from .objs import flux2mag
 
-__all__ = ('Spectrum', 'vactoair', 'airtovac')
+__all__ = ('Spectrum', 'vactoair', 'airtovac', 'abmag_filters')
+
+# Maximum number of LSF convolution operators kept in cache by
+# `Spectrum.LSF_convolve` and `Cube.LSF_convolve`.
+LSF_CACHE_SIZE = 8
+_lsf_operators = OrderedDict()
+_lsf_operators_lock = threading.Lock()
+
+# Maximum number of filter responses kept in cache by the AB magnitude
+# methods of `Spectrum` and by `abmag_filters`.
+FILTER_CACHE_SIZE = 64
+_filter_responses = OrderedDict()
+_filter_responses_lock = threading.Lock()
+
+# Mean wavelengths and widths (in Angstrom) of the box filters of
+# `Spectrum.abmag_filter_name`.
+_BAND_FILTERS = {'U': (3663., 650.), 'B': (4361., 890.), 'V': (5448., 840.),
+                 'Rc': (6410., 1600.), 'Ic': (7980., 1500.),
+                 'z': (8930., 1470.)}
 
 
 def vactoair(vacwl):
@@ -106,6 +128,88 @@ def airtovac(airwl):
     return airwl * n
 
 
+def abmag_filters(spectra, filters, wave=None, var=None, unit=None,
+                  spec_name='MUSE_TOT_SKYSUB'):
+    """Compute the AB magnitudes of many spectra in several filters.
+
+    The response of each filter is computed once for each wavelength grid
+    (and kept in cache, see ``FILTER_CACHE_SIZE``), and the mean fluxes of
+    all the spectra that share a wavelength grid are obtained with a matrix
+    product. The magnitudes are the same as with
+    `~mpdaf.obj.Spectrum.abmag_filter_name`,
+    `~mpdaf.obj.Spectrum.abmag_band` and `~mpdaf.obj.Spectrum.abmag_filter`.
+
+    Parameters
+    ----------
+    spectra : array, list of `~mpdaf.obj.Spectrum` or `~mpdaf.sdetect.SourceList`
+        The spectra, either as a 2D (masked) array of shape (nspec, nwave)
+        with the wavelength coordinates ``wave``, as a list of spectra, or
+        as a list of sources, in which case the spectrum ``spec_name`` of
+        each source is used.
+    filters : list
+        The filters. Each filter is either a filter name (see
+        `~mpdaf.obj.Spectrum.abmag_filter_name`), a tuple with the mean
+        wavelength and the width of a box filter (in Angstrom), or a tuple
+        with the arrays of wavelengths (in Angstrom) and efficiencies of
+        the filter curve.
+    wave : `mpdaf.obj.WaveCoord`
+        The wavelength coordinates of the 2D array of spectra.
+    var : array
+        The variances of the 2D array of spectra, or None.
+    unit : `astropy.units.Unit`
+        The flux unit of the 2D array of spectra. The default is
+        erg.s-1.cm-2.Angstrom-1.
+    spec_name : str
+        The name of the spectrum of the sources.
+
+    Returns
+    -------
+    out : array, array
+        The magnitudes and their errors, in arrays of shape
+        (nspec, nfilters). As for the methods of `~mpdaf.obj.Spectrum`, the
+        magnitudes of negative fluxes are set to 99 (with an infinite
+        error); this is also the case for the filters outside the spectra.
+        The rows of the sources without the spectrum ``spec_name`` are set
+        to NaN.
+
+    """
+    funit = u.Unit('erg.s-1.cm-2.Angstrom-1')
+
+    if isinstance(spectra, np.ndarray):
+        if wave is None:
+            raise ValueError('wave is required with an array of spectra')
+        if spectra.ndim != 2 or spectra.shape[1] != wave.shape:
+            raise ValueError('spectra must be an array of shape (nspec, {})'
+                             .format(wave.shape))
+        if var is not None and np.shape(var) != spectra.shape:
+            raise ValueError('var must have the same shape as spectra')
+        scale = 1.0 if unit is None else (1.0 * unit).to(funit).value
+        return _filter_magnitudes(spectra, var, wave, filters, scale)
+
+    spectra = [sp.spectra.get(spec_name) if hasattr(sp, 'spectra') else sp
+               for sp in spectra]
+
+    # Process together the spectra with the same wavelength coordinates,
+    # flux unit and variance availability.
+    groups = OrderedDict()
+    for i, sp in enumerate(spectra):
+        if sp is None:
+            continue
+        key = (sp.wave.coord(unit=u.angstrom).tobytes(), sp.unit,
+               sp._var is None)
+        groups.setdefault(key, []).append(i)
+
+    mag = np.full((len(spectra), len(filters)), np.nan)
+    err = np.full((len(spectra), len(filters)), np.nan)
+    for (_, spunit, novar), rows in groups.items():
+        data = np.ma.stack([spectra[i].data for i in rows])
+        var = None if novar else np.ma.stack([spectra[i].var for i in rows])
+        scale = (1.0 * spunit).to(funit).value
+        mag[rows], err[rows] = _filter_magnitudes(
+            data, var, spectra[rows[0]].wave, filters, scale)
+    return mag, err
+
+
 class Spectrum(ArithmeticMixin, DataArray):
 
     """Spectrum objects contain 1D arrays of numbers, optionally
@@ -539,42 +643,8 @@ class Spectrum(ArithmeticMixin, DataArray):
             is equivalent to specifying self.wave.unit.
 
         """
-        # Convert the attenuation from dB to a linear scale factor.
-        gcut = 10.0**(-atten / 20.0)
-
-        # Calculate the Nyquist folding frequency of the new pixel size.
-        nyquist_folding_freq = 0.5 / newstep
-
-        # Calculate the standard deviation of a Gaussian whose Fourier
-        # transform drops from unity at the center to gcut at the Nyquist
-        # folding frequency.
-        sigma = (0.5 / np.pi / nyquist_folding_freq *
-                 np.sqrt(-2.0 * np.log(gcut)))
-
-        # Convert the standard deviation from wavelength units to input pixels.
-        sigma /= self.get_step(unit=unit)
-
-        # Choose dimensions for the gaussian filtering kernel. Choose an
-        # extent from -4*sigma to +4*sigma. This truncates the gaussian
-        # where it drops to about 3e-4 of its peak.  The following
-        # calculation ensures that the dimensions of the array are odd, so
-        # that the gaussian will be symmetrically sampled either side of a
-        # central pixel. This prevents spectral shifts.
-        gshape = int(np.ceil(4.0 * sigma)) * 2 + 1
-
-        # fftconvolve requires that the kernel be no larger than the array
-        # that it is convolving, so reduce the size of the kernel array if
-        # needed. Be careful to choose an odd sized array.
-        n = self.shape[0]
-        if gshape > n:
-            gshape = n if n % 2 != 0 else (n - 1)
-
-        # Sample the gaussian filter symmetrically around the central pixel.
-        gx = np.arange(gshape, dtype=float) - gshape // 2
-        gy = np.exp(-0.5 * (gx / sigma)**2)
-
-        # Area-normalize the gaussian profile.
-        gy /= gy.sum()
+        gy = _decimation_kernel(newstep, self.get_step(unit=unit), atten,
+                                self.shape[0])
 
         # Filter the spectrum with the gaussian filter.
         self.fftconvolve(gy, inplace=True)
@@ -618,8 +688,6 @@ class Spectrum(ArithmeticMixin, DataArray):
         out : Spectrum
 
         """
-        out = self if inplace else self.copy()
-
         # Don't allow the spectrum to be started beyond the far end of
         # the spectrum, because this would result in an empty spectrum.
         if start is not None and start > self.get_end(unit):
@@ -639,80 +707,59 @@ class Spectrum(ArithmeticMixin, DataArray):
         # Get the existing wavelength step size in the new units.
         oldstep = self.wave.get_step(unit)
 
-        # If the spectrum is being resampled to a larger pixel size,
-        # then a decimation filter should be applied before
-        # resampling, to ensure that the new pixel size doesn't
-        # undersample rapidly changing features in the spectrum.
-
-        if step > oldstep and atten > 0.0:
-            out._decimation_filter(step, atten, unit=unit)
-
         # Get the data, mask (and variance) arrays, and replace bad pixels with
         # zeros.
-        if out._mask is not None:         # Is out.data a masked array?
-            data = out.data.filled(0.0)
-            if out._var is not None:
-                var = out.var.filled(0.0)
+        if self._mask is not None:        # Is self.data a masked array?
+            data = self.data.filled(0.0)
+            if self._var is not None:
+                var = self.var.filled(0.0)
             else:
                 var = None
-            mask = out._mask
-        else:                             # Is out.data just a numpy array?
-            mask = ~np.isfinite(out._data)
-            data = out._data.copy()
+            mask = self._mask
+        else:                             # Is self.data just a numpy array?
+            mask = ~np.isfinite(self._data)
+            data = self._data.copy()
             data[mask] = 0.0
-            if out.var is not None:
-                var = out.var.copy()
+            if self._var is not None:
+                var = self._var.copy()
                 var[mask] = 0.0
             else:
                 var = None
 
-        # Get the coordinates of the pixels of the input and output spectra.
-        xi = self.wave.coord()
-        xo = newwave.coord()
-
-        # Get a resampled versions of the data array, optionally the variance
-        # array, and a floating point version of the mask array. Note that the
-        # choice of linear interpolation is required to preserve flux.
-        data = interpolate.griddata(xi, data, xo, method="linear",
-                                    fill_value=np.nan)
-        if var is not None:
-            var = interpolate.griddata(xi, var, xo, method="linear",
-                                       fill_value=np.nan)
-        mask = interpolate.griddata(xi, mask.astype(float), xo,
-                                    method="linear", fill_value=1.0)
-
-        # Create a new boolean mask in which all pixels that had an integrated
-        # contribution of more than 'cutoff' originally masked pixels are
-        # masked. Note that setting the cutoff to the "obvious" value of zero
-        # results in lots of pixels being masked that are far away from any
-        # masked pixels, due to precision errors in the griddata()
-        # function.  Limit the minimum value of the cutoff to avoid this.
-        mask = np.greater(mask, max(cutoff, 1.0e-6))
+        # Get resampled versions of the data array, optionally the variance
+        # array, and a floating point version of the mask array, by linear
+        # interpolation between the coordinates of the pixels of the input
+        # and output spectra. Note that the choice of linear interpolation is
+        # required to preserve flux.
+        #
+        # If the spectrum is being resampled to a larger pixel size, then a
+        # decimation filter is applied before resampling, to ensure that the
+        # new pixel size doesn't undersample rapidly changing features in
+        # the spectrum. When up-sampling, it is applied to the output
+        # spectrum. The combination of this and the linear interpolation
+        # produces a much better interpolation than a cubic spline filter
+        # can. In particular, a spline interpolation does not conserve flux,
+        # whereas linear interpolation plus decimation filtering does.
+        data, var, mask = _resample_decimate(
+            self.wave.coord(), newwave.coord(), data, var, mask, oldstep,
+            step, atten, cutoff)
 
         # If masked arrays were not in use in the original spectrum, fill
         # bad pixels with NaNs.
-        if out._mask is None:
+        if self._mask is None:
             data[mask] = np.nan
             if var is not None:
                 var[mask] = np.nan
             mask = None
 
-        # Install the resampled arrays.
+        # Install the resampled arrays and the new wavelength world
+        # coordinates.
+        out = self if inplace else self.clone()
         out._data = data
         out._var = var
         out._mask = mask
-
-        # Install the new wavelength world coordinates.
         out.wave = newwave
 
-        # When up-sampling, decimation filter the output spectrum. The
-        # combination of this and the linear interpolation of the preceding
-        # griddata() produces a much better interpolation than a cubic spline
-        # filter can. In particular, a spline interpolation does not conserve
-        # flux, whereas linear interpolation plus decimation filtering does.
-        if step < oldstep and atten > 0.0:
-            out._decimation_filter(step, atten, unit=unit)
-
         return out
 
     def mean(self, lmin=None, lmax=None, weight=True, unit=u.angstrom):
@@ -1004,21 +1051,21 @@ class Spectrum(ArithmeticMixin, DataArray):
         else:
             vec_weight = None
 
+        # normalize w, with the wavelength range used by poly_val
+        w = self.wave.coord()
+        w0 = np.min(w)
+        dw = np.max(w) - w0
+        w = (w - w0) / dw
+
         if self._mask is np.ma.nomask:
             d = self._data
-            w = self.wave.coord()
         else:
             mask = ~self._mask
             d = self._data[mask]
-            w = self.wave.coord()[mask]
+            w = w[mask]
             if weight:
                 vec_weight = vec_weight[mask]
 
-        # normalize w
-        w0 = np.min(w)
-        dw = np.max(w) - w0
-        w = (w - w0) / dw
-
         p = np.polynomial.polynomial.polyfit(w, d, deg, w=vec_weight)
 
         if maxiter > 0:
@@ -1033,11 +1080,12 @@ class Spectrum(ArithmeticMixin, DataArray):
                 if len(ind[0]) <= deg + 1:
                     raise ValueError('Too few points to perform '
                                      'polynomial fit')
+                d = d[ind]
+                w = w[ind]
                 if vec_weight is not None:
                     vec_weight = vec_weight[ind]
-                p = np.polynomial.polynomial.polyfit(w[ind], d[ind],
-                                                     deg, w=vec_weight)
-                err = d[ind] - np.polynomial.polynomial.polyval(w[ind], p)
+                p = np.polynomial.polynomial.polyfit(w, d, deg, w=vec_weight)
+                err = d - np.polynomial.polynomial.polyval(w, p)
                 sig = np.std(err)
                 n_p = len(ind[0])
 
@@ -1111,16 +1159,7 @@ class Spectrum(ArithmeticMixin, DataArray):
         out : float, float
               Magnitude value and its error
         """
-        vflux, err_flux = self.mean(lmin=lbda - dlbda / 2.0,
-                                    lmax=lbda + dlbda / 2.0,
-                                    weight=None, unit=u.angstrom)
-        if vflux == 0:
-            return (99, 0)
-        else:
-            unit = u.Unit('erg.s-1.cm-2.Angstrom-1')
-            vflux2 = (vflux * self.unit).to(unit)
-            err_flux2 = (err_flux * self.unit).to(unit)
-            return flux2mag(vflux2.value, err_flux2.value, lbda)
+        return self._filter((lbda, dlbda), strict=False)
 
     def abmag_filter_name(self, name):
         """Compute AB magnitude using the filter name.
@@ -1136,34 +1175,9 @@ class Spectrum(ArithmeticMixin, DataArray):
         out : float, float
               Magnitude value and its error
         """
-
-        if name == 'U':
-            return self.abmag_band(3663., 650.)
-        elif name == 'B':
-            return self.abmag_band(4361., 890.)
-        elif name == 'V':
-            return self.abmag_band(5448., 840.)
-        elif name == 'Rc':
-            return self.abmag_band(6410., 1600.)
-        elif name == 'Ic':
-            return self.abmag_band(7980., 1500.)
-        elif name == 'z':
-            return self.abmag_band(8930., 1470.)
-        elif name == 'R-Johnson':
-            (l0, lmin, lmax, tck) = ABmag_filters.mag_RJohnson()
-            return self._filter(l0, lmin, lmax, tck)
-        else:
-            FILTERS = join(abspath(dirname(__file__)), 'filters',
-                           'filter_list.fits')
-            filtname = 'ACS_' + name
-
-            with fits.open(FILTERS) as hdul:
-                if filtname not in hdul:
-                    raise ValueError("filter '{}' not found".format(filtname))
-                lbda = hdul[filtname].data['lambda']
-                thr = hdul[filtname].data['throughput']
-
-            return self.abmag_filter(lbda, thr)
+        if name in _BAND_FILTERS:
+            return self.abmag_band(*_BAND_FILTERS[name])
+        return self._filter(name)
 
     def abmag_filter(self, lbda, eff):
         """Compute AB magnitude using array filter.
@@ -1180,56 +1194,28 @@ class Spectrum(ArithmeticMixin, DataArray):
         out : float, float
               Magnitude value and its error
         """
-        lbda = np.asarray(lbda)
-        eff = np.asarray(eff)
         if np.shape(lbda) != np.shape(eff):
             raise TypeError('lbda and eff inputs have not the same size.')
-        l0 = np.average(lbda, weights=eff)
-        lmin = lbda[0]
-        lmax = lbda[-1]
-        k = 3 if lbda.shape[0] > 3 else 1
-        tck = interpolate.splrep(lbda, eff, k=k)
-        return self._filter(l0, lmin, lmax, tck)
-
-    def _filter(self, l0, lmin, lmax, tck):
+        return self._filter((lbda, eff))
+
+    def _filter(self, filt, strict=True):
         """Compute AB magnitude.
 
         Parameters
         ----------
-        l0 : float
-            Mean wavelength in Angstrom.
-        lmin : float
-            Minimum wavelength in Angstrom.
-        lmax : float
-            Maximum wavelength in Angstrom.
-        tck : 3-tuple
-            (t,c,k) contains the spline representation. t = the knot-points,
-            c = coefficients and k = the order of the spline.
+        filt : str or tuple
+            The filter name, the (mean wavelength, width) of a box filter,
+            or the (wavelengths, efficiencies) arrays of a filter curve
+            (see `~mpdaf.obj.abmag_filters`).
+        strict : bool
+            If True, raise a ValueError if the filter is outside the
+            spectrum, otherwise return a magnitude of 99.
         """
-        try:
-            lambda_slice = self._wavelengths_to_slice(lmin, lmax, u.Angstrom)
-        except ValueError:
-            raise ValueError('Spectrum outside Filter band')
-
-        if lambda_slice.start == (lambda_slice.stop - 1):
-            raise ValueError('Filter band smaller than spectrum step')
-
-        lb = self.wave.coord(np.arange(lambda_slice.start, lambda_slice.stop),
-                             unit=u.Angstrom)
-        w = interpolate.splev(lb, tck, der=0)
-
-        vflux, wsum = np.ma.average(self.data[lambda_slice], weights=w,
-                                    returned=True)
-        if self.var is not None:
-            err_flux = np.sqrt(np.ma.sum(self.var[lambda_slice] * w**2) /
-                               wsum**2)
-        else:
-            err_flux = np.inf
-
-        unit = u.Unit('erg.s-1.cm-2.Angstrom-1')
-        vflux2 = (vflux * self.unit).to(unit)
-        err_flux2 = (err_flux * self.unit).to(unit)
-        return flux2mag(vflux2.value, err_flux2.value, l0)
+        scale = (1.0 * self.unit).to(u.Unit('erg.s-1.cm-2.Angstrom-1')).value
+        var = None if self._var is None else self.var[np.newaxis]
+        mag, err = _filter_magnitudes(self.data[np.newaxis], var, self.wave,
+                                      [filt], scale, strict=strict)
+        return (mag[0, 0], err[0, 0])
 
     def wavelet_filter(self, levels=9, sigmaCutoff=5.0, epsilon=0.05,
                        inplace=False):
@@ -2161,11 +2147,13 @@ class Spectrum(ArithmeticMixin, DataArray):
         The speed of this function scales as O(Nd x log(Nd)) where
         Nd=self.data.size.  This function temporarily allocates a pair of
         arrays that have the sum of the shapes of self.shape and other.shape,
-        rounded up to a power of two along each axis. This can involve a lot
-        of memory being allocated. For this reason, when other.shape is small,
-        Spectrum.convolve() may be more efficient than Spectrum.fftconvolve().
+        rounded up to a size that is efficient for the FFT. This can involve a
+        lot of memory being allocated. For this reason, when other.shape is
+        small, Spectrum.convolve() may be more efficient than
+        Spectrum.fftconvolve().
 
-        Uses `scipy.signal.fftconvolve`.
+        The transforms are computed with `scipy.fft`, and the transforms of
+        ``other`` and ``other**2`` are cached.
 
         Parameters
         ----------
@@ -2194,7 +2182,7 @@ class Spectrum(ArithmeticMixin, DataArray):
 
         """
         # Delegate the task to DataArray._convolve()
-        return self._convolve(signal.fftconvolve, other=other, inplace=inplace)
+        return self._convolve(_fftconvolve, other=other, inplace=inplace)
 
     def correlate(self, other, inplace=False):
         """Cross-correlate the spectrum with a other spectrum or an array.
@@ -2284,6 +2272,11 @@ class Spectrum(ArithmeticMixin, DataArray):
     def LSF_convolve(self, lsf, size, **kwargs):
         """Convolve spectrum with LSF.
 
+        The LSF is evaluated once at each wavelength of the spectrum, and
+        the resulting convolution operator is kept in cache (see
+        ``LSF_CACHE_SIZE``) for the next spectra with the same wavelength
+        coordinates. The variance is convolved by the square of the LSF.
+
         Parameters
         ----------
         lsf : python function
@@ -2307,38 +2300,11 @@ class Spectrum(ArithmeticMixin, DataArray):
         res = self.clone()
         if self._data.sum() == 0:
             return res
-        step = self.get_step(u.angstrom)
-        lbda = self.wave.coord(u.angstrom)
 
-        if size % 2 == 0:
-            raise ValueError('Size must be an odd number')
-        else:
-            k = size // 2
-
-        if isinstance(lsf, types.FunctionType):
-            f = lsf
-        else:
-            try:
-                f = getattr(lsf, 'get_LSF')
-            except Exception:
-                raise ValueError('lsf parameter is not valid')
-
-        data = np.empty(len(self._data) + 2 * k)
-        data[k:-k] = self._data
-        data[:k] = self._data[k:0:-1]
-        data[-k:] = self._data[-2:-k - 2:-1]
-
-        res._data = np.array([(f(lbda[i], step, size, **kwargs) *
-                               data[i:i + size]).sum()
-                              for i in range(self.shape[0])])
+        op, op2 = _lsf_operator(lsf, self.wave, size, kwargs)
+        res._data = op.dot(self._data)
         res._mask = self._mask
-
-        if self._var is None:
-            res._var = None
-        else:
-            res._var = np.array([(f(lbda[i], step, size, **kwargs) *
-                                  data[i:i + size]).sum()
-                                 for i in range(self.shape[0])])
+        res._var = None if self._var is None else op2.dot(self._var)
         return res
 
     def fit_lines(self, redshift, **kwargs):
@@ -2519,3 +2485,474 @@ class Spectrum(ArithmeticMixin, DataArray):
         std = StdDevUncertainty(np.sqrt(self._var), unit=self.unit, copy=False)
         return Spectrum1D(flux=flux, uncertainty=std, mask=self._mask,
                           wcs=self.wave.wcs, copy=False)
+
+
+@functools.lru_cache(maxsize=32)
+def _decimation_kernel(newstep, oldstep, atten, n):
+    """Return the gaussian kernel of the decimation filter of
+    `Spectrum._decimation_filter`, for a new pixel size newstep, a pixel
+    size oldstep (in the same units) and spectra of n pixels. The kernels
+    are kept in cache and are read-only."""
+    # Convert the attenuation from dB to a linear scale factor.
+    gcut = 10.0**(-atten / 20.0)
+
+    # Calculate the Nyquist folding frequency of the new pixel size.
+    nyquist_folding_freq = 0.5 / newstep
+
+    # Calculate the standard deviation of a Gaussian whose Fourier
+    # transform drops from unity at the center to gcut at the Nyquist
+    # folding frequency.
+    sigma = (0.5 / np.pi / nyquist_folding_freq *
+             np.sqrt(-2.0 * np.log(gcut)))
+
+    # Convert the standard deviation from wavelength units to input pixels.
+    sigma /= oldstep
+
+    # Choose dimensions for the gaussian filtering kernel. Choose an
+    # extent from -4*sigma to +4*sigma. This truncates the gaussian
+    # where it drops to about 3e-4 of its peak.  The following
+    # calculation ensures that the dimensions of the array are odd, so
+    # that the gaussian will be symmetrically sampled either side of a
+    # central pixel. This prevents spectral shifts.
+    gshape = int(np.ceil(4.0 * sigma)) * 2 + 1
+
+    # fftconvolve requires that the kernel be no larger than the array
+    # that it is convolving, so reduce the size of the kernel array if
+    # needed. Be careful to choose an odd sized array.
+    if gshape > n:
+        gshape = n if n % 2 != 0 else (n - 1)
+
+    # Sample the gaussian filter symmetrically around the central pixel.
+    gx = np.arange(gshape, dtype=float) - gshape // 2
+    gy = np.exp(-0.5 * (gx / sigma)**2)
+
+    # Area-normalize the gaussian profile.
+    gy /= gy.sum()
+    gy.flags.writeable = False
+    return gy
+
+
+def _decimate(data, var, newstep, oldstep, atten, axis=0, workers=None):
+    """Apply the decimation filter of `Spectrum._decimation_filter` along an
+    axis of an array of spectra.
+
+    The masked values of data and var (or None) must have been replaced by
+    zeros. The variances are convolved by the square of the kernel. The
+    kernel (and its Fourier transform, see `mpdaf.obj.data._fftconvolve`)
+    is computed once for all the spectra, which are convolved at once with
+    ``workers`` threads.
+
+    """
+    kernel = _decimation_kernel(newstep, oldstep, atten, data.shape[axis])
+    shape = [1] * data.ndim
+    shape[axis] = -1
+    kernel = kernel.reshape(shape)
+    data = _fftconvolve(data, kernel, axes=axis, workers=workers)
+    if var is not None:
+        var = _fftconvolve(var, kernel ** 2, axes=axis, workers=workers)
+    return data, var
+
+
+def _resample_decimate(xi, xo, data, var, mask, oldstep, newstep, atten,
+                       cutoff, axis=0, workers=None):
+    """Resample an array of spectra as `Spectrum.resample`.
+
+    This applies the decimation filter before the linear interpolation from
+    the coordinates xi to xo when the pixel size increases, or after it
+    when it decreases. The masked values of data and var (or None) must
+    have been replaced by zeros. The filter works on the temporary arrays
+    of the interpolation, so the input arrays are neither copied nor
+    modified.
+
+    """
+    if newstep > oldstep and atten > 0.0:
+        data, var = _decimate(data, var, newstep, oldstep, atten, axis=axis,
+                              workers=workers)
+        # The masked pixels do not contribute to the interpolation
+        np.copyto(data, 0.0, where=mask)
+        if var is not None:
+            np.copyto(var, 0.0, where=mask)
+    data, var, mask = _resample_linear(xi, xo, data, var, mask, cutoff,
+                                       axis=axis)
+    if newstep < oldstep and atten > 0.0:
+        # The output pixels have a size of newstep
+        np.copyto(data, 0.0, where=mask)
+        if var is not None:
+            np.copyto(var, 0.0, where=mask)
+        data, var = _decimate(data, var, newstep, newstep, atten, axis=axis,
+                              workers=workers)
+    return data, var, mask
+
+
+def _linear_weights(xi, xo):
+    """Return the weights of the linear interpolation of arrays sampled at
+    the increasing coordinates xi, to the coordinates xo.
+
+    Returns
+    -------
+    out : i, w, inside
+        The interpolated values at the coordinates xo are
+        ``a[i] * (1 - w) + a[i + 1] * w``, where they are within the range
+        of xi (inside).
+
+    """
+    xi = np.asarray(xi, dtype=float)
+    xo = np.asarray(xo, dtype=float)
+    inside = (xo >= xi[0]) & (xo <= xi[-1])
+    if xi.size == 1:
+        return np.zeros(xo.shape, dtype=int), np.zeros(xo.shape), inside
+    i = np.clip(np.searchsorted(xi, xo, side='right') - 1, 0, xi.size - 2)
+    w = (xo - xi[i]) / (xi[i + 1] - xi[i])
+    return i, w, inside
+
+
+def _interp_linear(arr, weights, axis=0, fill_value=np.nan):
+    """Interpolate an array (e.g. a stack of spectra) along an axis, with
+    the weights returned by `_linear_weights`. The values outside the range
+    of the input coordinates are set to fill_value."""
+    i, w, inside = weights
+    shape = [1] * arr.ndim
+    shape[axis] = -1
+    w = w.reshape(shape)
+    out = np.take(arr, i, axis=axis) * (1 - w)
+    out += np.take(arr, np.minimum(i + 1, arr.shape[axis] - 1),
+                   axis=axis) * w
+    if not inside.all():
+        out[(slice(None), ) * (axis % arr.ndim) + (~inside, )] = fill_value
+    return out
+
+
+def _resample_linear(xi, xo, data, var, mask, cutoff, axis=0):
+    """Resample data, var (or None) and mask arrays along an axis by linear
+    interpolation from the coordinates xi to the coordinates xo.
+
+    The masked values of data and var must have been replaced by zeros. The
+    output pixels outside the range of xi are NaN and masked, and the output
+    pixels that have an interpolated contribution of more than cutoff from
+    masked input pixels are masked.
+
+    """
+    weights = _linear_weights(xi, xo)
+    mask = np.broadcast_to(np.asarray(mask, dtype=float), data.shape)
+    mask = _interp_linear(mask, weights, axis=axis, fill_value=1.0)
+    data = _interp_linear(data, weights, axis=axis)
+    if var is not None:
+        var = _interp_linear(var, weights, axis=axis)
+
+    # Create a new boolean mask in which all pixels that had an integrated
+    # contribution of more than 'cutoff' originally masked pixels are
+    # masked. Limit the minimum value of the cutoff to avoid masking pixels
+    # because of rounding errors.
+    mask = np.greater(mask, max(cutoff, 1.0e-6))
+    return data, var, mask
+
+
+def _lsf_operator(lsf, wave, size, kwargs):
+    """Return the banded matrices that convolve spectra with a LSF.
+
+    The LSF is evaluated at each wavelength of ``wave``, and its values are
+    stored in a sparse matrix, such that ``op.dot(data)`` gives the same
+    result as the convolution of the spectra (along the first axis of
+    ``data``) with the LSF, with the spectra mirrored at the edges. The
+    second matrix contains the squares of the first one, to propagate the
+    variances. The matrices are kept in cache (see ``LSF_CACHE_SIZE``),
+    for the same LSF, wavelength coordinates, size and LSF parameters.
+
+    """
+    if size % 2 == 0:
+        raise ValueError('Size must be an odd number')
+
+    if isinstance(lsf, types.FunctionType):
+        f = lsf
+        lsf_key = lsf
+    else:
+        try:
+            f = getattr(lsf, 'get_LSF')
+        except Exception:
+            raise ValueError('lsf parameter is not valid')
+        lsf_key = (type(lsf), lsf.typ) if hasattr(lsf, 'typ') else lsf
+
+    step = wave.get_step(unit=u.angstrom)
+    lbda = wave.coord(unit=u.angstrom)
+    key = (lsf_key, lbda.tobytes(), size, tuple(sorted(kwargs.items())))
+    try:
+        hash(key)
+    except TypeError:
+        key = None
+
+    if key is not None:
+        with _lsf_operators_lock:
+            ops = _lsf_operators.get(key)
+            if ops is not None:
+                _lsf_operators.move_to_end(key)
+                return ops
+
+    n = lbda.shape[0]
+    k = size // 2
+    values = np.array([f(lbda[i], step, size, **kwargs) for i in range(n)])
+
+    # Column indices of the LSF values, mirrored at the edges of the
+    # spectra. The duplicated entries are summed by the sparse matrix.
+    cols = np.arange(n)[:, np.newaxis] + np.arange(-k, k + 1)
+    cols = np.abs(cols)
+    cols = np.where(cols > n - 1, 2 * (n - 1) - cols, cols)
+    rows = np.repeat(np.arange(n), size)
+    op = sparse.csr_matrix((values.ravel(), (rows, cols.ravel())),
+                           shape=(n, n))
+    ops = (op, op.multiply(op).tocsr())
+
+    if key is not None:
+        with _lsf_operators_lock:
+            _lsf_operators[key] = ops
+            while len(_lsf_operators) > LSF_CACHE_SIZE:
+                _lsf_operators.popitem(last=False)
+    return ops
+
+
+def _interp_masked(x, data, mask):
+    """Linearly interpolate the masked values of a stack of spectra.
+
+    This is the linear interpolation of `Spectrum._interp_data`, done for
+    all the rows of ``data`` (of shape (nspec, n)) at once: the values
+    before the first and after the last valid pixel are set to the nearest
+    valid value, and the rows without valid pixels are set to NaN.
+
+    """
+    n = data.shape[1]
+    idx = np.arange(n)
+    prev = np.maximum.accumulate(np.where(mask, -1, idx), axis=1)
+    nxt = np.minimum.accumulate(np.where(mask, n, idx)[:, ::-1],
+                                axis=1)[:, ::-1]
+    prev = np.where(prev < 0, nxt, prev)
+    nxt = np.where(nxt >= n, prev, nxt)
+    empty = prev >= n
+    prev[empty] = nxt[empty] = 0
+    rows = np.arange(data.shape[0])[:, np.newaxis]
+    d0, d1 = data[rows, prev], data[rows, nxt]
+    x0, x1 = x[prev], x[nxt]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        w = np.where(nxt > prev, (x - x0) / (x1 - x0), 0.)
+    out = d0 + (d1 - d0) * w
+    out[empty] = np.nan
+    return out
+
+
+def _poly_continuum(x, data, mask, var, deg, maxiter=0, nsig=(-3.0, 3.0)):
+    """Fit a polynomial on each row of a stack of spectra.
+
+    The weighted least-squares problems of all the spectra are solved at
+    once, and the outliers are rejected at each iteration as done by
+    `Spectrum.poly_fit`.
+
+    Parameters
+    ----------
+    x : array of shape (n,)
+        Wavelengths.
+    data, mask : arrays of shape (nspec, n)
+        Data values and masked pixels.
+    var : array of shape (nspec, n) or None
+        Variances, used to weight the pixels if not None.
+    deg : int
+        Polynomial degree.
+    maxiter : int
+        Maximum allowed iterations.
+    nsig : (float,float)
+        The low and high rejection factor in std units.
+
+    Returns
+    -------
+    out : array of shape (nspec, n)
+        The polynomial values, NaN for the spectra with too few points.
+
+    """
+    t = 2 * (x - x.min()) / (x.max() - x.min()) - 1
+    vander = np.polynomial.polynomial.polyvander(t, deg)
+    valid = ~mask & np.isfinite(data)
+    values = np.where(valid, data, 0.)
+    if var is None:
+        wght = np.ones(data.shape)
+    else:
+        with np.errstate(divide='ignore'):
+            wght = 1.0 / np.abs(var)
+        wght[~np.isfinite(wght)] = 0
+    bad = np.count_nonzero(valid, axis=1) <= deg + 1
+
+    def solve(used):
+        w = np.where(used, wght, 0.)
+        wv = w[:, :, np.newaxis] * vander
+        alpha = np.einsum('ski,kj->sij', wv, vander)
+        beta = np.einsum('ski,sk->si', wv, values)
+        alpha[bad] = np.eye(deg + 1)
+        beta[bad] = 0
+        try:
+            coef = np.linalg.solve(alpha, beta[..., np.newaxis])[..., 0]
+        except np.linalg.LinAlgError:
+            coef = np.einsum('sij,sj->si', np.linalg.pinv(alpha), beta)
+        return coef.dot(vander.T)
+
+    used = valid
+    model = solve(used)
+    for _ in range(maxiter):
+        err = values - model
+        npts = np.count_nonzero(used, axis=1)[:, np.newaxis]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = np.where(used, err, 0).sum(axis=1)[:, np.newaxis] / npts
+            sig = np.sqrt(np.where(used, (err - mean) ** 2, 0)
+                          .sum(axis=1)[:, np.newaxis] / npts)
+        new = used & (err >= nsig[0] * sig) & (np.abs(err) <= nsig[1] * sig)
+        # Stop when no pixel is rejected in any spectrum
+        if np.array_equal(new, used):
+            break
+        bad |= np.count_nonzero(new, axis=1) <= deg + 1
+        used = new
+        model = solve(used)
+
+    model[bad] = np.nan
+    return model
+
+
+def _median_continuum(data, ks):
+    """Apply the median filter of `Spectrum.median_filter` (with mirrored
+    edges) of size ``ks`` to each row of a stack of spectra."""
+    return ndi.median_filter(data, size=(1, ks), mode='reflect')
+
+
+def _wavelet_continuum(data, noise, levels, sigmaCutoff, epsilon):
+    """Apply the wavelet filter of `Spectrum.wavelet_filter` to each row of
+    a stack of spectra."""
+    return wavelet1D.cleanSignal(data, noise, levels, sigmaCutoff=sigmaCutoff,
+                                 epsilon=epsilon)
+
+
+def _spline_curve(lbda, eff):
+    """Return the mean wavelength, the wavelength range and the spline
+    representation of a filter curve."""
+    lbda = np.asarray(lbda)
+    eff = np.asarray(eff)
+    if np.shape(lbda) != np.shape(eff):
+        raise TypeError('lbda and eff inputs have not the same size.')
+    l0 = np.average(lbda, weights=eff)
+    k = 3 if lbda.shape[0] > 3 else 1
+    tck = interpolate.splrep(lbda, eff, k=k)
+    return (l0, lbda[0], lbda[-1], tck)
+
+
+@functools.lru_cache(maxsize=None)
+def _filter_curve(name):
+    """Return the mean wavelength, the wavelength range and the spline
+    representation (None for the box filters) of a named filter."""
+    if name in _BAND_FILTERS:
+        lbda, dlbda = _BAND_FILTERS[name]
+        return (lbda, lbda - dlbda / 2.0, lbda + dlbda / 2.0, None)
+    elif name == 'R-Johnson':
+        return ABmag_filters.mag_RJohnson()
+
+    FILTERS = join(abspath(dirname(__file__)), 'filters', 'filter_list.fits')
+    filtname = 'ACS_' + name
+    with fits.open(FILTERS) as hdul:
+        if filtname not in hdul:
+            raise ValueError("filter '{}' not found".format(filtname))
+        lbda = hdul[filtname].data['lambda']
+        thr = hdul[filtname].data['throughput']
+    return _spline_curve(lbda, thr)
+
+
+def _filter_response(filt, wave):
+    """Return the mean wavelength and the normalized response of a filter.
+
+    ``filt`` is a filter name, a (mean wavelength, width) tuple for a box
+    filter, or a (wavelengths, efficiencies) tuple for a filter curve. The
+    response is evaluated on the pixels of ``wave`` within the band of the
+    filter, and divided by its sum, so that its product with a spectrum
+    gives the mean flux in the filter. The responses are kept in cache (see
+    ``FILTER_CACHE_SIZE``) for the same filter and wavelength coordinates.
+    A ValueError is raised if the filter is outside the wavelength range.
+
+    """
+    if isinstance(filt, str):
+        fkey = filt
+    elif np.ndim(filt[0]) == 0:
+        fkey = ('band', float(filt[0]), float(filt[1]))
+    else:
+        lbda, eff = np.asarray(filt[0]), np.asarray(filt[1])
+        fkey = ('curve', lbda.tobytes(), eff.tobytes(), lbda.shape, eff.shape)
+    key = (fkey, wave.coord(unit=u.angstrom).tobytes())
+
+    with _filter_responses_lock:
+        response = _filter_responses.get(key)
+        if response is not None:
+            _filter_responses.move_to_end(key)
+            return response
+
+    if isinstance(filt, str):
+        l0, lmin, lmax, tck = _filter_curve(filt)
+    elif fkey[0] == 'band':
+        l0 = fkey[1]
+        lmin, lmax, tck = l0 - fkey[2] / 2.0, l0 + fkey[2] / 2.0, None
+    else:
+        l0, lmin, lmax, tck = _spline_curve(lbda, eff)
+
+    # Same pixel selection as Spectrum._wavelengths_to_slice
+    n = wave.shape
+    if (wave.pixel(lmin, unit=u.angstrom) > n or
+            wave.pixel(lmax, unit=u.angstrom) < 0):
+        raise ValueError('Spectrum outside Filter band')
+    i1 = wave.pixel(lmin, nearest=True, unit=u.angstrom)
+    i2 = wave.pixel(lmax, nearest=True, unit=u.angstrom) + 1
+
+    weights = np.zeros(n)
+    if tck is None:
+        weights[i1:i2] = 1.0
+    else:
+        if i1 == i2 - 1:
+            raise ValueError('Filter band smaller than spectrum step')
+        lb = wave.coord(np.arange(i1, i2), unit=u.angstrom)
+        weights[i1:i2] = interpolate.splev(lb, tck, der=0)
+    wsum = weights.sum()
+    if wsum == 0:
+        raise ValueError('Filter response is null over the spectrum')
+    weights /= wsum
+    weights.flags.writeable = False
+    response = (float(l0), weights)
+
+    with _filter_responses_lock:
+        _filter_responses[key] = response
+        while len(_filter_responses) > FILTER_CACHE_SIZE:
+            _filter_responses.popitem(last=False)
+    return response
+
+
+def _filter_magnitudes(data, var, wave, filters, scale, strict=False):
+    """Compute the AB magnitudes of a stack of spectra in several filters.
+
+    ``data`` and ``var`` (or None) are (masked) arrays of shape (nspec, n)
+    with the wavelength coordinates ``wave``, and ``scale`` converts their
+    unit to erg.s-1.cm-2.Angstrom-1. The mean flux in each filter is
+    computed for all the spectra with a product with the matrix of the
+    filter responses, normalized by the sum of the responses of the
+    unmasked pixels of each spectrum. The filters outside the spectra
+    raise a ValueError if ``strict`` is True, otherwise their magnitudes
+    are set to 99.
+
+    """
+    nfilt = len(filters)
+    weights = np.zeros((nfilt, wave.shape))
+    l0 = np.ones(nfilt)
+    for i, filt in enumerate(filters):
+        try:
+            l0[i], weights[i] = _filter_response(filt, wave)
+        except ValueError:
+            if strict:
+                raise
+
+    mask = np.ma.getmaskarray(data)
+    valid = (~mask).astype(float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        wsum = valid.dot(weights.T)
+        flux = np.ma.filled(data, 0.0).dot(weights.T) / wsum
+        if var is None:
+            err = np.full(flux.shape, np.inf)
+        else:
+            var = np.where(mask, 0.0, np.ma.filled(var, 0.0))
+            err = np.sqrt(var.dot((weights ** 2).T)) / wsum
+    return flux2mag(flux * scale, err * scale, l0)
@@ -113,6 +113,45 @@ class TestWCS:
         assert_allclose(wcs.sky2pix(wcs.pix2sky(pix2)), pix2)
         assert_allclose(wcs.sky2pix(sky, nearest=True), pixint)
 
+    @pytest.mark.parametrize('deg', (True, False))
+    def test_numpy_transform(self, deg):
+        """WCS class: testing the transformations done with Numpy"""
+        wcs = WCS(crval=(-30.2, 0.01), cdelt=(0.2 / 3600, 0.25 / 3600),
+                  rot=30, deg=deg, shape=(300, 400))
+        assert wcs._get_transform()[0] == ('tan' if deg else 'linear')
+        pix = np.random.RandomState(0).uniform(-100, 500, size=(1000, 2))
+        ra, dec = wcs.wcs.wcs_pix2world(pix[:, 1], pix[:, 0], 0)
+        sky = wcs.pix2sky(pix)
+        assert_allclose(sky[:, 0], dec, rtol=0, atol=1e-12)
+        dra = np.mod(sky[:, 1] - ra + 180, 360) - 180
+        assert_allclose(dra, 0, atol=1e-12)
+        assert_allclose(wcs.sky2pix(sky), pix, rtol=0, atol=1e-6)
+
+        # The transformation follows the changes of the WCS
+        wcs.set_crval1(0.02)
+        wcs.rotate(10)
+        ra, dec = wcs.wcs.wcs_pix2world(pix[:, 1], pix[:, 0], 0)
+        assert_allclose(wcs.pix2sky(pix)[:, 0], dec, rtol=0, atol=1e-12)
+
+    def test_coord_cache(self):
+        """WCS class: testing the cache of the coordinates"""
+        def ref_coord(wcs):
+            y, x = np.indices((wcs.naxis2, wcs.naxis1))
+            ra, dec = wcs.wcs.wcs_pix2world(x, y, 0)
+            return dec, ra
+
+        wcs = WCS(crval=(0, 0), shape=(5, 6))
+        dec, ra = wcs.coord()
+        assert_allclose((dec, ra), ref_coord(wcs))
+        dec[:] = 100
+        assert_allclose(wcs.coord(), ref_coord(wcs))
+        wcs.set_step((2, 2))
+        assert_allclose(wcs.coord(), ref_coord(wcs))
+        wcs.wcs.wcs.crval[1] = 10
+        assert_allclose(wcs.coord(), ref_coord(wcs))
+        assert wcs.coord()[0].min() == 10 - 2 * 2
+        assert wcs[1:3, 2:].coord()[0].shape == (2, 4)
+
     def test_rot(self):
         """WCS class: testing constructor 2 """
         h = fits.getheader(get_data_file('obj', 'IMAGE-HDFS-1.34.fits'), ext=1)
@@ -243,6 +282,31 @@ class TestWaveCoord:
         np.testing.assert_allclose(wave.pixel(wave.coord(unit=u.nm),
                                               unit=u.nm), pix)
 
+    def test_coord_cache(self):
+        """WaveCoord class: testing the cache of the coordinates"""
+        wave = WaveCoord(crval=4750, cdelt=1.25, cunit=u.angstrom, shape=100)
+        pix = np.arange(100, dtype=float)
+        lbda = wave.coord()
+        assert_array_equal(lbda, wave.wcs.wcs_pix2world(pix, 0)[0])
+        lbda[:] = 0
+        assert_array_equal(wave.coord(), 4750 + 1.25 * pix)
+        assert_allclose(wave.coord(unit=u.nm), 475 + 0.125 * pix)
+        assert_array_equal(wave.pixel(4750 + 1.25 * pix), pix)
+
+        wave.set_step(2.5)
+        assert_array_equal(wave.coord(), 4750 + 2.5 * pix)
+        wave.wcs.wcs.crval[0] = 5000
+        assert_array_equal(wave.coord(), 5000 + 2.5 * pix)
+        wave.shape = 10
+        assert_array_equal(wave.coord(), 5000 + 2.5 * pix[:10])
+        wave.unit = u.nm
+        assert_allclose(wave.coord(unit=u.angstrom), 50000 + 25 * pix[:10])
+
+        # Non-linear axes are transformed by astropy
+        wave.wcs.wcs.ctype[0] = 'WAVE-LOG'
+        assert wave._get_transform() is None
+        assert_allclose(wave.coord(), wave.wcs.wcs_pix2world(pix[:10], 0)[0])
+
     def test_get(self):
         """WaveCoord class: testing getters"""
         wave = WaveCoord(crval=0, crpix=1, cunit=u.nm, shape=10)
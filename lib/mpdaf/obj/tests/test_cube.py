@@ -42,6 +42,7 @@ from numpy import ma
 from numpy.testing import (assert_almost_equal, assert_array_equal,
                            assert_allclose)
 from operator import add, sub, mul, truediv as div
+from scipy import signal
 
 from mpdaf.tests.utils import (generate_cube, generate_image, generate_spectrum,
                             assert_masked_allclose, get_data_file)
@@ -301,6 +302,19 @@ def test_mask(cube):
     assert_array_equal(np.any(cube.mask[5:, :, :], axis=0),
                        np.ones(cube.shape[1:]))
 
+    # The 2D masks of mask_ellipse() and mask_polygon() are the same as
+    # for an image, for each wavelength plane between lmin and lmax.
+    poly = np.array([[0.5, 1.2], [6.2, 0.3], [7.5, 6.1], [2.4, 4.5]])
+    for inside in (True, False):
+        ima = cube[0].clone(data_init=np.zeros)
+        ima.mask_polygon(poly, unit=None, inside=inside)
+        cub = cube.clone(data_init=np.zeros)
+        cub.mask_polygon(poly, lmin=2, lmax=5, unit_poly=None,
+                         unit_wave=None, inside=inside)
+        assert_array_equal(cub._mask[2:5], ima._mask[np.newaxis].repeat(3, 0))
+        assert_array_equal(cub._mask[:2], not inside)
+        assert_array_equal(cub._mask[5:], not inside)
+
     # Check that we can select the same mask via the output of np.where()
     # passed to mask_selection().
     ksel = np.where(cube.data.mask)
@@ -983,3 +997,230 @@ def test_convolve():
 
     res = c.fftconvolve(kern)
     assert_masked_allclose(res.data, expected_data, atol=1e-15)
+
+
+def test_fftconvolve_spatial():
+    """Cube class: testing spatial convolution of each image."""
+    rng = np.random.RandomState(0)
+    shape = (5, 21, 18)
+    mask = np.zeros(shape, dtype=bool)
+    mask[:, 4, 6] = True
+    mask[2, 10:12, 3] = True
+    cube = generate_cube(data=rng.rand(*shape), var=rng.rand(*shape),
+                         mask=mask, wave=WaveCoord(crval=1, cunit=u.angstrom))
+    y, x = np.mgrid[-3:4, -3:3]
+    fwhm = np.linspace(1., 3., shape[0])[:, None, None]
+    psf = np.exp(-(x ** 2 + y ** 2) / (2 * (fwhm / 2.355) ** 2))
+    psf /= psf.sum(axis=(1, 2))[:, None, None]
+
+    # same kernel for all the images
+    res = cube.fftconvolve(psf[1])
+    res2 = cube.fftconvolve(Image(data=psf[1]))
+    for k in range(shape[0]):
+        ref = cube[k].fftconvolve(psf[1])
+        assert_masked_allclose(res[k].data, ref.data, atol=1e-14)
+        assert_masked_allclose(res[k].var, ref.var, atol=1e-14)
+        assert_masked_allclose(res2[k].data, ref.data, atol=1e-14)
+
+    # kernel that depends on the wavelength
+    res = cube.fftconvolve(psf, spatial=True, workers=2)
+    for k in range(shape[0]):
+        ref = cube[k].fftconvolve(psf[k])
+        assert_masked_allclose(res[k].data, ref.data, atol=1e-14)
+        assert_masked_allclose(res[k].var, ref.var, atol=1e-14)
+
+    # the 3D convolution is the same as with scipy
+    res = cube.fftconvolve(psf)
+    assert_allclose(res._data, signal.fftconvolve(cube.data.filled(0), psf,
+                                                  mode='same'), atol=1e-14)
+
+    with pytest.raises(ValueError):
+        cube.fftconvolve(psf[:2], spatial=True)
+
+
+def _regrid_test_cube():
+    rng = np.random.RandomState(0)
+    shape = (4, 30, 36)
+    wcs = WCS(crval=(10., 20.), crpix=(15.3, 20.7), deg=True, rot=5.,
+              cdelt=(0.2 / 3600, -0.2 / 3600), shape=shape[1:])
+    mask = np.zeros(shape, dtype=bool)
+    mask[:, 3:6, 7:9] = True
+    mask[:, :, -2:] = True
+    mask[2, 20:22, 25:28] = True
+    return generate_cube(data=rng.rand(*shape) * 10, var=rng.rand(*shape),
+                         mask=mask, wcs=wcs)
+
+
+def _assert_planes_equal(cube, images):
+    for k, im in enumerate(images):
+        assert_array_equal(cube._mask[k], im._mask)
+        assert_allclose(cube._data[k], im._data, rtol=1e-10, atol=1e-12)
+        assert_allclose(cube._var[k], im._var, rtol=1e-10, atol=1e-12)
+        assert cube.wcs.isEqual(im.wcs)
+
+
+@pytest.mark.parametrize('order', (0, 1, 3))
+@pytest.mark.parametrize('inc', (0.3, 0.15))
+def test_regrid(order, inc):
+    """Cube class: testing regrid method."""
+    cube = _regrid_test_cube()
+    args = ((25, 28), (10., 20.), (12.3, 14.1), (inc, -inc))
+    for flux in (False, True):
+        res = cube.regrid(*args, flux=flux, order=order, workers=2)
+        assert res.shape == (4, 25, 28)
+        _assert_planes_equal(res, [ima.regrid(*args, flux=flux, order=order)
+                                   for ima in iter_ima(cube)])
+
+
+def test_align_with_image():
+    """Cube class: testing align_with_image method."""
+    cube = _regrid_test_cube()
+    wcs = WCS(crval=(10., 20.), crpix=(14, 16), deg=True, rot=20.,
+              cdelt=(0.35 / 3600, -0.35 / 3600), shape=(20, 24))
+    other = Image(data=np.zeros((20, 24)), wcs=wcs)
+    for flux in (False, True):
+        res = cube.align_with_image(other, flux=flux, workers=2)
+        assert res.shape == (4, 20, 24)
+        _assert_planes_equal(res, [ima.align_with_image(other, flux=flux)
+                                   for ima in iter_ima(cube)])
+
+    res = cube.align_with_image(cube[0])
+    assert_array_equal(res._data, cube._data)
+
+    # images with different masked margins are cropped differently
+    cube._mask[0, :, :8] = True
+    cube._mask[1, :6, :] = True
+    cube._mask[3] = True
+    res = cube.align_with_image(other, workers=2)
+    _assert_planes_equal(res, [cube[k].align_with_image(other)
+                               for k in range(3)])
+    assert np.all(res._mask[3])
+
+
+@pytest.mark.parametrize('step', (2.5, 0.4))
+def test_resample(step):
+    """Cube class: testing resample against Spectrum.resample"""
+    np.random.seed(12)
+    data = np.random.normal(size=(200, 3, 4))
+    mask = np.zeros(data.shape, dtype=bool)
+    mask[50:53, 1, 2] = True
+    mask[120, :, 0] = True
+    wave = WaveCoord(crpix=1.0, cdelt=1.25, crval=4800.0, cunit=u.angstrom)
+    cube = generate_cube(data=data, var=data ** 2, mask=mask, wave=wave)
+
+    res = cube.resample(step)
+    assert res.wave.get_step() == step
+    assert res.shape[1:] == cube.shape[1:]
+    for y, x in np.ndindex(*cube.shape[1:]):
+        sp = cube[:, y, x].resample(step)
+        assert_masked_allclose(res.data[:, y, x], sp.data, atol=1e-12)
+        assert_masked_allclose(res.var[:, y, x], sp.var, atol=1e-12)
+
+    # with the start and shape of the output spectra
+    res = cube.resample(step, start=4805.0, shape=40)
+    assert_array_equal(cube.data, data)
+    for y, x in np.ndindex(*cube.shape[1:]):
+        sp = cube[:, y, x].resample(step, start=4805.0, shape=40)
+        assert_masked_allclose(res.data[:, y, x], sp.data, atol=1e-12)
+
+    # inplace
+    cube.resample(step, start=4810.0, shape=20, inplace=True)
+    assert cube.shape == (20, 3, 4)
+    assert_almost_equal(cube.wave.get_start(), 4810.0)
+
+
+def test_LSF_convolve():
+    """Cube class: testing LSF_convolve against Spectrum.LSF_convolve"""
+    from mpdaf.MUSE import LSF
+    lsf = LSF(typ='qsim_v1')
+    data = np.random.RandomState(3).normal(size=(40, 3, 2))
+    cube = generate_cube(data=data, var=2.0)
+    res = cube.LSF_convolve(lsf, 7)
+    assert_array_equal(cube.data, data)
+    for y, x in np.ndindex(*cube.shape[1:]):
+        sp = cube[:, y, x].LSF_convolve(lsf, 7)
+        assert_allclose(res.data[:, y, x], sp.data)
+        assert_allclose(res.var[:, y, x], sp.var)
+
+
+def test_gauss_fit_maps():
+    """Cube class: testing gauss_fit_maps against the Spectrum fits"""
+    rs = np.random.RandomState(0)
+    wave = WaveCoord(crpix=1, cdelt=1.25, crval=6500, cunit=u.angstrom)
+    lbda = wave.coord(np.arange(200))[:, np.newaxis, np.newaxis]
+    lpeak = 6600 + rs.normal(0, 3, (4, 5))
+    sigma = rs.uniform(2, 4, (4, 5))
+    flux = rs.uniform(50, 100, (4, 5))
+    wratio = 1.02
+
+    def line(center, flux):
+        return flux / np.sqrt(2 * np.pi) / sigma * \
+            np.exp(-(lbda - center) ** 2 / (2 * sigma ** 2))
+
+    cont = 2 + 0.001 * (lbda - 6500)
+    noise = rs.normal(0, 0.1, (200, 4, 5))
+    var = np.full(noise.shape, 0.01)
+    cube = generate_cube(data=cont + line(lpeak, flux) + noise, var=var,
+                         wave=wave)
+    mask = np.zeros((4, 5), dtype=bool)
+    mask[1, 2] = True
+
+    res = cube.gauss_fit_maps(6560, 6640, mask=mask)
+    assert res['lpeak'].unit == u.angstrom
+    assert_array_equal(res['flux'].mask, mask)
+    assert np.all(res['success'].data[~mask])
+    assert_allclose(res['lpeak'].data[~mask], lpeak[~mask], atol=0.2)
+    for y, x in [(0, 0), (3, 4)]:
+        fit = cube[:, y, x].gauss_fit(6560, 6640)
+        for name in ('lpeak', 'flux', 'fwhm', 'peak', 'err_flux',
+                     'err_lpeak'):
+            assert_allclose(res[name][y, x], getattr(fit, name), rtol=1e-4)
+
+    res = cube.gauss_fit_maps(6560, 6640, kind='asym')
+    fit = cube[:, 3, 4].gauss_asymfit(6560, 6640)
+    assert_allclose(res['flux_left'][3, 4], fit[0].flux, rtol=1e-5)
+    assert_allclose(res['fwhm_right'][3, 4], fit[1].fwhm, rtol=1e-5)
+
+    cube = generate_cube(data=cont + line(lpeak, flux) +
+                         line(lpeak * wratio, flux / 2) + noise, var=var,
+                         wave=wave)
+    res = cube.gauss_fit_maps(6560, 6780, kind='double', wratio=wratio)
+    fit = cube[:, 3, 4].gauss_dfit(6560, 6780, wratio)
+    assert_allclose(res['flux_1'][3, 4], fit[0].flux, rtol=1e-5)
+    assert_allclose(res['flux_2'][3, 4], fit[1].flux, rtol=1e-5)
+    assert_allclose(res['flux_2'].data / res['flux_1'].data, 0.5, atol=0.05)
+
+    with pytest.raises(ValueError):
+        cube.gauss_fit_maps(6560, 6640, kind='double')
+
+
+def test_continuum():
+    """Cube class: testing poly_spec, median_filter and wavelet_filter"""
+    rs = np.random.RandomState(0)
+    wave = WaveCoord(crpix=1, cdelt=1.25, crval=6500, cunit=u.angstrom)
+    lbda = wave.coord(np.arange(120))[:, np.newaxis, np.newaxis]
+    data = 2 + 0.001 * (lbda - 6500) + rs.normal(0, 0.1, (120, 3, 4))
+    data[50:53] += 5
+    var = rs.uniform(0.005, 0.02, data.shape)
+    mask = rs.uniform(size=data.shape) < 0.05
+    mask[:, 2, 3] = True
+    cube = generate_cube(data=data, var=var, mask=mask, wave=wave)
+
+    for kwargs in (dict(deg=3), dict(deg=2, maxiter=3),
+                   dict(deg=2, weight=False)):
+        cont = cube.poly_spec(**kwargs)
+        assert np.all(cont.mask[:, 2, 3])
+        for y, x in [(0, 0), (1, 2), (2, 1)]:
+            sp = cube[:, y, x].poly_spec(**kwargs)
+            assert_allclose(cont.data[:, y, x], sp.data, rtol=1e-10)
+
+    cont = cube.median_filter(10.)
+    assert cont.var is None
+    for y, x in [(0, 0), (1, 2), (2, 1)]:
+        assert_allclose(cont.data[:, y, x],
+                        cube[:, y, x].median_filter(10.).data)
+
+    cont = cube.wavelet_filter(levels=4)
+    for y, x in [(0, 0), (1, 2)]:
+        assert_allclose(cont.data[:, y, x],
+                        cube[:, y, x].wavelet_filter(levels=4).data)
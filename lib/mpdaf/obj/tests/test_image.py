@@ -37,7 +37,9 @@ import numpy as np
 import pytest
 import scipy.ndimage as ndi
 
-from mpdaf.obj import Image, WCS, gauss_image, moffat_image
+from mpdaf.obj import (Image, WCS, Gauss2D, Moffat2D, gauss_image,
+                       moffat_image, fit_moffat2d_stack,
+                       estimate_coordinate_offsets)
 from numpy.testing import (assert_array_equal, assert_allclose,
                            assert_almost_equal, assert_equal,
                            assert_array_almost_equal)
@@ -190,11 +192,7 @@ def test_gauss(fwhm, flux, factor, weight, fit_back, cont, center,
                           unit_center=None, unit_fwhm=None, circular=False,
                           full_output=True, maxiter=200)
     assert isinstance(gauss.ima, Image)
-    if factor == 1:
-        assert_array_almost_equal(gauss.center, (19.5, 14.5))
-    else:
-        # FIXME: This must be fixed, when factor=2 center is wrong
-        assert_array_almost_equal(gauss.center, (19.25, 14.25))
+    assert_array_almost_equal(gauss.center, (19.5, 14.5))
 
     for param, value in params.items():
         if np.isscalar(value):
@@ -292,6 +290,117 @@ def test_moffat(fwhm, flux, fit_n, n, fit_back, cont, center,
             assert_array_almost_equal(getattr(moffat, param), value, 2)
 
 
+@pytest.mark.parametrize('circular,rot', ((True, 0), (False, 0),
+                                          (False, None)))
+def test_gauss_fit_multi(circular, rot):
+    """Image class: testing batched Gaussian fits"""
+    wcs = WCS(cdelt=(0.2 / 3600, 0.2 / 3600), crval=(8.5, 12),
+              shape=(60, 80), deg=True)
+    fwhm = (1.2, 1.2) if circular else (1.2, 0.8)
+    centers = [(15.3, 14.8), (30., 40.2), (44.6, 65.1)]
+    fluxes = [5., 10., 7.]
+    ima = gauss_image(wcs=wcs, unit_center=None, unit_fwhm=u.arcsec,
+                      center=centers[0], flux=fluxes[0], fwhm=fwhm,
+                      rot=30 if rot is not None else 0, cont=2.)
+    for center, flux in zip(centers[1:], fluxes[1:]):
+        ima += gauss_image(wcs=wcs, unit_center=None, unit_fwhm=u.arcsec,
+                           center=center, flux=flux, fwhm=fwhm,
+                           rot=30 if rot is not None else 0)
+    ima._var = np.ones_like(ima._data)
+
+    res = ima.gauss_fit_multi(ima.wcs.pix2sky(centers) + 1e-5, size=4,
+                              fwhm=(1, 1), circular=circular, rot=rot)
+    assert len(res) == 3
+    assert np.all(res.success)
+    assert_array_almost_equal(res.center, ima.wcs.pix2sky(centers))
+    assert_array_almost_equal(res.flux, fluxes)
+    assert_array_almost_equal(res.cont, 2.)
+    assert_array_almost_equal(res.fwhm, [fwhm] * 3)
+
+    # the items are Gauss2D objects, with the same results as gauss_fit
+    gauss = res[1]
+    assert isinstance(gauss, Gauss2D)
+    ref = ima.gauss_fit(pos_min=(20, 30), pos_max=(40, 50),
+                        center=centers[1], fwhm=(1, 1), unit_center=None,
+                        circular=circular, rot=rot, verbose=False)
+    assert_array_almost_equal(gauss.center, ima.wcs.pix2sky(ref.center)[0])
+    for param in ('flux', 'fwhm', 'cont', 'peak'):
+        assert_array_almost_equal(getattr(gauss, param), getattr(ref, param))
+    if rot is not None and not circular:
+        assert_almost_equal(gauss.rot, 30)
+
+    # image without mask
+    ima.mask = np.ma.nomask
+    res2 = ima.gauss_fit_multi(ima.wcs.pix2sky(centers) + 1e-5, size=4,
+                               fwhm=(1, 1), circular=circular, rot=rot)
+    assert_array_almost_equal(res2.center, res.center)
+    assert_array_almost_equal(res2.flux, res.flux)
+
+
+@pytest.mark.parametrize('fit_n,n', ((True, 2.0), (False, 1.6)))
+def test_moffat_fit_multi(fit_n, n):
+    """Image class: testing batched Moffat fits"""
+    wcs = WCS(cdelt=(1., 1.), crval=(0, 0))
+    params = dict(fwhm=(2.8, 2.1), n=1.6, rot=30)
+    centers = np.array([(20., 20.), (20.4, 60.7), (61.2, 30.9)])
+    fluxes = np.array([12.3, 20., 5.])
+    ima = Image(wcs=wcs, data=np.full((80, 90), 8.24))
+    for center, flux in zip(centers, fluxes):
+        ima += moffat_image(wcs=wcs, shape=(80, 90), unit_center=None,
+                            unit_fwhm=None, center=center, flux=flux,
+                            **params)
+
+    res = ima.moffat_fit_multi(centers.round(), size=21, unit_center=None,
+                               unit_size=None, unit_fwhm=None, n=n,
+                               fwhm=(3., 3.), fit_n=fit_n)
+    assert np.all(res.success)
+    # the wings of the other sources bias slightly the fits
+    assert_array_almost_equal(res.center, centers, 2)
+    assert_array_almost_equal(res.flux, fluxes, 1)
+    assert_array_almost_equal(res.cont, 8.24, 2)
+    assert_array_almost_equal(res.rot, 30, 1)
+    assert_array_almost_equal(res.fwhm, [params['fwhm']] * 3, 2)
+    assert_array_almost_equal(res.n, 1.6, 2)
+
+    moffat = res[2]
+    assert isinstance(moffat, Moffat2D)
+    assert moffat.flux == res.flux[2]
+    assert [m.peak for m in res] == list(res.peak)
+
+    # fit directly the stack of cut-outs, with the masked pixels ignored
+    stack = np.ma.array([ima.data[10:31, 10:31], ima.data[50:71, 20:41]])
+    stack[0, 0, :] = np.ma.masked
+    stack[1, 5, 5] = np.nan
+    res = fit_moffat2d_stack(stack, fwhm=(3., 3.))
+    assert_array_almost_equal(res.center, [(10., 10.), (11.2, 10.9)], 2)
+    assert_array_almost_equal(res.n, 1.6, 2)
+    assert_array_equal(res.dof, [21 * 20 - 8, 21 * 21 - 9])
+
+
+def test_levenberg_marquardt_divergence():
+    """Image class: testing the convergence flags of the batched fits"""
+    from mpdaf.obj.fitting import _levenberg_marquardt
+    x = np.linspace(-1, 1, 20)
+    data = np.vstack([2 * x + 1, 0.3 * x + 1])
+
+    def model(v):
+        # a line, which is not defined for slopes above 0.3
+        f = v[:, 1, None] * x + v[:, 0, None]
+        f[v[:, 1] > 0.3] = np.nan
+        jac = np.stack([np.ones_like(f), np.broadcast_to(x, f.shape)], -1)
+        return f, jac
+
+    # The first fit can not move from its initial slope, all the trial
+    # steps give NaN values. For the second one, the initial parameters
+    # are at the minimum.
+    v, _, chisq, success = _levenberg_marquardt(
+        model, [[1., 0.3], [1., 0.3]], np.array([False, True]), data,
+        np.ones_like(data))
+    assert_array_equal(success, [False, True])
+    assert_array_equal(v, [[1., 0.3], [1., 0.3]])
+    assert chisq[0] > 1
+
+
 def test_mask():
     """Image class: testing mask functionalities"""
     wcs = WCS()
@@ -561,6 +670,13 @@ def test_ee():
     ee = image1.ee(center=(2, 2), unit_center=None, radius=1, unit_radius=None)
     assert ee == 4 * 2
 
+    # near the edges, the circle is centered on the middle of the truncated
+    # region, and limited to this region
+    image2 = Image(data=np.arange(30.).reshape(6, 5), wcs=wcs)
+    ee = image2.ee(center=(1, 1), unit_center=None, radius=2,
+                   unit_radius=None)
+    assert ee == np.sum([6, 7, 8, 11, 12, 13, 16, 17, 18])
+
     r, eer = image1.eer_curve(center=(2, 2), unit_center=None,
                               unit_radius=None, cont=0)
     assert r[1] == 1.0
@@ -571,6 +687,41 @@ def test_ee():
     assert_almost_equal(size[0], 1.775)
 
 
+def test_radial_profile():
+    """Image class: testing radial profiles."""
+    shape = (101, 101)
+    wcs = WCS(cdelt=(1., 1.), crval=(8.5, 12), shape=shape)
+    ima = gauss_image(wcs=wcs, fwhm=(5, 5), cont=2.0, unit_center=u.pix,
+                      unit_fwhm=u.pix, flux=10, peak=True)
+    ima.mask[0, :] = True
+
+    centers = [(50, 50), (49.5, 50.2)]
+    prof = ima.radial_profile(centers, radius=20, unit_center=None,
+                              unit_radius=None, oversample=4, cont=2)
+    assert len(prof) == 2
+    assert prof.flux.shape == (2, 20)
+    assert_array_equal(prof.radius, np.arange(20) + 0.5)
+    assert_allclose(prof.area[:, -1], np.pi * 19.5 ** 2, rtol=0.01)
+    assert_allclose(prof.ee_radius(0.5), 2.5, rtol=0.05)
+    assert_allclose(prof.fwhm(), 5, rtol=0.05)
+    assert_allclose(ima.fwhm(unit_radius=None, method='profile', cont=2),
+                    (5, 5), rtol=0.05)
+
+    # the profiles are the same as with individual computations
+    for center, flux in zip(centers, prof.flux):
+        p = ima.radial_profile(center, radius=20, unit_center=None,
+                               unit_radius=None, oversample=4, cont=2)
+        assert_allclose(p.flux[0], flux)
+
+    # ensquared energies
+    prof = ima.radial_profile(radius=3.5, unit_radius=None, square=True)
+    for k, ee in enumerate(prof.ee[0]):
+        assert_allclose(ee, ima.data[50 - k:51 + k, 50 - k:51 + k].sum())
+    r, eer = ima.eer_curve(unit_radius=None)
+    assert_array_equal(r, np.arange(50))
+    assert_allclose(eer[:4], prof.eer(ima.data.sum())[0])
+
+
 def test_rebin():
     """Image class: testing rebin methods."""
     wcs = WCS(crval=(0, 0))
@@ -729,6 +880,57 @@ def test_peak_detection_and_fwhm():
     assert_allclose(ima.fwhm(unit_radius=None), fwhm, rtol=0.1)
 
 
+def _tiled_test_image():
+    rng = np.random.RandomState(0)
+    shape = (150, 170)
+    data = rng.normal(0, 1, shape)
+    y, x = np.mgrid[:shape[0], :shape[1]]
+    for k in range(30):
+        cy, cx = rng.uniform(0, shape[0]), rng.uniform(0, shape[1])
+        width = rng.uniform(1, 6)
+        data += rng.uniform(20, 100) * np.exp(-((y - cy) ** 2 + (x - cx) ** 2)
+                                              / (2 * width ** 2))
+    # a ring crossing the borders of the tiles, with a hole that is filled
+    # by peak_detection
+    radius = np.hypot(y - 75, x - 80)
+    data[(radius > 10) & (radius < 14)] += 80
+    data[72, 76] += 20
+    mask = np.zeros(shape, dtype=bool)
+    mask[50:60, 100:130] = True
+    mask[:2] = True
+    return Image(data=data, mask=mask, wcs=WCS(shape=shape))
+
+
+@pytest.mark.parametrize('tile', (23, (40, 64)))
+def test_tiled_detection(tile):
+    """Image class: testing background, peak_detection and segment by
+    tiles"""
+    ima = _tiled_test_image()
+    assert ima.background(tile=tile) == ima.background()
+    nomask = ima.copy()
+    nomask.mask = np.ma.nomask
+    assert nomask.background(tile=tile) == nomask.background()
+
+    for nstruct, niter in ((3, 1), (4, 2)):
+        peaks = ima.peak_detection(nstruct, niter)
+        assert len(peaks) > 5
+        assert_allclose(ima.peak_detection(nstruct, niter, tile=tile,
+                                           workers=2), peaks, rtol=1e-12)
+
+    for kwargs in (dict(minsize=5, background=10),
+                   dict(minsize=4, background=5, median=(3, 3), minpts=30),
+                   dict(shape=(2, 1), minsize=3, background=8)):
+        ref = ima.segment(**kwargs)
+        res = ima.segment(tile=tile, **kwargs)
+        assert len(res) == len(ref)
+        for im1, im2 in zip(res, ref):
+            assert_masked_allclose(im1.data, im2.data)
+            assert im1.wcs.isEqual(im2.wcs)
+
+    with pytest.raises(ValueError):
+        ima.segment(tile=tile, interp='linear')
+
+
 def test_get_item():
     """Image class: testing __getitem__"""
     # Set the shape and contents of the image's data array.
@@ -811,6 +1013,90 @@ def test_align_with_image(hdfs_muse_image, hdfs_hst_image):
     assert_array_equal(hst_orig.data, hst.data)
 
 
+def test_estimate_coordinate_offsets():
+    # Images of a few sources, shifted by known offsets relative to the
+    # reference image.
+    wcs = WCS(crval=(0, 0), crpix=(1, 1), cdelt=(0.2 / 3600, 0.2 / 3600),
+              deg=True, shape=(60, 70))
+    sources = [(12.3, 20.1, 5.), (40.7, 50.2, 3.), (30.2, 15.6, 4.),
+               (48.1, 33.3, 6.)]
+
+    def field(dy, dx):
+        yy, xx = np.mgrid[:60, :70]
+        data = np.zeros((60, 70))
+        for y, x, flux in sources:
+            data += flux * np.exp(-((yy - y - dy) ** 2 +
+                                    (xx - x - dx) ** 2) / 4.)
+        return Image(data=data, wcs=wcs.copy())
+
+    ref = field(0, 0)
+    shifts = [(0, 0), (1.3, -0.6), (-2.1, 0.4)]
+    images = [field(dy, dx) for dy, dx in shifts]
+    images[2].mask_region((5, 5), 3, unit_center=None, unit_radius=None)
+
+    t = estimate_coordinate_offsets(images, ref, workers=2)
+    assert len(t) == 3
+    assert_allclose(t['dy'], [dy for dy, dx in shifts], atol=0.2)
+    assert_allclose(t['dx'], [dx for dy, dx in shifts], atol=0.2)
+    assert_allclose(t['peak'][0], 1)
+    assert t['shift_y'].unit == u.arcsec
+    assert_allclose(t['shift_y'], -0.2 * t['dy'])
+
+    # Without masks the results are the same as estimate_coordinate_offset.
+    for ima, row in zip(images[:2], t):
+        dy, dx = ima.estimate_coordinate_offset(ref)
+        assert_allclose((row['dy'], row['dx']), (dy, dx))
+
+
+def test_estimate_coordinate_offsets_pointings(monkeypatch):
+    # Exposures with different pointings, which share the same resampled
+    # reference image.
+    rng = np.random.RandomState(1)
+    sources = np.column_stack([rng.uniform(0, 90, 15), rng.uniform(0, 90, 15),
+                               rng.uniform(2, 8, 15)])
+
+    def field(crpix, dy, dx, shape=(50, 60)):
+        # sources at (y, x) on the grid of the reference image, which has
+        # crpix=(1, 1)
+        yy, xx = np.mgrid[:shape[0], :shape[1]]
+        yy = yy - crpix[0] + 1 - dy
+        xx = xx - crpix[1] + 1 - dx
+        data = np.zeros(shape)
+        for y, x, flux in sources:
+            data += flux * np.exp(-((yy - y) ** 2 + (xx - x) ** 2) / 4.)
+        wcs = WCS(crval=(0, 0), crpix=crpix, cdelt=(0.2 / 3600, 0.2 / 3600),
+                  deg=True, shape=shape)
+        return Image(data=data, wcs=wcs)
+
+    ref = field((1, 1), 0, 0, shape=(90, 90))
+    images = [field((-10, -20), 0.6, -0.3), field((-25.4, -12.7), -0.8, 1.1),
+              field((-14.5, -31.2), 0.2, 0.4, shape=(45, 52))]
+
+    calls = []
+    align = Image.align_with_image
+
+    def align_with_image(self, other, **kwargs):
+        calls.append(other.shape)
+        return align(self, other, **kwargs)
+
+    t = estimate_coordinate_offsets(images, ref, workers=2)
+    assert_allclose(t['dy'], [0.6, -0.8, 0.2], atol=0.2)
+    assert_allclose(t['dx'], [-0.3, 1.1, 0.4], atol=0.2)
+
+    monkeypatch.setattr(Image, 'align_with_image', align_with_image)
+    t2 = estimate_coordinate_offsets(images, ref, workers=2)
+    assert len(calls) == 1
+    monkeypatch.undo()
+    assert_allclose(t2['dy'], t['dy'])
+
+    # The first image is at an integer pixel position on the grid of the
+    # reference, so its resampled reference is the same as with
+    # estimate_coordinate_offset, the others differ by the interpolation.
+    for ima, row, atol in zip(images, t, (1e-10, 0.1, 0.1)):
+        dy, dx = ima.estimate_coordinate_offset(ref)
+        assert_allclose((row['dy'], row['dx']), (dy, dx), atol=atol)
+
+
 def test_prepare_data():
     image = generate_image(data=2.0)
     image[1, 1] = np.ma.masked
@@ -828,3 +1114,52 @@ def test_prepare_data():
     # data = image._prepare_data(interp='spline')
     # assert not np.ma.is_masked(data)
     # assert np.allclose(data, 2.0)
+
+
+@pytest.mark.parametrize('order', (0, 1))
+def test_get_regrid_operator(order):
+    """Image class: testing get_regrid_operator method."""
+    rng = np.random.RandomState(0)
+    wcs = WCS(crval=(10., 20.), crpix=(15.3, 20.7), deg=True,
+              cdelt=(0.2 / 3600, -0.2 / 3600), shape=(40, 50))
+    mask = np.zeros((40, 50), dtype=bool)
+    mask[3:6, 7:9] = True
+    image = generate_image(data=rng.rand(40, 50), var=rng.rand(40, 50),
+                           mask=mask, wcs=wcs)
+    args = ((30, 35), (10., 20.), (12.3, 14.1), (0.3, -0.3))
+
+    for flux in (False, True):
+        op = image.get_regrid_operator(*args, order=order, flux=flux)
+        # the operator is cached
+        assert op is image.get_regrid_operator(*args, order=order, flux=flux)
+        assert op.matrix.shape == (30 * 35, 40 * 50)
+
+        expected = image.regrid(*args, order=order, flux=flux,
+                                antialias=False)
+        res = op.regrid(image)
+        assert res.wcs.isEqual(expected.wcs)
+        assert_allclose(res._data, expected._data, rtol=1e-12)
+        assert_allclose(res._var, expected._var, rtol=1e-12)
+        assert_array_equal(res._mask, expected._mask)
+
+        # the same output grid, specified with another reference position,
+        # gives the same operator
+        refpos = expected.wcs.pix2sky([5, 6])[0]
+        assert op is image.get_regrid_operator(
+            args[0], refpos, (5, 6), args[3], order=order, flux=flux)
+
+    # masks with pixels near the edges, or without masked pixels
+    for mask in (image._mask | (rng.rand(40, 50) > 0.9), np.ma.nomask):
+        image.mask = mask
+        expected = image.regrid(*args, order=order, antialias=False)
+        res = image.get_regrid_operator(*args, order=order).regrid(image)
+        assert_array_equal(res._mask, expected._mask)
+    assert res._mask.any()
+
+    # stacks of images
+    stack = op(np.array([image._data, 2 * image._data]))
+    assert stack.shape == (2, 30, 35)
+    assert_allclose(stack[1], 2 * op(image._data))
+
+    with pytest.raises(ValueError):
+        image.get_regrid_operator(*args, order=3)
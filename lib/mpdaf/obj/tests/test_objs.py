@@ -37,8 +37,9 @@ import numpy as np
 from numpy.testing import (assert_array_equal, assert_allclose,
                            assert_almost_equal)
 
+from matplotlib.path import Path
 from mpdaf.obj import (is_float, is_int, bounding_box, flux2mag,
-                       mag2flux, UnitArray, UnitMaskedArray)
+                       mag2flux, polygon_mask, UnitArray, UnitMaskedArray)
 
 
 def test_is_float():
@@ -141,3 +142,32 @@ def test_bounding_box():
                                          shape=shape, step=[1.0, 1.0])
     assert sy == slice(0, 0)
     assert sx == slice(shape[1] - 1, shape[1] - 1)
+
+
+def test_polygon_mask():
+    shape = (40, 50)
+    grid = np.mgrid[:shape[0], :shape[1]].reshape(2, -1).T
+
+    # Compare with matplotlib, including vertices on the pixel centers for
+    # which the pixels on the edges must be classified in the same way.
+    rng = np.random.RandomState(12)
+    for decimals in (None, 0, 1):
+        for _ in range(20):
+            poly = rng.uniform(-10, 60, (rng.randint(3, 9), 2))
+            if decimals is not None:
+                poly = np.round(poly, decimals)
+            [sy, sx], mask = polygon_mask(poly, shape)
+            result = np.zeros(shape, dtype=bool)
+            result[sy, sx] = mask
+            expected = Path(poly).contains_points(grid).reshape(shape)
+            assert_array_equal(result, expected)
+
+    # The mask only covers the bounding box of the polygon.
+    [sy, sx], mask = polygon_mask([[2, 3], [2, 8], [6.5, 8], [6.5, 3]], shape)
+    assert sy == slice(2, 7)
+    assert sx == slice(3, 9)
+    assert mask.shape == (5, 6)
+
+    # A polygon outside of the array gives an empty mask.
+    [sy, sx], mask = polygon_mask([[-5, -5], [-5, -2], [-2, -2]], shape)
+    assert mask.size == 0
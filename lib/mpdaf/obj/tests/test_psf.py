@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) 2010-2018 CNRS / Centre de Recherche Astrophysique de Lyon
+Copyright (c) 2016-2019 Simon Conseil <simon.conseil@univ-lyon1.fr>
+
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors
+   may be used to endorse or promote products derived from this software
+   without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import numpy as np
+import pytest
+from astropy.modeling.models import Gaussian2D, Moffat2D
+from numpy.testing import assert_allclose
+from scipy.special import erf
+
+from mpdaf.obj import gauss_psf, moffat_psf
+
+
+def test_gauss_psf():
+    shape = (15, 12)
+    center = (7.3, 5.6)
+    fwhm = np.array([2.0, 2.5, 3.0])
+    sigma = fwhm / (2 * np.sqrt(2 * np.log(2)))
+    yy, xx = np.mgrid[:shape[0], :shape[1]]
+
+    # A stack of Gaussians sampled at the center of the pixels, with a peak
+    # value of 1.
+    psf = gauss_psf(shape, fwhm, center=center, ratio=1.5, normalize=False)
+    assert psf.shape == (3,) + shape
+    for k in range(3):
+        expected = Gaussian2D(1, center[1], center[0], 1.5 * sigma[k],
+                              sigma[k])(xx, yy)
+        assert_allclose(psf[k], expected, rtol=1e-12)
+
+    # The analytic integral over the pixels.
+    psf = gauss_psf(shape, fwhm[0], center=center, integrate=True,
+                    normalize=False)
+    s = np.sqrt(2) * sigma[0]
+    ey = erf((np.arange(shape[0] + 1) - 0.5 - center[0]) / s)
+    ex = erf((np.arange(shape[1] + 1) - 0.5 - center[1]) / s)
+    expected = np.pi / 2 * sigma[0] ** 2 * np.outer(np.diff(ey), np.diff(ex))
+    assert_allclose(psf, expected, rtol=1e-10, atol=1e-15)
+
+    # which is also given by the oversampled rotated Gaussian.
+    psf2 = gauss_psf(shape, fwhm[0], center=center, integrate=True,
+                     normalize=False, rot=90, oversample=20)
+    assert_allclose(psf2, psf, atol=5e-4)
+
+    psf = gauss_psf(shape, fwhm)
+    assert_allclose(psf.sum(axis=(1, 2)), 1)
+
+    with pytest.raises(ValueError):
+        gauss_psf(shape, 0)
+
+
+def test_moffat_psf():
+    shape = (21, 21)
+    fwhm = np.array([2.5, 3.0, 3.5])
+    beta = 2.5
+    alpha = fwhm / (2 * np.sqrt(2 ** (1 / beta) - 1))
+    yy, xx = np.mgrid[:shape[0], :shape[1]]
+
+    psf = moffat_psf(shape, fwhm, beta, normalize=False)
+    for k in range(3):
+        expected = Moffat2D(1, 10, 10, alpha[k], beta)(xx, yy)
+        assert_allclose(psf[k], expected, rtol=1e-12)
+
+    # The normalized images of a single FWHM, with a rotation by 90 degrees
+    # that is the same as the inverse of the axis ratio.
+    psf = moffat_psf(shape, 3.0, beta, ratio=2, rot=90)
+    assert psf.shape == shape
+    assert_allclose(psf.sum(), 1)
+    assert_allclose(psf, moffat_psf(shape, 6.0, beta, ratio=0.5), atol=1e-15)
+
+    # The oversampled images converge to the integral over the pixels,
+    # which has a lower peak than the sampled Moffat.
+    psf = moffat_psf(shape, 3.0, beta)
+    psf4 = moffat_psf(shape, 3.0, beta, integrate=True, oversample=4)
+    psf32 = moffat_psf(shape, 3.0, beta, integrate=True, oversample=32)
+    assert_allclose(psf4, psf32, atol=1e-3)
+    assert psf32.max() < psf.max()
+
+
+def test_psf_cache():
+    # The cached images are not modified by the callers.
+    psf = moffat_psf(11, [2.0, 3.0], 2.5)
+    psf *= 2
+    assert_allclose(moffat_psf(11, [2.0, 3.0], 2.5).sum(axis=(1, 2)), 1)
+    assert moffat_psf(11, [2.0, 3.0], 2.5).flags.writeable
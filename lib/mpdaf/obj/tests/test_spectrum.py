@@ -38,7 +38,8 @@ import numpy as np
 from astropy import units as u
 from astropy.io import ascii, fits
 from mpdaf.log import setup_logging
-from mpdaf.obj import Spectrum, Image, Cube, WCS, WaveCoord, airtovac, vactoair
+from mpdaf.obj import (Spectrum, Image, Cube, WCS, WaveCoord, airtovac,
+                       vactoair, abmag_filters)
 from mpdaf.tools import MpdafWarning
 from numpy.testing import (assert_array_almost_equal, assert_array_equal,
                            assert_almost_equal, assert_allclose)
@@ -395,6 +396,15 @@ def test_poly_fit(spec_var):
     assert_almost_equal(spfit2.mean()[0], 11.1, 1)
     assert_almost_equal(spfit3.mean()[0], 11.1, 1)
 
+    # The polynomial is evaluated with the normalization used for the fit,
+    # also when the ends of the spectrum are masked.
+    wave = WaveCoord(crpix=1, cdelt=2.0, crval=5000, cunit=u.angstrom)
+    x = np.linspace(0, 1, 50)
+    sp = Spectrum(data=1 + 2 * x - 3 * x ** 2, wave=wave)
+    sp.mask[[0, 1, -1]] = True
+    assert_allclose(sp.poly_spec(2).data.data, 1 + 2 * x - 3 * x ** 2,
+                    atol=1e-12)
+
 
 def test_filter(spec_var):
     """Spectrum class: testing filters"""
@@ -420,6 +430,57 @@ def test_mag():
     assert mag > 1.9 and mag < 2.0
 
 
+def test_abmag_filters(spec_var):
+    """Spectrum class: testing magnitudes of stacks of spectra."""
+    spec_var.unit = u.Unit('erg/cm2/s/Angstrom')
+    spec_var.wave.unit = u.angstrom
+    filters = ['B', 'V', 'R-Johnson', 'F606W', 'F814W', 'U', (5000., 1000.),
+               ([4000, 5000, 6000], [0.1, 1.0, 0.3])]
+
+    spectra = [spec_var.copy() for _ in range(4)]
+    spectra[1].data *= 3
+    spectra[2].mask[100:300] = True
+    spectra[3] = spectra[3].subspec(5000, 7000)
+    spectra[3].unit = u.Unit('1e-3 erg/cm2/s/Angstrom')
+
+    mag, err = abmag_filters(spectra, filters)
+    assert mag.shape == (4, len(filters))
+    for sp, m, e in zip(spectra, mag, err):
+        for i, filt in enumerate(filters):
+            if isinstance(filt, str):
+                try:
+                    ref = sp.abmag_filter_name(filt)
+                except ValueError:
+                    ref = (99, np.inf)
+            elif np.isscalar(filt[0]):
+                ref = sp.abmag_band(*filt)
+            else:
+                try:
+                    ref = sp.abmag_filter(*filt)
+                except ValueError:
+                    ref = (99, np.inf)
+            assert_allclose((m[i], e[i]), ref, rtol=1e-12)
+
+    # The last spectrum is outside of the U and B filters
+    assert_array_equal(mag[3, [0, 5]], 99)
+    assert_almost_equal(mag[1] - mag[0], [-2.5 * np.log10(3)] * 5 + [0] +
+                        [-2.5 * np.log10(3)] * 2)
+
+    # Stack of spectra, without the Spectrum objects
+    data = np.ma.array([sp.data for sp in spectra[:3]])
+    var = np.ma.array([sp.var for sp in spectra[:3]])
+    mag2, err2 = abmag_filters(data, filters, wave=spec_var.wave, var=var,
+                               unit=spec_var.unit)
+    assert_allclose(mag2, mag[:3], rtol=1e-12)
+    assert_allclose(err2, err[:3], rtol=1e-12)
+    mag2, err2 = abmag_filters(data.data, filters, wave=spec_var.wave)
+    assert_allclose(mag2[:2], mag[:2], rtol=1e-12)
+    assert np.all(np.isinf(err2))
+
+    with pytest.raises(ValueError):
+        abmag_filters(data, filters)
+
+
 def test_integrate():
     """Spectrum class: testing integration"""
     wave = WaveCoord(crpix=2.0, cdelt=3.0, crval=0.5, cunit=u.nm)
@@ -585,3 +646,70 @@ def test_to_spectrum1d(spec_var):
     sp = spec_var.to_spectrum1d()
     assert sp.flux.unit == spec_var.unit
     assert_allclose(sp.flux.value, spec_var._data)
+
+
+def test_resample_linear():
+    """Spectrum class: testing the linear resampling kernel"""
+    from mpdaf.obj.spectrum import _resample_linear
+    xi = np.arange(20) * 1.5 + 3.0
+    xo = np.linspace(0.0, 40.0, 57)
+    data = np.random.RandomState(0).normal(size=(3, 20))
+    mask = np.zeros(data.shape, dtype=bool)
+    mask[1, 5] = True
+    d, v, m = _resample_linear(xi, xo, data, data ** 2, mask, 0.25, axis=1)
+    inside = (xo >= xi[0]) & (xo <= xi[-1])
+    for k in range(3):
+        assert_allclose(d[k, inside], np.interp(xo[inside], xi, data[k]))
+        assert_allclose(v[k, inside], np.interp(xo[inside], xi, data[k] ** 2))
+        mexp = np.interp(xo, xi, mask[k].astype(float), left=1, right=1)
+        assert_array_equal(m[k], mexp > 0.25)
+    assert np.all(np.isnan(d[:, ~inside]))
+
+
+def test_decimate():
+    """Spectrum class: testing the decimation filter of stacks of spectra"""
+    from mpdaf.obj.spectrum import _decimate, _decimation_kernel
+    wave = WaveCoord(crpix=1.0, cdelt=1.25, crval=4750.0, cunit=u.angstrom)
+    data = np.random.RandomState(2).normal(size=(200, 4))
+    d, v = _decimate(data, data ** 2, 4.0, 1.25, 40.0, axis=0)
+    for k in range(4):
+        sp = Spectrum(data=data[:, k], var=data[:, k] ** 2, wave=wave)
+        sp._decimation_filter(4.0, 40.0, unit=u.angstrom)
+        assert_allclose(d[:, k], sp.data, atol=1e-12)
+        assert_allclose(v[:, k], sp.var, atol=1e-12)
+
+    # The kernel is computed once and cannot be modified
+    kernel = _decimation_kernel(4.0, 1.25, 40.0, 200)
+    assert kernel is _decimation_kernel(4.0, 1.25, 40.0, 200)
+    assert not kernel.flags.writeable
+
+
+def test_LSF_convolve():
+    """Spectrum class: testing LSF_convolve"""
+    from mpdaf.MUSE import LSF
+    lsf = LSF(typ='qsim_v1')
+    size = 11
+    k = size // 2
+    wave = WaveCoord(crpix=1.0, cdelt=1.25, crval=4750.0, cunit=u.angstrom)
+    data = np.random.RandomState(1).normal(size=300)
+    sp = Spectrum(data=data, var=np.abs(data), wave=wave)
+    res = sp.LSF_convolve(lsf, size)
+
+    # Compare with an explicit convolution, with mirrored edges.
+    lbda = sp.wave.coord(unit=u.angstrom)
+    pad = np.pad(data, k, mode='reflect')
+    pvar = np.pad(np.abs(data), k, mode='reflect')
+    kernels = [lsf.get_LSF(l, 1.25, size) for l in lbda]
+    ref = [(kern * pad[i:i + size]).sum() for i, kern in enumerate(kernels)]
+    refvar = [(kern ** 2 * pvar[i:i + size]).sum()
+              for i, kern in enumerate(kernels)]
+    assert_allclose(res.data, ref)
+    # On the edges, the mirrored pixels are correlated with the pixels
+    # that they duplicate, so only the variances of the inner pixels match.
+    assert_allclose(res.var[k:-k], refvar[k:-k])
+
+    # The cached operator gives the same result
+    assert_array_equal(sp.LSF_convolve(lsf, size).data, res.data)
+
+    with pytest.raises(ValueError):
+        sp.LSF_convolve(lsf, 10)
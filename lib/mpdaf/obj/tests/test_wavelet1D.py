@@ -33,6 +33,7 @@ OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import numpy as np
 from mpdaf.obj import wavelet_transform, wavelet_backTransform, cleanSignal
+from numpy.testing import assert_allclose
 
 
 def test_wavelet1D():
@@ -56,3 +57,32 @@ def test_wavelet1D():
                            sigmaCutoff=sigmaCutoff, epsilon=epsilon)
     assert np.abs(np.std(signal_final - denoised) - stdDev) < 1
     assert np.abs(np.std(signal - reconstructed) - stdDev) < 1
+
+
+def test_wavelet1D_stack():
+    from scipy.ndimage import convolve1d
+    from mpdaf.obj.wavelet1D import _h_convolve, get_h_coefficients
+
+    rs = np.random.RandomState(0)
+    x = np.arange(200)
+    signal = 50 * np.exp(-(x - 80)**2 / 50.) + rs.normal(0, 3, (5, 200))
+    noise = rs.uniform(2, 4, (5, 200))
+
+    h = get_h_coefficients(4)
+    for i in range(4):
+        assert_allclose(_h_convolve(signal, i),
+                        convolve1d(signal, h[i], mode='wrap'))
+
+    coefs = wavelet_transform(signal, 4)
+    assert coefs.shape == (5, 5, 200)
+    assert_allclose(coefs[:, 2], wavelet_transform(signal[2], 4))
+    assert_allclose(wavelet_backTransform(coefs), signal)
+
+    # one noise array per signal, or the same for all signals
+    denoised = cleanSignal(signal, noise, 4)
+    for i in range(5):
+        assert_allclose(denoised[i], cleanSignal(signal[i], noise[i], 4),
+                        atol=1e-10)
+    denoised = cleanSignal(signal, noise[0], 4)
+    assert_allclose(denoised[3], cleanSignal(signal[3], noise[0], 4),
+                    atol=1e-10)
@@ -17,13 +17,20 @@
 # be better to pick another scaling function.
 
 import numpy as np
+from functools import lru_cache
 from scipy.ndimage import convolve1d
 
+from ..tools import chunk_slices
+
 __all__ = ('wavelet_transform', 'wavelet_backTransform', 'cleanSignal')
 
 # See book by Starck
 H_COEFFICIENTS_LIST = np.array([1 / 16.0, 1 / 4.0, 3 / 8.0, 1 / 4.0, 1 / 16.0])
 
+# Maximum size (in bytes) of the arrays of wavelet coefficients computed at
+# once by cleanSignal, for stacks of signals.
+_CLEAN_CHUNK_BYTES = 2 ** 26
+
 
 def test_levels(signal, levels):
     """Test if the chosen levels are too many for our signal (sampling
@@ -31,7 +38,7 @@ def test_levels(signal, levels):
     """
     signal = np.asarray(signal)
     h_length = len(H_COEFFICIENTS_LIST)
-    signalSize = signal.size
+    signalSize = signal.shape[-1]
     max_level = np.log2((signalSize - 1.0) / (h_length - 1.0))
     if levels > max_level:
         # If the (level+1)-th h array is larger than the signal array, the
@@ -47,28 +54,53 @@ def test_levels(signal, levels):
     return levels
 
 
+@lru_cache(maxsize=32)
+def _h_array(level):
+    """Return the (read-only) h coefficient array of a level."""
+    h_length = len(H_COEFFICIENTS_LIST)
+    # Array long enough to store the spacing and the values
+    h_array = np.zeros(((2**level) - 1) * (h_length - 1) + h_length)
+    # The spacing between the values is 2**level - 1
+    h_array[::2**level] = H_COEFFICIENTS_LIST
+    h_array.flags.writeable = False
+    return h_array
+
+
 def get_h_coefficients(levels):
     """Build the list of h coefficient arrays.
 
     The spacing between the values is 2**i_level -1 (see Starck book).
+    The arrays are cached, and must not be modified.
 
     """
-    h_length = len(H_COEFFICIENTS_LIST)
-    h_coefficients = []
-    for i in range(levels):
-        # Array long enough to store the spacing and the values
-        max_length = ((2**i) - 1) * (h_length - 1) + h_length
-        h_array = np.zeros(max_length)
-        counter = 0
-        for index in range(len(h_array)):
-            # Now we enter the values and ensure that the spacing between them
-            # is correct
-            if index % (2**i) == 0:
-                h_array[index] = H_COEFFICIENTS_LIST[counter]
-                counter += 1
-        h_coefficients.append(h_array)
+    return [_h_array(i) for i in range(levels)]
 
-    return h_coefficients
+
+@lru_cache(maxsize=64)
+def _h_indices(size, level):
+    """Return the indices of the signal values multiplied by each of the
+    non-zero h coefficients of a level, for signals of a given size (with
+    the 'wrap' boundary condition)."""
+    offsets = (np.arange(len(H_COEFFICIENTS_LIST)) - 2) * 2**level
+    indices = (np.arange(size) + offsets[:, np.newaxis]) % size
+    indices.flags.writeable = False
+    return indices
+
+
+def _h_convolve(signal, level):
+    """Convolve signals (along the last axis) with the h coefficient array
+    of a level.
+
+    This gives the same result as ``convolve1d(signal, h, mode='wrap')``
+    with ``h = get_h_coefficients(level + 1)[level]``, but only the non-zero
+    coefficients of h are used.
+
+    """
+    indices = _h_indices(signal.shape[-1], level)
+    out = H_COEFFICIENTS_LIST[0] * signal[..., indices[0]]
+    for h, idx in zip(H_COEFFICIENTS_LIST[1:], indices[1:]):
+        out += h * signal[..., idx]
+    return out
 
 
 def wavelet_transform(signal, levels):
@@ -76,6 +108,10 @@ def wavelet_transform(signal, levels):
 
     levels: the number of wavelet levels we use.
 
+    The signal can also be a 2D array of several signals (one per row),
+    which are transformed at once. The coefficients are returned in an
+    array of shape (levels + 1, ) + signal.shape.
+
     """
     signal = np.array(signal, dtype=float)
     signal[np.isnan(signal)] = 0.0
@@ -83,34 +119,34 @@ def wavelet_transform(signal, levels):
     # Test if the chosen levels are too many for our signal
     levels = test_levels(signal, levels)
 
-    h_coefficients = get_h_coefficients(levels)
-
     # We need "levels" (e.g. 10) wavelet coefficient arrays
-    wavelet_coefficients = []
+    wavelet_coefficients = np.empty((levels + 1, ) + signal.shape)
     for i in range(levels):
         # Depending on the level, we have different h arrays for convolution.
-        convolved = convolve1d(signal, h_coefficients[i], mode='wrap')
-        convolved_2 = convolve1d(convolved, h_coefficients[i], mode='wrap')
-        # Calculate the wavelet coefficients and add them to list
-        wavelet_coefficients.append(signal - convolved_2)
+        convolved = _h_convolve(signal, i)
+        convolved_2 = _h_convolve(convolved, i)
+        # Calculate the wavelet coefficients
+        wavelet_coefficients[i] = signal - convolved_2
         # Overwrite signal with convolved signal for the next iteration
         signal = convolved
 
     # Get the coefficients for the scaling function
-    scaling_coefficients = convolved
-    # Merge all coefficients into 1 list
-    wavelet_coefficients.append(scaling_coefficients)
-    return np.array(wavelet_coefficients)
+    wavelet_coefficients[levels] = convolved
+    return wavelet_coefficients
 
 
 def wavelet_backTransform(coefficients):
-    """Transform from wavelet to real space."""
+    """Transform from wavelet to real space.
+
+    The coefficients can also be those of several signals (see
+    `wavelet_transform`), and the signals are returned in an array of shape
+    coefficients.shape[1:].
+
+    """
     # We have array number = levels + 1 (due to the smoothing coefficients)
-    coefficients = np.array(coefficients, dtype=float)
+    coefficients = np.asarray(coefficients, dtype=float)
     levels = coefficients.shape[0] - 1
 
-    h_coefficients = get_h_coefficients(levels)
-
     # We convolve each wavelet and the smoothing function with the
     # corresponding h array to re-transform into image space.
     # We have to go in reverse order.
@@ -119,21 +155,65 @@ def wavelet_backTransform(coefficients):
     signal = coefficients[levels]
     for i in range(levels):
         # levels-1 because python begins counting at 0
-        signal_convolved = convolve1d(signal, h_coefficients[levels - 1 - i],
-                                      mode='wrap')
+        signal_convolved = _h_convolve(signal, levels - 1 - i)
         # We add the corresponding coefficients for the next convolution
         signal = signal_convolved + coefficients[levels - 1 - i]
 
     return signal
 
 
+def _noise_coefficients(levels, noise):
+    """Return the standard deviations of the wavelet coefficients of a
+    noise with the given standard deviations (along the last axis)."""
+    signalSize = noise.shape[-1]
+
+    # We have a dirac function, 0 everywhere except 1 in the central pixel
+    # (pixel value = integral over signal in area of pixel = 1 for a dirac
+    # function)
+    diracSignal = np.zeros(signalSize)
+    diracSignal[signalSize // 2] = 1.0
+
+    # We calculate the wavelet coefficients. We do not need the coefficients
+    # for the "smoothing function", thus we delete the last array (.shape[0]
+    # gives us the number of arrays)
+    dirac_coefficients = wavelet_transform(diracSignal, levels)[:-1]
+
+    # We calculate the wavelet coefficients for the noise (= 1 sigma**2):
+    # convolve each row with the variance (the circular convolution of
+    # convolve1d with mode='wrap' is done with FFTs, with the same origin)
+    if noise.ndim == 1:
+        variance_coefficients = convolve1d(dirac_coefficients**2.0,
+                                           noise**2.0, mode='wrap')
+    else:
+        with np.errstate(invalid='ignore'):
+            variance_coefficients = np.fft.irfft(
+                np.fft.rfft(dirac_coefficients**2.0)[:, np.newaxis] *
+                np.fft.rfft(noise**2.0), signalSize)
+        variance_coefficients = np.roll(variance_coefficients,
+                                        -(signalSize // 2), axis=-1)
+        np.maximum(variance_coefficients, 0, out=variance_coefficients)
+
+    # Get standard deviation array of arrays
+    return variance_coefficients**(1 / 2.0)
+
+
 def cleanSignal(signal, noise, levels, sigmaCutoff=5.0, epsilon=0.05):
     """Filter an input signal by using the 1 standard deviation noise estimate
     and wavelets epsilon is the iteration-stop parameter for extracting signal
     from the residual signal.
+
+    The signal can also be a 2D array of several signals (one per row), with
+    the same noise for all of them (1D noise array) or one noise array per
+    signal (2D noise array). The signals are filtered by chunks, to limit
+    the size of the arrays of wavelet coefficients.
     """
     signal = np.array(signal, dtype=float)
     noise = np.array(noise, dtype=float)
+    if signal.ndim == 1:
+        return cleanSignal(signal[np.newaxis], noise, levels,
+                           sigmaCutoff=sigmaCutoff, epsilon=epsilon)[0]
+
+    noise = np.broadcast_to(noise, signal.shape).copy()
 
     # If we have missing values, set the signal to 0 and the noise to 100000
     # standard deviations to downweigh the signal
@@ -144,29 +224,30 @@ def cleanSignal(signal, noise, levels, sigmaCutoff=5.0, epsilon=0.05):
 
     sigmaCutoff = float(sigmaCutoff)
     epsilon = float(epsilon)
-    signalSize = signal.size
 
     # Test if the chosen levels are too many for our signal
     levels = test_levels(signal, levels)
 
-    # We have a dirac function, 0 everywhere except 1 in the central pixel
-    # (pixel value = integral over signal in area of pixel = 1 for a dirac
-    # function)
-    diracSignal = np.zeros(signalSize)
-    diracSignal[signalSize // 2] = 1.0
+    # Use the same noise coefficients for all the signals if possible
+    noise_coef = None
+    if np.all(noise == noise[0]):
+        noise_coef = _noise_coefficients(levels, noise[0])[:, np.newaxis]
 
-    # We calculate the wavelet coefficients. We do not need the coefficients
-    # for the "smoothing function", thus we delete the last array (.shape[0]
-    # gives us the number of arrays)
-    dirac_coefficients = wavelet_transform(diracSignal, levels)[:-1]
+    cleaned = np.empty(signal.shape)
+    chunksize = _CLEAN_CHUNK_BYTES // (8 * (levels + 1) * signal.shape[1])
+    for sl in chunk_slices(signal.shape[0], chunksize):
+        coef = (_noise_coefficients(levels, noise[sl]) if noise_coef is None
+                else noise_coef)
+        cleaned[sl] = _clean_signals(signal[sl], coef, levels, sigmaCutoff,
+                                     epsilon)
+    return cleaned
 
-    # We calculate the wavelet coefficients for the noise (= 1 sigma**2):
-    # convolve each row to obtain the variance
-    variance_coefficients = convolve1d(dirac_coefficients**2.0, noise**2.0,
-                                       mode='wrap')
 
-    # Get standard deviation array of arrays
-    noise_coef = variance_coefficients**(1 / 2.0)
+def _clean_signals(signal, noise_coef, levels, sigmaCutoff, epsilon):
+    """Filter a 2D array of signals, see `cleanSignal`. noise_coef contains
+    the standard deviations of the wavelet coefficients of the noise, for
+    each signal or for all of them."""
+    nsignal, signalSize = signal.shape
 
     # Create the multiresolution support
     signal_coef = np.abs(wavelet_transform(signal, levels))
@@ -176,39 +257,49 @@ def cleanSignal(signal, noise, levels, sigmaCutoff=5.0, epsilon=0.05):
     # is less than (x+1)*sigma detection, we consider it as noise. We increase
     # the threshold for i = 0 = high frequencies, as typically noise has high
     # frequencies and signal has lower frequencies.
-    M_support = np.vstack([
-        signal_coef[0] >= ((sigmaCutoff + 1.0) * noise_coef[0]),
+    M_support = np.concatenate([
+        signal_coef[:1] >= ((sigmaCutoff + 1.0) * noise_coef[:1]),
         signal_coef[1:-1] >= (sigmaCutoff * noise_coef[1:]),
         # Last row: smoothing function coefficients are always all significant
-        np.ones(signalSize, dtype=bool)
+        np.ones((1, nsignal, signalSize), dtype=bool)
     ])
+    del signal_coef
 
     # Do the cleaning
 
-    cleaned_signal = np.zeros(signalSize)
+    cleaned_signal = np.zeros(signal.shape)
     # Initialize the standard deviation of the residual signal
-    residual_signal_sigma_old = 0.0
+    residual_signal_sigma_old = np.zeros(nsignal)
     # Initialize the residual signal
-    residual_signal = signal
-    residual_signal_sigma = np.std(residual_signal)
+    residual_signal = signal.copy()
+    residual_signal_sigma = np.std(residual_signal, axis=1)
 
     # We can still extract signal from the residual. We do this here after the
     # first iteration until the epsilon condition is false and add it to the
-    # already extracted signal
-
-    while np.abs((residual_signal_sigma_old - residual_signal_sigma) /
-                 residual_signal_sigma) > epsilon:
+    # already extracted signal. The signals for which the condition is false
+    # are not processed anymore.
+    active = np.ones(nsignal, dtype=bool)
+    while True:
         # We continue to extract until the standard deviation doesn't change
         # too much
-        residual_coefficients = wavelet_transform(residual_signal, levels)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            active[active] = np.abs(
+                (residual_signal_sigma_old[active] -
+                 residual_signal_sigma[active]) /
+                residual_signal_sigma[active]) > epsilon
+        idx = np.flatnonzero(active)
+        if idx.size == 0:
+            break
+        residual_coefficients = wavelet_transform(residual_signal[idx],
+                                                  levels)
 
         # We clean the non-significant wavelets
-        residual_coefficients[~M_support] = 0.0
+        residual_coefficients[~M_support[:, idx]] = 0.0
 
-        cleaned_signal += wavelet_backTransform(residual_coefficients)
-        residual_signal = signal - cleaned_signal
-        residual_signal_sigma_old = residual_signal_sigma
-        residual_signal_sigma = np.std(residual_signal)
+        cleaned_signal[idx] += wavelet_backTransform(residual_coefficients)
+        residual_signal[idx] = signal[idx] - cleaned_signal[idx]
+        residual_signal_sigma_old[idx] = residual_signal_sigma[idx]
+        residual_signal_sigma[idx] = np.std(residual_signal[idx], axis=1)
 
     return cleaned_signal
 
@@ -336,13 +336,16 @@ def compute_optimal_spectrum(cube, mask, psf):
         PSF, 2D or 3D.
 
     """
-    # First ensure that we have a 3D psf
-    if psf.ndim != 3:
-        psf = broadcast_to_cube(psf, cube.shape)
-
-    # Normalize weights
-    psf = psf * mask
-    psf /= np.sum(psf, axis=(1, 2))[:, np.newaxis, np.newaxis]
+    # Normalize weights, only once for all the wavelengths with a 2D psf and
+    # mask, then ensure that we have a 3D psf
+    if psf.ndim == 2 and np.ndim(mask) == 2:
+        psf = psf * mask
+        psf = broadcast_to_cube(psf / np.sum(psf), cube.shape)
+    else:
+        if psf.ndim != 3:
+            psf = broadcast_to_cube(psf, cube.shape)
+        psf = psf * mask
+        psf /= np.sum(psf, axis=(1, 2))[:, np.newaxis, np.newaxis]
 
     data = cube.data.filled(np.nan)
 
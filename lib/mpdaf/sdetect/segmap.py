@@ -209,6 +209,12 @@ def regrid_to_image(im, other, order=1, inplace=False, antialias=True,
     else:
         newdim = other.shape
     inc = other.wcs.get_axis_increments(unit=unit_size)
+    if not antialias and order in (0, 1):
+        # Use the cached sparse operator, which is computed only once when
+        # many images with the same coordinates are regridded.
+        op = im.get_regrid_operator(newdim, refpos, [0, 0], inc, order=order,
+                                    unit_inc=unit_size)
+        return op.regrid(im, inplace=inplace)
     im = im.regrid(newdim, refpos, [0, 0], inc, order=order,
                    unit_inc=unit_size, inplace=inplace, antialias=antialias)
     return im
@@ -29,15 +29,17 @@ CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
 OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
+import astropy.units as u
 import numpy as np
 import pytest
 
 from astropy.io import fits
 from glob import glob
-from mpdaf.obj import Image
+from mpdaf.obj import Image, WCS
 from mpdaf.sdetect import Segmap, create_masks_from_segmap
+from mpdaf.sdetect.segmap import regrid_to_image
 from mpdaf.tests.utils import get_data_file
-from numpy.testing import assert_array_equal
+from numpy.testing import assert_allclose, assert_array_equal
 
 try:
     import joblib  # noqa
@@ -73,6 +75,31 @@ def test_align_segmap():
     assert (aligned.img.wcs.get_rot() - ref.wcs.get_rot()) < 1e-3
 
 
+@pytest.mark.parametrize('order', (0, 1))
+def test_regrid_to_image(order):
+    rng = np.random.RandomState(0)
+    mask = np.zeros((40, 50), dtype=bool)
+    mask[10:14, 20:23] = True
+    mask[30, 5] = True
+    mask[:, :2] = True
+    img = Image(data=rng.rand(40, 50), mask=mask,
+                wcs=WCS(crval=(10., 20.), crpix=(15.3, 20.7), deg=True,
+                        cdelt=(0.2 / 3600, -0.2 / 3600), shape=(40, 50)))
+    ref = Image(data=np.zeros((25, 30)),
+                wcs=WCS(crval=(10., 20.), crpix=(12.1, 14.6), deg=True,
+                        cdelt=(0.3 / 3600, -0.3 / 3600), shape=(25, 30)))
+
+    # without anti-aliasing, the masks are resampled like in Image.regrid
+    res = regrid_to_image(img, ref, order=order, antialias=False)
+    refpos = ref.wcs.pix2sky([0, 0])[0]
+    inc = ref.wcs.get_axis_increments(unit=u.arcsec)
+    expected = img.regrid(ref.shape, refpos, [0, 0], inc, order=order,
+                          antialias=False)
+    assert res.wcs.isEqual(expected.wcs)
+    assert_array_equal(res._mask, expected._mask)
+    assert_allclose(res._data, expected._data, rtol=1e-12)
+
+
 def test_cut_header():
     segmap = Segmap(get_data_file('segmap', 'segmap.fits'),
                     cut_header_after='NAXIS2')
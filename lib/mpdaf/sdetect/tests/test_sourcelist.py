@@ -31,8 +31,12 @@ OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 
+import astropy.units as u
+import numpy as np
 import pytest
+from mpdaf.obj import abmag_filters
 from mpdaf.sdetect import SourceList
+from numpy.testing import assert_allclose
 
 
 def test_sourcelist(tmpdir, source1, source2):
@@ -54,3 +58,16 @@ def test_sourcelist(tmpdir, source1, source2):
     assert tmpdir.join('out.fits').isfile()
     assert tmpdir.join('out').join('out-0001.fits').isfile()
     assert tmpdir.join('out').join('out-0032.fits').isfile()
+
+
+def test_sourcelist_abmag(source1, source2, spec_var):
+    spec_var.unit = u.Unit('erg/cm2/s/Angstrom')
+    spec_var.wave.unit = u.angstrom
+    source1.spectra['MUSE_TOT_SKYSUB'] = spec_var
+    slist = SourceList([source1, source2])
+
+    mag, err = abmag_filters(slist, ['B', 'F606W'])
+    assert mag.shape == (2, 2)
+    assert_allclose(mag[0], [spec_var.abmag_filter_name('B')[0],
+                             spec_var.abmag_filter_name('F606W')[0]])
+    assert np.all(np.isnan(mag[1])) and np.all(np.isnan(err[1]))
@@ -0,0 +1,333 @@
+"""
+Copyright (c) 2010-2018 CNRS / Centre de Recherche Astrophysique de Lyon
+Copyright (c) 2015-2019 Simon Conseil <simon.conseil@univ-lyon1.fr>
+
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors
+   may be used to endorse or promote products derived from this software
+   without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import numpy as np
+
+__all__ = ('clipped_stats', 'sorted_clipped_stats', 'MAD_TO_STD')
+
+#: Scale factor from the median absolute deviation to the standard deviation
+#: of a normal distribution, as used by the C merging functions.
+MAD_TO_STD = 1.4826
+
+
+def _median(values, lo, hi):
+    """Return the medians of the sorted ranges ``values[lo:hi]``, NaN for
+    empty ranges."""
+    n = hi - lo
+    last = len(values) - 1
+    i1 = np.clip(lo + (n - 1) // 2, 0, last)
+    i2 = np.clip(lo + n // 2, 0, last)
+    med = (values[i1] + values[i2]) / 2
+    return np.where(n > 0, med, np.nan)
+
+
+def _searchsorted(values, lo, hi, v, side='left'):
+    """Vectorized `numpy.searchsorted` of ``v[i]`` in the sorted ranges
+    ``values[lo[i]:hi[i]]``, by bisection."""
+    lo, hi = lo.copy(), hi.copy()
+    last = len(values) - 1
+    active = lo < hi
+    while active.any():
+        mid = (lo + hi) // 2
+        x = values[np.clip(mid, 0, last)]
+        right = (x < v) if side == 'left' else (x <= v)
+        right &= active
+        lo = np.where(right, mid + 1, lo)
+        hi = np.where(active & ~right, mid, hi)
+        active = lo < hi
+    return lo
+
+
+def _mad(values, lo, hi, med):
+    """Return the median absolute deviations from ``med`` of the sorted
+    ranges ``values[lo:hi]``.
+
+    The absolute deviations of a sorted range are two sorted sequences, the
+    values below the median in reverse order and the values above the
+    median, so their order statistics are found by bisection, without
+    computing and sorting the deviations.
+    """
+    last = len(values) - 1
+    mid = _searchsorted(values, lo, hi, med, side='left')
+    na, nb = mid - lo, hi - mid
+
+    def below(i):
+        # i-th deviation of the values below the median
+        return med - values[np.clip(mid - 1 - i, 0, last)]
+
+    def above(j):
+        # j-th deviation of the values above the median
+        return values[np.clip(mid + j, 0, last)] - med
+
+    def kth(k):
+        # find the number a of values below the median among the k + 1
+        # smallest deviations
+        amin = np.maximum(0, k + 1 - nb)
+        amax = np.minimum(k + 1, na)
+        active = amin < amax
+        while active.any():
+            a = (amin + amax) // 2
+            ok = (a >= na) | (k - a < 0) | (above(k - a) <= below(a))
+            amax = np.where(active & ok, a, amax)
+            amin = np.where(active & ~ok, a + 1, amin)
+            active = amin < amax
+        a, b = amin, k + 1 - amin
+        return np.maximum(np.where(a > 0, below(a - 1), -np.inf),
+                          np.where(b > 0, above(b - 1), -np.inf))
+
+    n = hi - lo
+    mad = (kth((n - 1) // 2) + kth(n // 2)) / 2
+    return np.where(n > 0, mad, np.nan)
+
+
+def _clip_sorted(values, starts, counts, sigma_lower=3.0, sigma_upper=3.0,
+                 maxiters=5, cenfunc='median', stdfunc='std', inclusive=True,
+                 nstop=0):
+    """Sigma-clip groups of sorted values.
+
+    ``values`` contains the groups one after the other, each group being
+    sorted and starting at the index given by ``starts``, with ``counts``
+    valid values followed by an optional padding of NaN values.
+
+    Since the groups are sorted, the values kept by the clipping are a
+    contiguous range of each group, so the clipping only updates the limits
+    of these ranges, and the means and standard deviations are computed
+    with cumulated sums. Return the mean, median, standard deviation (or
+    scaled MAD) and number of the kept values, and the ranges [lo, hi) of
+    the kept values.
+
+    """
+    if cenfunc not in ('median', 'mean'):
+        raise ValueError('cenfunc must be "median" or "mean"')
+    if stdfunc not in ('std', 'mad'):
+        raise ValueError('stdfunc must be "std" or "mad"')
+    if maxiters is None:
+        maxiters = np.iinfo(int).max
+
+    starts = np.asarray(starts, dtype=np.int64)
+    lo = starts
+    hi = starts + np.asarray(counts, dtype=np.int64)
+    sizes = np.diff(np.append(starts, len(values)))
+
+    # cumulated sums of the deviations from the median of each group (to
+    # limit the rounding errors), with zeros for the padding values
+    ref = np.nan_to_num(_median(values, lo, hi))
+    cs1 = np.zeros(len(values) + 1)
+    cs2 = np.zeros(len(values) + 1)
+    dev = cs2[1:]
+    np.subtract(values, np.repeat(ref, sizes), out=dev)
+    dev[np.isnan(dev)] = 0
+    np.cumsum(dev, out=cs1[1:])
+    dev *= dev
+    np.cumsum(dev, out=dev)
+
+    def moments(lo, hi):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            n = hi - lo
+            m1 = (cs1[hi] - cs1[lo]) / n
+            m2 = (cs2[hi] - cs2[lo]) / n
+            return m1 + ref, np.sqrt(np.maximum(m2 - m1 * m1, 0))
+
+    def stats(lo, hi):
+        mean, std = moments(lo, hi)
+        med = _median(values, lo, hi)
+        if stdfunc == 'mad':
+            std = MAD_TO_STD * _mad(values, lo, hi, med)
+        return mean, med, std
+
+    with np.errstate(invalid='ignore'):
+        for _ in range(maxiters):
+            mean, med, std = stats(lo, hi)
+            center = med if cenfunc == 'median' else mean
+            low = (np.full_like(center, -np.inf) if sigma_lower == np.inf
+                   else center - sigma_lower * std)
+            high = (np.full_like(center, np.inf) if sigma_upper == np.inf
+                    else center + sigma_upper * std)
+            newlo = _searchsorted(values, lo, hi, low,
+                                  side='left' if inclusive else 'right')
+            newhi = _searchsorted(values, lo, hi, high,
+                                  side='right' if inclusive else 'left')
+            # clipping stops for the groups where too few values would be
+            # kept
+            stop = (newhi - newlo) < nstop
+            newlo = np.where(stop, lo, newlo)
+            newhi = np.where(stop, hi, newhi)
+            if np.array_equal(newlo, lo) and np.array_equal(newhi, hi):
+                break
+            lo, hi = newlo, newhi
+
+    mean, med, std = stats(lo, hi)
+    return mean, med, std, hi - lo, lo, hi
+
+
+def clipped_stats(data, sigma=3.0, sigma_lower=None, sigma_upper=None,
+                  maxiters=5, cenfunc='median', stdfunc='std', axis=None,
+                  inclusive=True, nstop=0, return_mask=False):
+    """Compute sigma-clipped statistics of an array, or along some axes.
+
+    The values that are farther than ``sigma`` standard deviations from the
+    center (median or mean) of the values are rejected, and this is repeated
+    on the remaining values until no value is rejected or ``maxiters``
+    iterations. Masked and non-finite values are ignored.
+
+    The values of each set of statistics (for instance of each image of a
+    cube with ``axis=(1, 2)``) are sorted once in a single copy of the
+    data, and the clipping then only updates the range of the kept values,
+    without new copies of the data. With the default parameters the results
+    are the same as `astropy.stats.sigma_clipped_stats`, and with
+    ``cenfunc='median'``, ``inclusive=False`` and ``stdfunc='std'`` or
+    ``'mad'`` they are the same as the sigma clipping of the C merging
+    functions (`mpdaf.obj.CubeList.combine`).
+
+    Parameters
+    ----------
+    data : array or masked array
+        The input values.
+    sigma : float
+        Number of standard deviations used for the clipping limits.
+    sigma_lower, sigma_upper : float
+        Number of standard deviations used for the lower and upper limits.
+        They default to ``sigma``, and ``np.inf`` disables the clipping on
+        one side.
+    maxiters : int or None
+        Maximum number of iterations, None to iterate until convergence.
+    cenfunc : 'median' | 'mean'
+        The center of the clipping limits.
+    stdfunc : 'std' | 'mad'
+        The standard deviation used for the clipping limits and returned,
+        either the standard deviation of the kept values or their median
+        absolute deviation scaled by `MAD_TO_STD`.
+    axis : None, int or tuple of int
+        The axes along which the statistics are computed. By default they
+        are computed on the whole array.
+    inclusive : bool
+        If True, the values equal to a clipping limit are kept.
+    nstop : int
+        The clipping stops when fewer values than ``nstop`` would be kept.
+    return_mask : bool
+        If True, also return a boolean array with the shape of the data,
+        which is True for the rejected, masked and non-finite values.
+
+    Returns
+    -------
+    out : (mean, median, std, count) or (mean, median, std, count, mask)
+        The mean, median, standard deviation (or scaled MAD) and number of
+        the kept values. These are NaN when no value is kept.
+
+    """
+    sigma_lower = sigma if sigma_lower is None else sigma_lower
+    sigma_upper = sigma if sigma_upper is None else sigma_upper
+
+    values = np.ma.getdata(data)
+    mask = np.ma.getmask(data)
+    if axis is None:
+        axis = tuple(range(values.ndim))
+    axis = tuple(sorted(a % values.ndim for a in np.atleast_1d(axis)))
+    dest = tuple(range(values.ndim - len(axis), values.ndim))
+    outshape = tuple(s for i, s in enumerate(values.shape) if i not in axis)
+    n = int(np.prod([values.shape[i] for i in axis]))
+
+    # a single (sorted) copy of the values, with NaN for the invalid values
+    work = np.array(np.moveaxis(values, axis, dest), dtype=float, order='C')
+    work = work.reshape(-1, n)
+    work[~np.isfinite(work)] = np.nan
+    if mask is not np.ma.nomask:
+        work[np.moveaxis(mask, axis, dest).reshape(-1, n)] = np.nan
+    work.sort(axis=-1)
+    counts = n - np.isnan(work).sum(axis=-1)
+    work = work.ravel()
+
+    starts = np.arange(len(counts), dtype=np.int64) * n
+    mean, med, std, count, lo, hi = _clip_sorted(
+        work, starts, counts, sigma_lower=sigma_lower,
+        sigma_upper=sigma_upper, maxiters=maxiters, cenfunc=cenfunc,
+        stdfunc=stdfunc, inclusive=inclusive, nstop=nstop)
+
+    res = [x.reshape(outshape)[()] for x in (mean, med, std, count)]
+    if return_mask:
+        # the clipping limits are values, so the kept values are exactly the
+        # values between the smallest and the largest kept values
+        empty = hi == lo
+        vmin = np.where(empty, np.inf, work[np.minimum(lo, len(work) - 1)])
+        vmax = np.where(empty, -np.inf, work[np.maximum(hi - 1, 0)])
+        shape = list(values.shape)
+        for i in axis:
+            shape[i] = 1
+        vmin = vmin.reshape(shape)
+        vmax = vmax.reshape(shape)
+        with np.errstate(invalid='ignore'):
+            rejected = ~((values >= vmin) & (values <= vmax))
+        if mask is not np.ma.nomask:
+            rejected |= mask
+        res.append(rejected)
+    return tuple(res)
+
+
+def sorted_clipped_stats(values, starts, counts, sigma=3.0, sigma_lower=None,
+                         sigma_upper=None, maxiters=5, cenfunc='median',
+                         stdfunc='std', inclusive=True, nstop=0):
+    """Compute sigma-clipped statistics of groups of values that are
+    already sorted.
+
+    This is the same as `clipped_stats`, without the copy and the sort of
+    the values, for values that are already sorted, for instance by groups
+    with `numpy.lexsort`.
+
+    Parameters
+    ----------
+    values : 1D array
+        The values of all the groups, one group after the other. Each group
+        is sorted, and contains ``counts`` valid values followed by an
+        optional padding of NaN values.
+    starts : array of int
+        The index of the first value of each group.
+    counts : array of int
+        The number of valid values of each group.
+    sigma, sigma_lower, sigma_upper, maxiters, cenfunc, stdfunc
+        See `clipped_stats`.
+    inclusive, nstop
+        See `clipped_stats`.
+
+    Returns
+    -------
+    out : (mean, median, std, count)
+        Arrays with the mean, median, standard deviation (or scaled MAD)
+        and number of the kept values of each group. These are NaN when no
+        value is kept.
+
+    """
+    sigma_lower = sigma if sigma_lower is None else sigma_lower
+    sigma_upper = sigma if sigma_upper is None else sigma_upper
+    return _clip_sorted(np.asarray(values, dtype=float), starts, counts,
+                        sigma_lower=sigma_lower, sigma_upper=sigma_upper,
+                        maxiters=maxiters, cenfunc=cenfunc, stdfunc=stdfunc,
+                        inclusive=inclusive, nstop=nstop)[:4]
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) 2010-2018 CNRS / Centre de Recherche Astrophysique de Lyon
+Copyright (c) 2016-2019 Simon Conseil <simon.conseil@univ-lyon1.fr>
+
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors
+   may be used to endorse or promote products derived from this software
+   without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import numpy as np
+import pytest
+
+from astropy.stats import sigma_clip, sigma_clipped_stats
+from numpy.testing import assert_allclose, assert_array_equal
+
+from mpdaf.tools.stats import clipped_stats, sorted_clipped_stats, MAD_TO_STD
+
+
+@pytest.fixture
+def data():
+    rng = np.random.RandomState(42)
+    data = rng.normal(10, 2, (6, 40, 30))
+    data[rng.rand(*data.shape) < 0.05] += 30
+    data[0, 0, :5] = np.nan
+    return np.ma.array(data, mask=rng.rand(*data.shape) < 0.1)
+
+
+@pytest.mark.parametrize('axis', (None, 0, (1, 2), -1))
+def test_clipped_stats_astropy(data, axis):
+    mean, median, std, count, mask = clipped_stats(data, axis=axis,
+                                                   return_mask=True)
+    ref = sigma_clipped_stats(np.ma.masked_invalid(data), axis=axis)
+    assert_allclose(mean, ref[0])
+    assert_allclose(median, ref[1])
+    assert_allclose(std, ref[2])
+
+    clipped = sigma_clip(np.ma.masked_invalid(data), axis=axis)
+    assert_array_equal(mask, np.ma.getmaskarray(clipped))
+    assert_array_equal(count, np.sum(~clipped.mask, axis=axis))
+
+
+def test_clipped_stats_mad():
+    rng = np.random.RandomState(0)
+    for n in (1, 2, 5, 100, 101):
+        x = rng.normal(size=n)
+        _, median, std, count = clipped_stats(x, stdfunc='mad', maxiters=0)
+        assert median == np.median(x)
+        assert_allclose(std, MAD_TO_STD * np.median(np.abs(x - median)))
+        assert count == n
+
+    # MAD clipping with strict limits, as in the C merging functions
+    x = np.array([1., 2, 3, 4, 5, 6, 7, 8, 9, 100])
+    mean, median, std, count = clipped_stats(
+        x, sigma=3, stdfunc='mad', inclusive=False, maxiters=2)
+    assert count == 9
+    assert mean == 5
+    # nstop prevents the clipping
+    assert clipped_stats(x, stdfunc='mad', nstop=10)[3] == 10
+
+
+def test_clipped_stats_upper():
+    # upper clipping around the mean, as Image.background
+    rng = np.random.RandomState(1)
+    tab = rng.normal(size=1000)
+    tab[:20] += 10
+    mean, _, std, _ = clipped_stats(tab, sigma_lower=np.inf, sigma_upper=3,
+                                    cenfunc='mean', maxiters=4)
+    for n in range(4):
+        tab = tab[tab <= (tab.mean() + 3 * tab.std())]
+    assert_allclose(mean, tab.mean())
+    assert_allclose(std, tab.std())
+
+
+def test_clipped_stats_empty():
+    data = np.ma.array(np.ones((2, 3)), mask=[[True] * 3, [False] * 3])
+    mean, median, std, count = clipped_stats(data, axis=1)
+    assert_array_equal(count, [0, 3])
+    assert np.isnan(mean[0]) and np.isnan(median[0]) and np.isnan(std[0])
+    assert_array_equal(mean[1:], 1)
+    assert_array_equal(std[1:], 0)
+
+
+def test_sorted_clipped_stats(data):
+    # groups of sorted values, with a padding of NaN values
+    values = np.sort(data.filled(np.nan).reshape(6, -1), axis=1)
+    counts = np.sum(~np.isnan(values), axis=1)
+    starts = np.arange(6) * values.shape[1]
+    res = sorted_clipped_stats(values.ravel(), starts, counts,
+                               stdfunc='mad', maxiters=3)
+    ref = clipped_stats(data, axis=(1, 2), stdfunc='mad', maxiters=3)
+    for x, y in zip(res, ref):
+        assert_allclose(x, y)
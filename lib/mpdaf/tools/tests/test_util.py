@@ -39,7 +39,8 @@ import time
 import warnings
 
 from mpdaf.tools.util import (chdir, deprecated, broadcast_to_cube, timeit,
-                              timer, isiter, progressbar)
+                              timer, isiter, progressbar, get_workers,
+                              chunk_slices)
 
 try:
     import tqdm
@@ -122,3 +123,16 @@ def test_progressbar():
     bar = progressbar([1, 2, 3])
     assert isinstance(bar, tqdm.tqdm)
     assert next(iter(bar)) == 1
+
+
+def test_get_workers(monkeypatch):
+    import mpdaf
+    assert get_workers(3) == 3
+    assert get_workers(0) == 1
+    monkeypatch.setattr(mpdaf, 'CPU', 1)
+    assert get_workers() == 1
+
+
+def test_chunk_slices():
+    assert chunk_slices(0, 3) == []
+    assert chunk_slices(7, 3) == [slice(0, 3), slice(3, 6), slice(6, 7)]
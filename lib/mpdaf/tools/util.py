@@ -48,7 +48,8 @@ from time import time
 
 __all__ = ('MpdafWarning', 'MpdafUnitsWarning', 'deprecated', 'chdir',
            'timeit', 'timer', 'broadcast_to_cube', 'LowercaseOrderedDict',
-           'all_subclasses', 'isiter', 'isnotebook', 'progressbar')
+           'all_subclasses', 'isiter', 'isnotebook', 'progressbar',
+           'get_workers', 'chunk_slices')
 
 
 # NOTE(kgriffs): We don't want our deprecations to be ignored by default,
@@ -176,6 +177,29 @@ def progressbar(*args, **kwargs):
     return func(*args, **kwargs)
 
 
+def get_workers(workers=None):
+    """Return the number of threads to use for parallel computations.
+
+    By default this is the number of CPUs, limited by ``mpdaf.CPU`` if it is
+    set to a positive value.
+    """
+    if workers is not None:
+        return max(int(workers), 1)
+    from mpdaf import CPU
+    ncpu = os.cpu_count() or 1
+    if CPU > 0 and CPU < ncpu:
+        ncpu = CPU
+    return ncpu
+
+
+def chunk_slices(n, chunksize):
+    """Return a list of slices splitting ``range(n)`` in chunks of
+    ``chunksize`` elements."""
+    chunksize = max(int(chunksize), 1)
+    return [slice(start, min(start + chunksize, n))
+            for start in range(0, n, chunksize)]
+
+
 # Here we inherit unnecessarily from OrderedDict.
 # This is because when merging astropy.table.Table() objects, an explicit
 # check for the metadata object is a <dict> instance